@@ -21,14 +21,17 @@ and storage repositories
 """
 
 import abc
+import collections
 import re
 import sys
+import time
 
 if sys.platform == 'win32':
     import _winreg
     import wmi
 
 from nova import block_device
+from nova import utils
 from nova.virt import driver
 from oslo_log import log as logging
 
@@ -36,9 +39,67 @@ from hyperv.i18n import _LI
 
 LOG = logging.getLogger(__name__)
 
+# The last time each target portal was refreshed by this host.
+_portal_refresh_times = {}
+
+# The iSCSI session table snapshot, shared by all the BaseVolumeUtils
+# instances, so that logins and logouts performed through any of them
+# invalidate it, along with the time it was taken.
+_session_table = None
+_session_table_time = 0
+
+
+class ISCSISessionTable(object):
+    """Indexed snapshot of the iSCSI initiator sessions and their devices.
+
+    All the sessions are retrieved at once, allowing constant time lookups
+    by target and LUN, by drive number and by session id.
+    """
+
+    def __init__(self, initiator_sessions):
+        self._sessions_by_id = {}
+        self._sessions_by_target = collections.defaultdict(list)
+        self._devices_by_target_lun = {}
+        self._devices_by_number = {}
+
+        for session in initiator_sessions:
+            self._sessions_by_id[session.SessionId] = session
+            self._sessions_by_target[session.TargetName].append(session)
+
+            for device in session.Devices or []:
+                self._devices_by_target_lun.setdefault(
+                    (session.TargetName, device.ScsiLun), device)
+                self._devices_by_number.setdefault(
+                    device.DeviceNumber, (session, device))
+
+    def get_session(self, session_id):
+        return self._sessions_by_id.get(session_id)
+
+    def get_target_sessions(self, target_iqn):
+        return self._sessions_by_target.get(target_iqn, [])
+
+    def get_target_devices(self, target_iqn):
+        sessions = self.get_target_sessions(target_iqn)
+        if not sessions:
+            return []
+        return sessions[0].Devices or []
+
+    def get_device(self, target_iqn, target_lun):
+        return self._devices_by_target_lun.get((target_iqn, target_lun))
+
+    def get_device_by_number(self, device_number):
+        return self._devices_by_number.get(device_number, (None, None))
+
 
 class BaseVolumeUtils(object):
     _FILE_DEVICE_DISK = 7
+    # Portal refreshes are reused by the logins performed within this
+    # interval, for example when attaching multiple volumes at once.
+    _PORTAL_REFRESH_INTERVAL = 10
+    # Session table snapshots older than this are not used, as drive
+    # numbers and LUNs may get reused by sessions established meanwhile,
+    # for example by other services.
+    _SESSION_TABLE_TTL = 5
 
     def __init__(self, host='.'):
         if sys.platform == 'win32':
@@ -58,6 +119,34 @@ class BaseVolumeUtils(object):
     def execute_log_out(self, session_id):
         pass
 
+    def _ensure_target_portal(self, target_portal, force_refresh=False):
+        """Logs in the target portal unless it was refreshed recently.
+
+        Returns True if the portal was refreshed.
+        """
+        @utils.synchronized('iscsi-portal-%s' % target_portal)
+        def refresh_target_portal():
+            last_refresh_time = _portal_refresh_times.get(target_portal)
+            if (not force_refresh and last_refresh_time and
+                    time.time() - last_refresh_time <
+                    self._PORTAL_REFRESH_INTERVAL):
+                LOG.debug("Target portal %s was refreshed recently.",
+                          target_portal)
+                return False
+
+            self._login_target_portal(target_portal)
+            _portal_refresh_times[target_portal] = time.time()
+            return True
+        return refresh_target_portal()
+
+    def get_disk_arrival_listener(self, timeframe):
+        """Returns a WMI event listener for newly attached disks.
+
+        None is returned if disk arrival events are not available, in
+        which case callers have to poll for new disks.
+        """
+        return None
+
     def get_iscsi_initiator(self):
         """Get iscsi initiator name for this machine."""
 
@@ -101,49 +190,76 @@ class BaseVolumeUtils(object):
         if drive_number:
             return int(drive_number[0])
 
+    def _is_session_table_valid(self):
+        return (_session_table is not None and
+                time.time() - _session_table_time < self._SESSION_TABLE_TTL)
+
+    def get_session_table(self, refresh=False):
+        """Returns a cached snapshot of the iSCSI sessions.
+
+        The snapshot must be invalidated after logging in or out of
+        storage targets. It expires after a few seconds, as sessions may
+        also be established or torn down by other services.
+        """
+        global _session_table, _session_table_time
+
+        if refresh or not self._is_session_table_valid():
+            initiator_sessions = (
+                self._conn_wmi.MSiSCSIInitiator_SessionClass())
+            _session_table = ISCSISessionTable(initiator_sessions)
+            _session_table_time = time.time()
+        return _session_table
+
+    def invalidate_session_table(self):
+        global _session_table
+        _session_table = None
+
+    def _lookup_session_table(self, lookup_func):
+        # Devices may show up after the snapshot was taken, for which
+        # reason a miss is always confirmed using a fresh snapshot.
+        cached = self._is_session_table_valid()
+        result = lookup_func(self.get_session_table())
+        if not result and cached:
+            result = lookup_func(self.get_session_table(refresh=True))
+        return result
+
     def get_session_id_from_mounted_disk(self, physical_drive_path):
         drive_number = self._get_drive_number_from_disk_path(
             physical_drive_path)
         if not drive_number:
             return None
 
-        initiator_sessions = self._conn_wmi.MSiSCSIInitiator_SessionClass()
-        for initiator_session in initiator_sessions:
-            devices = initiator_session.Devices
-            for device in devices:
-                device_number = device.DeviceNumber
-                if device_number == drive_number:
-                    return initiator_session.SessionId
+        session = self._lookup_session_table(
+            lambda table: table.get_device_by_number(drive_number)[0])
+        if session:
+            return session.SessionId
 
     def _get_devices_for_target(self, target_iqn):
-        initiator_sessions = self._conn_wmi.MSiSCSIInitiator_SessionClass(
-            TargetName=target_iqn)
-        if not initiator_sessions:
-            return []
-
-        return initiator_sessions[0].Devices
+        return self._lookup_session_table(
+            lambda table: table.get_target_devices(target_iqn))
 
     def get_device_number_for_target(self, target_iqn, target_lun):
-        devices = self._get_devices_for_target(target_iqn)
-
-        for device in devices:
-            if device.ScsiLun == target_lun:
-                return device.DeviceNumber
+        device = self._lookup_session_table(
+            lambda table: table.get_device(target_iqn, target_lun))
+        if device:
+            return device.DeviceNumber
 
     def get_target_lun_count(self, target_iqn):
-        devices = self._get_devices_for_target(target_iqn)
+        # This is used when deciding whether a target should be logged
+        # out. As LUNs may be unmapped by the storage backend at any time,
+        # a fresh snapshot is used.
+        session_table = self.get_session_table(refresh=True)
+        devices = session_table.get_target_devices(target_iqn)
         disk_devices = [device for device in devices
                         if device.DeviceType == self._FILE_DEVICE_DISK]
         return len(disk_devices)
 
     def get_target_from_disk_path(self, disk_path):
-        initiator_sessions = self._conn_wmi.MSiSCSIInitiator_SessionClass()
         drive_number = self._get_drive_number_from_disk_path(disk_path)
         if not drive_number:
             return None
 
-        for initiator_session in initiator_sessions:
-            devices = initiator_session.Devices
-            for device in devices:
-                if device.DeviceNumber == drive_number:
-                    return (device.TargetName, device.ScsiLun)
+        device = self._lookup_session_table(
+            lambda table: table.get_device_by_number(drive_number)[1])
+        if device:
+            return (device.TargetName, device.ScsiLun)
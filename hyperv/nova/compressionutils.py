@@ -0,0 +1,193 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Utility functions for compressing and decompressing image streams.
+"""
+import time
+import zlib
+
+import eventlet
+from eventlet import tpool
+from oslo_log import log as logging
+from oslo_utils import units
+
+from hyperv.i18n import _
+from hyperv.nova import vmutils
+
+LOG = logging.getLogger(__name__)
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_CODECS = [COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_GZIP]
+
+# Image property set on compressed images, containing the codec used.
+IMAGE_COMPRESSION_PROPERTY = 'hyperv_image_compression'
+
+DEFAULT_CHUNK_SIZE = 4 * units.Mi
+
+_GZIP_MAGIC = b'\x1f\x8b\x08'
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _get_zlib_wbits(codec):
+    if codec == COMPRESSION_GZIP:
+        return _GZIP_WBITS
+    elif codec == COMPRESSION_ZLIB:
+        return zlib.MAX_WBITS
+    raise vmutils.HyperVException(_("Unsupported compression codec: %s") %
+                                  codec)
+
+
+def _compress_gzip_member(data):
+    # Concatenated gzip members form a valid gzip stream, which allows
+    # the chunks to be compressed independently.
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressedReader(object):
+    """File like object compressing the data read from another one.
+
+    gzip streams are compressed in chunks, using up to the given number of
+    native threads as zlib releases the GIL while compressing.
+    """
+
+    def __init__(self, src_file, codec, workers=1,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        _get_zlib_wbits(codec)
+
+        self._src_file = src_file
+        self._codec = codec
+        self._workers = workers
+        self._chunk_size = chunk_size
+
+        self._iterator = self._iter_compressed()
+        self._chunk = b''
+        self._position = 0
+
+        self.raw_size = 0
+        self.compressed_size = 0
+        self._start_time = None
+        self._end_time = None
+
+    def _iter_raw_chunks(self):
+        while True:
+            data = self._src_file.read(self._chunk_size)
+            if not data:
+                break
+            self.raw_size += len(data)
+            yield data
+
+    def _iter_compressed(self):
+        if self._codec == COMPRESSION_ZLIB:
+            compressor = zlib.compressobj()
+            for data in self._iter_raw_chunks():
+                yield compressor.compress(data)
+            yield compressor.flush()
+        elif self._workers > 1:
+            pool = eventlet.GreenPool(self._workers)
+            for data in pool.imap(
+                    lambda data: tpool.execute(_compress_gzip_member, data),
+                    self._iter_raw_chunks()):
+                yield data
+        else:
+            for data in self._iter_raw_chunks():
+                yield _compress_gzip_member(data)
+
+    def read(self, size=-1):
+        if self._start_time is None:
+            self._start_time = time.time()
+
+        data = []
+        while size:
+            if self._position >= len(self._chunk):
+                try:
+                    self._chunk = next(self._iterator)
+                except StopIteration:
+                    if self._end_time is None:
+                        self._end_time = time.time()
+                    break
+                self._position = 0
+                continue
+
+            end = len(self._chunk)
+            if size > 0:
+                end = min(end, self._position + size)
+                size -= end - self._position
+            data.append(self._chunk[self._position:end])
+            self._position = end
+
+        data = b''.join(data)
+        self.compressed_size += len(data)
+        return data
+
+    def get_stats(self):
+        elapsed = ((self._end_time or time.time()) -
+                   (self._start_time or time.time()))
+        return {
+            'codec': self._codec,
+            'raw_size': self.raw_size,
+            'compressed_size': self.compressed_size,
+            'ratio': (float(self.raw_size) / self.compressed_size
+                      if self.compressed_size else 0),
+            'throughput': (self.raw_size / elapsed / units.Mi
+                           if elapsed else 0),
+        }
+
+
+def get_file_compression(path):
+    """Returns the codec used to compress a file, based on its header."""
+    with open(path, 'rb') as f:
+        header = f.read(3)
+
+    if header == _GZIP_MAGIC:
+        return COMPRESSION_GZIP
+    elif (len(header) >= 2 and ord(header[0:1]) & 0x0F == zlib.DEFLATED and
+            (ord(header[0:1]) << 8 | ord(header[1:2])) % 31 == 0):
+        return COMPRESSION_ZLIB
+    return None
+
+
+def decompress_file(src_path, dest_path, codec,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """Decompresses a file, holding at most a chunk of output in memory."""
+    LOG.debug("Decompressing %(codec)s file %(src_path)s to %(dest_path)s",
+              {'codec': codec, 'src_path': src_path, 'dest_path': dest_path})
+    wbits = _get_zlib_wbits(codec)
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+            while True:
+                data = src.read(chunk_size)
+                if not data:
+                    break
+                while data:
+                    dest.write(decompressor.decompress(data, chunk_size))
+                    if decompressor.unused_data:
+                        # A new decompressor is used for each gzip member.
+                        data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(wbits)
+                    else:
+                        # The input which was not processed because of
+                        # the output size limit.
+                        data = decompressor.unconsumed_tail
+            dest.write(decompressor.flush())
+    except zlib.error as ex:
+        raise vmutils.HyperVException(
+            _("Failed to decompress %(src_path)s: %(ex)s") %
+            {'src_path': src_path, 'ex': ex})
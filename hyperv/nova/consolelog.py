@@ -0,0 +1,408 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Instance console log handling.
+"""
+
+import errno
+import gzip
+import mmap
+import os
+import shutil
+
+from eventlet import patcher
+from nova.i18n import _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import units
+
+from hyperv.nova import constants
+from hyperv.nova import ioreactor
+
+threading = patcher.original('threading')
+
+LOG = logging.getLogger(__name__)
+
+hyperv_opts = [
+    cfg.FloatOpt('console_log_flush_interval',
+                 default=1,
+                 help='The maximum number of seconds the instance console '
+                      'output is kept in memory before being written to '
+                      'the console log file.'),
+    cfg.IntOpt('console_log_flush_size',
+               default=64 * units.Ki,
+               help='The amount of instance console output, in bytes, '
+                    'which triggers a console log flush.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
+# Log regions at least this large are memory mapped instead of being
+# read, so that looking up the requested lines does not require copying
+# the whole region.
+_MMAP_MIN_SIZE = 64 * units.Ki
+# Compressed archives are decompressed sequentially, only their end being
+# kept in memory. Archives normally hold a single rotated log, this limit
+# guarding against unexpectedly large ones.
+_MAX_ARCHIVE_TAIL_SIZE = 16 * units.Mi
+_ARCHIVE_READ_CHUNK_SIZE = 64 * units.Ki
+
+
+def read_log_tail(log_paths, max_bytes=None, max_lines=None):
+    """Returns the end of the console output spread across the log files.
+
+    :param log_paths: the current log path, followed by the archived logs
+                      paths, starting with the newest one.
+    :param max_bytes: the maximum number of bytes to be returned.
+    :param max_lines: the maximum number of lines to be returned.
+
+    Only the requested data is read, starting from the end of the newest
+    log file. All the log files are opened before reading, so that a log
+    rotation cannot cause the same data to be returned twice. Archives
+    having the '.gz' extension are decompressed only if the newer logs
+    do not hold the requested data, at most the last 16 MiB of each
+    archive being read.
+    """
+    log_files = []
+    chunks = []
+    try:
+        # Start with the oldest log file.
+        for log_path in log_paths[::-1]:
+            try:
+                log_files.append(open(log_path, 'rb'))
+            except IOError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+        remaining_bytes = max_bytes
+        remaining_lines = max_lines
+        # The last byte of the console output does not end a line that
+        # has to be counted.
+        skip_last_byte = True
+        for log_file in log_files[::-1]:
+            if remaining_bytes == 0 or remaining_lines == 0:
+                break
+
+            chunk, lines = _read_file_tail(log_file, remaining_bytes,
+                                           remaining_lines, skip_last_byte)
+            if not chunk:
+                continue
+            chunks.append(chunk)
+            skip_last_byte = False
+
+            if remaining_bytes is not None:
+                remaining_bytes -= len(chunk)
+            if remaining_lines is not None:
+                remaining_lines -= lines
+    finally:
+        for log_file in log_files:
+            log_file.close()
+
+    return b''.join(chunks[::-1])
+
+
+def _read_file_tail(log_file, max_bytes, max_lines, skip_last_byte):
+    """Reads the end of a log file.
+
+    Returns the data along with the number of line separators found,
+    which are only looked up if a maximum number of lines is requested.
+    """
+    data = None
+    if log_file.name.endswith('.gz'):
+        data = _read_archive_tail(log_file, max_bytes)
+        size = len(data)
+    else:
+        size = os.fstat(log_file.fileno()).st_size
+
+    start = 0 if max_bytes is None else max(0, size - max_bytes)
+    if start == size:
+        return b'', 0
+
+    if data is not None:
+        end = size
+    elif size - start >= _MMAP_MIN_SIZE:
+        data = mmap.mmap(log_file.fileno(), size, access=mmap.ACCESS_READ)
+        end = size
+    else:
+        log_file.seek(start)
+        data = log_file.read(size - start)
+        start, end = 0, len(data)
+
+    try:
+        lines = 0
+        if max_lines is not None:
+            pos = end - 1 if skip_last_byte else end
+            while lines < max_lines:
+                pos = data.rfind(b'\n', start, pos)
+                if pos == -1:
+                    break
+                lines += 1
+            if lines == max_lines:
+                start = pos + 1
+        return data[start:end], lines
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def _read_archive_tail(log_file, max_bytes):
+    """Decompresses the end of a gzip compressed log file.
+
+    Compressed archives are not seekable, so they are decompressed
+    sequentially, keeping only the last max_bytes bytes in memory.
+    """
+    if max_bytes is None:
+        max_bytes = _MAX_ARCHIVE_TAIL_SIZE
+    else:
+        max_bytes = min(max_bytes, _MAX_ARCHIVE_TAIL_SIZE)
+
+    archive_file = gzip.GzipFile(fileobj=log_file, mode='rb')
+    data = bytearray()
+    while True:
+        chunk = archive_file.read(_ARCHIVE_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+        # Trimming the data only once it doubles in size avoids moving
+        # it on each read.
+        if len(data) >= 2 * max_bytes:
+            del data[:len(data) - max_bytes]
+
+    return bytes(data[max(0, len(data) - max_bytes):])
+
+
+class ConsoleLogWriter(object):
+    """Writes the instance console output to size limited log files.
+
+    The console output is buffered in memory, being written to the log
+    file when the buffered data exceeds a given size or after a given
+    interval. Flushes, including log rotations, are performed by the
+    reactor worker threads, never blocking the named pipe reader.
+
+    The log size is tracked in memory, avoiding querying the file
+    position on each write.
+
+    Rotated logs are compressed by a reactor worker thread, the rotation
+    itself being a simple rename.
+    """
+
+    def __init__(self, log_paths,
+                 max_size=constants.MAX_CONSOLE_LOG_FILE_SIZE):
+        # The current log path, followed by the last rotated log path
+        # and by the compressed archives paths, starting with the
+        # newest one.
+        self._log_path = log_paths[0]
+        self._rotated_log_path = (log_paths[1] if len(log_paths) > 1
+                                  else None)
+        self._archive_paths = log_paths[2:]
+        self._max_size = max_size
+
+        self._flush_interval = CONF.hyperv.console_log_flush_interval
+        self._flush_size = CONF.hyperv.console_log_flush_size
+
+        self._buffer = bytearray()
+        self._log_file = None
+        self._log_size = 0
+        self._flush_scheduled = False
+        self._flush_timer = None
+        self._archive_scheduled = False
+        self._stopped = False
+        self._stats = dict(bytes_logged=0, dropped_bytes=0,
+                           buffer_high_water_mark=0, rotations=0,
+                           write_errors=0, archive_errors=0)
+
+        # Protects the buffer.
+        self._lock = threading.Lock()
+        # Serializes log file operations.
+        self._flush_lock = threading.Lock()
+        # Serializes archive operations.
+        self._archive_lock = threading.Lock()
+        self._reactor = ioreactor.get_reactor()
+
+    def start(self):
+        self._open_log()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            if self._flush_timer:
+                self._flush_timer.cancel()
+
+        self._flush()
+        with self._flush_lock:
+            if self._log_file:
+                self._log_file.close()
+                self._log_file = None
+
+        # Wait for the archives to be consistent, as those may be copied
+        # once the instance is stopped.
+        with self._archive_lock:
+            pass
+
+    def get_stats(self):
+        """Returns the console log counters.
+
+        Those include the number of bytes written to the log files, the
+        number of bytes dropped because flushes did not keep up, the
+        maximum amount of buffered data, the number of log rotations and
+        the number of failed log writes and archive attempts.
+        """
+        return dict(self._stats)
+
+    def write(self, data):
+        """Buffers the data, scheduling a flush if needed.
+
+        The data is copied, so the caller may reuse the passed buffer.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+
+            self._buffer += data
+            overflow = len(self._buffer) - self._max_size
+            if overflow > 0:
+                # Flushes do not keep up, drop the oldest data.
+                del self._buffer[:overflow]
+                self._stats['dropped_bytes'] += overflow
+            self._stats['buffer_high_water_mark'] = max(
+                self._stats['buffer_high_water_mark'], len(self._buffer))
+
+            if len(self._buffer) >= self._flush_size:
+                if not self._flush_scheduled:
+                    self._flush_scheduled = True
+                    if self._flush_timer:
+                        self._flush_timer.cancel()
+                        self._flush_timer = None
+                    self._reactor.call_soon(self._flush)
+            elif not (self._flush_scheduled or self._flush_timer):
+                self._flush_timer = self._reactor.call_later(
+                    self._flush_interval, self._flush)
+
+    def _flush(self):
+        with self._flush_lock:
+            with self._lock:
+                data = self._buffer
+                self._buffer = bytearray()
+                self._flush_scheduled = False
+                self._flush_timer = None
+
+            if data and self._log_file:
+                try:
+                    self._write_to_log(data)
+                except (IOError, OSError) as err:
+                    self._stats['write_errors'] += 1
+                    LOG.warning(_LW("Failed to write console log "
+                                    "%(log_path)s. Error: %(err)s"),
+                                {'log_path': self._log_path, 'err': err})
+
+    def _open_log(self):
+        self._log_file = open(self._log_path, 'ab', 0)
+        self._log_file.seek(0, os.SEEK_END)
+        self._log_size = self._log_file.tell()
+
+    def _write_to_log(self, data):
+        data = memoryview(data)
+        while data:
+            if (self._log_size >= self._max_size and
+                    not self._rotate_logs()):
+                # Keep writing to the current log until the next
+                # rotation attempt.
+                chunk = data
+            else:
+                chunk = data[:self._max_size - self._log_size]
+
+            self._log_file.write(chunk)
+            self._log_size += len(chunk)
+            self._stats['bytes_logged'] += len(chunk)
+            data = data[len(chunk):]
+
+    def _rotate_logs(self):
+        self._log_file.close()
+        try:
+            if not self._rotated_log_path:
+                os.remove(self._log_path)
+            elif os.path.exists(self._rotated_log_path):
+                # The previously rotated log was not archived yet. We'll
+                # keep using the current log until then.
+                self._schedule_archive()
+                return False
+            else:
+                os.rename(self._log_path, self._rotated_log_path)
+                self._schedule_archive()
+            self._stats['rotations'] += 1
+            return True
+        except (IOError, OSError) as err:
+            # The log files might be in use if the console log is
+            # requested while the rotation is attempted. We'll retry on
+            # the next flush.
+            LOG.debug("Could not rotate console log %(log_path)s. "
+                      "Error: %(err)s",
+                      {'log_path': self._log_path, 'err': err})
+            return False
+        finally:
+            self._open_log()
+
+    def _schedule_archive(self):
+        if not self._archive_scheduled:
+            self._archive_scheduled = True
+            self._reactor.call_soon(self._archive_rotated_log)
+
+    def _archive_rotated_log(self):
+        with self._archive_lock:
+            self._archive_scheduled = False
+            if not os.path.exists(self._rotated_log_path):
+                return
+
+            try:
+                if not self._archive_paths:
+                    # No archives are kept.
+                    os.remove(self._rotated_log_path)
+                    return
+
+                self._shift_archives()
+                self._compress_log(self._rotated_log_path,
+                                   self._archive_paths[0])
+                os.remove(self._rotated_log_path)
+            except (IOError, OSError) as err:
+                self._stats['archive_errors'] += 1
+                # This will be retried on the next rotation.
+                LOG.warning(_LW("Could not archive console log "
+                                "%(log_path)s. Error: %(err)s"),
+                            {'log_path': self._rotated_log_path,
+                             'err': err})
+
+    def _shift_archives(self):
+        if not os.path.exists(self._archive_paths[0]):
+            # Already shifted by a previous attempt.
+            return
+
+        if os.path.exists(self._archive_paths[-1]):
+            os.remove(self._archive_paths[-1])
+
+        for src_path, dest_path in zip(self._archive_paths[-2::-1],
+                                       self._archive_paths[:0:-1]):
+            if os.path.exists(src_path):
+                os.rename(src_path, dest_path)
+
+    def _compress_log(self, log_path, archive_path):
+        # The archive is written to a temporary file first, so that
+        # readers never see a partially written archive.
+        tmp_path = archive_path + '.tmp'
+        with open(log_path, 'rb') as log_file:
+            with gzip.open(tmp_path, 'wb') as archive_file:
+                shutil.copyfileobj(log_file, archive_file)
+        os.rename(tmp_path, archive_path)
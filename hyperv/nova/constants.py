@@ -126,4 +126,5 @@ SERIAL_PORT_TYPES = {
 DEFAULT_SERIAL_CONSOLE_PORT = 1
 
 SERIAL_CONSOLE_BUFFER_SIZE = 4 * units.Ki
+SERIAL_CONSOLE_RING_BUFFER_SIZE = 256 * units.Ki
 MAX_CONSOLE_LOG_FILE_SIZE = units.Mi / 2
@@ -19,13 +19,16 @@ A Hyper-V Nova Compute driver.
 
 import platform
 
+from nova import context as nova_context
 from nova.virt import driver
+from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import excutils
 
 from hyperv.i18n import _
 from hyperv.nova import eventhandler
 from hyperv.nova import hostops
+from hyperv.nova import imagecache
 from hyperv.nova import livemigrationops
 from hyperv.nova import migrationops
 from hyperv.nova import rdpconsoleops
@@ -36,6 +39,10 @@ from hyperv.nova import volumeops
 
 LOG = logging.getLogger(__name__)
 
+CONF = cfg.CONF
+CONF.import_opt('console_output_max_bytes', 'hyperv.nova.serialconsoleops',
+                'hyperv')
+
 
 class HyperVDriver(driver.ComputeDriver):
     capabilities = {
@@ -55,9 +62,11 @@ class HyperVDriver(driver.ComputeDriver):
         self._migrationops = migrationops.MigrationOps()
         self._rdpconsoleops = rdpconsoleops.RDPConsoleOps()
         self._serialconsoleops = serialconsoleops.SerialConsoleOps()
+        self._imagecache = imagecache.ImageCache()
 
     def init_host(self, host):
         self._serialconsoleops.start_console_handlers()
+        self._imagecache.start_warmup(nova_context.get_admin_context())
         event_handler = eventhandler.InstanceEventHandler(
             state_change_callback=self.emit_event)
         event_handler.start_listener()
@@ -104,7 +113,9 @@ class HyperVDriver(driver.ComputeDriver):
         return self._volumeops.get_volume_connector(instance)
 
     def get_available_resource(self, nodename):
-        return self._hostops.get_available_resource()
+        resources = self._hostops.get_available_resource()
+        resources['stats'] = self._imagecache.get_warmup_stats()
+        return resources
 
     def get_available_nodes(self, refresh=False):
         return [platform.node()]
@@ -256,7 +267,9 @@ class HyperVDriver(driver.ComputeDriver):
         return self._serialconsoleops.get_serial_console(instance.name)
 
     def get_console_output(self, context, instance):
-        return self._serialconsoleops.get_console_output(instance.name)
+        return self._serialconsoleops.get_console_output(
+            instance.name,
+            max_bytes=CONF.hyperv.console_output_max_bytes or None)
 
     def rescue(self, context, instance, network_info, image_meta,
                rescue_password):
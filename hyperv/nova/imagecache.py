@@ -15,23 +15,108 @@
 """
 Image caching and management.
 """
+import collections
+import contextlib
+import copy
 import os
+import time
 
+import eventlet
+from keystoneclient import auth as ks_auth
+from keystoneclient import session as ks_session
+from nova.image import glance
+from nova import objects
 from nova import utils
 from nova.virt import images
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_service import sslutils
 from oslo_utils import excutils
 from oslo_utils import units
 
-from hyperv.i18n import _
+from hyperv.i18n import _, _LI, _LW
+from hyperv.nova import compressionutils
+from hyperv.nova import imagedownloader
 from hyperv.nova import utilsfactory
 from hyperv.nova import vmutils
 
+hyperv_opts = [
+    cfg.IntOpt('image_download_streams',
+               default=1,
+               help='The number of parallel streams used for downloading '
+                    'images from Glance, each stream fetching a different '
+                    'range of the image. If set to 1, the images are '
+                    'downloaded sequentially using the Nova image API.'),
+    cfg.IntOpt('image_download_chunk_size',
+               default=64,
+               help='The size in MB of the image ranges downloaded by each '
+                    'stream when using parallel image downloads.'),
+    cfg.ListOpt('image_cache_peers',
+                default=[],
+                help='List of Hyper-V hosts whose image cache is checked '
+                     'for images before downloading them from Glance. The '
+                     'image is copied from the peer which responds the '
+                     'fastest, through the share exposing its instances '
+                     'path.'),
+    cfg.StrOpt('image_cache_warmup_manifest',
+               help='Path of a file listing the ids of the images which '
+                    'are fetched in the background when the service '
+                    'starts, one per line. Lines starting with # are '
+                    'ignored. The warm-up is skipped if the file cannot '
+                    'be read.'),
+    cfg.ListOpt('image_cache_warmup_images',
+                default=[],
+                help='List of image ids which are fetched in the background '
+                     'when the service starts, along with the ones listed '
+                     'in the image_cache_warmup_manifest file. The warm-up '
+                     'is disabled unless images are given. The images are '
+                     'requested using the service credentials configured '
+                     'in the glance section through the Keystone auth '
+                     'plugin options (auth_plugin and the plugin specific '
+                     'ones), the warm-up being skipped if they are '
+                     'missing. The warm-up yields to the images fetched '
+                     'for instances being spawned.'),
+    cfg.IntOpt('image_cache_warmup_workers',
+               default=1,
+               help='The maximum number of images fetched concurrently '
+                    'while warming up the image cache.'),
+    cfg.BoolOpt('image_cache_warmup_disable_host',
+                default=False,
+                help='Disable the compute service while the image cache '
+                     'is being warmed up, so that instances are not '
+                     'scheduled on this host until the images are cached.'),
+    cfg.IntOpt('image_download_retries',
+               default=3,
+               help='The number of times an image range download is '
+                    'retried before the parallel image download fails.'),
+]
+
 LOG = logging.getLogger(__name__)
 
 CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
 CONF.import_opt('use_cow_images', 'nova.virt.driver')
+CONF.import_opt('host', 'nova.netconf')
+CONF.import_opt('api_insecure', 'nova.image.glance', group='glance')
+# The service credentials used for warming up the image cache.
+ks_session.Session.register_conf_options(CONF, 'glance')
+ks_auth.register_conf_options(CONF, 'glance')
+
+_WARMUP_DISABLED_REASON = 'Hyper-V image cache warm-up in progress'
+
+# Progress of the image cache warm-up, shared by the ImageCache instances,
+# logged as the images are fetched and reported through the host stats.
+_warmup_progress = {}
+# The number of images being fetched for instances, which the warm-up
+# waits for.
+_instance_image_fetches = 0
+# The interval at which the warm-up checks if instance image fetches
+# are still in progress.
+_WARMUP_YIELD_INTERVAL = 1
+
+# The amount of data read from each peer image when choosing the peer to
+# copy an image from.
+_PEER_PROBE_SIZE = units.Mi
 
 
 class ImageCache(object):
@@ -93,9 +178,166 @@ class ImageCache(object):
             copy_and_resize_vhd()
             return resized_vhd_path
 
-    def get_cached_image(self, context, instance, rescue_image_id=None):
-        image_id = rescue_image_id or instance.image_ref
+    def _fetch_image(self, context, image_id, image_path, image_meta,
+                     user_id=None, project_id=None):
+        if CONF.hyperv.image_cache_peers:
+            try:
+                if self._copy_image_from_peers(image_id, image_meta,
+                                               image_path):
+                    return
+            except Exception:
+                LOG.warning(_LW("Failed to copy image %s from the image "
+                                "cache peers."), image_id, exc_info=True)
+                if self._pathutils.exists(image_path):
+                    self._pathutils.remove(image_path)
+
+        if CONF.hyperv.image_download_streams > 1:
+            try:
+                self._download_image(context, image_meta, image_path)
+                return
+            except Exception:
+                LOG.warning(_LW("Parallel download of image %s failed. "
+                                "Falling back to a sequential download."),
+                            image_id, exc_info=True)
+                if self._pathutils.exists(image_path):
+                    self._pathutils.remove(image_path)
+
+        images.fetch(context, image_id, image_path, user_id, project_id)
+
+    def _get_image_meta(self, context, image_id):
+        (image_service,
+         image_id) = glance.get_remote_image_service(context, image_id)
+        return image_service.show(context, image_id)
+
+    def _download_image(self, context, image_meta, image_path):
+        """Downloads an image from Glance using parallel range requests."""
+        api_server = next(glance.get_api_servers())
+        url = '%s/v2/images/%s/file' % (api_server, image_meta['id'])
+        headers = {'X-Auth-Token': context.auth_token}
+
+        downloader = imagedownloader.ParallelDownloader(
+            streams=CONF.hyperv.image_download_streams,
+            chunk_size=CONF.hyperv.image_download_chunk_size * units.Mi,
+            retries=CONF.hyperv.image_download_retries,
+            **self._get_glance_ssl_params(url))
+        downloader.download(url, image_path, image_meta['size'],
+                            checksum=image_meta.get('checksum'),
+                            headers=headers)
+
+    @staticmethod
+    def _get_glance_ssl_params(url):
+        """Returns the TLS settings used by the Nova Glance client."""
+        if not url.startswith('https'):
+            return {}
+
+        # Registers the SSL options, as done by the Glance client.
+        sslutils.is_enabled(CONF)
+        if CONF.glance.api_insecure:
+            verify = False
+        else:
+            verify = CONF.ssl.ca_file or True
+        cert = None
+        if CONF.ssl.cert_file:
+            cert = ((CONF.ssl.cert_file, CONF.ssl.key_file)
+                    if CONF.ssl.key_file else CONF.ssl.cert_file)
+        return {'verify': verify, 'cert': cert}
+
+    def _probe_peer_image(self, peer, image_id):
+        """Looks for the image in the image cache of the given peer.
+
+        Returns the path of the image along with the time needed to read
+        a sample of it, or None if the image is not available.
+        """
+        try:
+            peer_base_dir = self._pathutils.get_base_vhd_dir(
+                remote_server=peer)
+            for format_ext in ['vhd', 'vhdx']:
+                peer_image_path = os.path.join(
+                    peer_base_dir, image_id + '.' + format_ext)
+                if self._pathutils.exists(peer_image_path):
+                    start_time = time.time()
+                    with self._pathutils.open(peer_image_path, 'rb') as f:
+                        f.read(_PEER_PROBE_SIZE)
+                    return time.time() - start_time, peer_image_path
+        except Exception as ex:
+            LOG.debug("Could not check the image cache of peer %(peer)s: "
+                      "%(ex)s", {'peer': peer, 'ex': ex})
+
+    def _find_peer_image(self, image_id):
+        peers = CONF.hyperv.image_cache_peers
+        pool = eventlet.GreenPool(len(peers))
+        peer_images = [
+            peer_image for peer_image in pool.imap(
+                lambda peer: self._probe_peer_image(peer, image_id), peers)
+            if peer_image]
+        if peer_images:
+            return min(peer_images)[1]
+
+    def _copy_image_from_peers(self, image_id, image_meta, image_path):
+        """Copies the image from the fastest peer having it cached.
+
+        Returns False if the image is not available on any peer.
+        """
+        if image_meta.get('properties', {}).get(
+                compressionutils.IMAGE_COMPRESSION_PROPERTY):
+            # Peers cache the decompressed images, which cannot be
+            # validated against the Glance checksum.
+            return False
+
+        peer_image_path = self._find_peer_image(image_id)
+        if not peer_image_path:
+            return False
+
+        LOG.debug("Copying image %(image_id)s from peer image "
+                  "%(peer_image_path)s",
+                  {'image_id': image_id, 'peer_image_path': peer_image_path})
+        self._pathutils.copyfile(peer_image_path, image_path)
+
+        checksum = image_meta.get('checksum')
+        if checksum and (imagedownloader.get_file_checksum(image_path) !=
+                         checksum):
+            LOG.warning(_LW("Checksum mismatch for image %(image_id)s "
+                            "copied from %(peer_image_path)s."),
+                        {'image_id': image_id,
+                         'peer_image_path': peer_image_path})
+            self._pathutils.remove(image_path)
+            return False
+        return True
+
+    def _get_image_format(self, image_path, image_meta):
+        """Returns the virtual disk format of a fetched image.
+
+        Compressed images are decompressed in place. The codec is given by
+        the image properties set when uploading the image, the file header
+        being checked only for images lacking them.
+        """
+        codec = image_meta.get('properties', {}).get(
+            compressionutils.IMAGE_COMPRESSION_PROPERTY)
+        if not codec:
+            try:
+                return self._vhdutils.get_vhd_format(image_path)
+            except vmutils.HyperVException:
+                codec = compressionutils.get_file_compression(image_path)
+                if not codec:
+                    raise
+        elif codec == compressionutils.COMPRESSION_NONE:
+            return self._vhdutils.get_vhd_format(image_path)
+
+        decompressed_path = image_path + '.decompressed'
+        try:
+            compressionutils.decompress_file(image_path, decompressed_path,
+                                             codec)
+            self._pathutils.remove(image_path)
+            self._pathutils.rename(decompressed_path, image_path)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if self._pathutils.exists(decompressed_path):
+                    self._pathutils.remove(decompressed_path)
 
+        return self._vhdutils.get_vhd_format(image_path)
+
+    def _cache_image(self, context, image_id, user_id=None, project_id=None):
+        """Fetches the image if not already cached, returning its path."""
         base_vhd_dir = self._pathutils.get_base_vhd_dir()
         base_vhd_path = os.path.join(base_vhd_dir, image_id)
 
@@ -110,11 +352,14 @@ class ImageCache(object):
 
             if not vhd_path:
                 try:
-                    images.fetch(context, image_id, base_vhd_path,
-                                 instance.user_id,
-                                 instance.project_id)
+                    # The image metadata is retrieved only once per
+                    # fetched image.
+                    image_meta = self._get_image_meta(context, image_id)
+                    self._fetch_image(context, image_id, base_vhd_path,
+                                      image_meta, user_id, project_id)
 
-                    format_ext = self._vhdutils.get_vhd_format(base_vhd_path)
+                    format_ext = self._get_image_format(base_vhd_path,
+                                                        image_meta)
                     vhd_path = base_vhd_path + '.' + format_ext.lower()
                     self._pathutils.rename(base_vhd_path, vhd_path)
                 except Exception:
@@ -124,7 +369,169 @@ class ImageCache(object):
 
             return vhd_path
 
-        vhd_path = fetch_image_if_not_existing()
+        return fetch_image_if_not_existing()
+
+    def _get_warmup_image_ids(self):
+        image_ids = list(CONF.hyperv.image_cache_warmup_images)
+
+        manifest_path = CONF.hyperv.image_cache_warmup_manifest
+        if manifest_path:
+            try:
+                with open(manifest_path, 'r') as f:
+                    lines = [line.strip() for line in f]
+            except IOError as ex:
+                LOG.warning(_LW("Could not read the image cache warm-up "
+                                "manifest %(manifest_path)s, skipping the "
+                                "warm-up. Error: %(ex)s"),
+                            {'manifest_path': manifest_path, 'ex': ex})
+                return []
+            image_ids += [line for line in lines
+                          if line and not line.startswith('#')]
+
+        return list(collections.OrderedDict.fromkeys(image_ids))
+
+    def _get_warmup_auth_session(self):
+        """Returns a Keystone session using the service credentials.
+
+        Returns None if no auth plugin is configured in the glance section.
+        """
+        auth_plugin = ks_auth.load_from_conf_options(CONF, 'glance')
+        if not auth_plugin:
+            return None
+        return ks_session.Session.load_from_conf_options(CONF, 'glance',
+                                                         auth=auth_plugin)
+
+    def _get_warmup_context(self, context, auth_session):
+        """Returns a copy of the context using a service token.
+
+        The token is requested for each image, the auth plugin renewing it
+        if it is about to expire.
+        """
+        warmup_context = copy.copy(context)
+        warmup_context.auth_token = auth_session.get_auth_headers()[
+            'X-Auth-Token']
+        return warmup_context
+
+    def start_warmup(self, context):
+        """Fetches the configured images in the background.
+
+        :param context: admin context used for updating the service state,
+                        the images being requested using the service
+                        credentials.
+        """
+        image_ids = self._get_warmup_image_ids()
+        if not image_ids:
+            return
+
+        try:
+            auth_session = self._get_warmup_auth_session()
+        except Exception:
+            LOG.warning(_LW("Could not load the service credentials, "
+                            "skipping the image cache warm-up."),
+                        exc_info=True)
+            return
+        if not auth_session:
+            LOG.warning(_LW("Skipping the image cache warm-up as no service "
+                            "credentials are configured in the glance "
+                            "section."))
+            return
+
+        _warmup_progress.clear()
+        _warmup_progress.update(total=len(image_ids), cached=0, failed=0)
+
+        LOG.info(_LI("Warming up the image cache with %d images."),
+                 len(image_ids))
+        if CONF.hyperv.image_cache_warmup_disable_host:
+            self._set_service_disabled(context, True)
+        eventlet.spawn_n(self._warm_up, context, auth_session, image_ids)
+
+    def _warm_up(self, context, auth_session, image_ids):
+        pool = eventlet.GreenPool(CONF.hyperv.image_cache_warmup_workers)
+        try:
+            for image_id in image_ids:
+                pool.spawn_n(self._warm_up_image, context, auth_session,
+                             image_id)
+            pool.waitall()
+        finally:
+            LOG.info(_LI("Image cache warm-up finished. Cached images: "
+                         "%(cached)d, failed: %(failed)d."),
+                     _warmup_progress)
+            if CONF.hyperv.image_cache_warmup_disable_host:
+                self._set_service_disabled(context, False)
+
+    def _warm_up_image(self, context, auth_session, image_id):
+        self._wait_for_instance_image_fetches()
+        try:
+            self._cache_image(
+                self._get_warmup_context(context, auth_session), image_id)
+            _warmup_progress['cached'] += 1
+            LOG.info(_LI("Image cache warm-up: cached image %(image_id)s. "
+                         "Progress: %(cached)d cached, %(failed)d failed "
+                         "out of %(total)d."),
+                     dict(_warmup_progress, image_id=image_id))
+        except Exception:
+            _warmup_progress['failed'] += 1
+            LOG.warning(_LW("Image cache warm-up: failed to cache image "
+                            "%s."), image_id, exc_info=True)
+
+    def get_warmup_stats(self):
+        """Returns the image cache warm-up progress as host stats.
+
+        The stats are reported along with the host resources, being
+        available to the scheduler. No stats are returned if the warm-up
+        was not started.
+        """
+        if not _warmup_progress:
+            return {}
+
+        progress = dict(_warmup_progress)
+        progress['pending'] = (progress['total'] - progress['cached'] -
+                               progress['failed'])
+        return dict(('image_cache_warmup_%s' % key, value)
+                    for key, value in progress.items())
+
+    def _wait_for_instance_image_fetches(self):
+        # The warm-up has a lower priority than spawning instances,
+        # yielding to the greenthreads fetching their images.
+        eventlet.sleep(0)
+        while _instance_image_fetches:
+            eventlet.sleep(_WARMUP_YIELD_INTERVAL)
+
+    @contextlib.contextmanager
+    def _instance_image_fetch(self):
+        global _instance_image_fetches
+        _instance_image_fetches += 1
+        try:
+            yield
+        finally:
+            _instance_image_fetches -= 1
+
+    def _set_service_disabled(self, context, disabled):
+        """Disables or re-enables the compute service during warm-up.
+
+        Services disabled for other reasons are not re-enabled.
+        """
+        try:
+            service = objects.Service.get_by_compute_host(context, CONF.host)
+            if disabled and not service.disabled:
+                service.disabled = True
+                service.disabled_reason = _WARMUP_DISABLED_REASON
+                service.save()
+            elif (not disabled and service.disabled and
+                    service.disabled_reason == _WARMUP_DISABLED_REASON):
+                service.disabled = False
+                service.disabled_reason = None
+                service.save()
+        except Exception:
+            LOG.warning(_LW("Failed to update the compute service status "
+                            "during the image cache warm-up."),
+                        exc_info=True)
+
+    def get_cached_image(self, context, instance, rescue_image_id=None):
+        image_id = rescue_image_id or instance.image_ref
+        with self._instance_image_fetch():
+            vhd_path = self._cache_image(context, image_id, instance.user_id,
+                                         instance.project_id)
 
         # Note: rescue images are not resized.
         is_vhd = vhd_path.split('.')[-1].lower() == 'vhd'
@@ -0,0 +1,228 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Parallel ranged image downloads.
+"""
+import collections
+import hashlib
+import time
+
+import eventlet
+from oslo_log import log as logging
+from oslo_utils import units
+import requests
+
+from hyperv.i18n import _, _LW
+from hyperv.nova import vmutils
+
+LOG = logging.getLogger(__name__)
+
+_IO_CHUNK_SIZE = 64 * units.Ki
+
+
+def get_file_checksum(path):
+    """Returns the md5 hex digest of the given file."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(_IO_CHUNK_SIZE), b''):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+class RangeRequestFailed(vmutils.HyperVException):
+    """Raised when a ranged request is not served as such.
+
+    This is not retried, as the server either does not support ranged
+    requests or refuses them.
+    """
+
+
+class ParallelDownloader(object):
+    """Downloads a file using multiple concurrent HTTP range requests.
+
+    The server support for ranged requests is checked before starting the
+    download. The destination file is preallocated, each range being
+    written at its own offset. Failed ranges are retried independently,
+    resuming from the last byte received. Once a range fails permanently,
+    the ranges being downloaded are cancelled and the remaining ones are
+    not requested anymore.
+    """
+
+    def __init__(self, streams, chunk_size, retries=3, retry_interval=1,
+                 timeout=60, verify=True, cert=None):
+        """Creates a downloader.
+
+        :param verify: passed to requests, either a bool telling if the
+                       server certificate is validated or the path of the
+                       CA bundle used to validate it.
+        :param cert: optional client certificate passed to requests,
+                     either a path or a (cert_file, key_file) tuple.
+        """
+        self._streams = streams
+        self._chunk_size = chunk_size
+        self._retries = retries
+        self._retry_interval = retry_interval
+        self._timeout = timeout
+        self._verify = verify
+        self._cert = cert
+
+    def _get_ranges(self, size):
+        return [(offset, min(self._chunk_size, size - offset))
+                for offset in range(0, size, self._chunk_size)]
+
+    def _get_range(self, url, headers, offset, length):
+        """Requests a range of the file, returning the streamed response.
+
+        :raises RangeRequestFailed: if the response is not a partial one,
+                                    in which case it is closed.
+        """
+        range_headers = dict(headers or {})
+        range_headers['Range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
+
+        response = requests.get(url, headers=range_headers, stream=True,
+                                timeout=self._timeout,
+                                verify=self._verify, cert=self._cert)
+        if response.status_code != requests.codes.partial_content:
+            response.close()
+            raise RangeRequestFailed(
+                _("Ranged request for %(url)s failed with status "
+                  "%(status)s") %
+                {'url': url, 'status': response.status_code})
+        return response
+
+    def _check_range_support(self, url, headers):
+        response = self._get_range(url, headers, 0, 1)
+        response.close()
+
+    def _download_range(self, url, headers, dest_path, offset, length):
+        """Downloads a range of the file.
+
+        Returns the number of bytes written, along with the error that
+        interrupted the download, if any.
+
+        :raises RangeRequestFailed: if the range is not served.
+        """
+        written = 0
+        try:
+            response = self._get_range(url, headers, offset, length)
+            try:
+                with open(dest_path, 'r+b') as f:
+                    f.seek(offset)
+                    for data in response.iter_content(_IO_CHUNK_SIZE):
+                        data = data[:length - written]
+                        f.write(data)
+                        written += len(data)
+                        if written == length:
+                            break
+            finally:
+                response.close()
+        except (requests.RequestException, IOError) as ex:
+            return written, ex
+
+        if written < length:
+            return written, _("Received %(written)d bytes out of "
+                              "%(length)d") % {'written': written,
+                                               'length': length}
+        return written, None
+
+    def _download_range_with_retries(self, url, headers, dest_path, offset,
+                                     length):
+        attempt = 0
+        while True:
+            written, error = self._download_range(url, headers, dest_path,
+                                                  offset, length)
+            offset += written
+            length -= written
+            if not error:
+                return
+
+            attempt += 1
+            if attempt > self._retries:
+                raise vmutils.HyperVException(
+                    _("Failed to download range at offset %(offset)d of "
+                      "%(url)s: %(error)s") %
+                    {'offset': offset, 'url': url, 'error': error})
+
+            LOG.warning(_LW("Retrying download of range at offset "
+                            "%(offset)d of %(url)s. Attempt %(attempt)d of "
+                            "%(retries)d. Error: %(error)s"),
+                        {'offset': offset, 'url': url, 'attempt': attempt,
+                         'retries': self._retries, 'error': error})
+            time.sleep(self._retry_interval)
+
+    def _download_ranges(self, url, headers, dest_path, ranges, workers,
+                         failures):
+        """Downloads the pending ranges until none are left.
+
+        On failure, the error is added to the failures list and the other
+        workers are killed, cancelling the ranges they are downloading.
+        """
+        while ranges and not failures:
+            offset, length = ranges.popleft()
+            try:
+                self._download_range_with_retries(url, headers, dest_path,
+                                                  offset, length)
+            except Exception as ex:
+                failures.append(ex)
+                current_worker = eventlet.getcurrent()
+                for worker in workers:
+                    if worker is not current_worker:
+                        worker.kill()
+
+    def download(self, url, dest_path, size, checksum=None, headers=None):
+        """Downloads the file at the given url.
+
+        :param size: the size of the file, in bytes.
+        :param checksum: optional md5 hex digest which the downloaded file
+                         is validated against.
+        :param headers: optional headers passed to each request.
+        """
+        LOG.debug("Downloading %(url)s to %(dest_path)s using up to "
+                  "%(streams)d streams",
+                  {'url': url, 'dest_path': dest_path,
+                   'streams': self._streams})
+        start_time = time.time()
+
+        self._check_range_support(url, headers)
+
+        with open(dest_path, 'wb') as f:
+            f.truncate(size)
+
+        ranges = collections.deque(self._get_ranges(size))
+        workers = []
+        failures = []
+        pool = eventlet.GreenPool(self._streams)
+        # The workers do not start before the list is filled, as the pool
+        # has enough room for all of them.
+        for i in range(min(self._streams, len(ranges))):
+            workers.append(pool.spawn(self._download_ranges, url, headers,
+                                      dest_path, ranges, workers, failures))
+        pool.waitall()
+        if failures:
+            raise failures[0]
+
+        if checksum:
+            actual_checksum = get_file_checksum(dest_path)
+            if actual_checksum != checksum:
+                raise vmutils.HyperVException(
+                    _("Checksum mismatch for %(url)s. Expected: "
+                      "%(checksum)s, actual: %(actual_checksum)s") %
+                    {'url': url, 'checksum': checksum,
+                     'actual_checksum': actual_checksum})
+
+        elapsed = time.time() - start_time
+        LOG.debug("Downloaded %(size)d bytes from %(url)s in %(elapsed).2f "
+                  "seconds", {'size': size, 'url': url, 'elapsed': elapsed})
@@ -0,0 +1,463 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Multiplexed I/O used by the serial console handlers of all the instances.
+"""
+
+import ctypes
+import errno
+import heapq
+import itertools
+import os
+import sys
+
+from eventlet import patcher
+from nova.i18n import _LE, _LW
+from nova import utils
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from hyperv.nova import ioutils
+
+threading = patcher.original('threading')
+time = patcher.original('time')
+select = patcher.original('select')
+socket = patcher.original('socket')
+Queue = patcher.original('Queue')
+
+LOG = logging.getLogger(__name__)
+
+hyperv_opts = [
+    cfg.IntOpt('serial_console_io_workers',
+               default=4,
+               help='The number of threads servicing the serial console '
+                    'named pipes and proxy connections of all the '
+                    'instances.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
+# select() rejects file descriptors not lower than FD_SETSIZE. On Windows,
+# it accepts up to FD_SETSIZE sockets per set instead.
+_FD_SETSIZE = 1024
+_WIN32_FD_SETSIZE = 512
+# The number of seconds the polling thread waits after a select error
+# that could not be tied to a file object.
+_POLL_ERROR_RETRY_INTERVAL = 1
+
+_reactor = None
+
+
+@utils.synchronized('hyperv-console-io-reactor')
+def get_reactor():
+    """Returns the reactor shared by all the serial console handlers."""
+    global _reactor
+    if not _reactor:
+        if sys.platform == 'win32':
+            reactor_cls = IOCPReactor
+        else:
+            reactor_cls = IOReactor
+        _reactor = reactor_cls(CONF.hyperv.serial_console_io_workers)
+        _reactor.start()
+    return _reactor
+
+
+class Timer(object):
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Waker(object):
+    """Loopback socket pair used for interrupting select calls."""
+
+    def __init__(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self._writer = socket.create_connection(
+                listener.getsockname())
+            self._reader, _ = listener.accept()
+        finally:
+            listener.close()
+
+        for sock in (self._reader, self._writer):
+            sock.setblocking(False)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def wake(self):
+        try:
+            self._writer.send(b'\0')
+        except socket.error:
+            # The socket buffer is full, a wake up is already pending.
+            pass
+
+    def consume(self):
+        try:
+            while self._reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+class IOReactor(object):
+    """Services asynchronous I/O using a fixed number of threads.
+
+    Socket readiness is polled by a single thread, the registered
+    callbacks being executed by a pool of worker threads. Interests are
+    one-shot: a callback has to register itself again in order to be
+    notified about subsequent events. This ensures that a callback does
+    not run concurrently with itself for a given socket.
+
+    As select is used for polling, the number of file objects which can
+    be waited on is limited by FD_SETSIZE. Interests exceeding this limit
+    are rejected with EMFILE socket errors.
+
+    On this platform agnostic implementation, named pipes are handled as
+    non-blocking file descriptors.
+    """
+
+    def __init__(self, workers):
+        self._num_workers = workers
+
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._tasks = Queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._waker = None
+
+    def start(self):
+        self._waker = _Waker()
+
+        jobs = [self._poll] + [self._run_tasks] * self._num_workers
+        for job in jobs:
+            worker = threading.Thread(target=job)
+            worker.setDaemon(True)
+            worker.start()
+            self._threads.append(worker)
+
+    def stop(self):
+        self._stopped.set()
+        self._waker.wake()
+        for idx in range(self._num_workers):
+            self._tasks.put(None)
+
+        for worker in self._threads:
+            worker_running = (worker.is_alive() and
+                              worker is not threading.current_thread())
+            if worker_running:
+                worker.join()
+        self._waker.close()
+
+    def call_soon(self, callback, *args):
+        """Executes the callback on a worker thread."""
+        self._tasks.put((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.time() + delay, callback, args)
+        with self._lock:
+            heapq.heappush(self._timers,
+                           (timer.deadline, next(self._timer_ids), timer))
+        self._waker.wake()
+        return timer
+
+    def wait_readable(self, fileobj, callback, *args):
+        self._add_interest(self._readers, fileobj, callback, args)
+
+    def wait_writable(self, fileobj, callback, *args):
+        self._add_interest(self._writers, fileobj, callback, args)
+
+    def cancel(self, fileobj):
+        """Drops the pending interests for the given file object."""
+        fd = self._get_fd(fileobj)
+        with self._lock:
+            self._readers.pop(fd, None)
+            self._writers.pop(fd, None)
+
+    def open_pipe(self, pipe_name):
+        return os.open(pipe_name, os.O_RDWR | os.O_NONBLOCK)
+
+    def close_pipe(self, pipe_handle):
+        self.cancel(pipe_handle)
+        os.close(pipe_handle)
+
+    def read_pipe(self, pipe_handle, buff, callback):
+        """Reads up to len(buff) bytes from the pipe into the buffer.
+
+        The callback will receive the number of bytes read and the error
+        code of the operation, if it failed.
+        """
+        def _read():
+            try:
+                data = os.read(pipe_handle, len(buff))
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    _wait()
+                else:
+                    callback(0, err.errno)
+                return
+
+            if not data:
+                callback(0, errno.EPIPE)
+                return
+            ctypes.memmove(buff, data, len(data))
+            callback(len(data), None)
+
+        def _wait():
+            try:
+                self.wait_readable(pipe_handle, _read)
+            except socket.error as err:
+                callback(0, err.errno)
+
+        _wait()
+
+    def write_pipe(self, pipe_handle, buff, num_bytes, callback):
+        data = ctypes.string_at(ctypes.addressof(buff), num_bytes)
+        offset = [0]
+
+        def _write():
+            try:
+                offset[0] += os.write(pipe_handle, data[offset[0]:])
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    callback(offset[0], err.errno)
+                    return
+
+            if offset[0] < num_bytes:
+                _wait()
+            else:
+                callback(num_bytes, None)
+
+        def _wait():
+            try:
+                self.wait_writable(pipe_handle, _write)
+            except socket.error as err:
+                callback(offset[0], err.errno)
+
+        _wait()
+
+    def _get_fd(self, fileobj):
+        if isinstance(fileobj, int):
+            return fileobj
+        return fileobj.fileno()
+
+    def _add_interest(self, interests, fileobj, callback, args):
+        fd = self._get_fd(fileobj)
+        with self._lock:
+            if fd not in interests and not self._can_poll(interests, fd):
+                LOG.warning(_LW("Serial console I/O: too many file objects "
+                                "are being polled, rejecting file "
+                                "descriptor %s."), fd)
+                raise socket.error(errno.EMFILE, os.strerror(errno.EMFILE))
+            interests[fd] = (callback, args)
+        self._waker.wake()
+
+    def _can_poll(self, interests, fd):
+        return fd < _FD_SETSIZE
+
+    def _run_tasks(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+
+            callback, args = task
+            try:
+                callback(*args)
+            except Exception:
+                LOG.exception(_LE("Serial console I/O callback failed."))
+
+    def _poll(self):
+        while not self._stopped.isSet():
+            with self._lock:
+                readers = list(self._readers)
+                writers = list(self._writers)
+            timeout = self._get_poll_timeout()
+
+            try:
+                readable, writable, _ = select.select(
+                    readers + [self._waker.fileno()], writers, [], timeout)
+            except (select.error, socket.error, ValueError) as err:
+                # A file object has been closed without cancelling its
+                # interests. Let the callbacks handle the error.
+                if not self._dispatch_bad_fds(readers, writers):
+                    # Avoid spinning if the error persists.
+                    LOG.error(_LE("Serial console I/O polling failed. "
+                                  "Error: %s"), err)
+                    self._stopped.wait(_POLL_ERROR_RETRY_INTERVAL)
+                continue
+
+            if self._waker.fileno() in readable:
+                self._waker.consume()
+
+            self._dispatch(self._readers, readable)
+            self._dispatch(self._writers, writable)
+            self._dispatch_timers()
+
+    def _get_poll_timeout(self):
+        with self._lock:
+            if not self._timers:
+                return None
+            return max(0, self._timers[0][0] - time.time())
+
+    def _dispatch(self, interests, fds):
+        for fd in fds:
+            with self._lock:
+                interest = interests.pop(fd, None)
+            if interest:
+                self.call_soon(interest[0], *interest[1])
+
+    def _dispatch_bad_fds(self, readers, writers):
+        """Dispatches the interests of invalid file descriptors.
+
+        Returns the number of file descriptors found to be invalid.
+        """
+        bad_fds = 0
+        for interests, fds in ((self._readers, readers),
+                               (self._writers, writers)):
+            for fd in fds:
+                try:
+                    select.select([fd], [], [], 0)
+                except (select.error, socket.error, ValueError):
+                    self._dispatch(interests, [fd])
+                    bad_fds += 1
+        return bad_fds
+
+    def _dispatch_timers(self):
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._timers or self._timers[0][0] > now:
+                    return
+                timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self.call_soon(timer.callback, *timer.args)
+
+
+class _PendingIO(object):
+    def __init__(self, overlapped_structure, buff, callback):
+        # Those have to be kept alive until the operation completes.
+        self.overlapped_structure = overlapped_structure
+        self.buff = buff
+        self.callback = callback
+
+
+class IOCPReactor(IOReactor):
+    """Windows reactor, handling named pipe I/O using a completion port.
+
+    Sockets are still handled by the polling thread, which may wait on
+    at most 511 sockets for each event type, due to the select limits.
+    """
+
+    _STOP_KEY = 1
+
+    def __init__(self, workers):
+        super(IOCPReactor, self).__init__(workers)
+        self._ioutils = ioutils.IOUtils()
+        self._completion_port = None
+        self._pending_io = {}
+
+    def start(self):
+        self._completion_port = self._ioutils.create_io_completion_port()
+        super(IOCPReactor, self).start()
+
+        worker = threading.Thread(target=self._process_completions)
+        worker.setDaemon(True)
+        worker.start()
+        self._threads.append(worker)
+
+    def stop(self):
+        self._ioutils.post_queued_completion_status(self._completion_port,
+                                                    key=self._STOP_KEY)
+        super(IOCPReactor, self).stop()
+        self._ioutils.close_handle(self._completion_port)
+
+    def open_pipe(self, pipe_name):
+        """Opens a named pipe in overlapped mode for asyncronous I/O."""
+        self._ioutils.wait_named_pipe(pipe_name)
+
+        pipe_handle = self._ioutils.open(
+            pipe_name,
+            desired_access=(ioutils.GENERIC_READ | ioutils.GENERIC_WRITE),
+            share_mode=(ioutils.FILE_SHARE_READ | ioutils.FILE_SHARE_WRITE),
+            creation_disposition=ioutils.OPEN_EXISTING,
+            flags_and_attributes=ioutils.FILE_FLAG_OVERLAPPED)
+        try:
+            self._ioutils.create_io_completion_port(
+                pipe_handle, self._completion_port)
+        except Exception:
+            self._ioutils.close_handle(pipe_handle)
+            raise
+        return pipe_handle
+
+    def _can_poll(self, interests, fd):
+        # Only sockets are polled, one of the readers being the waker.
+        return len(interests) < _WIN32_FD_SETSIZE - 1
+
+    def close_pipe(self, pipe_handle):
+        # Cancelled operations are still signaled through the
+        # completion port.
+        self._ioutils.cancel_io(pipe_handle)
+        self._ioutils.close_handle(pipe_handle)
+
+    def read_pipe(self, pipe_handle, buff, callback):
+        self._start_io(self._ioutils.read_file, pipe_handle, buff,
+                       len(buff), callback)
+
+    def write_pipe(self, pipe_handle, buff, num_bytes, callback):
+        self._start_io(self._ioutils.write_file, pipe_handle, buff,
+                       num_bytes, callback)
+
+    def _start_io(self, func, pipe_handle, buff, num_bytes, callback):
+        overlapped_structure = ioutils.OVERLAPPED()
+        address = self._ioutils.get_address(overlapped_structure)
+        self._pending_io[address] = _PendingIO(overlapped_structure,
+                                               buff, callback)
+        try:
+            func(pipe_handle, buff, num_bytes, overlapped_structure)
+        except ioutils.HyperVIOError as err:
+            # No completion packet is queued for failed requests.
+            del self._pending_io[address]
+            self.call_soon(callback, 0, err.error_code)
+
+    def _process_completions(self):
+        while True:
+            num_bytes, key, address, error_code = (
+                self._ioutils.get_queued_completion_status(
+                    self._completion_port))
+            if key == self._STOP_KEY:
+                return
+
+            pending_io = self._pending_io.pop(address, None)
+            if pending_io:
+                self.call_soon(pending_io.callback, num_bytes, error_code)
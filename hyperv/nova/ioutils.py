@@ -14,7 +14,6 @@
 #    under the License.
 
 import ctypes
-import struct
 import sys
 
 from eventlet import patcher
@@ -27,17 +26,19 @@ from hyperv.nova import vmutils
 
 LOG = logging.getLogger(__name__)
 
-Queue = patcher.original('Queue')
+threading = patcher.original('threading')
 
 if sys.platform == 'win32':
     from ctypes import wintypes
 
     kernel32 = ctypes.windll.kernel32
 
+    ULONG_PTR = ctypes.c_size_t
+
     class OVERLAPPED(ctypes.Structure):
         _fields_ = [
-            ('Internal', wintypes.ULONG),
-            ('InternalHigh', wintypes.ULONG),
+            ('Internal', ULONG_PTR),
+            ('InternalHigh', ULONG_PTR),
             ('Offset', wintypes.DWORD),
             ('OffsetHigh', wintypes.DWORD),
             ('hEvent', wintypes.HANDLE)
@@ -57,6 +58,21 @@ if sys.platform == 'win32':
     kernel32.WriteFileEx.argtypes = [
         wintypes.HANDLE, wintypes.LPCVOID, wintypes.DWORD,
         LPOVERLAPPED, LPOVERLAPPED_COMPLETION_ROUTINE]
+    kernel32.ReadFile.argtypes = [
+        wintypes.HANDLE, wintypes.LPVOID, wintypes.DWORD,
+        wintypes.LPDWORD, LPOVERLAPPED]
+    kernel32.WriteFile.argtypes = [
+        wintypes.HANDLE, wintypes.LPCVOID, wintypes.DWORD,
+        wintypes.LPDWORD, LPOVERLAPPED]
+
+    kernel32.CreateIoCompletionPort.argtypes = [
+        wintypes.HANDLE, wintypes.HANDLE, ULONG_PTR, wintypes.DWORD]
+    kernel32.CreateIoCompletionPort.restype = wintypes.HANDLE
+    kernel32.GetQueuedCompletionStatus.argtypes = [
+        wintypes.HANDLE, wintypes.LPDWORD, ctypes.POINTER(ULONG_PTR),
+        ctypes.POINTER(LPOVERLAPPED), wintypes.DWORD]
+    kernel32.PostQueuedCompletionStatus.argtypes = [
+        wintypes.HANDLE, wintypes.DWORD, ULONG_PTR, LPOVERLAPPED]
 
 
 FILE_FLAG_OVERLAPPED = 0x40000000
@@ -73,8 +89,11 @@ FORMAT_MESSAGE_IGNORE_INSERTS = 0x00000200
 INVALID_HANDLE_VALUE = -1
 WAIT_FAILED = 0xFFFFFFFF
 WAIT_FINISHED = 0
+ERROR_BROKEN_PIPE = 109
 ERROR_PIPE_BUSY = 231
 ERROR_PIPE_NOT_CONNECTED = 233
+ERROR_OPERATION_ABORTED = 995
+ERROR_IO_PENDING = 997
 ERROR_NOT_FOUND = 1168
 
 WAIT_PIPE_DEFAULT_TIMEOUT = 5  # seconds
@@ -82,7 +101,6 @@ WAIT_IO_COMPLETION_TIMEOUT = 2 * units.k
 WAIT_INFINITE_TIMEOUT = 0xFFFFFFFF
 
 IO_QUEUE_TIMEOUT = 2
-IO_QUEUE_BURST_TIMEOUT = 0.05
 
 
 class HyperVIOError(vmutils.HyperVException):
@@ -226,53 +244,341 @@ class IOUtils(object):
                                    completion_routine)
         self._wait_io_completion(overlapped_structure.hEvent)
 
+    def create_io_completion_port(self, handle=INVALID_HANDLE_VALUE,
+                                  port=None, key=0):
+        """Creates a completion port or associates a handle with one."""
+        return self._run_and_check_output(kernel32.CreateIoCompletionPort,
+                                          handle, port, key, 0,
+                                          error_codes=[None])
+
+    def get_queued_completion_status(self, port,
+                                     timeout=WAIT_INFINITE_TIMEOUT):
+        """Dequeues an I/O completion packet from the completion port.
+
+        Returns the number of bytes transferred, the completion key,
+        the address of the overlapped structure used by the completed
+        operation and the operation error code, if it failed.
+        """
+        num_bytes = wintypes.DWORD()
+        key = ULONG_PTR()
+        overlapped = LPOVERLAPPED()
+
+        ret_val = kernel32.GetQueuedCompletionStatus(
+            port, ctypes.byref(num_bytes), ctypes.byref(key),
+            ctypes.byref(overlapped), timeout)
+
+        error_code = None
+        if not ret_val:
+            if not overlapped:
+                # No completion packet has been dequeued.
+                self.handle_last_error(
+                    func_name='GetQueuedCompletionStatus')
+            error_code = kernel32.GetLastError()
+            kernel32.SetLastError(0)
+
+        overlapped_address = (ctypes.addressof(overlapped.contents)
+                              if overlapped else None)
+        return num_bytes.value, key.value, overlapped_address, error_code
+
+    def post_queued_completion_status(self, port, key=0):
+        self._run_and_check_output(kernel32.PostQueuedCompletionStatus,
+                                   port, 0, key, None)
+
+    def read_file(self, handle, buff, num_bytes, overlapped_structure):
+        """Starts an asynchronous read on a completion port bound handle.
+
+        The operation completion will be signaled through the completion
+        port, even if the operation completes synchronously.
+        """
+        self._run_and_check_output(kernel32.ReadFile,
+                                   handle, buff, num_bytes, None,
+                                   ctypes.byref(overlapped_structure),
+                                   ignored_error_codes=[ERROR_IO_PENDING])
+
+    def write_file(self, handle, buff, num_bytes, overlapped_structure):
+        self._run_and_check_output(kernel32.WriteFile,
+                                   handle, buff, num_bytes, None,
+                                   ctypes.byref(overlapped_structure),
+                                   ignored_error_codes=[ERROR_IO_PENDING])
+
+    def get_address(self, structure):
+        return ctypes.addressof(structure)
+
     def get_buffer(self, buff_size):
         return (ctypes.c_ubyte * buff_size)()
 
     def get_buffer_data(self, buff, num_bytes):
-        data = "".join([struct.pack('B', b)
-                        for b in buff[:num_bytes]])
-        return data
+        return ctypes.string_at(ctypes.addressof(buff), num_bytes)
+
+    def get_buffer_view(self, buff, num_bytes):
+        """Returns a view of the buffer content, without copying it."""
+        return memoryview(buff)[:num_bytes]
 
     def write_buffer_data(self, buff, data):
-        for i, c in enumerate(data):
-            buff[i] = struct.unpack('B', c)[0]
-
-
-class IOQueue(Queue.Queue):
-    def __init__(self, client_connected):
-        Queue.Queue.__init__(self)
-        self._client_connected = client_connected
-
-    def get(self, timeout=IO_QUEUE_TIMEOUT, continue_on_timeout=True):
-        while self._client_connected.isSet():
-            try:
-                return Queue.Queue.get(self, timeout=timeout)
-            except Queue.Empty:
-                if continue_on_timeout:
-                    continue
+        ctypes.memmove(buff, data, len(data))
+
+    def write_buffer_views(self, buff, views):
+        """Copies the data referenced by the given views to the buffer.
+
+        Returns the number of bytes copied.
+        """
+        buff_view = memoryview(buff)
+        offset = 0
+        for view in views:
+            buff_view[offset:offset + len(view)] = view
+            offset += len(view)
+        return offset
+
+
+class RingBuffer(object):
+    """Bounded byte ring buffer, shared by one writer and multiple readers.
+
+    Written data is copied into a preallocated bytearray, each reader
+    keeping its own position within the written data stream. This way, the
+    same data can be consumed by multiple readers without being queued for
+    each of them. Readers may either get a copy of the data or views of the
+    buffer region holding it, which are released by advancing the reader
+    position.
+
+    If overwrite is set, writes never block, readers falling behind by
+    more than the buffer size skipping ahead. The skipped bytes are
+    accounted for by each reader. Otherwise, writes block until the
+    slowest reader frees enough space.
+    """
+
+    def __init__(self, size=constants.SERIAL_CONSOLE_RING_BUFFER_SIZE,
+                 overwrite=True):
+        self._size = size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._overwrite = overwrite
+
+        # Total number of bytes written to the buffer.
+        self._write_pos = 0
+        # The maximum amount of data not yet consumed by all the readers.
+        self._high_water_mark = 0
+        self._readers = []
+        self._closed = False
+        # The lock is not reentrant, being cheaper to acquire. Waiting
+        # readers and writers are counted so that they are notified only
+        # if needed.
+        self._cond = threading.Condition(threading.Lock())
+        self._waiters = 0
+
+    @property
+    def write_pos(self):
+        return self._write_pos
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def high_water_mark(self):
+        return self._high_water_mark
+
+    def get_reader(self, callback=None):
+        """Returns a reader, starting at the current write position.
+
+        The optional callback is invoked each time new data is written,
+        outside the buffer lock.
+        """
+        with self._cond:
+            reader = RingBufferReader(self, self._write_pos, callback)
+            self._readers.append(reader)
+            return reader
+
+    def remove_reader(self, reader):
+        with self._cond:
+            if reader in self._readers:
+                self._readers.remove(reader)
+            # Writers may be waiting for this reader.
+            self._notify_waiters()
+
+    def close(self):
+        """Wakes up pending readers and writers."""
+        with self._cond:
+            self._closed = True
+            self._notify_waiters()
+
+    def write(self, data, timeout=None):
+        """Copies the data to the buffer.
+
+        Any object supporting the buffer interface may be passed,
+        including memoryview objects. Returns the number of bytes
+        written, which may be less than requested if the buffer gets
+        closed or if the timeout is reached while waiting for free space.
+        """
+        view = memoryview(data)
+        written = 0
+        with self._cond:
+            while len(view) and not self._closed:
+                if self._overwrite:
+                    if len(view) > self._size:
+                        # Only the trailing data fits in the buffer.
+                        self._write_pos += len(view) - self._size
+                        written += len(view) - self._size
+                        view = view[-self._size:]
+                    num_bytes = len(view)
+                    self._skip_slow_readers(self._write_pos + num_bytes)
+                else:
+                    free_space = self._size - self._get_used_space()
+                    if not free_space:
+                        self._wait(timeout)
+                        free_space = self._size - self._get_used_space()
+                        if not free_space and timeout is not None:
+                            break
+                        continue
+                    num_bytes = min(free_space, len(view))
+
+                if num_bytes < len(view):
+                    self._put_data(view[:num_bytes])
+                    view = view[num_bytes:]
                 else:
-                    break
-
-    def put(self, item, timeout=IO_QUEUE_TIMEOUT):
-        while self._client_connected.isSet():
-            try:
-                return Queue.Queue.put(self, item, timeout=timeout)
-            except Queue.Full:
-                continue
-
-    def get_burst(self, timeout=IO_QUEUE_TIMEOUT,
-                  burst_timeout=IO_QUEUE_BURST_TIMEOUT,
-                  max_size=constants.SERIAL_CONSOLE_BUFFER_SIZE):
-        # Get as much data as possible from the queue
-        # to avoid sending small chunks.
-        data = self.get(timeout=timeout)
-
-        while data and not (len(data) > max_size):
-            chunk = self.get(timeout=burst_timeout,
-                             continue_on_timeout=False)
-            if chunk:
-                data += chunk
-            else:
-                break
-        return data
+                    self._put_data(view)
+                    view = view[:0]
+                self._write_pos += num_bytes
+                written += num_bytes
+                self._high_water_mark = max(self._high_water_mark,
+                                            self._get_used_space())
+                self._notify_waiters()
+
+            callbacks = [reader.callback for reader in self._readers
+                         if reader.callback]
+
+        if written:
+            for callback in callbacks:
+                callback()
+        return written
+
+    def _wait_for_data(self, reader, size=None, timeout=None):
+        # Must be called while holding the lock. Returns the number of
+        # bytes which can be read.
+        if reader.pos == self._write_pos and not self._closed:
+            self._wait(timeout)
+
+        num_bytes = self._write_pos - reader.pos
+        if size is not None:
+            num_bytes = min(num_bytes, size)
+        return num_bytes
+
+    def _read(self, reader, size=None, timeout=None):
+        with self._cond:
+            num_bytes = self._wait_for_data(reader, size, timeout)
+            if not num_bytes:
+                return b''
+
+            # The data is copied, the buffer region being reusable by the
+            # writer once the reader position is advanced.
+            data = b''.join([view.tobytes() for view in
+                             self._get_views(reader.pos, num_bytes)])
+            reader.pos += num_bytes
+            # Writers may be waiting for free space.
+            self._notify_waiters()
+            return data
+
+    def _get_reader_views(self, reader, size=None, timeout=None):
+        with self._cond:
+            num_bytes = self._wait_for_data(reader, size, timeout)
+            reader.views_pos = reader.pos
+            if not num_bytes:
+                return []
+            return self._get_views(reader.pos, num_bytes)
+
+    def _consume(self, reader, num_bytes):
+        with self._cond:
+            # The reader may have been skipped ahead while using the views.
+            reader.pos = max(reader.pos, reader.views_pos + num_bytes)
+            # Writers may be waiting for free space.
+            self._notify_waiters()
+
+    def _get_available(self, reader):
+        with self._cond:
+            return self._write_pos - reader.pos
+
+    def _wait(self, timeout):
+        # Must be called while holding the lock.
+        self._waiters += 1
+        try:
+            self._cond.wait(timeout)
+        finally:
+            self._waiters -= 1
+
+    def _notify_waiters(self):
+        # Must be called while holding the lock.
+        if self._waiters:
+            self._cond.notify_all()
+
+    def _get_used_space(self):
+        if not self._readers:
+            return 0
+        return self._write_pos - min([reader.pos for reader in self._readers])
+
+    def _skip_slow_readers(self, end_pos):
+        min_pos = end_pos - self._size
+        for reader in self._readers:
+            if reader.pos < min_pos:
+                reader.skipped_bytes += min_pos - reader.pos
+                reader.pos = min_pos
+
+    def _put_data(self, view):
+        start = self._write_pos % self._size
+        first_part_size = min(len(view), self._size - start)
+        self._buffer[start:start + first_part_size] = view[:first_part_size]
+        if first_part_size < len(view):
+            self._buffer[:len(view) - first_part_size] = (
+                view[first_part_size:])
+
+    def _get_views(self, pos, num_bytes):
+        start = pos % self._size
+        end = start + num_bytes
+        if end <= self._size:
+            return [self._view[start:end]]
+        # The requested data wraps around the end of the buffer.
+        return [self._view[start:], self._view[:end - self._size]]
+
+
+class RingBufferReader(object):
+    def __init__(self, ring_buffer, pos, callback=None):
+        self._ring_buffer = ring_buffer
+        self.pos = pos
+        # The position at which the last views were taken.
+        self.views_pos = pos
+        self.callback = callback
+        self.skipped_bytes = 0
+
+    @property
+    def available(self):
+        """The number of bytes which can be read without waiting."""
+        return self._ring_buffer._get_available(self)
+
+    def read(self, size=None, timeout=None):
+        """Returns a copy of the available data, up to the requested size.
+
+        If no data is available, this waits for new data to be written,
+        returning an empty string if none is available when the timeout
+        is reached or if the buffer gets closed.
+        """
+        return self._ring_buffer._read(self, size, timeout)
+
+    def get_views(self, size=None, timeout=None):
+        """Returns views of the available data, up to the requested size.
+
+        The data is not copied. One memoryview is returned, or two of them
+        if the data wraps around the end of the buffer. The reader position
+        is not advanced until consume is called, the buffer region being
+        kept until then. Note that if overwrite is set, the region may
+        still be overwritten if this reader falls behind by more than the
+        buffer size meanwhile, in which case it is skipped ahead as usual.
+
+        Waits for new data the same way read does, returning an empty list
+        if none is available.
+        """
+        return self._ring_buffer._get_reader_views(self, size, timeout)
+
+    def consume(self, num_bytes):
+        """Advances the reader past data obtained through get_views."""
+        self._ring_buffer._consume(self, num_bytes)
+
+    def close(self):
+        self._ring_buffer.remove_reader(self)
@@ -0,0 +1,361 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In process ISO 9660 image writer, used for building config drives.
+
+The images contain a Joliet directory tree holding the original file names,
+along with the primary ISO 9660 tree, using uppercase level 2 names.
+"""
+import re
+import struct
+import time
+
+from hyperv.i18n import _
+from hyperv.nova import vmutils
+
+SECTOR_SIZE = 2048
+
+_SYSTEM_AREA_SECTORS = 16
+_ISO_STANDARD_ID = b'CD001'
+_JOLIET_ESCAPE_SEQUENCE = b'%/E'
+_JOLIET_MAX_NAME_LENGTH = 64
+_ISO_MAX_NAME_LENGTH = 30
+_ISO_MAX_EXT_LENGTH = 8
+
+_VD_TYPE_PRIMARY = 1
+_VD_TYPE_SUPPLEMENTARY = 2
+_VD_TYPE_TERMINATOR = 255
+
+_FILE_FLAG_DIRECTORY = 2
+
+_TREE_ISO = 'iso'
+_TREE_JOLIET = 'joliet'
+
+_ROOT_IDENTIFIER = b'\x00'
+_PARENT_IDENTIFIER = b'\x01'
+
+
+def _both_endian_16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both_endian_32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _get_sector_count(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def _pad(data, size, fill=b' '):
+    return data[:size] + fill * (size - len(data))
+
+
+def _pad_sectors(data):
+    return _pad(data, _get_sector_count(len(data)) * SECTOR_SIZE, b'\x00')
+
+
+def _get_record_length(identifier):
+    # Records are padded to an even length.
+    length = 33 + len(identifier)
+    return length + length % 2
+
+
+def _get_dir_size(record_lengths):
+    # Directory records may not span sector boundaries.
+    size = 0
+    for record_length in record_lengths:
+        if size % SECTOR_SIZE + record_length > SECTOR_SIZE:
+            size = _get_sector_count(size) * SECTOR_SIZE
+        size += record_length
+    return _get_sector_count(size) * SECTOR_SIZE
+
+
+class _File(object):
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.identifiers = {}
+        self.extent = 0
+
+
+class _Directory(object):
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent or self
+        self.children = {}
+        self.identifiers = {}
+        self.extents = {}
+        self.sizes = {}
+
+
+class ISOWriter(object):
+    """Builds ISO 9660 images containing in memory files."""
+
+    def __init__(self, volume_id, publisher=''):
+        self._volume_id = volume_id
+        self._publisher = publisher
+        self._root = _Directory(None)
+        self._root.identifiers = {_TREE_ISO: _ROOT_IDENTIFIER,
+                                  _TREE_JOLIET: _ROOT_IDENTIFIER}
+
+    def add_file(self, path, data):
+        """Adds a file, creating the parent directories if needed.
+
+        :param path: '/' separated path, relative to the image root.
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        names = [name for name in path.split('/') if name]
+        directory = self._root
+        for name in names[:-1]:
+            directory = directory.children.setdefault(
+                name, _Directory(name, directory))
+            if not isinstance(directory, _Directory):
+                raise vmutils.HyperVException(
+                    _("Cannot add %(path)s, as %(name)s is a file.") %
+                    {'path': path, 'name': name})
+        directory.children[names[-1]] = _File(names[-1], data)
+
+    def _get_iso_identifier(self, node, used_identifiers):
+        name = node.name.upper()
+        if isinstance(node, _Directory):
+            base, ext = name, None
+        else:
+            base, sep, ext = name.rpartition('.')
+            if not sep:
+                base, ext = ext, ''
+            ext = re.sub('[^A-Z0-9_]', '_', ext)[:_ISO_MAX_EXT_LENGTH]
+        base = re.sub('[^A-Z0-9_]', '_', base) or '_'
+        base = base[:_ISO_MAX_NAME_LENGTH - len(ext or '') - 1]
+
+        idx = 0
+        unique_base = base
+        while True:
+            if ext is None:
+                identifier = unique_base
+            else:
+                identifier = '%s.%s;1' % (unique_base, ext)
+            if identifier not in used_identifiers:
+                used_identifiers.add(identifier)
+                return identifier.encode('ascii')
+            idx += 1
+            suffix = str(idx)
+            unique_base = base[:len(base) - len(suffix)] + suffix
+
+    def _assign_identifiers(self, directory):
+        used_identifiers = set()
+        for name in sorted(directory.children):
+            if len(name) > _JOLIET_MAX_NAME_LENGTH:
+                raise vmutils.HyperVException(
+                    _("File name too long: %s") % name)
+
+            child = directory.children[name]
+            child.identifiers[_TREE_ISO] = self._get_iso_identifier(
+                child, used_identifiers)
+            child.identifiers[_TREE_JOLIET] = name.encode('utf-16-be')
+            if isinstance(child, _Directory):
+                self._assign_identifiers(child)
+
+    def _get_children(self, directory, tree):
+        return sorted(directory.children.values(),
+                      key=lambda child: child.identifiers[tree])
+
+    def _get_dirs(self, tree):
+        """Returns the directories, in path table order."""
+        dirs = [self._root]
+        for directory in dirs:
+            dirs.extend(child for child in self._get_children(directory, tree)
+                        if isinstance(child, _Directory))
+        return dirs
+
+    def _get_files(self, directory):
+        files = []
+        for child in self._get_children(directory, _TREE_ISO):
+            if isinstance(child, _Directory):
+                files += self._get_files(child)
+            else:
+                files.append(child)
+        return files
+
+    def _get_path_table(self, dirs, tree, byte_order):
+        dir_numbers = dict((id(directory), idx + 1)
+                           for idx, directory in enumerate(dirs))
+        path_table = []
+        for directory in dirs:
+            identifier = directory.identifiers[tree]
+            path_table.append(
+                struct.pack(byte_order + 'BBIH', len(identifier), 0,
+                            directory.extents[tree],
+                            dir_numbers[id(directory.parent)]) +
+                identifier + b'\x00' * (len(identifier) % 2))
+        return b''.join(path_table)
+
+    def _get_dir_record(self, identifier, extent, size, is_dir,
+                        record_time):
+        flags = _FILE_FLAG_DIRECTORY if is_dir else 0
+        record = (struct.pack('BB', _get_record_length(identifier), 0) +
+                  _both_endian_32(extent) +
+                  _both_endian_32(size) +
+                  record_time +
+                  struct.pack('BBB', flags, 0, 0) +
+                  _both_endian_16(1) +
+                  struct.pack('B', len(identifier)) +
+                  identifier)
+        return _pad(record, _get_record_length(identifier), b'\x00')
+
+    def _get_dir_records(self, directory, tree, record_time):
+        records = [
+            self._get_dir_record(_ROOT_IDENTIFIER, directory.extents[tree],
+                                 directory.sizes[tree], True, record_time),
+            self._get_dir_record(_PARENT_IDENTIFIER,
+                                 directory.parent.extents[tree],
+                                 directory.parent.sizes[tree], True,
+                                 record_time)]
+        for child in self._get_children(directory, tree):
+            if isinstance(child, _Directory):
+                records.append(self._get_dir_record(
+                    child.identifiers[tree], child.extents[tree],
+                    child.sizes[tree], True, record_time))
+            else:
+                records.append(self._get_dir_record(
+                    child.identifiers[tree], child.extent, len(child.data),
+                    False, record_time))
+
+        data = b''
+        for record in records:
+            if len(data) % SECTOR_SIZE + len(record) > SECTOR_SIZE:
+                data = _pad_sectors(data)
+            data += record
+        return _pad(data, directory.sizes[tree], b'\x00')
+
+    def _get_volume_descriptor(self, tree, volume_size, path_table_size,
+                               path_table_extents, volume_time, record_time):
+        if tree == _TREE_JOLIET:
+            vd_type = _VD_TYPE_SUPPLEMENTARY
+            escape_sequences = _JOLIET_ESCAPE_SEQUENCE
+
+            def encode(value, size):
+                return _pad(value.encode('utf-16-be'), size,
+                            ' '.encode('utf-16-be'))[:size]
+        else:
+            vd_type = _VD_TYPE_PRIMARY
+            escape_sequences = b''
+
+            def encode(value, size):
+                return _pad(value.encode('ascii'), size)
+
+        root_record = self._get_dir_record(
+            _ROOT_IDENTIFIER, self._root.extents[tree],
+            self._root.sizes[tree], True, record_time)
+        unset_time = b'0' * 16 + b'\x00'
+
+        descriptor = b''.join([
+            struct.pack('B', vd_type), _ISO_STANDARD_ID, b'\x01', b'\x00',
+            encode('', 32),
+            encode(self._volume_id, 32),
+            b'\x00' * 8,
+            _both_endian_32(volume_size),
+            _pad(escape_sequences, 32, b'\x00'),
+            _both_endian_16(1),
+            _both_endian_16(1),
+            _both_endian_16(SECTOR_SIZE),
+            _both_endian_32(path_table_size),
+            struct.pack('<II', path_table_extents[0], 0),
+            struct.pack('>II', path_table_extents[1], 0),
+            root_record,
+            encode('', 128),
+            encode(self._publisher, 128),
+            encode('', 128),
+            encode('', 128),
+            encode('', 37),
+            encode('', 37),
+            encode('', 37),
+            volume_time, volume_time, unset_time, unset_time,
+            b'\x01', b'\x00'])
+        return _pad(descriptor, SECTOR_SIZE, b'\x00')
+
+    def _get_terminator(self):
+        return _pad(struct.pack('B', _VD_TYPE_TERMINATOR) +
+                    _ISO_STANDARD_ID + b'\x01', SECTOR_SIZE, b'\x00')
+
+    def write(self, path):
+        """Writes the image to the given path."""
+        self._assign_identifiers(self._root)
+        trees = [_TREE_ISO, _TREE_JOLIET]
+        tree_dirs = dict((tree, self._get_dirs(tree)) for tree in trees)
+        files = self._get_files(self._root)
+
+        # The volume descriptors are followed by the path tables, the
+        # directories of both trees and the file data, shared by the trees.
+        for tree in trees:
+            for directory in tree_dirs[tree]:
+                directory.sizes[tree] = _get_dir_size(
+                    [_get_record_length(_ROOT_IDENTIFIER)] * 2 +
+                    [_get_record_length(child.identifiers[tree])
+                     for child in self._get_children(directory, tree)])
+
+        path_table_sizes = dict(
+            (tree, sum(8 + len(identifier) + len(identifier) % 2
+                       for identifier in [directory.identifiers[tree]
+                                          for directory in tree_dirs[tree]]))
+            for tree in trees)
+
+        extent = _SYSTEM_AREA_SECTORS + 3
+        path_table_extents = {}
+        for tree in trees:
+            path_table_extents[tree] = (
+                extent, extent + _get_sector_count(path_table_sizes[tree]))
+            extent += 2 * _get_sector_count(path_table_sizes[tree])
+
+        for tree in trees:
+            for directory in tree_dirs[tree]:
+                directory.extents[tree] = extent
+                extent += directory.sizes[tree] // SECTOR_SIZE
+
+        for file_ in files:
+            file_.extent = extent
+            extent += _get_sector_count(len(file_.data))
+        volume_size = extent
+
+        now = time.gmtime()
+        volume_time = time.strftime('%Y%m%d%H%M%S00', now).encode(
+            'ascii') + b'\x00'
+        record_time = struct.pack('7B', now.tm_year - 1900, now.tm_mon,
+                                  now.tm_mday, now.tm_hour, now.tm_min,
+                                  now.tm_sec, 0)
+
+        with open(path, 'wb') as f:
+            f.write(b'\x00' * SECTOR_SIZE * _SYSTEM_AREA_SECTORS)
+            for tree in trees:
+                f.write(self._get_volume_descriptor(
+                    tree, volume_size, path_table_sizes[tree],
+                    path_table_extents[tree], volume_time, record_time))
+            f.write(self._get_terminator())
+
+            for tree in trees:
+                for byte_order in ['<', '>']:
+                    f.write(_pad_sectors(self._get_path_table(
+                        tree_dirs[tree], tree, byte_order)))
+
+            for tree in trees:
+                for directory in tree_dirs[tree]:
+                    f.write(self._get_dir_records(directory, tree,
+                                                  record_time))
+
+            for file_ in files:
+                f.write(_pad_sectors(file_.data))
@@ -54,6 +54,7 @@ class LiveMigrationOps(object):
             self._livemigrutils = None
 
         self._pathutils = utilsfactory.get_pathutils()
+        self._vmutils = utilsfactory.get_vmutils()
         self._vmops = vmops.VMOps()
         self._volumeops = volumeops.VolumeOps()
         self._serial_console_ops = serialconsoleops.SerialConsoleOps()
@@ -76,6 +77,8 @@ class LiveMigrationOps(object):
             self._pathutils.copy_vm_console_logs(instance_name, dest)
             self._livemigrutils.live_migrate_vm(instance_name,
                                                 dest)
+            # The controller slots will be tracked by the destination host.
+            self._vmutils.forget_controller_slots(instance_name)
         except Exception:
             with excutils.save_and_reraise_exception():
                 LOG.debug("Calling live migration recover_method "
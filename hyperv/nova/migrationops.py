@@ -27,6 +27,7 @@ from oslo_utils import units
 from hyperv.i18n import _, _LE
 from hyperv.nova import imagecache
 from hyperv.nova import utilsfactory
+from hyperv.nova import vhdreader
 from hyperv.nova import vmops
 from hyperv.nova import vmutils
 from hyperv.nova import volumeops
@@ -186,35 +187,27 @@ class MigrationOps(object):
             self._vmops.power_on(instance, network_info=network_info)
 
     def _merge_base_vhd(self, diff_vhd_path, base_vhd_path):
-        base_vhd_copy_path = os.path.join(os.path.dirname(diff_vhd_path),
-                                          os.path.basename(base_vhd_path))
+        merged_vhd_path = os.path.join(os.path.dirname(diff_vhd_path),
+                                       os.path.basename(base_vhd_path))
         try:
-            LOG.debug('Copying base disk %(base_vhd_path)s to '
-                      '%(base_vhd_copy_path)s',
+            # The chain is flattened by reading the disks directly, which
+            # avoids copying the base disk before merging the diff VHD.
+            LOG.debug("Merging base disk %(base_vhd_path)s and "
+                      "diff disk %(diff_vhd_path)s into %(merged_vhd_path)s",
                       {'base_vhd_path': base_vhd_path,
-                       'base_vhd_copy_path': base_vhd_copy_path})
-            self._pathutils.copyfile(base_vhd_path, base_vhd_copy_path)
-
-            LOG.debug("Reconnecting copied base VHD "
-                      "%(base_vhd_copy_path)s and diff "
-                      "VHD %(diff_vhd_path)s",
-                      {'base_vhd_copy_path': base_vhd_copy_path,
-                       'diff_vhd_path': diff_vhd_path})
-            self._vhdutils.reconnect_parent_vhd(diff_vhd_path,
-                                                base_vhd_copy_path)
-
-            LOG.debug("Merging base disk %(base_vhd_copy_path)s and "
-                      "diff disk %(diff_vhd_path)s",
-                      {'base_vhd_copy_path': base_vhd_copy_path,
-                       'diff_vhd_path': diff_vhd_path})
-            self._vhdutils.merge_vhd(diff_vhd_path, base_vhd_copy_path)
+                       'diff_vhd_path': diff_vhd_path,
+                       'merged_vhd_path': merged_vhd_path})
+            with vhdreader.VHDChainReader(
+                    diff_vhd_path, parent_path=base_vhd_path) as vhd_chain:
+                vhd_chain.export_dynamic_vhd(merged_vhd_path)
 
             # Replace the differential VHD with the merged one
-            self._pathutils.rename(base_vhd_copy_path, diff_vhd_path)
+            self._pathutils.remove(diff_vhd_path)
+            self._pathutils.rename(merged_vhd_path, diff_vhd_path)
         except Exception:
             with excutils.save_and_reraise_exception():
-                if self._pathutils.exists(base_vhd_copy_path):
-                    self._pathutils.remove(base_vhd_copy_path)
+                if self._pathutils.exists(merged_vhd_path):
+                    self._pathutils.remove(merged_vhd_path)
 
     def _check_resize_vhd(self, vhd_path, vhd_info, new_size):
         curr_size = vhd_info['MaxInternalSize']
@@ -13,60 +13,53 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import errno
-import os
-
 from eventlet import patcher
 from nova.i18n import _, _LE  # noqa
 from oslo_log import log as logging
 
 from hyperv.nova import constants
+from hyperv.nova import ioreactor
 from hyperv.nova import ioutils
 from hyperv.nova import vmutils
 
 threading = patcher.original('threading')
-time = patcher.original('time')
 
 LOG = logging.getLogger(__name__)
 
 
 class NamedPipeHandler(object):
-    """Handles asyncronous I/O operations on a specified named pipe."""
+    """Handles asyncronous I/O operations on a specified named pipe.
 
-    _MAX_LOG_ROTATE_RETRIES = 5
+    The I/O operations are serviced by the reactor shared by all the
+    serial console handlers, no threads being used per pipe.
+    """
 
-    def __init__(self, pipe_name, input_queue=None, output_queue=None,
-                 connect_event=None, log_file=None):
+    def __init__(self, pipe_name, input_buffer=None, output_buffer=None,
+                 log_writer=None):
         self._pipe_name = pipe_name
-        self._input_queue = input_queue
-        self._output_queue = output_queue
-        self._log_file_path = log_file
+        self._input_buffer = input_buffer
+        self._output_buffer = output_buffer
+        self._log_writer = log_writer
 
-        self._connect_event = connect_event
         self._stopped = threading.Event()
-        self._workers = []
+        self._write_lock = threading.Lock()
         self._pipe_handle = None
+        self._input_reader = None
+        self._write_pending = False
+        self._stats = dict(bytes_read=0, bytes_written=0, io_errors=0)
 
         self._ioutils = ioutils.IOUtils()
+        self._reactor = ioreactor.get_reactor()
 
         self._setup_io_structures()
 
     def start(self):
         try:
             self._open_pipe()
-
-            if self._log_file_path:
-                self._log_file_handle = open(self._log_file_path, 'ab', 1)
-
-            jobs = [self._read_from_pipe]
-            if (self._input_queue and self._connect_event):
-                jobs.append(self._write_to_pipe)
-
-            for job in jobs:
-                worker = threading.Thread(target=job)
-                worker.setDaemon(True)
-                worker.start()
-                self._workers.append(worker)
+            self._read_from_pipe()
+            if self._input_buffer:
+                self._input_reader = self._input_buffer.get_reader(
+                    callback=self._write_to_pipe)
         except Exception as err:
             msg = (_("Named pipe handler failed to initialize. "
                      "Pipe Name: %(pipe_name)s "
@@ -79,17 +72,39 @@ class NamedPipeHandler(object):
 
     def stop(self):
         self._stopped.set()
-        self._cancel_io()
 
-        for worker in self._workers:
-            worker_running = (worker.is_alive() and
-                              worker is not threading.current_thread())
-            if worker_running:
-                worker.join()
+        if self._input_reader:
+            self._input_reader.close()
 
         self._close_pipe()
-        if self._log_file_handle:
-            self._log_file_handle.close()
+
+    def get_stats(self):
+        """Returns the pipe byte counters and the I/O error count."""
+        return dict(self._stats)
+
+    def attach_buffers(self, input_buffer, output_buffer):
+        """Starts passing the pipe I/O through the given buffers.
+
+        This allows enabling interactive sessions without reopening the
+        pipe, which would cause guest output to be lost.
+        """
+        with self._write_lock:
+            self._input_buffer = input_buffer
+            self._output_buffer = output_buffer
+            if self._pipe_handle:
+                self._input_reader = input_buffer.get_reader(
+                    callback=self._write_to_pipe)
+
+    def detach_buffers(self):
+        with self._write_lock:
+            input_reader = self._input_reader
+
+            self._input_reader = None
+            self._input_buffer = None
+            self._output_buffer = None
+
+        if input_reader:
+            input_reader.close()
 
     def _setup_io_structures(self):
         self._r_buffer = self._ioutils.get_buffer(
@@ -97,125 +112,85 @@ class NamedPipeHandler(object):
         self._w_buffer = self._ioutils.get_buffer(
             constants.SERIAL_CONSOLE_BUFFER_SIZE)
 
-        self._r_overlapped = self._ioutils.get_new_overlapped_structure()
-        self._w_overlapped = self._ioutils.get_new_overlapped_structure()
-
-        self._r_completion_routine = self._ioutils.get_completion_routine(
-            self._read_callback)
-        self._w_completion_routine = self._ioutils.get_completion_routine()
-
-        self._log_file_handle = None
-
     def _open_pipe(self):
-        """Opens a named pipe in overlapped mode for asyncronous I/O."""
-        self._ioutils.wait_named_pipe(self._pipe_name)
-
-        self._pipe_handle = self._ioutils.open(
-            self._pipe_name,
-            desired_access=(ioutils.GENERIC_READ | ioutils.GENERIC_WRITE),
-            share_mode=(ioutils.FILE_SHARE_READ | ioutils.FILE_SHARE_WRITE),
-            creation_disposition=ioutils.OPEN_EXISTING,
-            flags_and_attributes=ioutils.FILE_FLAG_OVERLAPPED)
+        self._pipe_handle = self._reactor.open_pipe(self._pipe_name)
 
     def _close_pipe(self):
         if self._pipe_handle:
-            self._ioutils.close_handle(self._pipe_handle)
+            # Pending operations are cancelled.
+            self._reactor.close_pipe(self._pipe_handle)
             self._pipe_handle = None
 
-    def _cancel_io(self):
-        if self._pipe_handle:
-            self._ioutils.set_event(self._r_overlapped.hEvent)
-            self._ioutils.set_event(self._w_overlapped.hEvent)
-            self._ioutils.cancel_io(self._pipe_handle)
-
     def _read_from_pipe(self):
-        self._start_io_worker(self._ioutils.read,
-                              self._r_buffer,
-                              self._r_overlapped,
-                              self._r_completion_routine)
+        if self._stopped.isSet():
+            return
+        self._reactor.read_pipe(self._pipe_handle, self._r_buffer,
+                                self._read_callback)
 
-    def _write_to_pipe(self):
-        self._start_io_worker(self._ioutils.write,
-                              self._w_buffer,
-                              self._w_overlapped,
-                              self._w_completion_routine,
-                              self._get_data_to_write)
-
-    def _start_io_worker(self, func, buff, overlapped_structure,
-                         completion_routine, buff_update_func=None):
-        try:
-            while not self._stopped.isSet():
-                if buff_update_func:
-                    num_bytes = buff_update_func()
-                    if not num_bytes:
-                        continue
-                else:
-                    num_bytes = len(buff)
-
-                func(self._pipe_handle, buff, num_bytes,
-                     overlapped_structure, completion_routine)
-        except Exception:
-            self._stopped.set()
+    def _read_callback(self, num_bytes, error_code=None):
+        if self._stopped.isSet():
+            return
+        if error_code:
+            self._handle_io_error(error_code)
+            return
 
-    def _read_callback(self, num_bytes):
-        data = self._ioutils.get_buffer_data(self._r_buffer,
+        # The read buffer is not reused before this callback returns,
+        # so it is passed as a view. The output buffer and the log writer
+        # still copy the data.
+        data = self._ioutils.get_buffer_view(self._r_buffer,
                                              num_bytes)
-        if self._output_queue:
-            self._output_queue.put(data)
+        # A single read is pending at a time, so the callbacks do not
+        # race.
+        self._stats['bytes_read'] += num_bytes
+        # The buffers may be detached meanwhile.
+        output_buffer = self._output_buffer
+        if output_buffer:
+            output_buffer.write(data)
 
-        if self._log_file_handle:
-            self._write_to_log(data)
+        if self._log_writer:
+            self._log_writer.write(data)
 
-    def _get_data_to_write(self):
-        while not (self._stopped.isSet() or self._connect_event.isSet()):
-            time.sleep(1)
+        self._read_from_pipe()
 
-        data = self._input_queue.get()
-        if data:
-            self._ioutils.write_buffer_data(self._w_buffer, data)
-            return len(data)
-        return 0
-
-    def _write_to_log(self, data):
-        if self._stopped.isSet():
-            return
-
-        try:
-            log_size = self._log_file_handle.tell() + len(data)
-            if (log_size >= constants.MAX_CONSOLE_LOG_FILE_SIZE):
-                self._rotate_logs()
-            self._log_file_handle.write(data)
-        except Exception:
+    def _write_to_pipe(self):
+        # Called when new input data is available, as well as when
+        # a write operation completes.
+        with self._write_lock:
+            if (self._write_pending or self._stopped.isSet() or
+                    not self._input_reader):
+                return
+
+            input_reader = self._input_reader
+            views = input_reader.get_views(
+                size=constants.SERIAL_CONSOLE_BUFFER_SIZE, timeout=0)
+            if not views:
+                return
+            self._write_pending = True
+
+        # The input data is copied straight from the input buffer to the
+        # write buffer, being released afterwards.
+        num_bytes = self._ioutils.write_buffer_views(self._w_buffer, views)
+        input_reader.consume(num_bytes)
+        self._reactor.write_pipe(self._pipe_handle, self._w_buffer,
+                                 num_bytes, self._write_callback)
+
+    def _write_callback(self, num_bytes, error_code=None):
+        with self._write_lock:
+            self._write_pending = False
+            if not error_code:
+                self._stats['bytes_written'] += num_bytes
+
+        if error_code:
+            self._handle_io_error(error_code)
+        else:
+            self._write_to_pipe()
+
+    def _handle_io_error(self, error_code):
+        if not self._stopped.isSet():
+            with self._write_lock:
+                self._stats['io_errors'] += 1
+            LOG.debug("Named pipe %(pipe_name)s I/O failed. "
+                      "Error code: %(error_code)s",
+                      {'pipe_name': self._pipe_name,
+                       'error_code': error_code})
             self._stopped.set()
-
-    def _rotate_logs(self):
-        self._log_file_handle.flush()
-        self._log_file_handle.close()
-
-        log_archive_path = self._log_file_path + '.1'
-
-        if os.path.exists(log_archive_path):
-            self._retry_if_file_in_use(os.remove,
-                                       log_archive_path)
-
-        self._retry_if_file_in_use(os.rename,
-                                   self._log_file_path,
-                                   log_archive_path)
-
-        self._log_file_handle = open(
-            self._log_file_path, 'ab', 1)
-
-    def _retry_if_file_in_use(self, f, *args, **kwargs):
-        # The log files might be in use if the console log is requested
-        # while a log rotation is attempted.
-        retry_count = 0
-        while True:
-            try:
-                return f(*args, **kwargs)
-            except WindowsError as err:
-                if (err.errno == errno.EACCES and
-                        retry_count < self._MAX_LOG_ROTATE_RETRIES):
-                    retry_count += 1
-                    time.sleep(1)
-                else:
-                    raise
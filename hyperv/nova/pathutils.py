@@ -39,6 +39,13 @@ hyperv_opts = [
                     'to copy files to the target host. If left blank, an '
                     'administrative share will be used, looking for the same '
                     '"instances_path" used locally'),
+    cfg.IntOpt('console_log_archive_count',
+               default=5,
+               min=0,
+               help='The number of gzip compressed console log archives '
+                    'kept for each instance, besides the current log. '
+                    'If set to 0, the console log is truncated when '
+                    'reaching its maximum size.'),
 ]
 
 CONF = cfg.CONF
@@ -234,8 +241,9 @@ class PathUtils(object):
         instance_path = self.get_instance_dir(instance_name)
         return os.path.join(instance_path, 'ephemeral.' + format_ext.lower())
 
-    def get_base_vhd_dir(self):
-        return self._get_instances_sub_dir('_base')
+    def get_base_vhd_dir(self, remote_server=None):
+        return self._get_instances_sub_dir('_base', remote_server,
+                                           create_dir=not remote_server)
 
     def get_export_dir(self, instance_name):
         dir_name = os.path.join('export', instance_name)
@@ -246,7 +254,16 @@ class PathUtils(object):
         instance_dir = self.get_instance_dir(instance_name,
                                              remote_server)
         console_log_path = os.path.join(instance_dir, 'console.log')
-        return console_log_path, console_log_path + '.1'
+        archive_count = CONF.hyperv.console_log_archive_count
+        if not archive_count:
+            return [console_log_path]
+
+        # The current log file, followed by the last rotated log, which
+        # is pending compression, and by the compressed archives,
+        # starting with the newest.
+        return ([console_log_path, console_log_path + '.1'] +
+                ['%s.%d.gz' % (console_log_path, idx)
+                 for idx in range(1, archive_count + 1)])
 
     def copy_vm_console_logs(self, instance_name, dest_host):
         local_log_paths = self.get_vm_console_log_paths(
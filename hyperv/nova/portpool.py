@@ -0,0 +1,239 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Listening socket pool used by the serial proxies.
+"""
+
+import collections
+import errno
+import socket
+import time
+
+from eventlet import patcher
+from nova import exception
+from nova.i18n import _
+from nova import utils
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from hyperv.nova import vmutils
+
+threading = patcher.original('threading')
+
+LOG = logging.getLogger(__name__)
+
+hyperv_opts = [
+    cfg.IntOpt('serial_console_port_pool_size',
+               default=4,
+               help='The number of listening sockets bound in advance '
+                    'for serial proxies. Sockets released by stopped '
+                    'proxies are kept for reuse up to this limit. '
+                    'Released ports are not reused before the console '
+                    'tokens issued for them expire, as defined by the '
+                    'console_token_ttl option.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+CONF.import_opt('port_range', 'nova.console.serial', group='serial_console')
+CONF.import_opt('proxyclient_address', 'nova.console.serial',
+                group='serial_console')
+CONF.import_opt('console_token_ttl', 'nova.consoleauth.manager')
+
+# Errors raised when binding ports used by other sockets. Binding a port
+# used exclusively by another socket fails with WSAEACCES on Windows.
+_PORT_IN_USE_ERRORS = (errno.EADDRINUSE, errno.EACCES,
+                       getattr(errno, 'WSAEACCES', errno.EACCES))
+
+_port_pool = None
+
+
+@utils.synchronized('hyperv-serial-port-pool')
+def get_port_pool():
+    """Returns the port pool shared by all the serial proxies."""
+    global _port_pool
+    if not _port_pool:
+        _port_pool = PortPool(CONF.serial_console.proxyclient_address,
+                              CONF.serial_console.port_range,
+                              CONF.hyperv.serial_console_port_pool_size,
+                              CONF.console_token_ttl)
+    return _port_pool
+
+
+class PortPool(object):
+    """Hands out listening sockets bound to ports from a given range.
+
+    Sockets are bound in advance, so that proxies do not race for ports
+    when many instances start at once, bind failures surfacing when a
+    socket is acquired instead of after the proxy has been started.
+
+    Released ports are quarantined for the given number of seconds, so
+    that clients holding console tokens issued for a stopped proxy cannot
+    reach a different instance. Quarantined sockets are kept listening,
+    being handed out again once the quarantine ends, connections pending
+    on them being dropped beforehand. Ports of released sockets exceeding
+    the pool size are not bound again before the quarantine ends either.
+    """
+
+    def __init__(self, addr, port_range, pool_size, quarantine_time=0):
+        self._addr = addr
+        self._min_port, self._max_port = self._parse_port_range(port_range)
+        self._pool_size = pool_size
+        self._quarantine_time = quarantine_time
+
+        # Idle listening sockets, the least recently released first.
+        self._free_socks = collections.deque()
+        # Released listening sockets along with their quarantine
+        # deadline, the least recently released first.
+        self._quarantined_socks = collections.deque()
+        # Quarantine deadlines of the released ports which are no longer
+        # bound, by port.
+        self._quarantined_ports = {}
+        # Ports bound by this pool, either idle or in use.
+        self._bound_ports = set()
+        # The next port to be checked when binding a new socket.
+        self._next_port = self._min_port
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse_port_range(port_range):
+        try:
+            min_port, max_port = map(int, port_range.split(':'))
+        except (AttributeError, ValueError):
+            min_port, max_port = None, None
+
+        if not (min_port and max_port and
+                0 < min_port <= max_port <= 65535):
+            err_msg = _("Invalid serial console port range: %s. "
+                        "Expected 'min:max', within 1-65535.")
+            raise vmutils.HyperVException(err_msg % port_range)
+        return min_port, max_port
+
+    def fill(self):
+        """Binds listening sockets until the pool is full.
+
+        This is best effort, the pool being refilled as sockets are
+        acquired.
+        """
+        with self._lock:
+            self._end_quarantine()
+            try:
+                while self._get_idle_count() < self._pool_size:
+                    self._free_socks.append(self._bind_socket())
+            except exception.SocketPortRangeExhaustedException:
+                LOG.debug("Could not fill the serial console port pool, "
+                          "all the ports in range %(min_port)s:"
+                          "%(max_port)s being in use.",
+                          {'min_port': self._min_port,
+                           'max_port': self._max_port})
+
+    def acquire_socket(self):
+        """Returns a listening socket bound to a port from the range."""
+        with self._lock:
+            self._end_quarantine()
+            if self._free_socks:
+                sock = self._free_socks.popleft()
+                self._drop_pending_conns(sock)
+            else:
+                sock = self._bind_socket()
+        return sock
+
+    def release_socket(self, sock):
+        """Recycles a socket previously handed out by the pool.
+
+        The socket must not be used by the caller afterwards.
+        """
+        port = sock.getsockname()[1]
+        deadline = time.time() + self._quarantine_time
+        with self._lock:
+            self._end_quarantine()
+            if self._get_idle_count() < self._pool_size:
+                self._quarantined_socks.append((deadline, sock))
+                return
+            self._bound_ports.discard(port)
+            self._quarantined_ports[port] = deadline
+        sock.close()
+
+    def _get_idle_count(self):
+        return len(self._free_socks) + len(self._quarantined_socks)
+
+    def _end_quarantine(self):
+        now = time.time()
+        while (self._quarantined_socks and
+               self._quarantined_socks[0][0] <= now):
+            self._free_socks.append(self._quarantined_socks.popleft()[1])
+
+        for port, deadline in list(self._quarantined_ports.items()):
+            if deadline <= now:
+                del self._quarantined_ports[port]
+
+    def _bind_socket(self):
+        num_ports = self._max_port - self._min_port + 1
+        for attempt in range(num_ports):
+            port = self._next_port
+            self._next_port = (self._min_port +
+                               (port - self._min_port + 1) % num_ports)
+            if (port in self._bound_ports or
+                    port in self._quarantined_ports):
+                continue
+
+            try:
+                sock = self._create_socket(port)
+            except socket.error as err:
+                if err.errno not in _PORT_IN_USE_ERRORS:
+                    raise vmutils.HyperVException(
+                        _("Failed to bind serial console port "
+                          "%(addr)s:%(port)s. Error: %(err)s") %
+                        {'addr': self._addr, 'port': port, 'err': err})
+                # Used by a different process.
+                continue
+
+            self._bound_ports.add(port)
+            return sock
+
+        raise exception.SocketPortRangeExhaustedException(host=self._addr)
+
+    def _create_socket(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if hasattr(socket, 'SO_EXCLUSIVEADDRUSE'):
+                # On Windows, SO_REUSEADDR would allow other sockets to
+                # bind the same port, hijacking the connections.
+                sock.setsockopt(socket.SOL_SOCKET,
+                                socket.SO_EXCLUSIVEADDRUSE, 1)
+            else:
+                # Allows rebinding ports having connections in the
+                # TIME_WAIT state.
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self._addr, port))
+            sock.listen(1)
+            sock.setblocking(False)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def _drop_pending_conns(sock):
+        # Clients may have connected to the port while it was idle,
+        # which must not reach the instance the socket is handed to.
+        while True:
+            try:
+                conn = sock.accept()[0]
+            except socket.error:
+                return
+            conn.close()
@@ -14,119 +14,244 @@
 #    under the License.
 
 from eventlet import patcher
-from nova.console import serial as serial_console
 from nova.console import type as ctype
 from nova import exception
 from nova.i18n import _, _LI  # noqa
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 
+from hyperv.nova import consolelog
 from hyperv.nova import constants
+from hyperv.nova import ioreactor
 from hyperv.nova import ioutils
 from hyperv.nova import namedpipe
+from hyperv.nova import portpool
 from hyperv.nova import serialproxy
 from hyperv.nova import utilsfactory
 from hyperv.nova import vmutils
 
-CONF = cfg.CONF
+threading = patcher.original('threading')
+
 LOG = logging.getLogger(__name__)
 
-threading = patcher.original('threading')
+hyperv_opts = [
+    cfg.BoolOpt('serial_console_lazy_proxy',
+                default=True,
+                help='Start the serial proxy of an instance only when its '
+                     'serial console is requested, instead of starting '
+                     'it along with the console logging.'),
+    cfg.IntOpt('serial_console_proxy_idle_timeout',
+               default=600,
+               min=0,
+               help='The number of seconds after which lazily started '
+                    'serial proxies having no clients connected are '
+                    'stopped, counting from the last time the serial '
+                    'console was requested. Lower values than the '
+                    'console_token_ttl option are raised to it, so that '
+                    'proxies are not stopped while the issued console '
+                    'tokens are still valid. If set to 0, the proxies '
+                    'are stopped only along with the instances.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+CONF.import_opt('console_token_ttl', 'nova.consoleauth.manager')
 
 
 class SerialConsoleHandler(object):
-    """Handles serial console ops related to a given instance."""
+    """Handles serial console ops related to a given instance.
+
+    The console output is always logged. The serial proxy, which allows
+    interactive sessions, may be started only when the serial console
+    is requested, being stopped after an idle period.
+    """
     def __init__(self, instance_name):
         self._vmutils = utilsfactory.get_vmutils()
         self._pathutils = utilsfactory.get_pathutils()
 
         self._instance_name = instance_name
-        self._log_path = self._pathutils.get_vm_console_log_paths(
-            self._instance_name)[0]
+        self._log_writer = consolelog.ConsoleLogWriter(
+            self._pathutils.get_vm_console_log_paths(self._instance_name))
 
-        self._client_connected = None
-        self._input_queue = None
-        self._output_queue = None
+        self._lazy_proxy = CONF.hyperv.serial_console_lazy_proxy
+        self._proxy_idle_timeout = 0
+        if self._lazy_proxy and CONF.hyperv.serial_console_proxy_idle_timeout:
+            self._proxy_idle_timeout = max(
+                CONF.hyperv.serial_console_proxy_idle_timeout,
+                CONF.console_token_ttl)
+
+        self._input_buffer = None
+        self._output_buffer = None
+        self._listen_host = None
+        self._listen_port = None
+        self._listen_sock = None
 
         self._serial_proxy = None
-        self._workers = []
+        self._idle_timer = None
+        # Pipe handlers, by pipe type.
+        self._pipe_handlers = {}
+        self._rw_pipe_path = None
+        self._log_pipe_type = None
+
+        self._lock = threading.Lock()
+        self._reactor = ioreactor.get_reactor()
 
     def start(self):
-        self._setup_handlers()
+        self._setup_named_pipe_handlers()
 
-        for worker in self._workers:
-            worker.start()
+        self._log_writer.start()
+        for handler in self._pipe_handlers.values():
+            handler.start()
 
-    def stop(self):
-        for worker in self._workers:
-            worker.stop()
+        if CONF.serial_console.enabled and not self._lazy_proxy:
+            with self._lock:
+                self._start_serial_proxy()
 
-        if self._serial_proxy:
-            serial_console.release_port(self._listen_host,
-                                        self._listen_port)
+    def stop(self):
+        with self._lock:
+            self._stop_serial_proxy()
 
-    def _setup_handlers(self):
-        if CONF.serial_console.enabled:
-            self._setup_serial_proxy_handler()
+        for handler in self._pipe_handlers.values():
+            handler.stop()
+        # Flushes the pending console output.
+        self._log_writer.stop()
 
-        self._setup_named_pipe_handlers()
+    def _start_serial_proxy(self):
+        if self._serial_proxy:
+            # The serial console was requested again, the proxy has to
+            # outlive the new console token.
+            self._serial_proxy.reset_idle_time()
+            return
+        if not self._rw_pipe_path:
+            raise exception.ConsoleTypeUnavailable(console_type='serial')
 
-    def _setup_serial_proxy_handler(self):
         self._listen_host = (
             CONF.serial_console.proxyclient_address)
-        self._listen_port = serial_console.acquire_port(
-            self._listen_host)
+        # The socket is already bound and listening, so the proxy can't
+        # fail to bind the port once started.
+        self._listen_sock = portpool.get_port_pool().acquire_socket()
+        self._listen_port = self._listen_sock.getsockname()[1]
 
         LOG.info(_LI('Initializing serial proxy on '
                      '%(addr)s:%(port)s, handling connections '
                      'to instance %(instance_name)s.'),
-                     {'addr': self._listen_host,
-                      'port': self._listen_port,
-                      'instance_name': self._instance_name})
-
-        # Use this event in order to manage
-        # pending queue operations.
-        self._client_connected = threading.Event()
-        self._input_queue = ioutils.IOQueue(
-            client_connected=self._client_connected)
-        self._output_queue = ioutils.IOQueue(
-            client_connected=self._client_connected)
+                 {'addr': self._listen_host,
+                  'port': self._listen_port,
+                  'instance_name': self._instance_name})
+
+        # The guest output is dropped if the client can't keep up
+        # instead of blocking the named pipe reader. On the other hand,
+        # client input has to wait for the guest.
+        self._input_buffer = ioutils.RingBuffer(overwrite=False)
+        self._output_buffer = ioutils.RingBuffer()
 
         self._serial_proxy = serialproxy.SerialProxy(
             self._instance_name, self._listen_host,
-            self._listen_port, self._input_queue,
-            self._output_queue, self._client_connected)
+            self._listen_port, self._input_buffer,
+            self._output_buffer, sock=self._listen_sock)
+        try:
+            self._serial_proxy.start()
+            self._attach_rw_pipe_handler()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._stop_serial_proxy()
 
-        self._workers.append(self._serial_proxy)
+        if self._proxy_idle_timeout:
+            self._schedule_idle_check(self._proxy_idle_timeout)
+
+    def _stop_serial_proxy(self):
+        if not self._serial_proxy:
+            return
+
+        if self._idle_timer:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+        self._serial_proxy.stop()
+        self._detach_rw_pipe_handler()
+        for buff in (self._input_buffer, self._output_buffer):
+            buff.close()
+        portpool.get_port_pool().release_socket(self._listen_sock)
+
+        self._serial_proxy = None
+        self._listen_sock = None
+        self._input_buffer = None
+        self._output_buffer = None
+
+    def _attach_rw_pipe_handler(self):
+        rw_handler = self._pipe_handlers.get(constants.SERIAL_PORT_TYPE_RW)
+        if rw_handler:
+            # The 'rw' pipe is already used for logging.
+            rw_handler.attach_buffers(self._input_buffer,
+                                      self._output_buffer)
+        else:
+            rw_handler = self._get_named_pipe_handler(
+                self._rw_pipe_path,
+                pipe_type=constants.SERIAL_PORT_TYPE_RW,
+                enable_logging=False)
+            self._pipe_handlers[constants.SERIAL_PORT_TYPE_RW] = rw_handler
+            rw_handler.start()
+
+    def _detach_rw_pipe_handler(self):
+        if self._log_pipe_type == constants.SERIAL_PORT_TYPE_RW:
+            self._pipe_handlers[constants.SERIAL_PORT_TYPE_RW].detach_buffers()
+        else:
+            rw_handler = self._pipe_handlers.pop(
+                constants.SERIAL_PORT_TYPE_RW, None)
+            if rw_handler:
+                rw_handler.stop()
+
+    def _schedule_idle_check(self, delay):
+        self._idle_timer = self._reactor.call_later(delay,
+                                                    self._check_proxy_idle)
+
+    def _check_proxy_idle(self):
+        with self._lock:
+            if not self._serial_proxy:
+                return
+
+            idle_time = self._serial_proxy.get_idle_time()
+            if idle_time < self._proxy_idle_timeout:
+                self._schedule_idle_check(
+                    self._proxy_idle_timeout - idle_time)
+                return
+
+            LOG.info(_LI("Stopping the idle serial proxy of instance "
+                         "%(instance_name)s."),
+                     {'instance_name': self._instance_name})
+            self._stop_serial_proxy()
 
     def _setup_named_pipe_handlers(self):
         # At most 2 named pipes will be used to access the vm serial ports.
         #
         # The named pipe having the 'ro' suffix will be used only for logging
         # while the 'rw' pipe will be used for interactive sessions, logging
-        # only when there is no 'ro' pipe.
+        # only when there is no 'ro' pipe. The 'rw' pipe is opened
+        # along with the serial proxy if it's not used for logging.
         serial_port_mapping = self._get_vm_serial_port_mapping()
-        log_rw_pipe_output = not serial_port_mapping.get(
-            constants.SERIAL_PORT_TYPE_RO)
-
-        for pipe_type, pipe_path in serial_port_mapping.iteritems():
-            enable_logging = (pipe_type == constants.SERIAL_PORT_TYPE_RO or
-                              log_rw_pipe_output)
-            handler = self._get_named_pipe_handler(
-                pipe_path,
-                pipe_type=pipe_type,
-                enable_logging=enable_logging)
-            self._workers.append(handler)
+        self._rw_pipe_path = serial_port_mapping.get(
+            constants.SERIAL_PORT_TYPE_RW)
+
+        if constants.SERIAL_PORT_TYPE_RO in serial_port_mapping:
+            self._log_pipe_type = constants.SERIAL_PORT_TYPE_RO
+        else:
+            self._log_pipe_type = constants.SERIAL_PORT_TYPE_RW
+
+        handler = self._get_named_pipe_handler(
+            serial_port_mapping[self._log_pipe_type],
+            pipe_type=self._log_pipe_type,
+            enable_logging=True)
+        self._pipe_handlers[self._log_pipe_type] = handler
 
     def _get_named_pipe_handler(self, pipe_path, pipe_type,
                                 enable_logging):
         kwargs = {}
         if pipe_type == constants.SERIAL_PORT_TYPE_RW:
-            kwargs = {'input_queue': self._input_queue,
-                      'output_queue': self._output_queue,
-                      'connect_event': self._client_connected}
+            kwargs = {'input_buffer': self._input_buffer,
+                      'output_buffer': self._output_buffer}
         if enable_logging:
-            kwargs['log_file'] = self._log_path
+            kwargs['log_writer'] = self._log_writer
 
         handler = namedpipe.NamedPipeHandler(pipe_path, **kwargs)
         return handler
@@ -155,8 +280,33 @@ class SerialConsoleHandler(object):
 
         return serial_port_mapping
 
+    def get_stats(self):
+        """Returns the console I/O counters of the instance.
+
+        The serial proxy counters are included only while the proxy is
+        running.
+        """
+        with self._lock:
+            stats = {'log': self._log_writer.get_stats(),
+                     'pipes': dict((pipe_type, handler.get_stats())
+                                   for pipe_type, handler
+                                   in self._pipe_handlers.items()),
+                     'proxy': None}
+            if self._serial_proxy:
+                proxy_stats = self._serial_proxy.get_stats()
+                proxy_stats['clients'] = self._serial_proxy.get_conn_stats()
+                proxy_stats['input_buffer_high_water_mark'] = (
+                    self._input_buffer.high_water_mark)
+                proxy_stats['output_buffer_high_water_mark'] = (
+                    self._output_buffer.high_water_mark)
+                stats['proxy'] = proxy_stats
+        return stats
+
     def get_serial_console(self):
         if not CONF.serial_console.enabled:
             raise exception.ConsoleTypeUnavailable(console_type='serial')
-        return ctype.ConsoleSerial(host=self._listen_host,
-                                   port=self._listen_port)
+
+        with self._lock:
+            self._start_serial_proxy()
+            return ctype.ConsoleSerial(host=self._listen_host,
+                                       port=self._listen_port)
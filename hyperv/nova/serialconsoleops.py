@@ -16,21 +16,49 @@
 import functools
 import os
 
+import eventlet
 from nova import exception
 from nova.i18n import _, _LI, _LE  # noqa
 from nova import utils
 from oslo_config import cfg
 from oslo_log import log as logging
 
+from hyperv.nova import consolelog
+from hyperv.nova import constants
+from hyperv.nova import ioreactor
+from hyperv.nova import portpool
 from hyperv.nova import serialconsolehandler
 from hyperv.nova import utilsfactory
 from hyperv.nova import vmutils
 
-CONF = cfg.CONF
-
 LOG = logging.getLogger(__name__)
 
+hyperv_opts = [
+    cfg.IntOpt('serial_console_handler_start_workers',
+               default=4,
+               help='The maximum number of serial console handlers '
+                    'started concurrently when the service starts.'),
+    cfg.IntOpt('serial_console_stats_log_interval',
+               default=0,
+               help='The interval, in seconds, at which the console I/O '
+                    'counters of each instance are logged. If set to 0, '
+                    'the counters are not logged.'),
+    cfg.IntOpt('console_output_max_bytes',
+               default=constants.MAX_CONSOLE_LOG_FILE_SIZE,
+               min=0,
+               help='The maximum amount of instance console output, in '
+                    'bytes, returned when the console log is requested. '
+                    'Only the end of the console log is returned. If set '
+                    'to 0, the whole console log is returned.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
 _console_handlers = {}
+# Set if the serial proxy ports could not be set up, in which case the
+# serial consoles are reported as unavailable.
+_serial_proxy_disabled = False
 
 
 def instance_synchronized(func):
@@ -83,32 +111,88 @@ class SerialConsoleOps(object):
     @instance_synchronized
     def get_serial_console(self, instance_name):
         handler = _console_handlers.get(instance_name)
-        if not handler:
+        if not handler or _serial_proxy_disabled:
             raise exception.ConsoleTypeUnavailable(console_type='serial')
         return handler.get_serial_console()
 
-    @instance_synchronized
-    def get_console_output(self, instance_name):
+    def get_console_output(self, instance_name, max_bytes=None,
+                           max_lines=None):
+        # The instance lock is not required, the console log writer
+        # handles concurrent reads.
         console_log_paths = self._pathutils.get_vm_console_log_paths(
             instance_name)
 
         try:
-            log = ''
-            # Start with the oldest console log file.
-            for log_path in console_log_paths[::-1]:
-                if os.path.exists(log_path):
-                    with open(log_path, 'rb') as fp:
-                        log += fp.read()
-            return log
-        except IOError as err:
+            return consolelog.read_log_tail(console_log_paths,
+                                            max_bytes=max_bytes,
+                                            max_lines=max_lines)
+        except (IOError, OSError) as err:
             msg = (_("Could not get instance %(instance_name)s "
                      "console output. Error: %(err)s") %
                    {'instance_name': instance_name,
                     'err': err})
             raise vmutils.HyperVException(msg)
 
+    def get_console_stats(self, instance_name=None):
+        """Returns the console I/O counters, by instance name.
+
+        If no instance name is passed, the counters of all the instances
+        having console handlers are returned.
+        """
+        if instance_name:
+            instance_names = [instance_name]
+        else:
+            instance_names = list(_console_handlers)
+
+        console_stats = {}
+        for name in instance_names:
+            handler = _console_handlers.get(name)
+            if handler:
+                console_stats[name] = handler.get_stats()
+        return console_stats
+
+    def _schedule_console_stats_log(self):
+        ioreactor.get_reactor().call_later(
+            CONF.hyperv.serial_console_stats_log_interval,
+            self._log_console_stats)
+
+    def _log_console_stats(self):
+        try:
+            console_stats = self.get_console_stats()
+            for instance_name, stats in sorted(console_stats.items()):
+                LOG.info(_LI("Instance %(instance_name)s serial console "
+                             "stats: %(stats)s"),
+                         {'instance_name': instance_name,
+                          'stats': stats})
+        finally:
+            self._schedule_console_stats_log()
+
     def start_console_handlers(self):
+        global _serial_proxy_disabled
+
+        if CONF.serial_console.enabled:
+            # Validates the port range and binds the proxy sockets in
+            # advance, before instances start requesting them.
+            try:
+                portpool.get_port_pool().fill()
+            except vmutils.HyperVException as exc:
+                # The console output is still logged.
+                LOG.error(_LE('The serial console proxy ports could not '
+                              'be set up, serial consoles are disabled. '
+                              'Exception: %s'), exc)
+                _serial_proxy_disabled = True
+
+        if CONF.hyperv.serial_console_stats_log_interval:
+            self._schedule_console_stats_log()
+
+        # This is done in the background, avoiding delaying the service
+        # startup on hosts running many instances.
+        eventlet.spawn_n(self._start_console_handlers)
+
+    def _start_console_handlers(self):
         active_instances = self._vmutils.get_active_instances()
+        pool = eventlet.GreenPool(
+            CONF.hyperv.serial_console_handler_start_workers)
         for instance_name in active_instances:
             instance_path = self._pathutils.get_instance_dir(instance_name)
 
@@ -116,4 +200,5 @@ class SerialConsoleOps(object):
             if not os.path.exists(instance_path):
                 continue
 
-            self.start_console_handler(instance_name)
+            pool.spawn_n(self.start_console_handler, instance_name)
+        pool.waitall()
@@ -19,50 +19,146 @@ import functools
 import socket
 
 from nova.i18n import _
+from oslo_config import cfg
+from oslo_utils import units
 
 from hyperv.nova import constants
+from hyperv.nova import ioreactor
 from hyperv.nova import vmutils
 
 threading = patcher.original('threading')
+time = patcher.original('time')
+
+hyperv_opts = [
+    cfg.IntOpt('serial_console_send_coalesce_size',
+               default=4 * units.Ki,
+               help='The amount of serial console output, in bytes, '
+                    'which is sent to the client right away. Smaller '
+                    'amounts are delayed while output is continuously '
+                    'being sent, in order to avoid small packets.'),
+    cfg.FloatOpt('serial_console_send_coalesce_delay',
+                 default=0.02,
+                 help='The maximum number of seconds serial console '
+                      'output is delayed in order to be coalesced. '
+                      'Output following an idle period is always sent '
+                      'right away.'),
+    cfg.IntOpt('serial_console_socket_send_buffer_size',
+               default=64 * units.Ki,
+               help='The send buffer size of the serial console client '
+                    'sockets. If set to 0, the system default is used.'),
+    cfg.IntOpt('serial_console_max_clients',
+               default=5,
+               help='The maximum number of clients simultaneously '
+                    'connected to an instance serial console. The first '
+                    'client may write to the console, the other ones '
+                    'being read-only. Once the limit is reached, new '
+                    'clients wait for a connected one to disconnect.'),
+    cfg.BoolOpt('serial_console_drop_slow_clients',
+                default=False,
+                help='Disconnect serial console clients which do not '
+                     'keep up with the instance output. By default, such '
+                     'clients skip the output they missed.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
+
+# Used when the guest doesn't keep up with the client input.
+IO_RETRY_INTERVAL = 0.1
+# Used when the reactor cannot poll the listening socket, having too many
+# sockets to wait on.
+ACCEPT_RETRY_INTERVAL = 1
 
 
 def handle_socket_errors(func):
     @functools.wraps(func)
-    def wrapper(self, *args, **kwargs):
+    def wrapper(self, conn, *args, **kwargs):
         try:
-            return func(self, *args, **kwargs)
+            return func(self, conn, *args, **kwargs)
         except socket.error:
-            self._client_connected.clear()
+            self._close_conn(conn)
     return wrapper
 
 
-class SerialProxy(threading.Thread):
-    def __init__(self, instance_name, addr, port, input_queue,
-                 output_queue, client_connected):
-        super(SerialProxy, self).__init__()
-        self.setDaemon(True)
+class _ClientConnection(object):
+    def __init__(self, sock, writer=False):
+        self.sock = sock
+        # Only the designated writer may send input to the instance.
+        self.writer = writer
+        # The output is sent straight from the buffer shared by all the
+        # clients, each of them keeping only its reader position.
+        self.output_reader = None
+        self.send_pending = False
+        self.flush_timer = None
+        self.last_flush = 0
+        self.closed = False
+        self.stats = dict(bytes_received=0, bytes_sent=0, flushes=0)
+
+
+class SerialProxy(object):
+    """Proxies the instance serial console to TCP clients.
+
+    The sockets are serviced by the reactor shared by all the serial
+    console handlers, no threads being used per proxy or connection.
+
+    The instance output is fanned out to all the connected clients, each
+    of them reading from the shared output buffer at its own position.
+    Clients which do not keep up skip the overwritten output, or get
+    disconnected, never stalling the named pipe reader.
 
+    Output is coalesced similarly to the Nagle algorithm: data following
+    an idle period is sent right away, keeping interactive sessions
+    responsive, while bulk output is sent once enough data is available
+    or once the coalesce delay passes. The Nagle algorithm itself is
+    disabled on the client sockets.
+    """
+
+    def __init__(self, instance_name, addr, port, input_buffer,
+                 output_buffer, sock=None):
         self._instance_name = instance_name
         self._addr = addr
         self._port = port
-        self._conn = None
+        # A listening socket may be passed, in which case it will not be
+        # closed when the proxy stops, being owned by the caller.
+        self._sock = sock
+        self._owns_sock = sock is None
+        # Client connections, in the order in which they were accepted.
+        self._conns = []
+        self._accepting = False
+        self._idle_since = None
+        # Totals, including the clients which disconnected meanwhile.
+        self._stats = dict(connections=0, dropped_clients=0,
+                           bytes_received=0, bytes_sent=0)
+
+        self._input_buffer = input_buffer
+        self._output_buffer = output_buffer
 
-        self._input_queue = input_queue
-        self._output_queue = output_queue
-        self._client_connected = client_connected
+        self._max_clients = CONF.hyperv.serial_console_max_clients
+        self._drop_slow_clients = CONF.hyperv.serial_console_drop_slow_clients
+        self._coalesce_size = CONF.hyperv.serial_console_send_coalesce_size
+        self._coalesce_delay = CONF.hyperv.serial_console_send_coalesce_delay
+        self._send_buffer_size = (
+            CONF.hyperv.serial_console_socket_send_buffer_size)
+
+        self._lock = threading.Lock()
         self._stopped = threading.Event()
+        self._reactor = ioreactor.get_reactor()
 
     def _setup_socket(self):
         try:
-            self._sock = socket.socket(socket.AF_INET,
-                                       socket.SOCK_STREAM)
-            self._sock.setsockopt(socket.SOL_SOCKET,
-                                  socket.SO_REUSEADDR,
-                                  1)
-            self._sock.bind((self._addr, self._port))
-            self._sock.listen(1)
+            if self._owns_sock:
+                self._sock = socket.socket(socket.AF_INET,
+                                           socket.SOCK_STREAM)
+                self._sock.setsockopt(socket.SOL_SOCKET,
+                                      socket.SO_REUSEADDR,
+                                      1)
+                self._sock.bind((self._addr, self._port))
+            self._sock.listen(self._max_clients)
+            self._sock.setblocking(False)
         except socket.error as err:
-            self._sock.close()
+            if self._owns_sock:
+                self._sock.close()
             msg = (_('Failed to initialize serial proxy on'
                      '%(addr)s:%(port)s, handling connections '
                      'to instance %(instance_name)s. Error: %(error)s') %
@@ -71,52 +167,266 @@ class SerialProxy(threading.Thread):
                     'error': err})
             raise vmutils.HyperVException(msg)
 
+    def start(self):
+        self._setup_socket()
+        self._idle_since = time.time()
+        self._accepting = True
+        self._wait_for_conns()
+
     def stop(self):
         self._stopped.set()
-        self._client_connected.clear()
-        if self._conn:
-            self._conn.shutdown(socket.SHUT_RDWR)
-            self._conn.close()
-        self._sock.close()
+        with self._lock:
+            conns = list(self._conns)
+        for conn in conns:
+            self._close_conn(conn)
 
-    def run(self):
-        self._setup_socket()
-        while not self._stopped.isSet():
-            self._accept_conn()
+        if self._sock:
+            self._reactor.cancel(self._sock)
+            if self._owns_sock:
+                self._sock.close()
+
+    def get_idle_time(self):
+        """Returns the number of seconds since a client was connected."""
+        with self._lock:
+            if self._conns:
+                return 0
+            return time.time() - self._idle_since
+
+    def reset_idle_time(self):
+        """Restarts the idle period of a proxy having no clients."""
+        with self._lock:
+            self._idle_since = time.time()
+
+    def get_stats(self):
+        """Returns the proxy counters.
+
+        Those include the number of accepted connections, the number of
+        clients disconnected for not keeping up and the number of bytes
+        received from and sent to all the clients.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def get_conn_stats(self):
+        """Returns the counters of the connected clients.
+
+        Each item contains the number of bytes received from and sent to
+        the client, the number of output flushes and the number of output
+        bytes skipped by the client, as well as whether the client is the
+        designated writer.
+        """
+        with self._lock:
+            conns_stats = []
+            for conn in self._conns:
+                conn_stats = dict(conn.stats)
+                conn_stats['skipped_bytes'] = (
+                    conn.output_reader.skipped_bytes)
+                conn_stats['writer'] = conn.writer
+                conns_stats.append(conn_stats)
+            return conns_stats
 
-    @handle_socket_errors
     def _accept_conn(self):
-        self._conn, client_addr = self._sock.accept()
-        self._client_connected.set()
+        if self._stopped.isSet():
+            return
+
+        try:
+            sock, client_addr = self._sock.accept()
+        except socket.error:
+            self._wait_for_conns()
+            return
+
+        try:
+            self._setup_conn_socket(sock)
+        except socket.error:
+            sock.close()
+            self._wait_for_conns()
+            return
+
+        with self._lock:
+            writer = not any(conn.writer for conn in self._conns)
+            conn = _ClientConnection(sock, writer=writer)
+            # Only the data written after the client connected is sent.
+            conn.output_reader = self._output_buffer.get_reader(
+                callback=functools.partial(self._schedule_send, conn))
+            self._conns.append(conn)
+            self._stats['connections'] += 1
+            # Once the limit is reached, other clients will wait until
+            # one of the connected ones disconnects.
+            accepting = len(self._conns) < self._max_clients
+            self._accepting = accepting
+
+        try:
+            self._reactor.wait_readable(sock, self._get_data, conn)
+        except socket.error:
+            # Too many sockets are being polled.
+            self._close_conn(conn)
+        if accepting:
+            self._wait_for_conns()
 
-        workers = []
-        for job in [self._get_data, self._send_data]:
-            worker = threading.Thread(target=job)
-            worker.setDaemon(True)
-            worker.start()
-            workers.append(worker)
+    def _wait_for_conns(self):
+        if self._stopped.isSet():
+            return
 
-        for worker in workers:
-            worker_running = (worker.is_alive() and
-                              worker is not threading.current_thread())
-            if worker_running:
-                worker.join()
+        try:
+            self._reactor.wait_readable(self._sock, self._accept_conn)
+        except socket.error:
+            # Too many sockets are being polled, retry later.
+            self._reactor.call_later(ACCEPT_RETRY_INTERVAL,
+                                     self._wait_for_conns)
+
+    def _setup_conn_socket(self, sock):
+        sock.setblocking(False)
+        # The output is coalesced by the proxy.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self._send_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            self._send_buffer_size)
+
+    def _close_conn(self, conn):
+        """Closes the client connection.
+
+        Returns False if the connection was already closed.
+        """
+        with self._lock:
+            if conn.closed:
+                return False
+
+            conn.closed = True
+            if conn.flush_timer:
+                conn.flush_timer.cancel()
+                conn.flush_timer = None
+
+            self._conns.remove(conn)
+            if not self._conns:
+                self._idle_since = time.time()
+            elif conn.writer:
+                # Hand over the console input to the longest connected
+                # client.
+                self._conns[0].writer = True
+
+            resume_accepting = not (self._accepting or
+                                    self._stopped.isSet())
+            if resume_accepting:
+                self._accepting = True
+
+        self._reactor.cancel(conn.sock)
+        conn.output_reader.close()
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        conn.sock.close()
+
+        if resume_accepting:
+            self._wait_for_conns()
+        return True
+
+    @handle_socket_errors
+    def _get_data(self, conn):
+        if conn.closed:
+            return
+
+        data = conn.sock.recv(constants.SERIAL_CONSOLE_BUFFER_SIZE)
+        if not data:
+            self._close_conn(conn)
+            return
+
+        with self._lock:
+            conn.stats['bytes_received'] += len(data)
+            self._stats['bytes_received'] += len(data)
+            writer = conn.writer
 
-        self._conn.close()
-        self._conn = None
+        if writer:
+            self._write_input(conn, data)
+        else:
+            # Input from read-only clients is discarded.
+            self._reactor.wait_readable(conn.sock, self._get_data, conn)
 
     @handle_socket_errors
-    def _get_data(self):
-        while self._client_connected.isSet():
-            data = self._conn.recv(constants.SERIAL_CONSOLE_BUFFER_SIZE)
-            if not data:
-                self._client_connected.clear()
+    def _write_input(self, conn, data):
+        if conn.closed:
+            return
+
+        written = self._input_buffer.write(data, timeout=0)
+        if written < len(data):
+            # Stop reading from the client until the guest reads the
+            # pending input.
+            self._reactor.call_later(IO_RETRY_INTERVAL, self._write_input,
+                                     conn, data[written:])
+        else:
+            self._reactor.wait_readable(conn.sock, self._get_data, conn)
+
+    @handle_socket_errors
+    def _schedule_send(self, conn):
+        # Called when new output data is available.
+        if self._drop_slow_clients and conn.output_reader.skipped_bytes:
+            if self._close_conn(conn):
+                with self._lock:
+                    self._stats['dropped_clients'] += 1
+            return
+
+        with self._lock:
+            if (conn.send_pending or conn.closed or
+                    not conn.output_reader.available):
                 return
-            self._input_queue.put(data)
+
+            flush_deadline = conn.last_flush + self._coalesce_delay
+            delay = flush_deadline - time.time()
+            if (delay > 0 and
+                    conn.output_reader.available < self._coalesce_size):
+                # Output is being sent continuously, wait for more data.
+                if not conn.flush_timer:
+                    conn.flush_timer = self._reactor.call_later(
+                        delay, self._flush_output, conn)
+                return
+
+            conn.send_pending = True
+            if conn.flush_timer:
+                conn.flush_timer.cancel()
+                conn.flush_timer = None
+        self._reactor.wait_writable(conn.sock, self._send_data, conn)
 
     @handle_socket_errors
-    def _send_data(self):
-        while self._client_connected.isSet():
-            data = self._output_queue.get_burst()
-            if data:
-                self._conn.sendall(data)
+    def _flush_output(self, conn):
+        with self._lock:
+            conn.flush_timer = None
+            if (conn.send_pending or conn.closed or
+                    not conn.output_reader.available):
+                return
+            conn.send_pending = True
+        self._reactor.wait_writable(conn.sock, self._send_data, conn)
+
+    @handle_socket_errors
+    def _send_data(self, conn):
+        with self._lock:
+            if conn.closed:
+                return
+            # Get all the data available at once, avoiding sending small
+            # chunks. The data is not copied, the views referencing the
+            # output buffer.
+            views = conn.output_reader.get_views(timeout=0)
+
+        # If the data wraps around the end of the buffer, the second view
+        # is sent when the socket becomes writable again.
+        sent = conn.sock.send(views[0]) if views else 0
+
+        with self._lock:
+            if conn.closed:
+                return
+            conn.output_reader.consume(sent)
+            conn.stats['bytes_sent'] += sent
+            self._stats['bytes_sent'] += sent
+            if sent < sum(len(view) for view in views):
+                send_pending = True
+            else:
+                if views:
+                    conn.stats['flushes'] += 1
+                    conn.last_flush = time.time()
+                send_pending = False
+                conn.send_pending = False
+
+        if send_pending:
+            self._reactor.wait_writable(conn.sock, self._send_data, conn)
+        else:
+            # Output received in the meantime is subject to coalescing.
+            self._schedule_send(conn)
@@ -18,15 +18,38 @@ Management class for VM snapshot operations.
 """
 import os
 
+import eventlet
 from nova.compute import task_states
 from nova.image import glance
 from oslo_config import cfg
 from oslo_log import log as logging
 
-from hyperv.i18n import _LW
+from hyperv.i18n import _LI, _LW
+from hyperv.nova import compressionutils
 from hyperv.nova import utilsfactory
+from hyperv.nova import vhdreader
+
+hyperv_opts = [
+    cfg.BoolOpt('compact_snapshot_images',
+                default=False,
+                help='Upload snapshot images as compacted dynamic VHDs, '
+                     'leaving the blocks which contain only zeros '
+                     'unallocated. This reduces the image size at the cost '
+                     'of reading the allocated blocks twice.'),
+    cfg.StrOpt('snapshot_image_compression',
+               default=compressionutils.COMPRESSION_NONE,
+               choices=compressionutils.COMPRESSION_CODECS,
+               help='Codec used for compressing snapshot images while '
+                    'being uploaded. Compressed images are decompressed '
+                    'transparently when fetched by Hyper-V compute nodes.'),
+    cfg.IntOpt('snapshot_compression_workers',
+               default=1,
+               help='The number of threads used for compressing gzip '
+                    'snapshot images.'),
+]
 
 CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
 LOG = logging.getLogger(__name__)
 
 
@@ -37,14 +60,36 @@ class SnapshotOps(object):
         self._vhdutils = utilsfactory.get_vhdutils()
 
     def _save_glance_image(self, context, image_id, image_vhd_path):
+        with self._pathutils.open(image_vhd_path, 'rb') as f:
+            self._upload_glance_image(context, image_id, f)
+
+    def _upload_glance_image(self, context, image_id, image_data):
         (glance_image_service,
          image_id) = glance.get_remote_image_service(context, image_id)
         image_metadata = {"is_public": False,
                           "disk_format": "vhd",
                           "container_format": "bare",
                           "properties": {}}
-        with self._pathutils.open(image_vhd_path, 'rb') as f:
-            glance_image_service.update(context, image_id, image_metadata, f)
+
+        codec = CONF.hyperv.snapshot_image_compression
+        if codec != compressionutils.COMPRESSION_NONE:
+            image_data = compressionutils.CompressedReader(
+                image_data, codec,
+                workers=CONF.hyperv.snapshot_compression_workers)
+            image_metadata["properties"][
+                compressionutils.IMAGE_COMPRESSION_PROPERTY] = codec
+
+        glance_image_service.update(context, image_id, image_metadata,
+                                    image_data)
+
+        if codec != compressionutils.COMPRESSION_NONE:
+            stats = image_data.get_stats()
+            stats['image_id'] = image_id
+            LOG.info(_LI("Uploaded %(codec)s compressed image %(image_id)s. "
+                         "Size: %(raw_size)d bytes, compressed size: "
+                         "%(compressed_size)d bytes, compression ratio: "
+                         "%(ratio).2f, throughput: %(throughput).2f MB/s"),
+                     stats)
 
     def snapshot(self, context, instance, image_id, update_task_state):
         """Create snapshot from a running VM instance."""
@@ -63,49 +108,29 @@ class SnapshotOps(object):
             src_base_disk_path = self._vhdutils.get_vhd_parent_path(
                 src_vhd_path)
 
-            export_dir = self._pathutils.get_export_dir(instance_name)
-
-            dest_vhd_path = os.path.join(export_dir, os.path.basename(
-                src_vhd_path))
-            LOG.debug('Copying VHD %(src_vhd_path)s to %(dest_vhd_path)s',
-                      {'src_vhd_path': src_vhd_path,
-                       'dest_vhd_path': dest_vhd_path})
-            self._pathutils.copyfile(src_vhd_path, dest_vhd_path)
-
-            image_vhd_path = None
-            if not src_base_disk_path:
-                image_vhd_path = dest_vhd_path
-            else:
-                basename = os.path.basename(src_base_disk_path)
-                dest_base_disk_path = os.path.join(export_dir, basename)
-                LOG.debug('Copying base disk %(src_vhd_path)s to '
-                          '%(dest_base_disk_path)s',
-                          {'src_vhd_path': src_vhd_path,
-                           'dest_base_disk_path': dest_base_disk_path})
-                self._pathutils.copyfile(src_base_disk_path,
-                                         dest_base_disk_path)
-
-                LOG.debug("Reconnecting copied base VHD "
-                          "%(dest_base_disk_path)s and diff "
-                          "VHD %(dest_vhd_path)s",
-                          {'dest_base_disk_path': dest_base_disk_path,
-                           'dest_vhd_path': dest_vhd_path})
-                self._vhdutils.reconnect_parent_vhd(dest_vhd_path,
-                                                    dest_base_disk_path)
-
-                LOG.debug("Merging base disk %(dest_base_disk_path)s and "
-                          "diff disk %(dest_vhd_path)s",
-                          {'dest_base_disk_path': dest_base_disk_path,
-                           'dest_vhd_path': dest_vhd_path})
-                self._vhdutils.merge_vhd(dest_vhd_path, dest_base_disk_path)
-                image_vhd_path = dest_base_disk_path
-
             LOG.debug("Updating Glance image %(image_id)s with content from "
-                      "merged disk %(image_vhd_path)s",
-                      {'image_id': image_id, 'image_vhd_path': image_vhd_path})
+                      "disk %(src_vhd_path)s",
+                      {'image_id': image_id, 'src_vhd_path': src_vhd_path})
             update_task_state(task_state=task_states.IMAGE_UPLOADING,
                               expected_state=task_states.IMAGE_PENDING_UPLOAD)
-            self._save_glance_image(context, image_id, image_vhd_path)
+
+            # The VM snapshot keeps the root disk chain read-only until it
+            # is removed, as the instance writes to a new differencing
+            # disk. The image can be uploaded directly from it.
+            image_uploaded = False
+            if src_base_disk_path or CONF.hyperv.compact_snapshot_images:
+                image_uploaded = self._upload_flattened_vhd(
+                    context, image_id, src_vhd_path, src_base_disk_path)
+
+            if image_uploaded:
+                LOG.debug("Uploaded flattened disk %s", src_vhd_path)
+            elif not src_base_disk_path:
+                self._save_glance_image(context, image_id, src_vhd_path)
+            else:
+                export_dir = self._pathutils.get_export_dir(instance_name)
+                image_vhd_path = self._export_merged_vhd(
+                    src_vhd_path, src_base_disk_path, export_dir)
+                self._save_glance_image(context, image_id, image_vhd_path)
 
             LOG.debug("Snapshot image %(image_id)s updated for VM "
                       "%(instance_name)s",
@@ -121,3 +146,67 @@ class SnapshotOps(object):
             if export_dir:
                 LOG.debug('Removing directory: %s', export_dir)
                 self._pathutils.rmtree(export_dir)
+
+    def _upload_flattened_vhd(self, context, image_id, src_vhd_path,
+                              src_base_disk_path=None):
+        """Uploads the flattened disk chain as a dynamic VHD.
+
+        The chain is merged while being uploaded, without using temporary
+        files. Returns False if the chain cannot be stored as a VHD.
+        """
+        with vhdreader.VHDChainReader(
+                src_vhd_path, parent_path=src_base_disk_path) as vhd_chain:
+            if vhd_chain.virtual_size > vhdreader.VHD_MAX_VIRTUAL_SIZE:
+                LOG.debug("The virtual size of %s exceeds the maximum VHD "
+                          "size. The disk chain will be merged using the "
+                          "image management service.", src_vhd_path)
+                return False
+
+            self._upload_glance_image(
+                context, image_id, vhd_chain.get_dynamic_vhd_stream(
+                    skip_zero_blocks=CONF.hyperv.compact_snapshot_images))
+        return True
+
+    def _export_merged_vhd(self, src_vhd_path, src_base_disk_path,
+                           export_dir):
+        """Merges a copy of the given differencing disk into its parent.
+
+        Returns the path of the merged disk.
+        """
+        dest_vhd_path = os.path.join(export_dir, os.path.basename(
+            src_vhd_path))
+        dest_base_disk_path = os.path.join(
+            export_dir, os.path.basename(src_base_disk_path))
+
+        # The disks are copied concurrently, the copies being performed
+        # by external processes.
+        LOG.debug('Copying VHD %(src_vhd_path)s and base disk '
+                  '%(src_base_disk_path)s to %(export_dir)s',
+                  {'src_vhd_path': src_vhd_path,
+                   'src_base_disk_path': src_base_disk_path,
+                   'export_dir': export_dir})
+        copy_pool = eventlet.GreenPool()
+        copy_threads = [
+            copy_pool.spawn(self._pathutils.copyfile, src_path, dest_path)
+            for src_path, dest_path in [
+                (src_vhd_path, dest_vhd_path),
+                (src_base_disk_path, dest_base_disk_path)]]
+        copy_pool.waitall()
+        for copy_thread in copy_threads:
+            # Propagates copy errors.
+            copy_thread.wait()
+
+        LOG.debug("Reconnecting copied base VHD "
+                  "%(dest_base_disk_path)s and diff "
+                  "VHD %(dest_vhd_path)s",
+                  {'dest_base_disk_path': dest_base_disk_path,
+                   'dest_vhd_path': dest_vhd_path})
+        self._vhdutils.reconnect_parent_vhd(dest_vhd_path,
+                                            dest_base_disk_path)
+
+        LOG.debug("Merging base disk %(dest_base_disk_path)s and "
+                  "diff disk %(dest_vhd_path)s",
+                  {'dest_base_disk_path': dest_base_disk_path,
+                   'dest_vhd_path': dest_vhd_path})
+        self._vhdutils.merge_vhd(dest_vhd_path, dest_base_disk_path)
+        return dest_base_disk_path
@@ -0,0 +1,650 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Block level reader for VHD and VHDX differencing disk chains.
+
+The virtual disk content is resolved through the block allocation tables
+and sector bitmaps of each disk in the chain, allowing the chain to be
+flattened into a dynamic VHD without using the Hyper-V image management
+service.
+
+Official VHD format specs can be retrieved at:
+http://technet.microsoft.com/en-us/library/bb676673.aspx
+See "Download the Specifications Without Registering"
+
+Official VHDX format specs can be retrieved at:
+http://www.microsoft.com/en-us/download/details.aspx?id=34750
+"""
+import os
+import struct
+import uuid
+
+from oslo_log import log as logging
+from oslo_utils import units
+
+from hyperv.i18n import _
+from hyperv.nova import constants
+from hyperv.nova import vhdutils
+from hyperv.nova import vmutils
+
+LOG = logging.getLogger(__name__)
+
+VHD_SECTOR_SIZE = 512
+VHD_FOOTER_SIZE = 512
+VHD_DYNAMIC_HEADER_SIZE = 1024
+VHD_DYNAMIC_HEADER_SIGNATURE = 'cxsparse'
+VHD_UNALLOCATED_BLOCK = 0xFFFFFFFF
+VHD_DEFAULT_BLOCK_SIZE = 2 * units.Mi
+VHD_MAX_VIRTUAL_SIZE = 2040 * units.Gi
+VHD_PARENT_LOCATOR_COUNT = 8
+
+VHDX_REGION_TABLE_OFFSET = 192 * units.Ki
+VHDX_REGION_TABLE_SIGNATURE = 'regi'
+VHDX_METADATA_TABLE_SIGNATURE = 'metadata'
+VHDX_HEADER_SIGNATURE = 'head'
+VHDX_HEADER_OFFSETS = [64 * units.Ki, 128 * units.Ki]
+VHDX_BAT_REGION_GUID = uuid.UUID('2dc27766-f623-4200-9d64-115e9bfd4a08')
+VHDX_METADATA_REGION_GUID = uuid.UUID('8b7ca206-4790-4b9a-b8fe-575f050f886e')
+VHDX_FILE_PARAMETERS_GUID = uuid.UUID('caa16737-fa36-4d43-b3b6-33f0aa44e76b')
+VHDX_VIRTUAL_DISK_SIZE_GUID = uuid.UUID(
+    '2fa54224-cd1b-4876-b211-5dbed83bf4b8')
+VHDX_LOGICAL_SECTOR_SIZE_GUID = uuid.UUID(
+    '8141bf1d-a96f-4709-ba47-f233a8faab5f')
+VHDX_PARENT_LOCATOR_GUID = uuid.UUID('a8d35f2d-b30b-454d-abf7-d3d84834ab0c')
+VHDX_HAS_PARENT_FLAG = 2
+VHDX_CHUNK_SECTOR_COUNT = 1 << 23
+
+VHDX_PAYLOAD_BLOCK_ZERO = 2
+VHDX_PAYLOAD_BLOCK_FULLY_PRESENT = 6
+VHDX_PAYLOAD_BLOCK_PARTIALLY_PRESENT = 7
+VHDX_SB_BLOCK_PRESENT = 6
+
+
+def _get_bitmap_runs(bitmap, first_bit, bit_count, msb_first=False):
+    """Returns the (first_bit, bit_count) runs of set bits in a bitmap."""
+    runs = []
+    run_start = None
+    end = first_bit + bit_count
+    bit = first_bit
+    while bit < end:
+        byte = bitmap[bit // 8]
+        if not bit % 8 and bit + 8 <= end and byte in (0, 0xFF):
+            # Whole bytes are checked at once.
+            present = byte == 0xFF
+            step = 8
+        else:
+            shift = 7 - bit % 8 if msb_first else bit % 8
+            present = (byte >> shift) & 1
+            step = 1
+
+        if present and run_start is None:
+            run_start = bit
+        elif not present and run_start is not None:
+            runs.append((run_start, bit - run_start))
+            run_start = None
+        bit += step
+
+    if run_start is not None:
+        runs.append((run_start, end - run_start))
+    return runs
+
+
+class _VirtualDiskFile(object):
+    """Base class for the disks which are part of a chain."""
+
+    def __init__(self, path):
+        self.path = path
+        self.virtual_size = 0
+        self.parent_paths = []
+        self._file = open(path, 'rb')
+
+    @property
+    def is_differencing(self):
+        return bool(self.parent_paths)
+
+    def close(self):
+        self._file.close()
+
+    def read(self, file_offset, length):
+        self._file.seek(file_offset)
+        data = self._file.read(length)
+        if len(data) != length:
+            raise vmutils.HyperVException(
+                _("Unexpected end of file while reading virtual disk "
+                  "%(path)s at offset %(offset)s") %
+                {'path': self.path, 'offset': file_offset})
+        return data
+
+    def get_extents(self, offset, length):
+        """Returns the ranges of the given area stored by this disk.
+
+        The ranges are returned in order as (offset, length, file_offset)
+        tuples, file_offset being None for ranges explicitly zeroed.
+        Areas that are not covered by those ranges are resolved using the
+        parent disk or, in case of disks without a parent, are zeroed.
+        """
+        raise NotImplementedError()
+
+    def _get_block_extents(self, offset, length, block_size, get_extents):
+        # Splits the requested area by blocks, clamping it to the virtual
+        # disk size as a parent disk may be smaller than its child.
+        extents = []
+        end = min(offset + length, self.virtual_size)
+        while offset < end:
+            block_index = offset // block_size
+            block_offset = offset % block_size
+            chunk_length = min(block_size - block_offset, end - offset)
+            extents += get_extents(block_index, block_offset, chunk_length)
+            offset += chunk_length
+        return extents
+
+
+class VHDFile(_VirtualDiskFile):
+    _DISK_TYPE_FIXED = constants.VHD_TYPE_FIXED
+    _DISK_TYPE_DIFFERENCING = 4
+    _PARENT_LOCATOR_CODES = ['W2ku', 'W2ru']
+
+    def __init__(self, path):
+        super(VHDFile, self).__init__(path)
+
+        try:
+            self._file.seek(-VHD_FOOTER_SIZE, 2)
+            footer = self._file.read(VHD_FOOTER_SIZE)
+            if footer[:8] != vhdutils.VHD_SIGNATURE:
+                raise vmutils.HyperVException(_("Invalid VHD footer in %s") %
+                                              path)
+
+            (dynamic_header_offset,) = struct.unpack_from('>Q', footer, 16)
+            (self.virtual_size,) = struct.unpack_from('>Q', footer, 48)
+            (self._disk_type,) = struct.unpack_from('>I', footer, 60)
+
+            if self._disk_type != self._DISK_TYPE_FIXED:
+                self._read_dynamic_header(dynamic_header_offset)
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def is_differencing(self):
+        return self._disk_type == self._DISK_TYPE_DIFFERENCING
+
+    def _read_dynamic_header(self, header_offset):
+        header = self.read(header_offset, VHD_DYNAMIC_HEADER_SIZE)
+        if header[:8] != VHD_DYNAMIC_HEADER_SIGNATURE:
+            raise vmutils.HyperVException(
+                _("Invalid VHD dynamic disk header in %s") % self.path)
+
+        (bat_offset,) = struct.unpack_from('>Q', header, 16)
+        (bat_entries, self.block_size) = struct.unpack_from('>II', header, 28)
+        self._bat = struct.unpack('>%dI' % bat_entries,
+                                  self.read(bat_offset, bat_entries * 4))
+
+        sectors_per_block = self.block_size // VHD_SECTOR_SIZE
+        bitmap_size = (sectors_per_block + 7) // 8
+        self._bitmap_size = (
+            (bitmap_size + VHD_SECTOR_SIZE - 1) //
+            VHD_SECTOR_SIZE * VHD_SECTOR_SIZE)
+
+        if self._disk_type == self._DISK_TYPE_DIFFERENCING:
+            self._read_parent_locators(header)
+
+    def _read_parent_locators(self, header):
+        for idx in range(VHD_PARENT_LOCATOR_COUNT):
+            locator_offset = 576 + idx * 24
+            (code, _data_space, data_length, _reserved,
+             data_offset) = struct.unpack_from('>4sIIIQ', header,
+                                               locator_offset)
+            if code in self._PARENT_LOCATOR_CODES and data_length:
+                parent_path = self.read(data_offset, data_length).decode(
+                    'utf-16-le').rstrip(u'\x00')
+                self.parent_paths.insert(
+                    self._PARENT_LOCATOR_CODES.index(code), parent_path)
+
+        parent_name = header[64:576].decode('utf-16-be').rstrip(u'\x00')
+        if parent_name:
+            self.parent_paths.append(parent_name)
+
+    def get_extents(self, offset, length):
+        if self._disk_type == self._DISK_TYPE_FIXED:
+            end = min(offset + length, self.virtual_size)
+            if offset >= end:
+                return []
+            return [(offset, end - offset, offset)]
+
+        return self._get_block_extents(offset, length, self.block_size,
+                                       self._get_dynamic_block_extents)
+
+    def _get_dynamic_block_extents(self, block_index, block_offset, length):
+        if block_index >= len(self._bat):
+            return []
+        block_sector = self._bat[block_index]
+        if block_sector == VHD_UNALLOCATED_BLOCK:
+            return []
+
+        block_file_offset = block_sector * VHD_SECTOR_SIZE
+        data_file_offset = block_file_offset + self._bitmap_size
+        virtual_block_offset = block_index * self.block_size
+
+        if not self.is_differencing:
+            return [(virtual_block_offset + block_offset, length,
+                     data_file_offset + block_offset)]
+
+        # Sectors that are not marked in the bitmap of differencing disks
+        # are stored by the parent disk.
+        bitmap = bytearray(self.read(block_file_offset, self._bitmap_size))
+        first_sector = block_offset // VHD_SECTOR_SIZE
+        last_sector = (block_offset + length - 1) // VHD_SECTOR_SIZE
+        extents = []
+        for (run_sector, run_sector_count) in _get_bitmap_runs(
+                bitmap, first_sector, last_sector - first_sector + 1,
+                msb_first=True):
+            run_offset = max(run_sector * VHD_SECTOR_SIZE, block_offset)
+            run_end = min((run_sector + run_sector_count) * VHD_SECTOR_SIZE,
+                          block_offset + length)
+            extents.append((virtual_block_offset + run_offset,
+                            run_end - run_offset,
+                            data_file_offset + run_offset))
+        return extents
+
+
+class VHDXFile(_VirtualDiskFile):
+    _PARENT_LOCATOR_KEYS = ['absolute_win32_path', 'relative_path']
+
+    def __init__(self, path):
+        super(VHDXFile, self).__init__(path)
+
+        try:
+            if self.read(0, 8) != vhdutils.VHDX_SIGNATURE:
+                raise vmutils.HyperVException(
+                    _("Invalid VHDX file identifier in %s") % path)
+            self._check_log()
+
+            regions = self._read_region_table()
+            self._read_metadata(*regions[VHDX_METADATA_REGION_GUID])
+            self._read_bat(*regions[VHDX_BAT_REGION_GUID])
+        except Exception:
+            self.close()
+            raise
+
+    def _check_log(self):
+        headers = []
+        for header_offset in VHDX_HEADER_OFFSETS:
+            header = self.read(header_offset, 80)
+            if header[:4] == VHDX_HEADER_SIGNATURE:
+                headers.append(header)
+        if not headers:
+            raise vmutils.HyperVException(_("Invalid VHDX headers in %s") %
+                                          self.path)
+
+        current_header = max(headers,
+                             key=lambda h: struct.unpack_from('<Q', h, 8))
+        if uuid.UUID(bytes_le=current_header[48:64]).int:
+            # The log must be replayed before the disk content can be read.
+            raise vmutils.HyperVException(
+                _("VHDX %s has a pending log") % self.path)
+
+    def _read_region_table(self):
+        header = self.read(VHDX_REGION_TABLE_OFFSET, 16)
+        if header[:4] != VHDX_REGION_TABLE_SIGNATURE:
+            raise vmutils.HyperVException(
+                _("Invalid VHDX region table in %s") % self.path)
+        (entry_count,) = struct.unpack_from('<I', header, 8)
+
+        entries = self.read(VHDX_REGION_TABLE_OFFSET + 16, entry_count * 32)
+        regions = {}
+        for idx in range(entry_count):
+            entry = entries[idx * 32:(idx + 1) * 32]
+            region_offset, region_length = struct.unpack_from('<QI', entry,
+                                                              16)
+            regions[uuid.UUID(bytes_le=entry[:16])] = (region_offset,
+                                                       region_length)
+        return regions
+
+    def _read_metadata(self, metadata_offset, metadata_length):
+        metadata = self.read(metadata_offset, metadata_length)
+        if metadata[:8] != VHDX_METADATA_TABLE_SIGNATURE:
+            raise vmutils.HyperVException(
+                _("Invalid VHDX metadata table in %s") % self.path)
+        (entry_count,) = struct.unpack_from('<H', metadata, 10)
+
+        items = {}
+        for idx in range(entry_count):
+            entry_offset = 32 + idx * 32
+            item_offset, item_length = struct.unpack_from(
+                '<II', metadata, entry_offset + 16)
+            items[uuid.UUID(bytes_le=metadata[entry_offset:
+                                              entry_offset + 16])] = (
+                metadata[item_offset:item_offset + item_length])
+
+        self.block_size, flags = struct.unpack_from(
+            '<II', items[VHDX_FILE_PARAMETERS_GUID])
+        (self.virtual_size,) = struct.unpack_from(
+            '<Q', items[VHDX_VIRTUAL_DISK_SIZE_GUID])
+        (self.logical_sector_size,) = struct.unpack_from(
+            '<I', items[VHDX_LOGICAL_SECTOR_SIZE_GUID])
+        self._chunk_ratio = (VHDX_CHUNK_SECTOR_COUNT *
+                             self.logical_sector_size // self.block_size)
+
+        if flags & VHDX_HAS_PARENT_FLAG:
+            self._read_parent_locator(items[VHDX_PARENT_LOCATOR_GUID])
+
+    def _read_parent_locator(self, locator):
+        (entry_count,) = struct.unpack_from('<H', locator, 18)
+        entries = {}
+        for idx in range(entry_count):
+            (key_offset, value_offset,
+             key_length, value_length) = struct.unpack_from(
+                '<IIHH', locator, 20 + idx * 12)
+            key = locator[key_offset:key_offset + key_length].decode(
+                'utf-16-le')
+            entries[key] = locator[value_offset:
+                                   value_offset + value_length].decode(
+                'utf-16-le')
+
+        self.parent_paths = [entries[key] for key in self._PARENT_LOCATOR_KEYS
+                             if entries.get(key)]
+        if not self.parent_paths:
+            raise vmutils.HyperVException(
+                _("Could not find the parent locator of VHDX %s") %
+                self.path)
+
+    def _read_bat(self, bat_offset, bat_length):
+        self._bat = struct.unpack('<%dQ' % (bat_length // 8),
+                                  self.read(bat_offset, bat_length))
+
+    def _get_bat_entry(self, entry_index):
+        if entry_index >= len(self._bat):
+            return 0, 0
+        entry = self._bat[entry_index]
+        return entry & 7, (entry >> 20) * units.Mi
+
+    def get_extents(self, offset, length):
+        return self._get_block_extents(offset, length, self.block_size,
+                                       self._get_payload_block_extents)
+
+    def _get_payload_block_extents(self, block_index, block_offset, length):
+        # Each chunk of payload blocks is followed by a sector bitmap block.
+        chunk_index = block_index // self._chunk_ratio
+        state, block_file_offset = self._get_bat_entry(
+            block_index + chunk_index)
+        virtual_offset = block_index * self.block_size + block_offset
+
+        if state == VHDX_PAYLOAD_BLOCK_FULLY_PRESENT:
+            return [(virtual_offset, length, block_file_offset + block_offset)]
+        elif not self.is_differencing:
+            return []
+        elif state == VHDX_PAYLOAD_BLOCK_ZERO:
+            return [(virtual_offset, length, None)]
+        elif state != VHDX_PAYLOAD_BLOCK_PARTIALLY_PRESENT:
+            return []
+
+        sb_state, sb_file_offset = self._get_bat_entry(
+            (chunk_index + 1) * (self._chunk_ratio + 1) - 1)
+        if sb_state != VHDX_SB_BLOCK_PRESENT:
+            raise vmutils.HyperVException(
+                _("Missing sector bitmap block in VHDX %s") % self.path)
+
+        sector_size = self.logical_sector_size
+        chunk_sector = ((block_index % self._chunk_ratio) * self.block_size +
+                        block_offset) // sector_size
+        sector_count = (block_offset + length - 1) // sector_size - (
+            block_offset // sector_size) + 1
+        # Only the bitmap bytes describing the requested sectors are read.
+        bitmap_offset = chunk_sector // 8
+        bitmap = bytearray(self.read(
+            sb_file_offset + bitmap_offset,
+            (chunk_sector % 8 + sector_count + 7) // 8))
+
+        extents = []
+        block_first_sector = (chunk_sector -
+                              block_offset // sector_size)
+        for run_sector, run_sector_count in _get_bitmap_runs(
+                bitmap, chunk_sector % 8, sector_count):
+            run_block_offset = (
+                (bitmap_offset * 8 + run_sector - block_first_sector) *
+                sector_size)
+            run_start = max(run_block_offset, block_offset)
+            run_end = min(run_block_offset + run_sector_count * sector_size,
+                          block_offset + length)
+            extents.append((virtual_offset + run_start - block_offset,
+                            run_end - run_start,
+                            block_file_offset + run_start))
+        return extents
+
+
+def open_virtual_disk(path):
+    """Opens a VHD or VHDX file, depending on its format."""
+    with open(path, 'rb') as f:
+        is_vhdx = f.read(8) == vhdutils.VHDX_SIGNATURE
+
+    if is_vhdx:
+        return VHDXFile(path)
+    return VHDFile(path)
+
+
+class VHDChainReader(object):
+    """Reads the virtual content of a differencing disk chain.
+
+    The parent disks are located using the paths stored by their child
+    disks. The parent of the top disk may be passed explicitly, for example
+    when the chain was copied from a different host.
+    """
+
+    def __init__(self, path, parent_path=None):
+        self._disks = []
+        try:
+            disk = open_virtual_disk(path)
+            self._disks.append(disk)
+            while disk.is_differencing:
+                if parent_path and len(self._disks) == 1:
+                    disk_parent_path = parent_path
+                else:
+                    disk_parent_path = self._lookup_parent_path(disk)
+                LOG.debug("Opening parent %(parent_path)s of virtual disk "
+                          "%(path)s",
+                          {'parent_path': disk_parent_path,
+                           'path': disk.path})
+                disk = open_virtual_disk(disk_parent_path)
+                self._disks.append(disk)
+        except Exception:
+            self.close()
+            raise
+
+        self.virtual_size = self._disks[0].virtual_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for disk in self._disks:
+            disk.close()
+
+    def _lookup_parent_path(self, disk):
+        disk_dir = os.path.dirname(disk.path)
+        for parent_path in disk.parent_paths:
+            # The paths are stored using the Windows path separator and may
+            # be relative to the directory of the child disk.
+            parent_path = os.path.join(disk_dir,
+                                       parent_path.replace('\\', os.sep))
+            if os.path.exists(parent_path):
+                return os.path.normpath(parent_path)
+
+        raise vmutils.HyperVException(
+            _("Could not find the parent of virtual disk %(path)s. "
+              "Parent locators: %(parent_paths)s") %
+            {'path': disk.path, 'parent_paths': disk.parent_paths})
+
+    def get_extents(self, offset, length):
+        """Resolves the given area down the chain.
+
+        Returns (offset, length, disk, file_offset) tuples, areas that are
+        not included being zeroed.
+        """
+        extents = []
+        pending = [(offset, length)]
+        for disk in self._disks:
+            unresolved = []
+            for pending_offset, pending_length in pending:
+                position = pending_offset
+                for (extent_offset, extent_length,
+                     file_offset) in disk.get_extents(pending_offset,
+                                                      pending_length):
+                    if extent_offset > position:
+                        unresolved.append((position,
+                                           extent_offset - position))
+                    extents.append((extent_offset, extent_length,
+                                    disk, file_offset))
+                    position = extent_offset + extent_length
+                pending_end = pending_offset + pending_length
+                if position < pending_end:
+                    unresolved.append((position, pending_end - position))
+
+            pending = unresolved
+            if not pending:
+                break
+        return extents
+
+    def is_allocated(self, offset, length):
+        return any(file_offset is not None for
+                   (_offset, _length, _disk, file_offset) in
+                   self.get_extents(offset, length))
+
+    def read(self, offset, length):
+        data = bytearray(length)
+        for (extent_offset, extent_length,
+             disk, file_offset) in self.get_extents(offset, length):
+            if file_offset is None:
+                continue
+            data_offset = extent_offset - offset
+            data[data_offset:data_offset + extent_length] = disk.read(
+                file_offset, extent_length)
+        return bytes(data)
+
+    def is_zeroed(self, offset, length):
+        return not self.read(offset, length).strip(b'\x00')
+
+    def iter_dynamic_vhd(self, block_size=VHD_DEFAULT_BLOCK_SIZE,
+                         skip_zero_blocks=False):
+        """Yields the content of a dynamic VHD flattening the chain.
+
+        Only the blocks allocated in at least one of the disks of the chain
+        are included. If requested, blocks containing only zeros are left
+        unallocated as well, at the cost of reading the allocated blocks
+        twice as the block allocation table precedes the blocks.
+        """
+        if self.virtual_size > VHD_MAX_VIRTUAL_SIZE:
+            raise vmutils.HyperVException(
+                _("The virtual size of %(path)s exceeds the maximum VHD "
+                  "size") % {'path': self._disks[0].path})
+
+        block_count = (self.virtual_size + block_size - 1) // block_size
+        allocated_blocks = [
+            block_index for block_index in range(block_count)
+            if self.is_allocated(block_index * block_size, block_size)]
+        if skip_zero_blocks:
+            allocated_block_count = len(allocated_blocks)
+            allocated_blocks = [
+                block_index for block_index in allocated_blocks
+                if not self.is_zeroed(block_index * block_size, block_size)]
+            LOG.debug("Skipping %(zero_block_count)d zeroed blocks out of "
+                      "%(block_count)d allocated blocks.",
+                      {'zero_block_count': (allocated_block_count -
+                                            len(allocated_blocks)),
+                       'block_count': allocated_block_count})
+
+        bat_size = block_count * 4
+        bat_size += -bat_size % VHD_SECTOR_SIZE
+        bitmap_size = block_size // VHD_SECTOR_SIZE // 8
+        bitmap_size += -bitmap_size % VHD_SECTOR_SIZE
+
+        bat_offset = VHD_FOOTER_SIZE + VHD_DYNAMIC_HEADER_SIZE
+        block_sector = (bat_offset + bat_size) // VHD_SECTOR_SIZE
+        bat = [VHD_UNALLOCATED_BLOCK] * block_count
+        for block_index in allocated_blocks:
+            bat[block_index] = block_sector
+            block_sector += (bitmap_size + block_size) // VHD_SECTOR_SIZE
+
+        footer = _get_vhd_footer(self.virtual_size)
+        yield footer
+        yield _get_vhd_dynamic_header(bat_offset, block_count, block_size)
+        yield struct.pack('>%dI' % block_count, *bat).ljust(bat_size, b'\xff')
+
+        bitmap = b'\xff' * bitmap_size
+        for block_index in allocated_blocks:
+            block_offset = block_index * block_size
+            data = self.read(block_offset,
+                             min(block_size,
+                                 self.virtual_size - block_offset))
+            yield bitmap
+            yield data.ljust(block_size, b'\x00')
+        yield footer
+
+    def export_dynamic_vhd(self, dest_path, skip_zero_blocks=False):
+        LOG.debug("Flattening virtual disk chain %(chain)s to %(dest_path)s",
+                  {'chain': [disk.path for disk in self._disks],
+                   'dest_path': dest_path})
+        with open(dest_path, 'wb') as f:
+            for data in self.iter_dynamic_vhd(
+                    skip_zero_blocks=skip_zero_blocks):
+                f.write(data)
+
+    def get_dynamic_vhd_stream(self, skip_zero_blocks=False):
+        """Returns a file like object flattening the chain."""
+        return _IteratorReader(self.iter_dynamic_vhd(
+            skip_zero_blocks=skip_zero_blocks))
+
+
+class _IteratorReader(object):
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._chunk = b''
+        self._position = 0
+
+    def read(self, size=-1):
+        data = []
+        while size:
+            if self._position >= len(self._chunk):
+                try:
+                    self._chunk = next(self._iterator)
+                except StopIteration:
+                    break
+                self._position = 0
+                continue
+
+            end = len(self._chunk)
+            if size > 0:
+                end = min(end, self._position + size)
+                size -= end - self._position
+            data.append(self._chunk[self._position:end])
+            self._position = end
+        return b''.join(data)
+
+
+def _get_vhd_footer(virtual_size):
+    return vhdutils.get_vhd_footer(virtual_size, constants.VHD_TYPE_DYNAMIC,
+                                   data_offset=VHD_FOOTER_SIZE)
+
+
+def _get_vhd_dynamic_header(bat_offset, block_count, block_size):
+    header = struct.pack(
+        '>8sQQIII', VHD_DYNAMIC_HEADER_SIGNATURE, 0xFFFFFFFFFFFFFFFF,
+        bat_offset, 0x00010000, block_count,
+        block_size).ljust(VHD_DYNAMIC_HEADER_SIZE, b'\x00')
+    return header[:36] + struct.pack(
+        '>I', vhdutils.get_vhd_checksum(header)) + header[40:]
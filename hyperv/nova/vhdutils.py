@@ -25,6 +25,8 @@ http://www.microsoft.com/en-us/download/details.aspx?id=34750
 """
 import struct
 import sys
+import time
+import uuid
 
 if sys.platform == 'win32':
     import wmi
@@ -46,6 +48,54 @@ VHD_BLK_SIZE_OFFSET = 544
 VHD_SIGNATURE = 'conectix'
 VHDX_SIGNATURE = 'vhdxfile'
 
+VHD_SECTOR_SIZE = 512
+VHD_NO_DATA_OFFSET = 0xFFFFFFFFFFFFFFFF
+VHD_FOOTER_CHECKSUM_OFFSET = 64
+VHD_FOOTER_DISK_TYPE_OFFSET = 60
+# Seconds between the Unix epoch and the VHD one (2000-01-01 00:00 UTC).
+VHD_EPOCH_OFFSET = 946684800
+
+
+def get_vhd_checksum(data):
+    return ~sum(bytearray(data)) & 0xFFFFFFFF
+
+
+def _get_vhd_geometry(virtual_size):
+    total_sectors = min(virtual_size // VHD_SECTOR_SIZE, 65535 * 16 * 255)
+    if total_sectors >= 65535 * 16 * 63:
+        sectors_per_track = 255
+        heads = 16
+        cylinder_times_heads = total_sectors // sectors_per_track
+    else:
+        sectors_per_track = 17
+        cylinder_times_heads = total_sectors // sectors_per_track
+        heads = max((cylinder_times_heads + 1023) // 1024, 4)
+        if cylinder_times_heads >= heads * 1024 or heads > 16:
+            sectors_per_track = 31
+            heads = 16
+            cylinder_times_heads = total_sectors // sectors_per_track
+        if cylinder_times_heads >= heads * 1024:
+            sectors_per_track = 63
+            heads = 16
+            cylinder_times_heads = total_sectors // sectors_per_track
+    return cylinder_times_heads // heads, heads, sectors_per_track
+
+
+def get_vhd_footer(virtual_size, vhd_type, data_offset=VHD_NO_DATA_OFFSET):
+    """Returns a new VHD footer, having a random unique id."""
+    cylinders, heads, sectors_per_track = _get_vhd_geometry(virtual_size)
+    footer = struct.pack(
+        '>8sIIQI4sI4sQQHBBII16sB',
+        VHD_SIGNATURE, 2, 0x00010000, data_offset,
+        max(int(time.time()) - VHD_EPOCH_OFFSET, 0), b'win ', 0x00060001,
+        b'Wi2k', virtual_size, virtual_size, cylinders, heads,
+        sectors_per_track, vhd_type, 0,
+        uuid.uuid4().bytes, 0).ljust(VHD_HEADER_SIZE_FIX, b'\x00')
+    checksum_end = VHD_FOOTER_CHECKSUM_OFFSET + 4
+    return (footer[:VHD_FOOTER_CHECKSUM_OFFSET] +
+            struct.pack('>I', get_vhd_checksum(footer)) +
+            footer[checksum_end:])
+
 
 class VHDUtils(object):
 
@@ -210,3 +260,35 @@ class VHDUtils(object):
 
     def get_best_supported_vhd_format(self):
         return constants.DISK_FORMAT_VHD
+
+    def convert_raw_to_fixed_vhd(self, path):
+        """Turns a raw disk image into a fixed VHD, in place.
+
+        A fixed VHD consists of the raw data followed by a footer, so only
+        the footer needs to be appended. The raw data is padded to a
+        multiple of the sector size.
+        """
+        with open(path, 'r+b') as f:
+            f.seek(0, 2)
+            raw_size = f.tell()
+            virtual_size = raw_size + (-raw_size % VHD_SECTOR_SIZE)
+
+            f.write(b'\x00' * (virtual_size - raw_size))
+            f.write(get_vhd_footer(virtual_size, constants.VHD_TYPE_FIXED))
+
+    def convert_fixed_vhd_to_raw(self, path):
+        """Turns a fixed VHD into a raw disk image, in place."""
+        with open(path, 'r+b') as f:
+            f.seek(0, 2)
+            file_size = f.tell()
+            if file_size >= VHD_HEADER_SIZE_FIX:
+                f.seek(-VHD_HEADER_SIZE_FIX, 2)
+                footer = f.read(VHD_HEADER_SIZE_FIX)
+                (vhd_type,) = struct.unpack_from(
+                    '>I', footer, VHD_FOOTER_DISK_TYPE_OFFSET)
+                if (footer.startswith(VHD_SIGNATURE) and
+                        vhd_type == constants.VHD_TYPE_FIXED):
+                    f.truncate(file_size - VHD_HEADER_SIZE_FIX)
+                    return
+
+        raise vmutils.HyperVException(_('Not a fixed VHD: %s') % path)
@@ -25,7 +25,7 @@ from eventlet import timeout as etimeout
 from nova.api.metadata import base as instance_metadata
 from nova.compute import vm_states
 from nova import exception
-from nova import utils
+from nova import version
 from nova.virt import configdrive
 from nova.virt import hardware
 from oslo_concurrency import processutils
@@ -40,6 +40,7 @@ from oslo_utils import uuidutils
 from hyperv.i18n import _, _LI, _LE, _LW
 from hyperv.nova import constants
 from hyperv.nova import imagecache
+from hyperv.nova import isowriter
 from hyperv.nova import serialconsoleops
 from hyperv.nova import utilsfactory
 from hyperv.nova import vif as vif_utils
@@ -58,12 +59,19 @@ hyperv_opts = [
                 help='Sets the admin password in the config drive image'),
     cfg.StrOpt('qemu_img_cmd',
                default="qemu-img.exe",
+               deprecated_for_removal=True,
                help='Path of qemu-img command which is used to convert '
-                    'between different image types'),
+                    'between different image types. Not used anymore, as '
+                    'config drive images are converted in place.'),
     cfg.BoolOpt('config_drive_cdrom',
                 default=False,
                 help='Attaches the Config Drive image as a cdrom drive '
                      'instead of a disk drive'),
+    cfg.BoolOpt('config_drive_use_iso_writer',
+                default=False,
+                help='Builds the Config Drive ISO images in process instead '
+                     'of using the mkisofs command. The images include '
+                     'Joliet file names, without Rock Ridge extensions.'),
     cfg.BoolOpt('enable_instance_metrics_collection',
                 default=False,
                 help='Enables metrics collections for an instance by using '
@@ -94,6 +102,8 @@ CONF = cfg.CONF
 CONF.register_opts(hyperv_opts, 'hyperv')
 CONF.import_opt('use_cow_images', 'nova.virt.driver')
 
+CONFIG_DRIVE_LABEL = 'config-2'
+
 SHUTDOWN_TIME_INCREMENT = 5
 REBOOT_TYPE_SOFT = 'SOFT'
 REBOOT_TYPE_HARD = 'HARD'
@@ -408,33 +418,39 @@ class VMOps(object):
         LOG.info(_LI('Creating config drive at %(path)s'),
                  {'path': configdrive_path_iso}, instance=instance)
 
-        with configdrive.ConfigDriveBuilder(instance_md=inst_md) as cdb:
-            try:
-                cdb.make_drive(configdrive_path_iso)
-            except processutils.ProcessExecutionError as e:
-                with excutils.save_and_reraise_exception():
-                    LOG.error(_LE('Creating config drive failed with '
-                                  'error: %s'),
-                              e, instance=instance)
+        if CONF.hyperv.config_drive_use_iso_writer:
+            self._write_config_drive_iso(inst_md, configdrive_path_iso)
+        else:
+            with configdrive.ConfigDriveBuilder(instance_md=inst_md) as cdb:
+                try:
+                    cdb.make_drive(configdrive_path_iso)
+                except processutils.ProcessExecutionError as e:
+                    with excutils.save_and_reraise_exception():
+                        LOG.error(_LE('Creating config drive failed with '
+                                      'error: %s'),
+                                  e, instance=instance)
 
         if not CONF.hyperv.config_drive_cdrom:
             configdrive_path = self._pathutils.get_configdrive_path(
                 instance.name, constants.DISK_FORMAT_VHD, rescue=rescue)
-            utils.execute(CONF.hyperv.qemu_img_cmd,
-                          'convert',
-                          '-f',
-                          'raw',
-                          '-O',
-                          'vpc',
-                          configdrive_path_iso,
-                          configdrive_path,
-                          attempts=1)
-            self._pathutils.remove(configdrive_path_iso)
+            # The ISO image is turned into a fixed VHD by appending a
+            # footer, without copying its content.
+            self._vhdutils.convert_raw_to_fixed_vhd(configdrive_path_iso)
+            self._pathutils.rename(configdrive_path_iso, configdrive_path)
         else:
             configdrive_path = configdrive_path_iso
 
         return configdrive_path
 
+    def _write_config_drive_iso(self, inst_md, configdrive_path_iso):
+        iso_writer = isowriter.ISOWriter(
+            volume_id=CONFIG_DRIVE_LABEL,
+            publisher='OpenStack Compute %s' % (
+                version.version_string_with_package()))
+        for path, data in inst_md.metadata_for_config_drive():
+            iso_writer.add_file(path, data)
+        iso_writer.write(configdrive_path_iso)
+
     def _configure_remotefx(self, instance, config):
         if not CONF.hyperv.enable_remotefx:
             raise vmutils.HyperVException(
@@ -498,6 +514,8 @@ class VMOps(object):
                 self._volumeops.disconnect_volumes(block_device_info)
             else:
                 LOG.debug("Instance not found", instance=instance)
+                # The VM may have been removed by the hypervisor.
+                self._vmutils.forget_controller_slots(instance_name)
 
             if destroy_disks:
                 self._delete_disk_files(instance_name)
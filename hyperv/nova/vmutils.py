@@ -18,6 +18,7 @@
 Utility class for VM related operations on Hyper-V.
 """
 
+import functools
 import sys
 import time
 import uuid
@@ -26,8 +27,10 @@ if sys.platform == 'win32':
     import wmi
 
 from nova import exception
+from nova import utils
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 from oslo_utils import uuidutils
 
 from hyperv.i18n import _, _LW
@@ -61,6 +64,82 @@ class UnsupportedConfigDriveFormatException(HyperVException):
         super(HyperVException, self).__init__(message)
 
 
+# Controller slot allocators, grouped by VM name and keyed by the
+# controller path.
+_slot_allocators = {}
+
+
+def vm_slots_synchronized(func):
+    @functools.wraps(func)
+    def wrapper(self, vm_name, *args, **kwargs):
+        @utils.synchronized('%s-controller-slots' % vm_name)
+        def inner():
+            return func(self, vm_name, *args, **kwargs)
+        return inner()
+    return wrapper
+
+
+class ControllerSlotAllocator(object):
+    """Keeps track of the used slots of a disk controller.
+
+    The used slots are stored in a bitmap, so that free slots can be
+    found without iterating over the attached disks.
+    """
+
+    # Reserved slots whose disks do not show up as attached after this
+    # interval are considered free when re-seeding the allocator.
+    _PENDING_SLOT_TIMEOUT = 300
+
+    def __init__(self, slot_count, used_slots=()):
+        self._all_slots_mask = (1 << slot_count) - 1
+        self._bitmap = 0
+        # Reserved slots, mapped to the reservation time. The disks using
+        # them may not be attached yet.
+        self._pending_slots = {}
+        self.needs_reseed = False
+        self.reseed(used_slots)
+
+    def reseed(self, used_slots):
+        """Resets the used slots to the slots of the attached disks.
+
+        Slots reserved recently are still considered used, as the disks
+        using them may be in the process of being attached.
+        """
+        used_slots = set(used_slots)
+        expire_time = time.time() - self._PENDING_SLOT_TIMEOUT
+        self._pending_slots = dict(
+            (slot, reserve_time)
+            for slot, reserve_time in self._pending_slots.items()
+            if slot not in used_slots and reserve_time > expire_time)
+
+        self._bitmap = 0
+        for slot in used_slots.union(self._pending_slots):
+            self._bitmap |= 1 << slot
+        self.needs_reseed = False
+
+    def reserve(self, count=1):
+        free_slots_mask = ~self._bitmap & self._all_slots_mask
+        slots = []
+        while free_slots_mask and len(slots) < count:
+            lowest_free_slot_bit = free_slots_mask & -free_slots_mask
+            slots.append(lowest_free_slot_bit.bit_length() - 1)
+            free_slots_mask ^= lowest_free_slot_bit
+
+        if len(slots) < count:
+            raise HyperVException(_("Exceeded the maximum number of slots"))
+
+        reserve_time = time.time()
+        for slot in slots:
+            self._bitmap |= 1 << slot
+            self._pending_slots[slot] = reserve_time
+        return slots
+
+    def release(self, slots):
+        for slot in slots:
+            self._bitmap &= ~(1 << slot)
+            self._pending_slots.pop(slot, None)
+
+
 class VMUtils(object):
 
     # These constants can be overridden by inherited classes
@@ -83,10 +162,12 @@ class VMUtils(object):
     _SYNTHETIC_ETHERNET_PORT_SETTING_DATA_CLASS = \
     'Msvm_SyntheticEthernetPortSettingData'
     _AFFECTED_JOB_ELEMENT_CLASS = "Msvm_AffectedJobElement"
+    _DISK_DRIVE_CLASS = 'Msvm_DiskDrive'
     _CIM_RES_ALLOC_SETTING_DATA_CLASS = 'Cim_ResourceAllocationSettingData'
     _COMPUTER_SYSTEM_CLASS = "Msvm_ComputerSystem"
 
     _VM_ENABLED_STATE_PROP = "EnabledState"
+    _VM_CAPTION = "Virtual Machine"
 
     _SHUTDOWN_COMPONENT = "Msvm_ShutdownComponent"
     _VIRTUAL_SYSTEM_CURRENT_SETTINGS = 3
@@ -382,8 +463,14 @@ class VMUtils(object):
     def attach_scsi_drive(self, vm_name, path, drive_type=constants.DISK):
         vm = self._lookup_vm_check(vm_name)
         ctrller_path = self._get_vm_scsi_controller(vm)
-        drive_addr = self.get_free_controller_slot(ctrller_path)
-        self.attach_drive(vm_name, path, ctrller_path, drive_addr, drive_type)
+        drive_addr = self.reserve_controller_slots(vm_name, ctrller_path)[0]
+        try:
+            self.attach_drive(vm_name, path, ctrller_path, drive_addr,
+                              drive_type)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.release_controller_slots(vm_name, ctrller_path,
+                                              [drive_addr])
 
     def attach_ide_drive(self, vm_name, path, ctrller_addr, drive_addr,
                          drive_type=constants.DISK):
@@ -448,6 +535,29 @@ class VMUtils(object):
         diskdrive.HostResource = [mounted_disk_path]
         self._add_virt_resource(diskdrive, vm.path_())
 
+    def attach_volumes_to_controller(self, vm_name, controller_path,
+                                     volumes):
+        """Attach multiple volumes to a controller using a single job.
+
+            :param volumes: a list of (address, mounted_disk_path) tuples
+        """
+
+        vm = self._lookup_vm_check(vm_name)
+
+        diskdrives = []
+        for address, mounted_disk_path in volumes:
+            diskdrive = self._get_new_resource_setting_data(
+                self._PHYS_DISK_RES_SUB_TYPE)
+
+            self._set_disk_resource_address(diskdrive, address)
+            diskdrive.Parent = controller_path
+            diskdrive.HostResource = [mounted_disk_path]
+            diskdrives.append(diskdrive)
+        self._add_virt_resources(diskdrives, vm.path_())
+
+    def _set_disk_resource_address(self, disk_resource, address):
+        disk_resource.Address = address
+
     def _get_disk_resource_address(self, disk_resource):
         return disk_resource.Address
 
@@ -584,6 +694,7 @@ class VMUtils(object):
         # Remove the VM. Does not destroy disks.
         (job_path, ret_val) = vs_man_svc.DestroyVirtualSystem(vm.path_())
         self.check_ret_val(ret_val, job_path)
+        self.forget_controller_slots(vm_name)
 
     def check_ret_val(self, ret_val, job_path, success_values=[0]):
         if ret_val == constants.WMI_JOB_STATUS_STARTED:
@@ -637,8 +748,13 @@ class VMUtils(object):
 
     def _add_virt_resource(self, res_setting_data, vm_path):
         """Adds a new resource to the VM."""
+        return self._add_virt_resources([res_setting_data], vm_path)
+
+    def _add_virt_resources(self, res_setting_data_list, vm_path):
+        """Adds multiple resources to the VM using a single job."""
         vs_man_svc = self._conn.Msvm_VirtualSystemManagementService()[0]
-        res_xml = [res_setting_data.GetText_(1)]
+        res_xml = [res_setting_data.GetText_(1)
+                   for res_setting_data in res_setting_data_list]
         (job_path,
          new_resources,
          ret_val) = vs_man_svc.AddVirtualSystemResources(res_xml, vm_path)
@@ -698,6 +814,11 @@ class VMUtils(object):
             if not is_physical:
                 self._remove_virt_resource(parent, vm.path_())
 
+            # Physical disks are attached directly to the controller,
+            # while virtual disks are attached through a disk drive.
+            ctrller_resource = disk_resource if is_physical else parent
+            self._release_disk_resource_slot(vm_name, ctrller_resource)
+
     def _get_mounted_disk_resource_from_path(self, disk_path, is_physical):
         if is_physical:
             class_name = self._RESOURCE_ALLOC_SETTING_DATA_CLASS
@@ -729,6 +850,22 @@ class VMUtils(object):
         if len(mounted_disks):
             return mounted_disks[0].path_()
 
+    def get_attached_virtual_disk_paths(self):
+        """Returns the paths of the virtual hard disks attached to the VMs."""
+        disk_resources = self._conn.query(
+            "SELECT * FROM %(class_name)s "
+            "WHERE ResourceSubType = '%(res_sub_type)s'" %
+            {'class_name': self._STORAGE_ALLOC_SETTING_DATA_CLASS,
+             'res_sub_type': self._HARD_DISK_RES_SUB_TYPE})
+
+        disk_paths = []
+        for disk_resource in disk_resources:
+            conn = getattr(disk_resource, self._VIRT_DISK_CONNECTION_ATTR,
+                           None)
+            if conn:
+                disk_paths.append(conn[0])
+        return disk_paths
+
     def get_controller_volume_paths(self, controller_path):
         disks = self._conn.query("SELECT * FROM %(class_name)s "
                                  "WHERE ResourceSubType = '%(res_sub_type)s' "
@@ -755,6 +892,75 @@ class VMUtils(object):
                 return slot
         raise HyperVException(_("Exceeded the maximum number of slots"))
 
+    @vm_slots_synchronized
+    def reserve_controller_slots(self, vm_name, scsi_controller_path,
+                                 count=1):
+        """Reserves free SCSI controller slots, returning their addresses.
+
+        The attached disks are retrieved only once per controller, the
+        allocator being re-seeded from them if it runs out of slots or
+        if an attach failed. The reserved slots must be released if the
+        disks cannot be attached.
+        """
+        vm_allocators = _slot_allocators.setdefault(vm_name, {})
+        allocator_key = self._get_slot_allocator_key(scsi_controller_path)
+        allocator = vm_allocators.get(allocator_key)
+        if not allocator:
+            allocator = ControllerSlotAllocator(
+                constants.SCSI_CONTROLLER_SLOTS_NUMBER,
+                self._get_used_controller_slots(scsi_controller_path))
+            vm_allocators[allocator_key] = allocator
+        elif allocator.needs_reseed:
+            allocator.reseed(
+                self._get_used_controller_slots(scsi_controller_path))
+        else:
+            try:
+                return allocator.reserve(count)
+            except HyperVException:
+                # Disks may have been detached without going through
+                # this driver.
+                allocator.reseed(
+                    self._get_used_controller_slots(scsi_controller_path))
+        return allocator.reserve(count)
+
+    @vm_slots_synchronized
+    def release_controller_slots(self, vm_name, controller_path, slots):
+        """Releases slots reserved for disks that could not be attached.
+
+        As the state of the slots is not known after a failed attach, the
+        controller allocator is re-seeded on the next reservation.
+        """
+        allocator = _slot_allocators.get(vm_name, {}).get(
+            self._get_slot_allocator_key(controller_path))
+        if allocator:
+            allocator.release(slots)
+            allocator.needs_reseed = True
+
+    def _get_used_controller_slots(self, controller_path):
+        attached_disks = self.get_attached_disks(controller_path)
+        return [int(self._get_disk_resource_address(disk))
+                for disk in attached_disks]
+
+    @staticmethod
+    def _get_slot_allocator_key(controller_path):
+        # WMI object paths may or may not include the host name, while the
+        # namespace and the class name are case insensitive.
+        return controller_path.split(':', 1)[-1].lower()
+
+    @vm_slots_synchronized
+    def _release_disk_resource_slot(self, vm_name, disk_resource):
+        # Slots are tracked only for controllers used by the allocator.
+        allocator = _slot_allocators.get(vm_name, {}).get(
+            self._get_slot_allocator_key(disk_resource.Parent))
+        if allocator:
+            slot = int(self._get_disk_resource_address(disk_resource))
+            allocator.release([slot])
+
+    @vm_slots_synchronized
+    def forget_controller_slots(self, vm_name):
+        """Drops the slot allocators of a VM which left this host."""
+        _slot_allocators.pop(vm_name, None)
+
     def enable_vm_metrics_collection(self, vm_name):
         raise NotImplementedError(_("Metrics collection is not supported on "
                                     "this version of Hyper-V"))
@@ -788,12 +994,12 @@ class VMUtils(object):
 
     def get_active_instances(self):
         """Return the names of all the active instances known to Hyper-V."""
-        vm_names = self.list_instances()
-        vms = [self._lookup_vm(vm_name) for vm_name in vm_names]
-        active_vm_names = [v.ElementName for v in vms
-            if v.EnabledState == constants.HYPERV_VM_STATE_ENABLED]
-
-        return active_vm_names
+        # The host itself is also a Msvm_ComputerSystem instance.
+        vms = self._conn.Msvm_ComputerSystem(
+            ['ElementName'],
+            Caption=self._VM_CAPTION,
+            EnabledState=constants.HYPERV_VM_STATE_ENABLED)
+        return [v.ElementName for v in vms]
 
     def get_vm_gen(self, instance_name):
         return constants.VM_GEN_1
@@ -812,6 +1018,24 @@ class VMUtils(object):
         return self._conn.Msvm_ComputerSystem.watch_for(raw_wql=query,
                                                         fields=[field])
 
+    def get_disk_drive_arrival_listener(self, timeframe):
+        query = self._get_creation_event_wql_query(
+            cls=self._DISK_DRIVE_CLASS, timeframe=timeframe)
+        return self._conn.Msvm_DiskDrive.watch_for(raw_wql=query)
+
+    def _get_creation_event_wql_query(self, cls, timeframe):
+        """Return a WQL query used for polling WMI object creation events.
+
+            :param cls: the WMI class polled for events
+            :param timeframe: check for events that occurred in
+                              the specified timeframe
+        """
+        return ("SELECT * FROM __InstanceCreationEvent "
+                "WITHIN %(timeframe)s "
+                "WHERE TargetInstance ISA '%(class)s'" %
+                    {'class': cls,
+                     'timeframe': timeframe})
+
     def _get_event_wql_query(self, cls, field,
                              timeframe, filtered_states=None):
         """Return a WQL query used for polling WMI events.
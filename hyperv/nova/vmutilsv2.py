@@ -224,6 +224,9 @@ class VMUtilsV2(vmutils.VMUtils):
 
         self._add_virt_resource(diskdrive, vm.path_())
 
+    def _set_disk_resource_address(self, disk_resource, address):
+        disk_resource.AddressOnParent = address
+
     def _get_disk_resource_address(self, disk_resource):
         return disk_resource.AddressOnParent
 
@@ -247,11 +250,13 @@ class VMUtilsV2(vmutils.VMUtils):
         # Remove the VM. It does not destroy any associated virtual disk.
         (job_path, ret_val) = vs_man_svc.DestroySystem(vm.path_())
         self.check_ret_val(ret_val, job_path)
+        self.forget_controller_slots(vm_name)
 
-    def _add_virt_resource(self, res_setting_data, vm_path):
-        """Adds a new resource to the VM."""
+    def _add_virt_resources(self, res_setting_data_list, vm_path):
+        """Adds multiple resources to the VM using a single job."""
         vs_man_svc = self._conn.Msvm_VirtualSystemManagementService()[0]
-        res_xml = [res_setting_data.GetText_(1)]
+        res_xml = [res_setting_data.GetText_(1)
+                   for res_setting_data in res_setting_data_list]
         (job_path,
          new_resources,
          ret_val) = vs_man_svc.AddResourceSettings(vm_path, res_xml)
@@ -18,18 +18,26 @@
 Management class for Storage-related functions (attach, detach, etc).
 """
 import collections
+import functools
 import os
 import re
+import sys
 import time
 
+if sys.platform == 'win32':
+    import wmi
+
+import eventlet
 from nova import exception
+from nova import utils
 from nova.virt import driver
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_service import loopingcall
 from oslo_utils import excutils
 from oslo_utils import units
 
-from hyperv.i18n import _, _LE, _LW
+from hyperv.i18n import _, _LE, _LI, _LW
 from hyperv.nova import utilsfactory
 from hyperv.nova import vmutils
 
@@ -50,6 +58,36 @@ hyper_volumeops_opts = [
                default=5,
                help='Interval between checks for a mounted iSCSI '
                     'disk, in seconds.'),
+    cfg.BoolOpt('volume_batch_attach',
+                default=False,
+                help='Attach the volumes of an instance being spawned in a '
+                     'single batch. Each iSCSI target is logged in once for '
+                     'all its volumes and the disks are added to the '
+                     'instance using a single WMI call.'),
+    cfg.IntOpt('iscsi_session_linger_time',
+               default=0,
+               help='The number of seconds for which iSCSI target sessions '
+                    'are kept after the last volume exported by the target '
+                    'is disconnected, avoiding logging out and back in when '
+                    'such volumes are attached shortly after. 0 disables '
+                    'lingering.'),
+    cfg.IntOpt('iscsi_session_stats_log_interval',
+               default=0,
+               help='The interval, in seconds, at which the iSCSI target '
+                    'session counters are logged. If set to 0, the '
+                    'counters are not logged.'),
+    cfg.IntOpt('smbfs_share_linger_time',
+               default=0,
+               help='The number of seconds for which SMB shares are kept '
+                    'mounted after the last volume stored on them is '
+                    'disconnected. 0 disables lingering.'),
+    cfg.IntOpt('smbfs_share_check_interval',
+               default=60,
+               help='Interval between checks of the SMB shares mounted by '
+                    'this service, in seconds. Shares that are no longer '
+                    'available are remounted when attaching volumes. 0 '
+                    'disables the checks, in which case the SMB mappings '
+                    'are verified on each attach.'),
 ]
 
 CONF = cfg.CONF
@@ -57,6 +95,43 @@ CONF.register_opts(hyper_volumeops_opts, 'hyperv')
 CONF.import_opt('host', 'nova.netconf')
 CONF.import_opt('my_ip', 'nova.netconf')
 
+# The iSCSI target sessions are shared by all the instances using volumes
+# exported by a given target, for which reason the number of volumes in use
+# is tracked per target.
+_target_users = collections.Counter()
+_idle_target_logouts = {}
+_target_session_stats = collections.Counter()
+_session_stats_log_loop = []
+
+# SMB shares mounted by this service, along with the paths of the volume
+# disks stored on each of them which are in use. The disk paths are
+# tracked instead of a volume count as the same volume may be passed again
+# when the instance is powered on or when its volumes are reconnected.
+_mounted_shares = set()
+_share_users = collections.defaultdict(set)
+_idle_share_unmounts = {}
+_share_check_loop = []
+
+
+def target_synchronized(func):
+    @functools.wraps(func)
+    def wrapper(self, target_iqn, *args, **kwargs):
+        @utils.synchronized('iscsi-target-%s' % target_iqn)
+        def inner():
+            return func(self, target_iqn, *args, **kwargs)
+        return inner()
+    return wrapper
+
+
+def share_synchronized(func):
+    @functools.wraps(func)
+    def wrapper(self, export_path, *args, **kwargs):
+        @utils.synchronized('smbfs-share-%s' % export_path)
+        def inner():
+            return func(self, export_path, *args, **kwargs)
+        return inner()
+    return wrapper
+
 
 class VolumeOps(object):
     """Management class for Volume-related tasks
@@ -84,6 +159,17 @@ class VolumeOps(object):
     def attach_volumes(self, block_device_info, instance_name, ebs_root):
         mapping = driver.block_device_info_get_mapping(block_device_info)
 
+        if CONF.hyperv.volume_batch_attach and len(mapping) > 1:
+            connection_infos = [vol['connection_info'] for vol in mapping]
+            driver_types = set([connection_info.get('driver_volume_type')
+                                for connection_info in connection_infos])
+            # The volumes are attached in the order in which they are
+            # mapped, so batches cannot span multiple volume drivers.
+            if len(driver_types) == 1:
+                self._attach_volumes_batch(connection_infos, instance_name,
+                                           ebs_root)
+                return
+
         if ebs_root:
             self.attach_volume(mapping[0]['connection_info'],
                                instance_name, True)
@@ -91,6 +177,17 @@ class VolumeOps(object):
         for vol in mapping:
             self.attach_volume(vol['connection_info'], instance_name)
 
+    def _attach_volumes_batch(self, connection_infos, instance_name,
+                              ebs_root):
+        volume_driver = self._get_volume_driver(
+            connection_info=connection_infos[0])
+        volume_driver.attach_volumes(connection_infos, instance_name,
+                                     ebs_root)
+
+        for connection_info in connection_infos:
+            self._set_volume_qos_specs(volume_driver, connection_info,
+                                       instance_name)
+
     def disconnect_volumes(self, block_device_info):
         mapping = driver.block_device_info_get_mapping(block_device_info)
         block_devices = self._group_block_devices_by_type(
@@ -103,7 +200,11 @@ class VolumeOps(object):
         volume_driver = self._get_volume_driver(
             connection_info=connection_info)
         volume_driver.attach_volume(connection_info, instance_name, ebs_root)
+        self._set_volume_qos_specs(volume_driver, connection_info,
+                                   instance_name)
 
+    def _set_volume_qos_specs(self, volume_driver, connection_info,
+                              instance_name):
         qos_specs = connection_info['data'].get('qos_specs') or {}
         min_iops, max_iops = self.parse_disk_qos_specs(qos_specs)
         if min_iops or max_iops:
@@ -205,11 +306,19 @@ class VolumeOps(object):
 
 
 class ISCSIVolumeDriver(object):
+    # Disk creation events are checked without blocking, as the WMI calls
+    # would otherwise block the whole process.
+    _EVENT_WAIT_TIMEOUT = 0
+    _DISK_EVENT_TIMEFRAME = 1
+    _DISK_EVENT_CHECK_INTERVAL = 0.2
+    _DEVICE_POLL_MIN_INTERVAL = 0.5
+
     def __init__(self):
         self._vmutils = utilsfactory.get_vmutils()
         self._volutils = utilsfactory.get_volumeutils()
+        self._event_listeners = {}
 
-    def login_storage_target(self, connection_info):
+    def login_storage_target(self, connection_info, wait_for_device=True):
         data = connection_info['data']
         target_lun = data['target_lun']
         target_iqn = data['target_iqn']
@@ -225,6 +334,16 @@ class ISCSIVolumeDriver(object):
                  {'target_iqn': target_iqn,
                   'auth_method': auth_method})
 
+        self._acquire_target_session(target_iqn, target_lun, target_portal,
+                                     auth_username, auth_password,
+                                     wait_for_device)
+
+    @target_synchronized
+    def _acquire_target_session(self, target_iqn, target_lun, target_portal,
+                                auth_username=None, auth_password=None,
+                                wait_for_device=True):
+        self._cancel_idle_target_logout(target_iqn)
+
         # Check if we already logged in
         if self._volutils.get_device_number_for_target(target_iqn, target_lun):
             LOG.debug("Already logged in on storage target. No need to "
@@ -232,6 +351,7 @@ class ISCSIVolumeDriver(object):
                       "IQN: %(target_iqn)s, LUN: %(target_lun)s",
                       {'target_portal': target_portal,
                        'target_iqn': target_iqn, 'target_lun': target_lun})
+            _target_session_stats['reused_sessions'] += 1
         else:
             LOG.debug("Logging in on storage target. Portal: "
                       "%(target_portal)s, IQN: %(target_iqn)s, "
@@ -241,8 +361,13 @@ class ISCSIVolumeDriver(object):
             self._volutils.login_storage_target(target_lun, target_iqn,
                                                 target_portal, auth_username,
                                                 auth_password)
-            # Wait for the target to be mounted
-            self._get_mounted_disk_from_lun(target_iqn, target_lun, True)
+            _target_session_stats['logins'] += 1
+            if wait_for_device:
+                # Wait for the target to be mounted
+                self._get_mounted_disk_from_lun(target_iqn, target_lun, True)
+
+        _target_users[target_iqn] += 1
+        self._start_session_stats_log()
 
     def disconnect_volumes(self, block_device_mapping):
         iscsi_targets = collections.defaultdict(int)
@@ -253,22 +378,83 @@ class ISCSIVolumeDriver(object):
         for target_iqn, disconnected_luns in iscsi_targets.items():
             self.logout_storage_target(target_iqn, disconnected_luns)
 
+    @target_synchronized
     def logout_storage_target(self, target_iqn, disconnected_luns_count=1):
+        if _target_users[target_iqn] > disconnected_luns_count:
+            _target_users[target_iqn] -= disconnected_luns_count
+            LOG.debug("Skipping disconnecting target %s as there "
+                      "are LUNs still being used.", target_iqn)
+            return
+        _target_users.pop(target_iqn, None)
+
+        # Sessions established before the service was started are not
+        # tracked, for which reason the available LUNs are checked as well.
         total_available_luns = self._volutils.get_target_lun_count(
             target_iqn)
 
-        if total_available_luns == disconnected_luns_count:
-            LOG.debug("Logging off storage target %s", target_iqn)
-            self._volutils.logout_storage_target(target_iqn)
-        else:
+        if total_available_luns != disconnected_luns_count:
             LOG.debug("Skipping disconnecting target %s as there "
                       "are LUNs still being used.", target_iqn)
+        elif CONF.hyperv.iscsi_session_linger_time:
+            LOG.debug("Storage target %(target_iqn)s is idle. It will be "
+                      "logged off in %(linger_time)s seconds unless used "
+                      "again.",
+                      {'target_iqn': target_iqn,
+                       'linger_time': CONF.hyperv.iscsi_session_linger_time})
+            _idle_target_logouts[target_iqn] = eventlet.spawn_after(
+                CONF.hyperv.iscsi_session_linger_time,
+                self._logout_idle_target, target_iqn)
+            _target_session_stats['deferred_logouts'] += 1
+        else:
+            self._logout_target(target_iqn)
+
+    @target_synchronized
+    def _logout_idle_target(self, target_iqn):
+        # The logout may have been cancelled while waiting for the lock.
+        if _idle_target_logouts.pop(target_iqn, None):
+            self._logout_target(target_iqn)
+
+    def _cancel_idle_target_logout(self, target_iqn):
+        idle_target_logout = _idle_target_logouts.pop(target_iqn, None)
+        if idle_target_logout:
+            LOG.debug("Reusing idle storage target %s", target_iqn)
+            idle_target_logout.cancel()
+
+    def _logout_target(self, target_iqn):
+        LOG.debug("Logging off storage target %s", target_iqn)
+        self._volutils.logout_storage_target(target_iqn)
+        _target_session_stats['logouts'] += 1
+
+    def get_target_session_stats(self):
+        """Returns statistics about the iSCSI target sessions in use."""
+        stats = dict(_target_session_stats)
+        stats.update(active_targets=len(_target_users),
+                     volume_users=sum(_target_users.values()),
+                     idle_targets=len(_idle_target_logouts))
+        return stats
+
+    def _start_session_stats_log(self):
+        if (_session_stats_log_loop or
+                not CONF.hyperv.iscsi_session_stats_log_interval):
+            return
+
+        stats_log = loopingcall.FixedIntervalLoopingCall(
+            self._log_target_session_stats)
+        stats_log.start(
+            interval=CONF.hyperv.iscsi_session_stats_log_interval,
+            initial_delay=CONF.hyperv.iscsi_session_stats_log_interval)
+        _session_stats_log_loop.append(stats_log)
+
+    def _log_target_session_stats(self):
+        LOG.info(_LI("iSCSI target session stats: %s"),
+                 self.get_target_session_stats())
 
     def attach_volume(self, connection_info, instance_name, ebs_root=False):
         """Attach a volume to the SCSI controller or to the IDE controller if
         ebs_root is True
         """
         target_iqn = None
+        reserved_slot = None
         LOG.debug("Attach_volume: %(connection_info)s to %(instance_name)s",
                   {'connection_info': connection_info,
                    'instance_name': instance_name})
@@ -293,7 +479,9 @@ class ISCSIVolumeDriver(object):
                 # Find the SCSI controller for the vm
                 ctrller_path = self._vmutils.get_vm_scsi_controller(
                     instance_name)
-                slot = self._vmutils.get_free_controller_slot(ctrller_path)
+                slot = self._vmutils.reserve_controller_slots(
+                    instance_name, ctrller_path)[0]
+                reserved_slot = slot
 
             self._vmutils.attach_volume_to_controller(instance_name,
                                                       ctrller_path,
@@ -303,9 +491,143 @@ class ISCSIVolumeDriver(object):
             with excutils.save_and_reraise_exception():
                 LOG.error(_LE('Unable to attach volume to instance %s'),
                           instance_name)
+                if reserved_slot is not None:
+                    self._vmutils.release_controller_slots(
+                        instance_name, ctrller_path, [reserved_slot])
                 if target_iqn:
                     self.logout_storage_target(target_iqn)
 
+    def attach_volumes(self, connection_infos, instance_name,
+                       ebs_root=False):
+        """Attach multiple volumes to an instance.
+
+        The volumes are grouped by storage target, while the volumes
+        are attached to the SCSI controller using a single WMI call, in
+        the given order. If ebs_root is True, the first volume is attached
+        to the IDE controller. If any of the volumes cannot be attached,
+        all of them are rolled back.
+        """
+        LOG.debug("Attaching %(count)d volumes to %(instance_name)s",
+                  {'count': len(connection_infos),
+                   'instance_name': instance_name})
+        attached_root_disk_path = None
+        reserved_slots = []
+        # The volumes whose targets were logged in, which have to be
+        # released on failure.
+        connected_infos = []
+        try:
+            mounted_disk_paths = self._login_storage_targets(
+                connection_infos, connected_infos)
+
+            if ebs_root:
+                root_disk_path = mounted_disk_paths.pop(0)
+                ctrller_path = self._vmutils.get_vm_ide_controller(
+                    instance_name, 0)
+                self._vmutils.attach_volume_to_controller(instance_name,
+                                                          ctrller_path, 0,
+                                                          root_disk_path)
+                attached_root_disk_path = root_disk_path
+
+            if mounted_disk_paths:
+                ctrller_path = self._vmutils.get_vm_scsi_controller(
+                    instance_name)
+                reserved_slots = self._vmutils.reserve_controller_slots(
+                    instance_name, ctrller_path, len(mounted_disk_paths))
+                self._vmutils.attach_volumes_to_controller(
+                    instance_name, ctrller_path,
+                    zip(reserved_slots, mounted_disk_paths))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.error(_LE('Unable to attach volumes to instance %s'),
+                          instance_name)
+                if reserved_slots:
+                    self._vmutils.release_controller_slots(
+                        instance_name, ctrller_path, reserved_slots)
+                if attached_root_disk_path:
+                    self._vmutils.detach_vm_disk(instance_name,
+                                                 attached_root_disk_path)
+                self.disconnect_volumes(
+                    [{'connection_info': connection_info}
+                     for connection_info in connected_infos])
+
+    def _login_storage_targets(self, connection_infos, connected_infos):
+        """Logs in the storage targets of the given volumes.
+
+        All the targets are logged in first, the disks of all the volumes
+        being awaited at once afterwards. The volumes whose targets were
+        logged in are appended to connected_infos.
+
+        Returns the mounted disk paths, in the order of the given volumes.
+        """
+        target_volumes = collections.OrderedDict()
+        for connection_info in connection_infos:
+            target_iqn = connection_info['data']['target_iqn']
+            target_volumes.setdefault(target_iqn, []).append(
+                connection_info)
+
+        # The logins themselves are performed sequentially. The WMI and
+        # iscsicli calls block the whole process, so green threads would
+        # not overlap them, while WMI objects cannot be shared with native
+        # threads. The devices, which take most of the time to show up,
+        # are awaited together.
+        for volumes in target_volumes.values():
+            for connection_info in volumes:
+                self.login_storage_target(connection_info,
+                                          wait_for_device=False)
+                connected_infos.append(connection_info)
+
+        target_luns = [(connection_info['data']['target_iqn'],
+                        connection_info['data']['target_lun'])
+                       for connection_info in connection_infos]
+        mounted_disks = self._wait_for_mounted_disks(target_luns)
+        return [mounted_disks[target_lun] for target_lun in target_luns]
+
+    def _wait_for_mounted_disks(self, target_luns):
+        """Waits for the disks of all the given target LUNs at once.
+
+        Returns the mounted disk paths, by (target_iqn, target_lun).
+        """
+        target_luns = set(target_luns)
+        mounted_disks = {}
+
+        def get_mounted_disks():
+            for target_iqn, target_lun in target_luns - set(mounted_disks):
+                device_number = self._get_device_number(target_iqn,
+                                                        target_lun)
+                if device_number is None:
+                    continue
+                mounted_disk_path = (
+                    self._vmutils.get_mounted_disk_by_drive_number(
+                        device_number))
+                if mounted_disk_path:
+                    mounted_disks[(target_iqn, target_lun)] = (
+                        mounted_disk_path)
+            if len(mounted_disks) == len(target_luns):
+                return mounted_disks
+
+        timeout = (CONF.hyperv.mounted_disk_query_retry_count *
+                   CONF.hyperv.mounted_disk_query_retry_interval +
+                   CONF.hyperv.volume_attach_retry_count *
+                   CONF.hyperv.volume_attach_retry_interval)
+        found_disks = self._wait_for_device(
+            get_mounted_disks,
+            lambda: self._get_event_listener(
+                'Msvm_DiskDrive',
+                self._vmutils.get_disk_drive_arrival_listener),
+            timeout=timeout,
+            max_interval=CONF.hyperv.volume_attach_retry_interval)
+        if found_disks is None:
+            missing_targets = sorted(set(
+                target_iqn for target_iqn, target_lun
+                in target_luns - set(mounted_disks)))
+            raise exception.NotFound(_('Unable to find the mounted disks '
+                                       'for target_iqn: %s. Please ensure '
+                                       'that the host\'s SAN policy is set '
+                                       'to "OfflineAll" or '
+                                       '"OfflineShared"') %
+                                     ', '.join(missing_targets))
+        return mounted_disks
+
     def detach_volume(self, connection_info, instance_name):
         """Detach a volume to the SCSI controller."""
         LOG.debug("Detach_volume: %(connection_info)s "
@@ -327,36 +649,110 @@ class ISCSIVolumeDriver(object):
 
         self.logout_storage_target(target_iqn)
 
+    def _get_event_listener(self, event_type, get_listener):
+        if event_type not in self._event_listeners:
+            try:
+                listener = get_listener(self._DISK_EVENT_TIMEFRAME)
+            except wmi.x_wmi as exc:
+                LOG.warning(_LW("Could not subscribe to %(event_type)s "
+                                "events, polling will be used instead. "
+                                "Error: %(exc)s"),
+                            {'event_type': event_type, 'exc': exc})
+                listener = None
+            self._event_listeners[event_type] = listener
+        return self._event_listeners[event_type]
+
+    def _check_disk_arrival(self, listener):
+        # Consume all the pending events. Any new disk is just a hint that
+        # the device lookup should be retried.
+        disk_arrived = False
+        if listener:
+            while True:
+                try:
+                    listener(self._EVENT_WAIT_TIMEOUT)
+                    disk_arrived = True
+                except wmi.x_wmi_timed_out:
+                    break
+        return disk_arrived
+
+    def _wait_for_device(self, get_device, get_listener, timeout,
+                         max_interval):
+        """Returns the device as soon as it becomes available.
+
+        The device lookup is retried using an exponential backoff, or
+        right away if a disk creation event is received. The event
+        listener is only requested if the device is not available
+        already. None is returned if the device could not be found within
+        the specified timeout.
+        """
+        deadline = time.time() + timeout
+        poll_interval = min(self._DEVICE_POLL_MIN_INTERVAL, max_interval)
+        next_poll = 0
+        listener = None
+
+        while True:
+            now = time.time()
+            if (now >= next_poll or now >= deadline or
+                    self._check_disk_arrival(listener)):
+                device = get_device()
+                if device is not None:
+                    return device
+                if now >= deadline:
+                    return None
+
+                LOG.debug('Device not found yet. Retrying in at most '
+                          '%s seconds.', poll_interval)
+                next_poll = now + poll_interval
+                poll_interval = min(poll_interval * 2, max_interval)
+                if listener is None and get_listener:
+                    listener = get_listener()
+
+            if listener:
+                wait = self._DISK_EVENT_CHECK_INTERVAL
+            else:
+                wait = next_poll - now
+            time.sleep(max(0, min(wait, deadline - now)))
+
+    def _get_device_number(self, target_iqn, target_lun):
+        device_number = self._volutils.get_device_number_for_target(
+            target_iqn, target_lun)
+        if device_number not in (None, -1):
+            return device_number
+
     def _get_mounted_disk_from_lun(self, target_iqn, target_lun,
                                    wait_for_device=False):
         # The WMI query in get_device_number_for_target can incorrectly
         # return no data when the system is under load.  This issue can
         # be avoided by adding a retry.
-        for i in xrange(CONF.hyperv.mounted_disk_query_retry_count):
-            device_number = self._volutils.get_device_number_for_target(
-                target_iqn, target_lun)
-            if device_number in (None, -1):
-                attempt = i + 1
-                LOG.debug('Attempt %d to get device_number '
-                          'from get_device_number_for_target failed. '
-                          'Retrying...', attempt)
-                time.sleep(CONF.hyperv.mounted_disk_query_retry_interval)
-            else:
-                break
-
-        if device_number in (None, -1):
+        device_number = self._wait_for_device(
+            lambda: self._get_device_number(target_iqn, target_lun),
+            lambda: self._get_event_listener(
+                'MSFT_Disk', self._volutils.get_disk_arrival_listener),
+            timeout=(CONF.hyperv.mounted_disk_query_retry_count *
+                     CONF.hyperv.mounted_disk_query_retry_interval),
+            max_interval=CONF.hyperv.mounted_disk_query_retry_interval)
+
+        if device_number is None:
             raise exception.NotFound(_('Unable to find a mounted disk for '
                                        'target_iqn: %s') % target_iqn)
         LOG.debug('Device number: %(device_number)s, '
                   'target lun: %(target_lun)s',
                   {'device_number': device_number, 'target_lun': target_lun})
+
         # Finding Mounted disk drive
-        for i in range(0, CONF.hyperv.volume_attach_retry_count):
-            mounted_disk_path = self._vmutils.get_mounted_disk_by_drive_number(
-                device_number)
-            if mounted_disk_path or not wait_for_device:
-                break
-            time.sleep(CONF.hyperv.volume_attach_retry_interval)
+        if wait_for_device:
+            timeout = (CONF.hyperv.volume_attach_retry_count *
+                       CONF.hyperv.volume_attach_retry_interval)
+        else:
+            timeout = 0
+        mounted_disk_path = self._wait_for_device(
+            lambda: self._vmutils.get_mounted_disk_by_drive_number(
+                device_number),
+            lambda: self._get_event_listener(
+                'Msvm_DiskDrive',
+                self._vmutils.get_disk_drive_arrival_listener),
+            timeout=timeout,
+            max_interval=CONF.hyperv.volume_attach_retry_interval)
 
         if not mounted_disk_path:
             raise exception.NotFound(_('Unable to find a mounted disk for '
@@ -398,13 +794,17 @@ class SMBFSVolumeDriver(object):
         self._pathutils = utilsfactory.get_pathutils()
         self._vmutils = utilsfactory.get_vmutils()
         self._volutils = utilsfactory.get_volumeutils()
-        self._username_regex = re.compile(r'user(?:name)?=([^, ]+)')
-        self._password_regex = re.compile(r'pass(?:word)?=([^, ]+)')
+        self._credentials_regex = re.compile(
+            r'(user(?:name)?|pass(?:word)?)=([^, ]+)')
 
     def attach_volume(self, connection_info, instance_name, ebs_root=False):
-        self.ensure_share_mounted(connection_info)
-
+        export_path = self._get_export_path(connection_info)
         disk_path = self._get_disk_path(connection_info)
+        self._acquire_share(export_path,
+                            self._get_mount_options(connection_info),
+                            [disk_path])
+
+        reserved_slot = None
 
         try:
             if ebs_root:
@@ -414,7 +814,9 @@ class SMBFSVolumeDriver(object):
             else:
                 ctrller_path = self._vmutils.get_vm_scsi_controller(
                  instance_name)
-                slot = self._vmutils.get_free_controller_slot(ctrller_path)
+                slot = self._vmutils.reserve_controller_slots(
+                    instance_name, ctrller_path)[0]
+                reserved_slot = slot
 
             self._vmutils.attach_drive(instance_name,
                                        disk_path,
@@ -422,9 +824,80 @@ class SMBFSVolumeDriver(object):
                                        slot)
         except vmutils.HyperVException as exn:
             LOG.exception(_LE('Attach volume failed: %s'), exn)
+            if reserved_slot is not None:
+                self._vmutils.release_controller_slots(
+                    instance_name, ctrller_path, [reserved_slot])
+            self._release_share(export_path, [disk_path])
             raise vmutils.HyperVException(_('Unable to attach volume '
                                             'to instance %s') % instance_name)
 
+    def attach_volumes(self, connection_infos, instance_name,
+                       ebs_root=False):
+        """Attach multiple volumes to an instance.
+
+        The SCSI controller slots are reserved in a single pass. If ebs_root
+        is True, the first volume is attached to the IDE controller. If any
+        of the volumes cannot be attached, all of them are detached.
+        """
+        share_volumes = collections.OrderedDict()
+        share_opts = {}
+        for connection_info in connection_infos:
+            export_path = self._get_export_path(connection_info)
+            share_volumes.setdefault(export_path, []).append(
+                self._get_disk_path(connection_info))
+            share_opts.setdefault(export_path,
+                                  self._get_mount_options(connection_info))
+
+        acquired_shares = []
+        try:
+            for export_path, share_disk_paths in share_volumes.items():
+                self._acquire_share(export_path, share_opts[export_path],
+                                    share_disk_paths)
+                acquired_shares.append(export_path)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for export_path in acquired_shares:
+                    self._release_share(export_path,
+                                        share_volumes[export_path])
+
+        disk_paths = [self._get_disk_path(connection_info)
+                      for connection_info in connection_infos]
+        attached_disk_paths = []
+        pending_slots = []
+        try:
+            if ebs_root:
+                root_disk_path = disk_paths.pop(0)
+                ctrller_path = self._vmutils.get_vm_ide_controller(
+                    instance_name, 0)
+                self._vmutils.attach_drive(instance_name, root_disk_path,
+                                           ctrller_path, 0)
+                attached_disk_paths.append(root_disk_path)
+
+            if disk_paths:
+                ctrller_path = self._vmutils.get_vm_scsi_controller(
+                    instance_name)
+                pending_slots = self._vmutils.reserve_controller_slots(
+                    instance_name, ctrller_path, len(disk_paths))
+                for disk_path, slot in zip(disk_paths, list(pending_slots)):
+                    self._vmutils.attach_drive(instance_name, disk_path,
+                                               ctrller_path, slot)
+                    attached_disk_paths.append(disk_path)
+                    pending_slots.remove(slot)
+        except vmutils.HyperVException as exn:
+            LOG.exception(_LE('Attach volumes failed: %s'), exn)
+            # The slots of the attached disks are released when detaching
+            # them.
+            if pending_slots:
+                self._vmutils.release_controller_slots(
+                    instance_name, ctrller_path, pending_slots)
+            for disk_path in attached_disk_paths:
+                self._vmutils.detach_vm_disk(instance_name, disk_path,
+                                             is_physical=False)
+            for export_path, share_disk_paths in share_volumes.items():
+                self._release_share(export_path, share_disk_paths)
+            raise vmutils.HyperVException(_('Unable to attach volumes '
+                                            'to instance %s') % instance_name)
+
     def detach_volume(self, connection_info, instance_name):
         LOG.debug("Detaching volume: %(connection_info)s "
                   "from %(instance_name)s",
@@ -436,17 +909,18 @@ class SMBFSVolumeDriver(object):
 
         self._vmutils.detach_vm_disk(instance_name, disk_path,
                                      is_physical=False)
-        self._pathutils.unmount_smb_share(export_path)
+        self._release_share(export_path, [disk_path])
 
     def disconnect_volumes(self, block_device_mapping):
-        export_paths = set()
+        share_volumes = collections.OrderedDict()
         for vol in block_device_mapping:
             connection_info = vol['connection_info']
             export_path = self._get_export_path(connection_info)
-            export_paths.add(export_path)
+            share_volumes.setdefault(export_path, []).append(
+                self._get_disk_path(connection_info))
 
-        for export_path in export_paths:
-            self._pathutils.unmount_smb_share(export_path)
+        for export_path, disk_paths in share_volumes.items():
+            self._release_share(export_path, disk_paths)
 
     def _get_export_path(self, connection_info):
         return connection_info['data']['export'].replace('/', '\\')
@@ -457,31 +931,142 @@ class SMBFSVolumeDriver(object):
         disk_path = os.path.join(export, disk_name)
         return disk_path
 
+    def _get_mount_options(self, connection_info):
+        return connection_info['data'].get('options', '')
+
     def ensure_share_mounted(self, connection_info):
         export_path = self._get_export_path(connection_info)
+        self._ensure_share_mounted(export_path,
+                                   self._get_mount_options(connection_info))
+
+    @share_synchronized
+    def _ensure_share_mounted(self, export_path, opts_str):
+        self._mount_share(export_path, opts_str)
+
+    def _mount_share(self, export_path, opts_str):
+        # The mapping state of the shares mounted by this service is
+        # verified periodically, unless the checks are disabled.
+        if (export_path in _mounted_shares and
+                CONF.hyperv.smbfs_share_check_interval):
+            LOG.debug('Share already mounted: %s', export_path)
+            return
 
         if not self._pathutils.check_smb_mapping(export_path):
-            opts_str = connection_info['data'].get('options', '')
             username, password = self._parse_credentials(opts_str)
             self._pathutils.mount_smb_share(export_path,
                                             username=username,
                                             password=password)
+        _mounted_shares.add(export_path)
+        self._start_share_checks()
+
+    @share_synchronized
+    def _acquire_share(self, export_path, opts_str, disk_paths):
+        idle_share_unmount = _idle_share_unmounts.pop(export_path, None)
+        if idle_share_unmount:
+            LOG.debug("Reusing idle share %s", export_path)
+            idle_share_unmount.cancel()
+
+        self._mount_share(export_path, opts_str)
+        _share_users[export_path].update(disk_paths)
+
+    @share_synchronized
+    def _release_share(self, export_path, disk_paths):
+        share_users = _share_users[export_path]
+        share_users.difference_update(disk_paths)
+        if share_users:
+            LOG.debug("Skipping unmounting share %s as there are volumes "
+                      "stored on it still being used.", export_path)
+            return
+        _share_users.pop(export_path, None)
+
+        # Volumes attached before the service was started are not tracked,
+        # for which reason the disks attached to the instances are checked
+        # as well.
+        if self._share_has_attached_disks(export_path):
+            LOG.debug("Skipping unmounting share %s as there are disks "
+                      "stored on it attached to instances.", export_path)
+        elif CONF.hyperv.smbfs_share_linger_time:
+            LOG.debug("Share %(export_path)s is idle. It will be unmounted "
+                      "in %(linger_time)s seconds unless used again.",
+                      {'export_path': export_path,
+                       'linger_time': CONF.hyperv.smbfs_share_linger_time})
+            if export_path not in _idle_share_unmounts:
+                _idle_share_unmounts[export_path] = eventlet.spawn_after(
+                    CONF.hyperv.smbfs_share_linger_time,
+                    self._unmount_idle_share, export_path)
+        else:
+            self._unmount_share(export_path)
+
+    @share_synchronized
+    def _unmount_idle_share(self, export_path):
+        # The unmount may have been cancelled while waiting for the lock.
+        if _idle_share_unmounts.pop(export_path, None):
+            self._unmount_share(export_path)
+
+    def _unmount_share(self, export_path):
+        _mounted_shares.discard(export_path)
+        self._pathutils.unmount_smb_share(export_path)
+
+    def _share_has_attached_disks(self, export_path):
+        share_prefix = export_path.rstrip('\\').lower() + '\\'
+        return any(disk_path.lower().startswith(share_prefix)
+                   for disk_path in
+                   self._vmutils.get_attached_virtual_disk_paths())
+
+    def _start_share_checks(self):
+        if _share_check_loop or not CONF.hyperv.smbfs_share_check_interval:
+            return
+
+        share_check = loopingcall.FixedIntervalLoopingCall(
+            self._check_mounted_shares)
+        share_check.start(interval=CONF.hyperv.smbfs_share_check_interval,
+                          initial_delay=CONF.hyperv.smbfs_share_check_interval)
+        _share_check_loop.append(share_check)
+
+    def _check_mounted_shares(self):
+        for export_path in list(_mounted_shares):
+            try:
+                self._check_mounted_share(export_path)
+            except Exception as exc:
+                LOG.warning(_LW('Failed to check SMB share %(export_path)s: '
+                                '%(exc)s'),
+                            {'export_path': export_path, 'exc': exc})
+
+    @share_synchronized
+    def _check_mounted_share(self, export_path):
+        if (export_path in _mounted_shares and
+                not self._pathutils.check_smb_mapping(export_path)):
+            LOG.warning(_LW('SMB share %s is no longer available. It will '
+                            'be remounted when attaching volumes stored '
+                            'on it.'), export_path)
+            _mounted_shares.discard(export_path)
 
     def _parse_credentials(self, opts_str):
-        match = self._username_regex.findall(opts_str)
-        username = match[0] if match and match[0] != 'guest' else None
+        credentials = {}
+        for opt_name, opt_value in self._credentials_regex.findall(opts_str):
+            # The first occurrence of each option is used.
+            credentials.setdefault(opt_name[:4], opt_value)
 
-        match = self._password_regex.findall(opts_str)
-        password = match[0] if match else None
+        username = credentials.get('user')
+        if username == 'guest':
+            username = None
+        password = credentials.get('pass')
 
         return username, password
 
+    def _acquire_volume_share(self, connection_info):
+        self._acquire_share(self._get_export_path(connection_info),
+                            self._get_mount_options(connection_info),
+                            [self._get_disk_path(connection_info)])
+
     def fix_instance_volume_disk_path(self, instance_name, connection_info,
                                       disk_address):
-        self.ensure_share_mounted(connection_info)
+        # The volumes of instances started before the service was
+        # restarted are tracked starting with this point.
+        self._acquire_volume_share(connection_info)
 
     def initialize_volume_connection(self, connection_info):
-        self.ensure_share_mounted(connection_info)
+        self._acquire_volume_share(connection_info)
 
     def set_disk_qos_specs(self, connection_info, instance_name,
                            min_iops, max_iops):
@@ -73,8 +73,15 @@ class VolumeUtils(basevolumeutils.BaseVolumeUtils):
     def login_storage_target(self, target_lun, target_iqn, target_portal,
                              auth_username=None, auth_password=None):
         """Ensure that the target is logged in."""
-
-        self._login_target_portal(target_portal)
+        try:
+            self._login_storage_target(target_lun, target_iqn, target_portal,
+                                       auth_username, auth_password)
+        finally:
+            self.invalidate_session_table()
+
+    def _login_storage_target(self, target_lun, target_iqn, target_portal,
+                              auth_username=None, auth_password=None):
+        portal_refreshed = self._ensure_target_portal(target_portal)
         # Listing targets
         self.execute('iscsicli.exe', 'ListTargets')
 
@@ -102,6 +109,11 @@ class VolumeUtils(basevolumeutils.BaseVolumeUtils):
                           {'target_iqn': target_iqn,
                            'exc': exc,
                            'attempt': attempt})
+                if not portal_refreshed:
+                    # The target may have been added after the portal was
+                    # last refreshed.
+                    portal_refreshed = self._ensure_target_portal(
+                        target_portal, force_refresh=True)
                 time.sleep(CONF.hyperv.volume_attach_retry_interval)
 
         raise vmutils.HyperVException(_('Failed to login target %s') %
@@ -113,8 +125,11 @@ class VolumeUtils(basevolumeutils.BaseVolumeUtils):
         sessions = self._conn_wmi.query("SELECT * FROM "
                                         "MSiSCSIInitiator_SessionClass "
                                         "WHERE TargetName='%s'" % target_iqn)
-        for session in sessions:
-            self.execute_log_out(session.SessionId)
+        try:
+            for session in sessions:
+                self.execute_log_out(session.SessionId)
+        finally:
+            self.invalidate_session_table()
 
     def execute_log_out(self, session_id):
         """Executes log out of the session described by its session ID."""
@@ -67,8 +67,15 @@ class VolumeUtilsV2(basevolumeutils.BaseVolumeUtils):
     def login_storage_target(self, target_lun, target_iqn, target_portal,
                              auth_username=None, auth_password=None):
         """Ensure that the target is logged in."""
+        try:
+            self._login_storage_target(target_lun, target_iqn, target_portal,
+                                       auth_username, auth_password)
+        finally:
+            self.invalidate_session_table()
 
-        self._login_target_portal(target_portal)
+    def _login_storage_target(self, target_lun, target_iqn, target_portal,
+                              auth_username=None, auth_password=None):
+        portal_refreshed = self._ensure_target_portal(target_portal)
 
         retry_count = CONF.hyperv.volume_attach_retry_count
 
@@ -96,9 +103,10 @@ class VolumeUtilsV2(basevolumeutils.BaseVolumeUtils):
                     auth['AuthenticationType'] = self._CHAP_AUTH_TYPE
                     auth['ChapUsername'] = auth_username
                     auth['ChapSecret'] = auth_password
+                # Connect returns once the session is established, so the
+                # target state can be checked again right away.
                 target.Connect(NodeAddress=target_iqn,
                                IsPersistent=True, **auth)
-                time.sleep(CONF.hyperv.volume_attach_retry_interval)
             except wmi.x_wmi as exc:
                 LOG.debug("Attempt %(attempt)d to connect to target  "
                           "%(target_iqn)s failed. Retrying. "
@@ -106,11 +114,23 @@ class VolumeUtilsV2(basevolumeutils.BaseVolumeUtils):
                           {'target_iqn': target_iqn,
                            'exc': exc,
                            'attempt': attempt})
+                if not portal_refreshed:
+                    # The target may have been added after the portal was
+                    # last refreshed.
+                    portal_refreshed = self._ensure_target_portal(
+                        target_portal, force_refresh=True)
+                time.sleep(CONF.hyperv.volume_attach_retry_interval)
         raise vmutils.HyperVException(_('Failed to login target %s') %
                                       target_iqn)
 
     def logout_storage_target(self, target_iqn):
         """Logs out storage target through its session id."""
+        try:
+            self._logout_storage_target(target_iqn)
+        finally:
+            self.invalidate_session_table()
+
+    def _logout_storage_target(self, target_iqn):
         targets = self._conn_storage.MSFT_iSCSITarget(NodeAddress=target_iqn)
         if targets:
             target = targets[0]
@@ -124,6 +144,12 @@ class VolumeUtilsV2(basevolumeutils.BaseVolumeUtils):
 
                 target.Disconnect()
 
+    def get_disk_arrival_listener(self, timeframe):
+        query = ("SELECT * FROM __InstanceCreationEvent "
+                 "WITHIN %s "
+                 "WHERE TargetInstance ISA 'MSFT_Disk'" % timeframe)
+        return self._conn_storage.MSFT_Disk.watch_for(raw_wql=query)
+
     def execute_log_out(self, session_id):
         sessions = self._conn_wmi.MSiSCSIInitiator_SessionClass(
             SessionId=session_id)
@@ -78,8 +78,8 @@ class PathUtils(object):
         instance_path = self.get_instance_dir(instance_name)
         return os.path.join(instance_path, 'ephemeral.' + format_ext.lower())
 
-    def get_base_vhd_dir(self):
-        return os.path.join(self.get_instances_dir(), '_base')
+    def get_base_vhd_dir(self, remote_server=None):
+        return os.path.join(self.get_instances_dir(remote_server), '_base')
 
     def get_export_dir(self, instance_name):
         export_dir = os.path.join(self.get_instances_dir(), 'export',
@@ -43,6 +43,16 @@ class BaseVolumeUtilsTestCase(test.NoDBTestCase):
 
         super(BaseVolumeUtilsTestCase, self).setUp()
 
+        patcher = mock.patch.dict(basevolumeutils._portal_refresh_times,
+                                  clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        session_table_patcher = mock.patch.object(
+            basevolumeutils, '_session_table', None)
+        session_table_patcher.start()
+        self.addCleanup(session_table_patcher.stop)
+
     def test_get_iscsi_initiator_ok(self):
         self._check_get_iscsi_initiator(
             mock.MagicMock(return_value=mock.sentinel.FAKE_KEY),
@@ -124,7 +134,7 @@ class BaseVolumeUtilsTestCase(test.NoDBTestCase):
         mock_ses_class = self._volutils._conn_wmi.MSiSCSIInitiator_SessionClass
         mock_ses_class.return_value = [init_session]
         devices = self._volutils._get_devices_for_target(
-            mock.sentinel.FAKE_IQN)
+            mock.sentinel.FAKE_TARGET_NAME)
 
         self.assertEqual(init_session.Devices, devices)
 
@@ -136,29 +146,132 @@ class BaseVolumeUtilsTestCase(test.NoDBTestCase):
 
         self.assertEqual(0, len(devices))
 
-    @mock.patch.object(basevolumeutils.BaseVolumeUtils,
-                       '_get_devices_for_target')
-    def test_get_device_number_for_target(self, fake_get_devices):
+    def test_get_device_number_for_target(self):
+        init_session = self._create_initiator_session()
+        mock_ses_class = self._volutils._conn_wmi.MSiSCSIInitiator_SessionClass
+        mock_ses_class.return_value = [init_session]
+        device_number = self._volutils.get_device_number_for_target(
+            mock.sentinel.FAKE_TARGET_NAME, mock.sentinel.FAKE_LUN)
+
+        self.assertEqual(mock.sentinel.FAKE_DEVICE_NUMBER, device_number)
+
+    def test_get_device_number_for_target_cached(self):
         init_session = self._create_initiator_session()
-        fake_get_devices.return_value = init_session.Devices
         mock_ses_class = self._volutils._conn_wmi.MSiSCSIInitiator_SessionClass
         mock_ses_class.return_value = [init_session]
+
+        for i in range(3):
+            device_number = self._volutils.get_device_number_for_target(
+                mock.sentinel.FAKE_TARGET_NAME, mock.sentinel.FAKE_LUN)
+            self.assertEqual(mock.sentinel.FAKE_DEVICE_NUMBER, device_number)
+
+        mock_ses_class.assert_called_once_with()
+
+    def test_get_device_number_for_target_refreshed_on_miss(self):
+        init_session = self._create_initiator_session()
+        mock_ses_class = self._volutils._conn_wmi.MSiSCSIInitiator_SessionClass
+        mock_ses_class.side_effect = [[], [init_session]]
+
+        self._volutils.get_session_table()
         device_number = self._volutils.get_device_number_for_target(
-            mock.sentinel.FAKE_IQN, mock.sentinel.FAKE_LUN)
+            mock.sentinel.FAKE_TARGET_NAME, mock.sentinel.FAKE_LUN)
 
         self.assertEqual(mock.sentinel.FAKE_DEVICE_NUMBER, device_number)
+        self.assertEqual(2, mock_ses_class.call_count)
+
+    @mock.patch('time.time')
+    def _test_ensure_target_portal(self, mock_time, last_refresh_time=None,
+                                   force_refresh=False):
+        mock_time.return_value = 100
+        if last_refresh_time is not None:
+            basevolumeutils._portal_refresh_times[
+                mock.sentinel.portal] = last_refresh_time
+        self._volutils._login_target_portal = mock.Mock()
+
+        refreshed = self._volutils._ensure_target_portal(
+            mock.sentinel.portal, force_refresh=force_refresh)
+
+        expected_refresh = (
+            force_refresh or last_refresh_time is None or
+            100 - last_refresh_time >= self._volutils._PORTAL_REFRESH_INTERVAL)
+        self.assertEqual(expected_refresh, refreshed)
+        if expected_refresh:
+            self._volutils._login_target_portal.assert_called_once_with(
+                mock.sentinel.portal)
+            self.assertEqual(
+                100, basevolumeutils._portal_refresh_times[
+                    mock.sentinel.portal])
+        else:
+            self.assertFalse(self._volutils._login_target_portal.called)
+
+    def test_ensure_target_portal(self):
+        self._test_ensure_target_portal()
+
+    def test_ensure_target_portal_recently_refreshed(self):
+        self._test_ensure_target_portal(last_refresh_time=95)
+
+    def test_ensure_target_portal_expired(self):
+        self._test_ensure_target_portal(last_refresh_time=50)
+
+    def test_ensure_target_portal_forced(self):
+        self._test_ensure_target_portal(last_refresh_time=95,
+                                        force_refresh=True)
+
+    def test_invalidate_session_table(self):
+        mock_ses_class = self._volutils._conn_wmi.MSiSCSIInitiator_SessionClass
+        mock_ses_class.return_value = []
+
+        self._volutils.get_session_table()
+        self._volutils.invalidate_session_table()
+        self._volutils.get_session_table()
+
+        self.assertEqual(2, mock_ses_class.call_count)
+
+    @mock.patch('time.time')
+    def test_session_table_expired(self, mock_time):
+        mock_ses_class = self._volutils._conn_wmi.MSiSCSIInitiator_SessionClass
+        mock_ses_class.return_value = []
+        mock_time.side_effect = [0, self._volutils._SESSION_TABLE_TTL,
+                                 self._volutils._SESSION_TABLE_TTL]
+
+        first_table = self._volutils.get_session_table()
+        second_table = self._volutils.get_session_table()
+
+        self.assertIsNot(first_table, second_table)
+        self.assertEqual(2, mock_ses_class.call_count)
 
     @mock.patch.object(basevolumeutils.BaseVolumeUtils,
-                       '_get_devices_for_target')
-    def test_get_target_lun_count(self, fake_get_devices):
+                       '_get_drive_number_from_disk_path')
+    def test_session_table_invalidated_by_other_instance(
+            self, mock_get_drive_number):
+        mock_get_drive_number.return_value = mock.sentinel.FAKE_DEVICE_NUMBER
+        # A drive number gets reused after a logout performed through a
+        # different BaseVolumeUtils instance.
+        old_session = self._create_initiator_session()
+        new_session = self._create_initiator_session()
+        new_session.SessionId = mock.sentinel.NEW_SESSION_ID
+        mock_ses_class = self._volutils._conn_wmi.MSiSCSIInitiator_SessionClass
+        mock_ses_class.side_effect = [[old_session], [new_session]]
+        other_volutils = basevolumeutils.BaseVolumeUtils()
+        other_volutils._conn_wmi = self._volutils._conn_wmi
+
+        self._volutils.get_session_id_from_mounted_disk(self._FAKE_DISK_PATH)
+        other_volutils.invalidate_session_table()
+        session_id = self._volutils.get_session_id_from_mounted_disk(
+            self._FAKE_DISK_PATH)
+
+        self.assertEqual(mock.sentinel.NEW_SESSION_ID, session_id)
+
+    def test_get_target_lun_count(self):
         init_session = self._create_initiator_session()
         # Only disk devices are being counted.
         disk_device = mock.Mock(DeviceType=self._volutils._FILE_DEVICE_DISK)
         init_session.Devices.append(disk_device)
-        fake_get_devices.return_value = init_session.Devices
+        mock_ses_class = self._volutils._conn_wmi.MSiSCSIInitiator_SessionClass
+        mock_ses_class.return_value = [init_session]
 
         lun_count = self._volutils.get_target_lun_count(
-            mock.sentinel.FAKE_IQN)
+            mock.sentinel.FAKE_TARGET_NAME)
 
         self.assertEqual(1, lun_count)
 
@@ -184,5 +297,47 @@ class BaseVolumeUtilsTestCase(test.NoDBTestCase):
         init_session = mock.MagicMock()
         init_session.Devices = [device]
         init_session.SessionId = mock.sentinel.FAKE_SESSION_ID
+        init_session.TargetName = mock.sentinel.FAKE_TARGET_NAME
 
         return init_session
+
+
+class ISCSISessionTableTestCase(test.NoDBTestCase):
+    """Unit tests for the Hyper-V ISCSISessionTable class."""
+
+    def setUp(self):
+        super(ISCSISessionTableTestCase, self).setUp()
+
+        self._device = mock.Mock(ScsiLun=mock.sentinel.lun,
+                                 DeviceNumber=mock.sentinel.device_number)
+        self._session = mock.Mock(SessionId=mock.sentinel.session_id,
+                                  TargetName=mock.sentinel.target_iqn,
+                                  Devices=[self._device])
+        self._table = basevolumeutils.ISCSISessionTable([self._session])
+
+    def test_get_session(self):
+        self.assertEqual(self._session,
+                         self._table.get_session(mock.sentinel.session_id))
+        self.assertIsNone(self._table.get_session(mock.sentinel.other_id))
+
+    def test_get_target_devices(self):
+        self.assertEqual(
+            [self._device],
+            self._table.get_target_devices(mock.sentinel.target_iqn))
+        self.assertEqual(
+            [], self._table.get_target_devices(mock.sentinel.other_iqn))
+
+    def test_get_device(self):
+        device = self._table.get_device(mock.sentinel.target_iqn,
+                                        mock.sentinel.lun)
+        self.assertEqual(self._device, device)
+        self.assertIsNone(self._table.get_device(mock.sentinel.target_iqn,
+                                                 mock.sentinel.other_lun))
+
+    def test_get_device_by_number(self):
+        self.assertEqual(
+            (self._session, self._device),
+            self._table.get_device_by_number(mock.sentinel.device_number))
+        self.assertEqual(
+            (None, None),
+            self._table.get_device_by_number(mock.sentinel.other_number))
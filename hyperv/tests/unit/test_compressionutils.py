@@ -0,0 +1,128 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import io
+import os
+import shutil
+import tempfile
+import zlib
+
+import mock
+
+from hyperv.nova import compressionutils
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class CompressionUtilsTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the Hyper-V compression utils."""
+
+    _FAKE_DATA = b''.join(
+        [(b'%d' % idx) * 100 + os.urandom(100) for idx in range(100)])
+
+    def setUp(self):
+        super(CompressionUtilsTestCase, self).setUp()
+
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir)
+
+    def _compress(self, codec, workers=1, read_size=-1):
+        reader = compressionutils.CompressedReader(
+            io.BytesIO(self._FAKE_DATA), codec, workers=workers,
+            chunk_size=1000)
+
+        data = []
+        while True:
+            chunk = reader.read(read_size)
+            if not chunk:
+                break
+            data.append(chunk)
+        return reader, b''.join(data)
+
+    def _test_compress_and_decompress(self, codec, workers=1):
+        reader, compressed_data = self._compress(codec, workers=workers,
+                                                 read_size=333)
+        compressed_path = os.path.join(self._tmp_dir, 'compressed')
+        decompressed_path = os.path.join(self._tmp_dir, 'decompressed')
+        with open(compressed_path, 'wb') as f:
+            f.write(compressed_data)
+
+        self.assertEqual(codec, compressionutils.get_file_compression(
+            compressed_path))
+        compressionutils.decompress_file(compressed_path, decompressed_path,
+                                         codec, chunk_size=100)
+
+        with open(decompressed_path, 'rb') as f:
+            self.assertEqual(self._FAKE_DATA, f.read())
+
+        stats = reader.get_stats()
+        self.assertEqual(len(self._FAKE_DATA), stats['raw_size'])
+        self.assertEqual(len(compressed_data), stats['compressed_size'])
+        self.assertEqual(codec, stats['codec'])
+
+    def test_zlib(self):
+        self._test_compress_and_decompress(compressionutils.COMPRESSION_ZLIB)
+
+    def test_gzip(self):
+        self._test_compress_and_decompress(compressionutils.COMPRESSION_GZIP)
+
+    def test_gzip_multiple_workers(self):
+        self._test_compress_and_decompress(compressionutils.COMPRESSION_GZIP,
+                                           workers=4)
+
+    def test_decompress_highly_compressed_file(self):
+        data = b'\0' * 100000
+        compressed_path = os.path.join(self._tmp_dir, 'compressed')
+        decompressed_path = os.path.join(self._tmp_dir, 'decompressed')
+        with open(compressed_path, 'wb') as f:
+            # Two gzip members, each expanding far beyond the chunk size.
+            f.write(compressionutils._compress_gzip_member(data) * 2)
+
+        with mock.patch.object(compressionutils.zlib,
+                               'decompressobj',
+                               wraps=zlib.decompressobj) as mock_decompobj:
+            compressionutils.decompress_file(
+                compressed_path, decompressed_path,
+                compressionutils.COMPRESSION_GZIP, chunk_size=100)
+
+        self.assertEqual(2, mock_decompobj.call_count)
+        with open(decompressed_path, 'rb') as f:
+            self.assertEqual(data * 2, f.read())
+
+    def test_read_all(self):
+        _, compressed_data = self._compress(compressionutils.COMPRESSION_ZLIB)
+        self.assertEqual(self._FAKE_DATA, zlib.decompress(compressed_data))
+
+    def test_unsupported_codec(self):
+        self.assertRaises(vmutils.HyperVException,
+                          compressionutils.CompressedReader,
+                          io.BytesIO(), 'fake_codec')
+
+    def test_get_file_compression_uncompressed(self):
+        path = os.path.join(self._tmp_dir, 'uncompressed')
+        with open(path, 'wb') as f:
+            f.write(b'conectix')
+
+        self.assertIsNone(compressionutils.get_file_compression(path))
+
+    def test_decompress_invalid_file(self):
+        src_path = os.path.join(self._tmp_dir, 'invalid')
+        with open(src_path, 'wb') as f:
+            f.write(b'\x1f\x8b\x08' + b'\xff' * 100)
+
+        self.assertRaises(vmutils.HyperVException,
+                          compressionutils.decompress_file, src_path,
+                          os.path.join(self._tmp_dir, 'dest'),
+                          compressionutils.COMPRESSION_GZIP)
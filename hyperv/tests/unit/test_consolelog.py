@@ -0,0 +1,333 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import gzip
+import os
+import shutil
+import tempfile
+
+import mock
+
+from hyperv.nova import consolelog
+from hyperv.tests.unit import test_base
+
+
+class ConsoleLogWriterTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the Hyper-V ConsoleLogWriter class."""
+
+    _FAKE_MAX_SIZE = 10
+
+    def setUp(self):
+        super(ConsoleLogWriterTestCase, self).setUp()
+
+        reactor_patcher = mock.patch.object(consolelog.ioreactor,
+                                            'get_reactor')
+        mock_get_reactor = reactor_patcher.start()
+        self.addCleanup(reactor_patcher.stop)
+
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir)
+        log_path = os.path.join(self._tmp_dir, 'console.log')
+        self._log_paths = [log_path, log_path + '.1', log_path + '.1.gz',
+                           log_path + '.2.gz']
+
+        self.flags(console_log_flush_size=4,
+                   console_log_flush_interval=mock.sentinel.interval,
+                   group='hyperv')
+        self._mock_reactor = mock_get_reactor.return_value
+        self._log_writer = consolelog.ConsoleLogWriter(
+            self._log_paths, max_size=self._FAKE_MAX_SIZE)
+        self._log_writer.start()
+        self.addCleanup(self._log_writer.stop)
+
+    def _get_logs(self):
+        logs = []
+        for log_path in self._log_paths:
+            if os.path.exists(log_path):
+                open_func = gzip.open if log_path.endswith('.gz') else open
+                with open_func(log_path, 'rb') as f:
+                    logs.append(f.read())
+            else:
+                logs.append(None)
+        return logs
+
+    def _write_logs(self, *logs):
+        for log_path, data in zip(self._log_paths, logs):
+            if data is None:
+                continue
+            open_func = gzip.open if log_path.endswith('.gz') else open
+            with open_func(log_path, 'wb') as f:
+                f.write(data)
+
+    def test_write_schedules_timer(self):
+        self._log_writer.write(b'ab')
+        self._log_writer.write(b'c')
+
+        self._mock_reactor.call_later.assert_called_once_with(
+            mock.sentinel.interval, self._log_writer._flush)
+        self.assertFalse(self._mock_reactor.call_soon.called)
+        self.assertEqual([b'', None, None, None], self._get_logs())
+
+    def test_write_exceeding_flush_size(self):
+        self._log_writer.write(b'ab')
+        mock_timer = self._mock_reactor.call_later.return_value
+
+        self._log_writer.write(b'cd')
+        self._log_writer.write(b'ef')
+
+        mock_timer.cancel.assert_called_once_with()
+        self._mock_reactor.call_soon.assert_called_once_with(
+            self._log_writer._flush)
+
+    def test_write_drops_old_data(self):
+        self._log_writer.write(b'fake_data_' * 2 + b'123')
+
+        self._log_writer._flush()
+
+        self.assertEqual([b'e_data_123', None, None, None], self._get_logs())
+        stats = self._log_writer.get_stats()
+        self.assertEqual(13, stats['dropped_bytes'])
+        self.assertEqual(self._FAKE_MAX_SIZE,
+                         stats['buffer_high_water_mark'])
+
+    def test_flush(self):
+        self._log_writer.write(b'abcdef')
+
+        self._log_writer._flush()
+
+        self.assertEqual([b'abcdef', None, None, None], self._get_logs())
+        self.assertEqual(6, self._log_writer._log_size)
+        self.assertFalse(self._log_writer._flush_scheduled)
+        self.assertEqual(6, self._log_writer.get_stats()['bytes_logged'])
+
+    @mock.patch.object(consolelog.ConsoleLogWriter, '_write_to_log')
+    def test_flush_failure(self, mock_write_to_log):
+        mock_write_to_log.side_effect = IOError
+        self._log_writer.write(b'abcdef')
+
+        self._log_writer._flush()
+
+        self.assertEqual(1, self._log_writer.get_stats()['write_errors'])
+        self.assertEqual(bytearray(), self._log_writer._buffer)
+
+    def test_rotate_logs(self):
+        self._log_writer.write(b'0123456789')
+        self._log_writer._flush()
+        self._log_writer.write(b'abc')
+        self._log_writer._flush()
+
+        self.assertEqual([b'abc', b'0123456789', None, None],
+                         self._get_logs())
+        self._mock_reactor.call_soon.assert_called_with(
+            self._log_writer._archive_rotated_log)
+        self.assertEqual(1, self._log_writer.get_stats()['rotations'])
+
+    def test_rotate_logs_splits_data(self):
+        self._log_writer.write(b'01234567')
+        self._log_writer._flush()
+
+        self._log_writer.write(b'89abcd')
+        self._log_writer._flush()
+
+        self.assertEqual([b'abcd', b'0123456789', None, None],
+                         self._get_logs())
+
+    def test_rotate_logs_pending_archive(self):
+        self._write_logs(None, b'fake_rotated_log')
+
+        self._log_writer.write(b'0123456789')
+        self._log_writer._flush()
+        self._log_writer.write(b'abc')
+        self._log_writer._flush()
+        self._log_writer.write(b'def')
+        self._log_writer._flush()
+
+        # The current log is used until the rotated log gets archived.
+        self.assertEqual([b'0123456789abcdef', b'fake_rotated_log',
+                          None, None], self._get_logs())
+        archive_calls = [
+            call for call in self._mock_reactor.call_soon.call_args_list
+            if call == mock.call(self._log_writer._archive_rotated_log)]
+        self.assertEqual(1, len(archive_calls))
+        self.assertEqual(0, self._log_writer.get_stats()['rotations'])
+
+    def test_rotate_logs_without_archives(self):
+        self._log_writer.stop()
+        self._log_writer = consolelog.ConsoleLogWriter(
+            self._log_paths[:1], max_size=self._FAKE_MAX_SIZE)
+        self._log_writer.start()
+        self.addCleanup(self._log_writer.stop)
+
+        self._log_writer.write(b'0123456789')
+        self._log_writer._flush()
+        self._log_writer.write(b'abc')
+        self._log_writer._flush()
+
+        self.assertEqual([b'abc', None, None, None], self._get_logs())
+
+    def test_archive_rotated_log(self):
+        self._write_logs(None, b'fake_rotated_log', b'fake_archive_1',
+                         b'fake_archive_2')
+
+        self._log_writer._archive_rotated_log()
+
+        self.assertEqual([b'', None, b'fake_rotated_log', b'fake_archive_1'],
+                         self._get_logs())
+
+    def test_archive_rotated_log_without_archives(self):
+        self._log_writer._archive_paths = []
+        self._write_logs(None, b'fake_rotated_log')
+
+        self._log_writer._archive_rotated_log()
+
+        self.assertEqual([b'', None, None, None], self._get_logs())
+
+    def test_archive_rotated_log_retry(self):
+        # A previous attempt has already shifted the archives.
+        self._write_logs(None, b'fake_rotated_log', None, b'fake_archive_1')
+
+        self._log_writer._archive_rotated_log()
+
+        self.assertEqual([b'', None, b'fake_rotated_log', b'fake_archive_1'],
+                         self._get_logs())
+
+    @mock.patch.object(consolelog.ConsoleLogWriter, '_compress_log')
+    def test_archive_rotated_log_failure(self, mock_compress_log):
+        mock_compress_log.side_effect = IOError
+        self._write_logs(None, b'fake_rotated_log', b'fake_archive_1')
+
+        self._log_writer._archive_rotated_log()
+
+        mock_compress_log.assert_called_once_with(self._log_paths[1],
+                                                  self._log_paths[2])
+        self.assertEqual([b'', b'fake_rotated_log', None, b'fake_archive_1'],
+                         self._get_logs())
+        self.assertFalse(self._log_writer._archive_scheduled)
+        self.assertEqual(1, self._log_writer.get_stats()['archive_errors'])
+
+    @mock.patch.object(consolelog.os, 'rename')
+    def test_rotate_logs_failure(self, mock_rename):
+        mock_rename.side_effect = OSError
+
+        self._log_writer.write(b'0123456789')
+        self._log_writer._flush()
+        self._log_writer.write(b'abc')
+        self._log_writer._flush()
+
+        self.assertEqual([b'0123456789abc', None, None, None],
+                         self._get_logs())
+        self.assertEqual(13, self._log_writer._log_size)
+
+    def test_existing_log_size(self):
+        self._log_writer.write(b'01234567')
+        self._log_writer.stop()
+
+        self._log_writer = consolelog.ConsoleLogWriter(
+            self._log_paths, max_size=self._FAKE_MAX_SIZE)
+        self._log_writer.start()
+        self.addCleanup(self._log_writer.stop)
+
+        self.assertEqual(8, self._log_writer._log_size)
+
+    def test_stop_flushes_data(self):
+        self._log_writer.write(b'abc')
+
+        self._log_writer.stop()
+        self._log_writer.write(b'def')
+
+        self._mock_reactor.call_later.return_value.cancel.assert_any_call()
+        self.assertEqual([b'abc', None, None, None], self._get_logs())
+        self.assertIsNone(self._log_writer._log_file)
+
+
+class ReadLogTailTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the console log tail reader."""
+
+    _FAKE_LOGS = [b'line5\nline6\n', b'line3\nline4\n', b'line1\nline2']
+
+    def setUp(self):
+        super(ReadLogTailTestCase, self).setUp()
+
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir)
+        log_path = os.path.join(self._tmp_dir, 'console.log')
+        self._log_paths = [log_path, log_path + '.1', log_path + '.1.gz']
+
+        for log_path, data in zip(self._log_paths, self._FAKE_LOGS):
+            open_func = gzip.open if log_path.endswith('.gz') else open
+            with open_func(log_path, 'wb') as f:
+                f.write(data)
+
+    def _test_read_log_tail(self, expected_output, **kwargs):
+        output = consolelog.read_log_tail(self._log_paths, **kwargs)
+        self.assertEqual(expected_output, output)
+
+    def test_read_log_tail(self):
+        self._test_read_log_tail(b''.join(self._FAKE_LOGS[::-1]))
+
+    def test_read_log_tail_missing_logs(self):
+        os.remove(self._log_paths[1])
+        os.remove(self._log_paths[2])
+
+        self._test_read_log_tail(self._FAKE_LOGS[0])
+
+    def test_read_log_tail_max_bytes(self):
+        self._test_read_log_tail(b'e4\nline5\nline6\n', max_bytes=15)
+
+    def test_read_log_tail_max_lines(self):
+        self._test_read_log_tail(b'line4\nline5\nline6\n', max_lines=3)
+
+    def test_read_log_tail_max_lines_spanning_logs(self):
+        # The second log does not end with a line separator.
+        self._test_read_log_tail(b'line2line3\nline4\nline5\nline6\n',
+                                 max_lines=4)
+
+    def test_read_log_tail_bytes_and_lines(self):
+        self._test_read_log_tail(b'ne6\n', max_bytes=4, max_lines=2)
+        self._test_read_log_tail(b'line6\n', max_bytes=100, max_lines=1)
+
+    def test_read_log_tail_no_trailing_separator(self):
+        with open(self._log_paths[0], 'ab') as f:
+            f.write(b'line7')
+
+        self._test_read_log_tail(b'line6\nline7', max_lines=2)
+
+    @mock.patch.object(consolelog, '_MMAP_MIN_SIZE', 1)
+    def test_read_log_tail_mmap(self):
+        self._test_read_log_tail(b'line4\nline5\nline6\n', max_lines=3)
+        self._test_read_log_tail(b'e6\n', max_bytes=3)
+
+    @mock.patch.object(consolelog, '_read_archive_tail')
+    def test_read_log_tail_skips_archives(self, mock_read_archive_tail):
+        self._test_read_log_tail(b'line4\nline5\nline6\n', max_lines=3)
+
+        self.assertFalse(mock_read_archive_tail.called)
+
+    @mock.patch.object(consolelog, '_ARCHIVE_READ_CHUNK_SIZE', 2)
+    @mock.patch.object(consolelog, '_MAX_ARCHIVE_TAIL_SIZE', 8)
+    def test_read_log_tail_archive_limit(self):
+        self._test_read_log_tail(
+            b'e1\nline2line3\nline4\nline5\nline6\n')
+        self._test_read_log_tail(
+            b'\nline2line3\nline4\nline5\nline6\n', max_bytes=30)
+
+    @mock.patch.object(consolelog, 'open', create=True)
+    def test_read_log_tail_exception(self, mock_open):
+        mock_log_file = mock.Mock()
+        mock_open.side_effect = [mock_log_file, IOError]
+
+        self.assertRaises(IOError, consolelog.read_log_tail,
+                          self._log_paths)
+        mock_log_file.close.assert_called_once_with()
@@ -16,6 +16,7 @@
 Test suite for the Hyper-V driver and related APIs.
 """
 
+import collections
 import time
 import uuid
 
@@ -39,6 +40,7 @@ from oslo_utils import fileutils
 from hyperv.nova import basevolumeutils
 from hyperv.nova import constants
 from hyperv.nova import driver as driver_hyperv
+from hyperv.nova import hostops
 from hyperv.nova import hostutils
 from hyperv.nova import imagecache
 from hyperv.nova import networkutils
@@ -125,6 +127,7 @@ class HyperVAPIBaseTestCase(test.NoDBTestCase):
             pass
         self.stubs.Set(time, 'sleep', fake_sleep)
 
+        self.stubs.Set(volumeops, '_target_users', collections.Counter())
         self.stubs.Set(pathutils, 'PathUtils', fake.PathUtils)
         self._mox.StubOutWithMock(fake.PathUtils, 'open')
         self._mox.StubOutWithMock(fake.PathUtils, 'copyfile')
@@ -158,7 +161,7 @@ class HyperVAPIBaseTestCase(test.NoDBTestCase):
                                   'get_mounted_disk_by_drive_number')
         self._mox.StubOutWithMock(vmutils.VMUtils, 'detach_vm_disk')
         self._mox.StubOutWithMock(vmutils.VMUtils, 'get_vm_storage_paths')
-        self._mox.StubOutWithMock(vmutils.VMUtils, 'get_free_controller_slot')
+        self._mox.StubOutWithMock(vmutils.VMUtils, 'reserve_controller_slots')
         self._mox.StubOutWithMock(vmutils.VMUtils,
                                   'enable_vm_metrics_collection')
         self._mox.StubOutWithMock(vmutils.VMUtils, 'get_vm_id')
@@ -578,9 +581,9 @@ class HyperVAPITestCase(HyperVAPIBaseTestCase):
             m.AndReturn(fake_controller_path)
 
             fake_free_slot = 1
-            m = vmutils.VMUtils.get_free_controller_slot(
-                fake_controller_path)
-            m.AndReturn(fake_free_slot)
+            m = vmutils.VMUtils.reserve_controller_slots(
+                instance_name, fake_controller_path)
+            m.AndReturn([fake_free_slot])
 
         m = vmutils.VMUtils.attach_volume_to_controller(instance_name,
                                                         fake_controller_path,
@@ -794,6 +797,40 @@ class HyperVAPITestCase(HyperVAPIBaseTestCase):
                           self._conn.refresh_instance_security_rules,
                           instance=None)
 
+    @mock.patch.object(imagecache.ImageCache, 'get_warmup_stats')
+    @mock.patch.object(hostops.HostOps, 'get_available_resource')
+    def test_get_available_resource(self, mock_get_resources,
+                                    mock_get_warmup_stats):
+        mock_get_resources.return_value = {'vcpus': 1}
+
+        resources = self._conn.get_available_resource(mock.sentinel.node)
+
+        self.assertEqual(
+            {'vcpus': 1, 'stats': mock_get_warmup_stats.return_value},
+            resources)
+
+    @mock.patch.object(serialconsoleops.SerialConsoleOps,
+                       'get_console_output')
+    def _test_get_console_output(self, mock_get_console_output,
+                                 max_bytes, expected_max_bytes):
+        self.flags(console_output_max_bytes=max_bytes, group='hyperv')
+        instance = self._get_instance()
+
+        console_output = self._conn.get_console_output(self._context,
+                                                       instance)
+
+        self.assertEqual(mock_get_console_output.return_value,
+                         console_output)
+        mock_get_console_output.assert_called_once_with(
+            instance.name, max_bytes=expected_max_bytes)
+
+    def test_get_console_output(self):
+        self._test_get_console_output(max_bytes=1024,
+                                      expected_max_bytes=1024)
+
+    def test_get_console_output_unlimited(self):
+        self._test_get_console_output(max_bytes=0, expected_max_bytes=None)
+
     def test_get_rdp_console(self):
         self.flags(my_ip="192.168.1.1")
 
@@ -13,14 +13,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
 import os
+import shutil
+import tempfile
 
 import mock
 from nova import exception
 from nova import objects
 from nova.tests.unit.objects import test_flavor
 from oslo_config import cfg
+from oslo_utils import units
 
+from hyperv.nova import compressionutils
 from hyperv.nova import constants
 from hyperv.nova import imagecache
 from hyperv.nova import vmutils
@@ -54,6 +59,14 @@ class ImageCacheTestCase(test.NoDBTestCase):
         self.addCleanup(patched_func.stop)
         self.addCleanup(patched_get_pathutils.stop)
 
+        patcher = mock.patch.dict(imagecache._warmup_progress, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(imagecache.ImageCache, '_get_image_meta',
+                                    return_value={})
+        self._mock_get_image_meta = patcher.start()
+        self.addCleanup(patcher.stop)
+
         self.imagecache = imagecache.ImageCache()
         self.imagecache._pathutils = mock.MagicMock()
         self.imagecache._vhdutils = mock.MagicMock()
@@ -109,6 +122,310 @@ class ImageCacheTestCase(test.NoDBTestCase):
         self.imagecache._pathutils.rename.assert_called_once_with(
             expected_path, expected_vhd_path)
 
+    @mock.patch.object(imagecache.ImageCache, '_download_image')
+    @mock.patch.object(imagecache.ImageCache, '_copy_image_from_peers')
+    def test_get_cached_image_single_meta_lookup(self, mock_copy_from_peers,
+                                                 mock_download_image):
+        self.flags(image_cache_peers=['fake_peer'], image_download_streams=4,
+                   group='hyperv')
+        mock_copy_from_peers.return_value = False
+        (expected_path,
+         expected_vhd_path) = self._prepare_get_cached_image(False, False)
+
+        result = self.imagecache.get_cached_image(self.context, self.instance)
+
+        self.assertEqual(expected_vhd_path, result)
+        self._mock_get_image_meta.assert_called_once_with(
+            self.context, self.FAKE_IMAGE_REF)
+        image_meta = self._mock_get_image_meta.return_value
+        mock_copy_from_peers.assert_called_once_with(
+            self.FAKE_IMAGE_REF, image_meta, expected_path)
+        mock_download_image.assert_called_once_with(
+            self.context, image_meta, expected_path)
+
+    @mock.patch.object(imagecache.ImageCache, '_download_image')
+    @mock.patch.object(imagecache.images, 'fetch')
+    def _test_fetch_image(self, mock_fetch, mock_download_image,
+                          streams=1, download_fails=False):
+        self.flags(image_download_streams=streams, group='hyperv')
+        if download_fails:
+            mock_download_image.side_effect = vmutils.HyperVException
+
+        self.imagecache._fetch_image(self.context, mock.sentinel.image_id,
+                                     mock.sentinel.image_path,
+                                     mock.sentinel.image_meta,
+                                     mock.sentinel.user_id,
+                                     mock.sentinel.project_id)
+
+        if streams > 1:
+            mock_download_image.assert_called_once_with(
+                self.context, mock.sentinel.image_meta,
+                mock.sentinel.image_path)
+        else:
+            self.assertFalse(mock_download_image.called)
+
+        if streams == 1 or download_fails:
+            mock_fetch.assert_called_once_with(
+                self.context, mock.sentinel.image_id,
+                mock.sentinel.image_path, mock.sentinel.user_id,
+                mock.sentinel.project_id)
+        else:
+            self.assertFalse(mock_fetch.called)
+
+    def test_fetch_image(self):
+        self._test_fetch_image()
+
+    def test_fetch_image_parallel(self):
+        self._test_fetch_image(streams=4)
+
+    def test_fetch_image_parallel_failure(self):
+        self._test_fetch_image(streams=4, download_fails=True)
+        self.imagecache._pathutils.remove.assert_called_once_with(
+            mock.sentinel.image_path)
+
+    @mock.patch.object(imagecache.imagedownloader, 'ParallelDownloader')
+    @mock.patch.object(imagecache.glance, 'get_api_servers')
+    def test_download_image(self, mock_get_api_servers, mock_downloader):
+        self.flags(image_download_streams=4, image_download_chunk_size=1,
+                   image_download_retries=2, group='hyperv')
+        mock_context = mock.Mock()
+        image_meta = {'id': 'fake_image_id', 'size': mock.sentinel.size,
+                      'checksum': mock.sentinel.checksum}
+        mock_get_api_servers.return_value = iter(['http://fake_glance'])
+
+        self.imagecache._download_image(mock_context, image_meta,
+                                        mock.sentinel.image_path)
+
+        mock_downloader.assert_called_once_with(
+            streams=4, chunk_size=units.Mi, retries=2)
+        mock_downloader.return_value.download.assert_called_once_with(
+            'http://fake_glance/v2/images/fake_image_id/file',
+            mock.sentinel.image_path, mock.sentinel.size,
+            checksum=mock.sentinel.checksum,
+            headers={'X-Auth-Token': mock_context.auth_token})
+
+    @mock.patch.object(imagecache.ImageCache, '_get_glance_ssl_params')
+    @mock.patch.object(imagecache.imagedownloader, 'ParallelDownloader')
+    @mock.patch.object(imagecache.glance, 'get_api_servers')
+    def test_download_image_https(self, mock_get_api_servers,
+                                  mock_downloader, mock_get_ssl_params):
+        image_meta = {'id': 'fake_image_id', 'size': mock.sentinel.size}
+        mock_get_api_servers.return_value = iter(['https://fake_glance'])
+        mock_get_ssl_params.return_value = {'verify': mock.sentinel.verify,
+                                            'cert': mock.sentinel.cert}
+
+        self.imagecache._download_image(mock.Mock(), image_meta,
+                                        mock.sentinel.image_path)
+
+        mock_get_ssl_params.assert_called_once_with(
+            'https://fake_glance/v2/images/fake_image_id/file')
+        mock_downloader.assert_called_once_with(
+            streams=mock.ANY, chunk_size=mock.ANY, retries=mock.ANY,
+            verify=mock.sentinel.verify, cert=mock.sentinel.cert)
+
+    def _test_get_glance_ssl_params(self, url, insecure=False, ca_file=None,
+                                    cert_file=None, key_file=None):
+        # Registers the SSL options.
+        imagecache.sslutils.is_enabled(CONF)
+        self.flags(api_insecure=insecure, group='glance')
+        self.flags(ca_file=ca_file, cert_file=cert_file, key_file=key_file,
+                   group='ssl')
+
+        # The certificate files are checked for existence.
+        with mock.patch.object(imagecache.sslutils, 'is_enabled'):
+            return self.imagecache._get_glance_ssl_params(url)
+
+    def test_get_glance_ssl_params_http(self):
+        ssl_params = self._test_get_glance_ssl_params(
+            url='http://fake_glance', ca_file='fake_ca_file')
+        self.assertEqual({}, ssl_params)
+
+    def test_get_glance_ssl_params(self):
+        ssl_params = self._test_get_glance_ssl_params(
+            url='https://fake_glance', ca_file='fake_ca_file',
+            cert_file='fake_cert_file', key_file='fake_key_file')
+
+        expected_params = {'verify': 'fake_ca_file',
+                           'cert': ('fake_cert_file', 'fake_key_file')}
+        self.assertEqual(expected_params, ssl_params)
+
+    def test_get_glance_ssl_params_insecure(self):
+        ssl_params = self._test_get_glance_ssl_params(
+            url='https://fake_glance', insecure=True,
+            ca_file='fake_ca_file', cert_file='fake_cert_file')
+
+        expected_params = {'verify': False, 'cert': 'fake_cert_file'}
+        self.assertEqual(expected_params, ssl_params)
+
+    def test_get_glance_ssl_params_default(self):
+        ssl_params = self._test_get_glance_ssl_params(
+            url='https://fake_glance')
+
+        self.assertEqual({'verify': True, 'cert': None}, ssl_params)
+
+    @mock.patch.object(imagecache.ImageCache, '_copy_image_from_peers')
+    @mock.patch.object(imagecache.images, 'fetch')
+    def _test_fetch_image_from_peers(self, mock_fetch, mock_copy_from_peers,
+                                     copied=True):
+        self.flags(image_cache_peers=['fake_peer'], group='hyperv')
+        mock_copy_from_peers.return_value = copied
+
+        self.imagecache._fetch_image(self.context, mock.sentinel.image_id,
+                                     mock.sentinel.image_path,
+                                     mock.sentinel.image_meta,
+                                     mock.sentinel.user_id,
+                                     mock.sentinel.project_id)
+
+        mock_copy_from_peers.assert_called_once_with(
+            mock.sentinel.image_id, mock.sentinel.image_meta,
+            mock.sentinel.image_path)
+        self.assertEqual(not copied, mock_fetch.called)
+
+    def test_fetch_image_from_peers(self):
+        self._test_fetch_image_from_peers()
+
+    def test_fetch_image_not_available_on_peers(self):
+        self._test_fetch_image_from_peers(copied=False)
+
+    def _setup_peers(self, peer_images):
+        """Uses local directories as the image cache of the peers."""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        peer_dirs = {}
+        for peer, image_data in peer_images.items():
+            peer_dirs[peer] = os.path.join(tmp_dir, peer)
+            os.makedirs(peer_dirs[peer])
+            if image_data is not None:
+                peer_image_path = os.path.join(
+                    peer_dirs[peer], self.FAKE_IMAGE_REF + '.vhdx')
+                with open(peer_image_path, 'wb') as f:
+                    f.write(image_data)
+
+        self.flags(image_cache_peers=sorted(peer_images), group='hyperv')
+        pathutils = self.imagecache._pathutils
+        pathutils.get_base_vhd_dir.side_effect = (
+            lambda remote_server: peer_dirs[remote_server])
+        pathutils.exists.side_effect = os.path.exists
+        pathutils.open.side_effect = open
+        pathutils.copyfile.side_effect = shutil.copyfile
+        pathutils.remove.side_effect = os.remove
+        return tmp_dir, peer_dirs
+
+    def _test_copy_image_from_peers(self, peer_images,
+                                    checksum_data=b'fake_data',
+                                    properties=None):
+        image_meta = {'checksum': hashlib.md5(checksum_data).hexdigest(),
+                      'properties': properties or {}}
+        tmp_dir, peer_dirs = self._setup_peers(peer_images)
+        image_path = os.path.join(tmp_dir, self.FAKE_IMAGE_REF)
+
+        copied = self.imagecache._copy_image_from_peers(
+            self.FAKE_IMAGE_REF, image_meta, image_path)
+
+        if copied:
+            with open(image_path, 'rb') as f:
+                self.assertEqual(checksum_data, f.read())
+        else:
+            self.assertFalse(os.path.exists(image_path))
+        return copied
+
+    def test_copy_image_from_peers(self):
+        copied = self._test_copy_image_from_peers(
+            peer_images={'peer1': None, 'peer2': b'fake_data'})
+        self.assertTrue(copied)
+
+    def test_copy_image_from_peers_unavailable(self):
+        copied = self._test_copy_image_from_peers(
+            peer_images={'peer1': None})
+        self.assertFalse(copied)
+
+    def test_copy_image_from_peers_checksum_mismatch(self):
+        copied = self._test_copy_image_from_peers(
+            peer_images={'peer1': b'corrupted_data'})
+        self.assertFalse(copied)
+
+    def test_copy_compressed_image_from_peers(self):
+        copied = self._test_copy_image_from_peers(
+            peer_images={'peer1': b'fake_data'},
+            properties={'hyperv_image_compression': 'gzip'})
+        self.assertFalse(copied)
+
+    @mock.patch.object(imagecache.ImageCache, '_probe_peer_image')
+    def test_find_peer_image(self, mock_probe_peer_image):
+        self.flags(image_cache_peers=['peer1', 'peer2', 'peer3'],
+                   group='hyperv')
+        mock_probe_peer_image.side_effect = [
+            (2, mock.sentinel.slow_peer_image), None,
+            (1, mock.sentinel.fast_peer_image)]
+
+        peer_image_path = self.imagecache._find_peer_image(
+            mock.sentinel.image_id)
+
+        self.assertEqual(mock.sentinel.fast_peer_image, peer_image_path)
+        mock_probe_peer_image.assert_has_calls(
+            [mock.call(peer, mock.sentinel.image_id)
+             for peer in ['peer1', 'peer2', 'peer3']])
+
+    @mock.patch.object(imagecache.compressionutils, 'decompress_file')
+    @mock.patch.object(imagecache.compressionutils, 'get_file_compression')
+    def _test_get_image_format(self, mock_get_file_compression,
+                               mock_decompress_file, compressed=True,
+                               codec_property=None):
+        fake_path = os.path.join(self.FAKE_BASE_DIR, self.FAKE_IMAGE_REF)
+        decompressed_path = fake_path + '.decompressed'
+        image_meta = {'properties': {}}
+        if codec_property:
+            image_meta['properties'][
+                compressionutils.IMAGE_COMPRESSION_PROPERTY] = codec_property
+        mock_get_vhd_format = self.imagecache._vhdutils.get_vhd_format
+        mock_get_vhd_format.side_effect = (
+            [constants.DISK_FORMAT_VHD] if codec_property else
+            [vmutils.HyperVException, constants.DISK_FORMAT_VHD])
+        mock_get_file_compression.return_value = (
+            mock.sentinel.codec if compressed else None)
+
+        if not (compressed or codec_property):
+            self.assertRaises(vmutils.HyperVException,
+                              self.imagecache._get_image_format, fake_path,
+                              image_meta)
+            self.assertFalse(mock_decompress_file.called)
+            return
+
+        ret_val = self.imagecache._get_image_format(fake_path, image_meta)
+
+        self.assertEqual(constants.DISK_FORMAT_VHD, ret_val)
+        mock_get_vhd_format.assert_called_with(fake_path)
+        if codec_property:
+            # The file header is not checked if the codec is known.
+            self.assertFalse(mock_get_file_compression.called)
+            self.assertEqual(1, mock_get_vhd_format.call_count)
+        if codec_property == compressionutils.COMPRESSION_NONE:
+            self.assertFalse(mock_decompress_file.called)
+            return
+
+        expected_codec = codec_property or mock.sentinel.codec
+        mock_decompress_file.assert_called_once_with(
+            fake_path, decompressed_path, expected_codec)
+        self.imagecache._pathutils.remove.assert_called_once_with(fake_path)
+        self.imagecache._pathutils.rename.assert_called_once_with(
+            decompressed_path, fake_path)
+
+    def test_get_image_format_compressed(self):
+        self._test_get_image_format()
+
+    def test_get_image_format_unsupported(self):
+        self._test_get_image_format(compressed=False)
+
+    def test_get_image_format_compression_property(self):
+        self._test_get_image_format(
+            compressed=False,
+            codec_property=compressionutils.COMPRESSION_GZIP)
+
+    def test_get_image_format_no_compression_property(self):
+        self._test_get_image_format(
+            codec_property=compressionutils.COMPRESSION_NONE)
+
     @mock.patch.object(imagecache.images, 'fetch')
     def test_get_cached_image_with_fetch_exception(self, mock_fetch):
         (expected_path,
@@ -161,3 +478,226 @@ class ImageCacheTestCase(test.NoDBTestCase):
                                            self.instance.project_id)
         self.imagecache._vhdutils.get_vhd_info.assert_called_once_with(
             expected_vhd_path)
+
+    def test_get_warmup_image_ids(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        manifest_path = os.path.join(tmp_dir, 'manifest')
+        with open(manifest_path, 'w') as f:
+            f.write('# Windows images\nimage2\n\n  image3  \nimage1\n')
+        self.flags(image_cache_warmup_images=['image1', 'image2'],
+                   image_cache_warmup_manifest=manifest_path,
+                   group='hyperv')
+
+        image_ids = self.imagecache._get_warmup_image_ids()
+
+        self.assertEqual(['image1', 'image2', 'image3'], image_ids)
+
+    @mock.patch.object(imagecache, 'LOG')
+    def test_get_warmup_image_ids_missing_manifest(self, mock_log):
+        self.flags(image_cache_warmup_images=['image1'],
+                   image_cache_warmup_manifest='fake/missing/manifest',
+                   group='hyperv')
+
+        image_ids = self.imagecache._get_warmup_image_ids()
+
+        self.assertEqual([], image_ids)
+        self.assertTrue(mock_log.warning.called)
+
+    @mock.patch.object(imagecache.ks_session.Session,
+                       'load_from_conf_options')
+    @mock.patch.object(imagecache.ks_auth, 'load_from_conf_options')
+    def _test_get_warmup_auth_session(self, mock_load_auth,
+                                      mock_load_session,
+                                      auth_plugin=mock.sentinel.auth_plugin):
+        mock_load_auth.return_value = auth_plugin
+
+        auth_session = self.imagecache._get_warmup_auth_session()
+
+        mock_load_auth.assert_called_once_with(CONF, 'glance')
+        if auth_plugin:
+            mock_load_session.assert_called_once_with(CONF, 'glance',
+                                                      auth=auth_plugin)
+            self.assertEqual(mock_load_session.return_value, auth_session)
+        else:
+            self.assertFalse(mock_load_session.called)
+            self.assertIsNone(auth_session)
+
+    def test_get_warmup_auth_session(self):
+        self._test_get_warmup_auth_session()
+
+    def test_get_warmup_auth_session_no_auth_plugin(self):
+        self._test_get_warmup_auth_session(auth_plugin=None)
+
+    def test_get_warmup_context(self):
+        mock_context = mock.Mock(auth_token=None)
+        mock_session = mock.Mock()
+        mock_session.get_auth_headers.return_value = {
+            'X-Auth-Token': mock.sentinel.auth_token}
+
+        warmup_context = self.imagecache._get_warmup_context(mock_context,
+                                                             mock_session)
+
+        self.assertEqual(mock.sentinel.auth_token, warmup_context.auth_token)
+        self.assertIsNone(mock_context.auth_token)
+
+    @mock.patch.object(imagecache, 'LOG')
+    @mock.patch.object(imagecache.eventlet, 'spawn_n')
+    @mock.patch.object(imagecache.ImageCache, '_set_service_disabled')
+    @mock.patch.object(imagecache.ImageCache, '_get_warmup_auth_session')
+    @mock.patch.object(imagecache.ImageCache, '_get_warmup_image_ids')
+    def _test_start_warmup(self, mock_get_image_ids, mock_get_auth_session,
+                           mock_set_service_disabled, mock_spawn_n,
+                           mock_log, image_ids=None, disable_host=True,
+                           auth_session=mock.sentinel.auth_session,
+                           auth_session_exc=None):
+        self.flags(image_cache_warmup_disable_host=disable_host,
+                   group='hyperv')
+        mock_get_image_ids.return_value = image_ids or []
+        mock_get_auth_session.return_value = auth_session
+        mock_get_auth_session.side_effect = auth_session_exc
+
+        self.imagecache.start_warmup(mock.sentinel.context)
+
+        if not image_ids or not auth_session or auth_session_exc:
+            self.assertFalse(mock_spawn_n.called)
+            self.assertFalse(mock_set_service_disabled.called)
+            self.assertEqual({}, imagecache._warmup_progress)
+            self.assertEqual(bool(image_ids), mock_log.warning.called)
+            return
+
+        mock_spawn_n.assert_called_once_with(self.imagecache._warm_up,
+                                             mock.sentinel.context,
+                                             auth_session, image_ids)
+        self.assertEqual(disable_host, mock_set_service_disabled.called)
+        self.assertEqual(
+            {'total': len(image_ids), 'cached': 0, 'failed': 0},
+            imagecache._warmup_progress)
+
+    def test_start_warmup(self):
+        self._test_start_warmup(image_ids=[mock.sentinel.image_id])
+
+    def test_start_warmup_no_disable_host(self):
+        self._test_start_warmup(image_ids=[mock.sentinel.image_id],
+                                disable_host=False)
+
+    def test_start_warmup_no_images(self):
+        self._test_start_warmup()
+
+    def test_start_warmup_no_credentials(self):
+        self._test_start_warmup(image_ids=[mock.sentinel.image_id],
+                                auth_session=None)
+
+    def test_start_warmup_invalid_credentials(self):
+        self._test_start_warmup(image_ids=[mock.sentinel.image_id],
+                                auth_session_exc=Exception)
+
+    @mock.patch.object(imagecache.ImageCache, '_get_warmup_context')
+    @mock.patch.object(imagecache.ImageCache,
+                       '_wait_for_instance_image_fetches')
+    @mock.patch.object(imagecache.ImageCache, '_set_service_disabled')
+    @mock.patch.object(imagecache.ImageCache, '_cache_image')
+    def test_warm_up(self, mock_cache_image, mock_set_service_disabled,
+                     mock_wait_for_fetches, mock_get_warmup_context):
+        self.flags(image_cache_warmup_disable_host=True,
+                   image_cache_warmup_workers=2, group='hyperv')
+        imagecache._warmup_progress.update(total=3, cached=0, failed=0)
+        mock_cache_image.side_effect = [None, vmutils.HyperVException, None]
+        image_ids = ['image1', 'image2', 'image3']
+        warmup_context = mock_get_warmup_context.return_value
+
+        self.imagecache._warm_up(self.context, mock.sentinel.auth_session,
+                                 image_ids)
+
+        mock_get_warmup_context.assert_called_with(
+            self.context, mock.sentinel.auth_session)
+        mock_cache_image.assert_has_calls(
+            [mock.call(warmup_context, image_id) for image_id in image_ids],
+            any_order=True)
+        mock_set_service_disabled.assert_called_once_with(self.context,
+                                                          False)
+        self.assertEqual(3, mock_wait_for_fetches.call_count)
+        self.assertEqual({'total': 3, 'cached': 2, 'failed': 1},
+                         imagecache._warmup_progress)
+
+    def test_get_warmup_stats(self):
+        imagecache._warmup_progress.update(total=5, cached=2, failed=1)
+
+        stats = self.imagecache.get_warmup_stats()
+
+        self.assertEqual({'image_cache_warmup_total': 5,
+                          'image_cache_warmup_cached': 2,
+                          'image_cache_warmup_failed': 1,
+                          'image_cache_warmup_pending': 2}, stats)
+
+    def test_get_warmup_stats_not_started(self):
+        self.assertEqual({}, self.imagecache.get_warmup_stats())
+
+    @mock.patch.object(imagecache.eventlet, 'sleep')
+    def test_wait_for_instance_image_fetches(self, mock_sleep):
+        def fake_sleep(seconds):
+            if mock_sleep.call_count == 3:
+                imagecache._instance_image_fetches = 0
+
+        mock_sleep.side_effect = fake_sleep
+
+        with mock.patch.object(imagecache, '_instance_image_fetches', 1):
+            self.imagecache._wait_for_instance_image_fetches()
+
+        mock_sleep.assert_has_calls(
+            [mock.call(0)] +
+            [mock.call(imagecache._WARMUP_YIELD_INTERVAL)] * 2)
+
+    @mock.patch.object(imagecache.ImageCache, '_cache_image')
+    def test_get_cached_image_tracks_instance_fetches(self,
+                                                      mock_cache_image):
+        fetches = []
+
+        def fake_cache_image(*args, **kwargs):
+            fetches.append(imagecache._instance_image_fetches)
+            return self.FAKE_BASE_DIR + '.vhdx'
+
+        mock_cache_image.side_effect = fake_cache_image
+
+        self.imagecache.get_cached_image(self.context, self.instance)
+
+        self.assertEqual([1], fetches)
+        self.assertEqual(0, imagecache._instance_image_fetches)
+
+    @mock.patch.object(imagecache.objects.Service, 'get_by_compute_host')
+    def _test_set_service_disabled(self, mock_get_service, disabled,
+                                   service_disabled, disabled_reason=None):
+        mock_service = mock_get_service.return_value
+        mock_service.disabled = service_disabled
+        mock_service.disabled_reason = disabled_reason
+
+        self.imagecache._set_service_disabled(self.context, disabled)
+
+        mock_get_service.assert_called_once_with(self.context, CONF.host)
+        return mock_service
+
+    def test_disable_service(self):
+        mock_service = self._test_set_service_disabled(
+            disabled=True, service_disabled=False)
+
+        self.assertTrue(mock_service.disabled)
+        self.assertEqual(imagecache._WARMUP_DISABLED_REASON,
+                         mock_service.disabled_reason)
+        mock_service.save.assert_called_once_with()
+
+    def test_enable_service(self):
+        mock_service = self._test_set_service_disabled(
+            disabled=False, service_disabled=True,
+            disabled_reason=imagecache._WARMUP_DISABLED_REASON)
+
+        self.assertFalse(mock_service.disabled)
+        self.assertIsNone(mock_service.disabled_reason)
+        mock_service.save.assert_called_once_with()
+
+    def test_enable_service_disabled_by_admin(self):
+        mock_service = self._test_set_service_disabled(
+            disabled=False, service_disabled=True,
+            disabled_reason=mock.sentinel.reason)
+
+        self.assertTrue(mock_service.disabled)
+        self.assertFalse(mock_service.save.called)
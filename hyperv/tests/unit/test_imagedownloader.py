@@ -0,0 +1,188 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+import mock
+
+from hyperv.nova import imagedownloader
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class _FakeResponse(object):
+    def __init__(self, status_code, data, chunk_size=100):
+        self.status_code = status_code
+        self._data = data
+        self._chunk_size = chunk_size
+
+    def iter_content(self, chunk_size):
+        for offset in range(0, len(self._data), self._chunk_size):
+            yield self._data[offset:offset + self._chunk_size]
+
+    def close(self):
+        pass
+
+
+class _FakeRangeServer(object):
+    """Serves range requests, optionally truncating some of them.
+
+    The range support probe is neither truncated nor rejected.
+    """
+
+    def __init__(self, data, truncated_requests=0, supports_ranges=True,
+                 rejects_ranges=False):
+        self.data = data
+        self.requested_ranges = []
+        self.ssl_params = set()
+        self._truncated_requests = truncated_requests
+        self._supports_ranges = supports_ranges
+        self._rejects_ranges = rejects_ranges
+
+    def get(self, url, headers, stream, timeout, verify, cert):
+        self.ssl_params.add((verify, cert))
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)',
+                                       headers['Range']).groups())
+        self.requested_ranges.append((start, end))
+        is_probe = (start, end) == (0, 0)
+        if not self._supports_ranges:
+            return _FakeResponse(200, self.data)
+        if self._rejects_ranges and not is_probe:
+            return _FakeResponse(503, b'')
+
+        data = self.data[start:end + 1]
+        if self._truncated_requests and not is_probe:
+            self._truncated_requests -= 1
+            data = data[:len(data) // 2]
+        return _FakeResponse(206, data)
+
+
+class ParallelDownloaderTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the Hyper-V ParallelDownloader class."""
+
+    _FAKE_URL = 'http://fake_glance/v2/images/fake_id/file'
+    _FAKE_DATA = os.urandom(2500)
+
+    def setUp(self):
+        super(ParallelDownloaderTestCase, self).setUp()
+
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir)
+        self._dest_path = os.path.join(self._tmp_dir, 'image')
+
+        self._downloader = imagedownloader.ParallelDownloader(
+            streams=3, chunk_size=1000, retries=1, retry_interval=0)
+
+    def _download(self, server, checksum=None):
+        with mock.patch.object(imagedownloader.requests, 'get',
+                               side_effect=server.get):
+            self._downloader.download(self._FAKE_URL, self._dest_path,
+                                      len(server.data), checksum=checksum,
+                                      headers={'X-Auth-Token': 'fake'})
+
+    def _get_downloaded_data(self):
+        with open(self._dest_path, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        server = _FakeRangeServer(self._FAKE_DATA)
+        checksum = hashlib.md5(self._FAKE_DATA).hexdigest()
+
+        self._download(server, checksum=checksum)
+
+        self.assertEqual(self._FAKE_DATA, self._get_downloaded_data())
+        self.assertEqual([(0, 0), (0, 999), (1000, 1999), (2000, 2499)],
+                         sorted(server.requested_ranges))
+        self.assertEqual(set([(True, None)]), server.ssl_params)
+
+    def test_download_ssl_params(self):
+        server = _FakeRangeServer(self._FAKE_DATA)
+        self._downloader = imagedownloader.ParallelDownloader(
+            streams=3, chunk_size=1000, verify=mock.sentinel.ca_file,
+            cert=mock.sentinel.cert)
+
+        self._download(server)
+
+        self.assertEqual(set([(mock.sentinel.ca_file, mock.sentinel.cert)]),
+                         server.ssl_params)
+
+    def test_download_resumes_truncated_range(self):
+        server = _FakeRangeServer(self._FAKE_DATA, truncated_requests=1)
+
+        self._download(server)
+
+        self.assertEqual(self._FAKE_DATA, self._get_downloaded_data())
+        self.assertEqual(5, len(server.requested_ranges))
+        self.assertIn((500, 999), server.requested_ranges)
+
+    def test_download_retries_exceeded(self):
+        server = _FakeRangeServer(self._FAKE_DATA, truncated_requests=2)
+
+        self.assertRaises(vmutils.HyperVException, self._download, server)
+
+    def test_download_ranges_not_supported(self):
+        server = _FakeRangeServer(self._FAKE_DATA, supports_ranges=False)
+
+        self.assertRaises(imagedownloader.RangeRequestFailed,
+                          self._download, server)
+        # Only the range support is probed.
+        self.assertEqual([(0, 0)], server.requested_ranges)
+        self.assertFalse(os.path.exists(self._dest_path))
+
+    @mock.patch('time.sleep')
+    def test_download_rejected_range_not_retried(self, mock_sleep):
+        server = _FakeRangeServer(self._FAKE_DATA, rejects_ranges=True)
+        self._downloader = imagedownloader.ParallelDownloader(
+            streams=1, chunk_size=1000, retries=3)
+
+        self.assertRaises(imagedownloader.RangeRequestFailed,
+                          self._download, server)
+        # The remaining ranges are not requested anymore.
+        self.assertEqual([(0, 0), (0, 999)], server.requested_ranges)
+        self.assertFalse(mock_sleep.called)
+
+    @mock.patch.object(imagedownloader.ParallelDownloader,
+                       '_download_range_with_retries')
+    @mock.patch.object(imagedownloader.eventlet, 'getcurrent')
+    def test_download_ranges_failure_kills_workers(self, mock_getcurrent,
+                                                   mock_download_range):
+        mock_download_range.side_effect = vmutils.HyperVException
+        workers = [mock.Mock(), mock.Mock()]
+        mock_getcurrent.return_value = workers[0]
+        ranges = collections.deque([(0, 1000), (1000, 1000)])
+        failures = []
+
+        self._downloader._download_ranges(
+            self._FAKE_URL, mock.sentinel.headers, self._dest_path, ranges,
+            workers, failures)
+
+        mock_download_range.assert_called_once_with(
+            self._FAKE_URL, mock.sentinel.headers, self._dest_path, 0, 1000)
+        self.assertEqual(1, len(failures))
+        self.assertIsInstance(failures[0], vmutils.HyperVException)
+        self.assertEqual(collections.deque([(1000, 1000)]), ranges)
+        self.assertFalse(workers[0].kill.called)
+        workers[1].kill.assert_called_once_with()
+
+    def test_download_checksum_mismatch(self):
+        server = _FakeRangeServer(self._FAKE_DATA)
+
+        self.assertRaises(vmutils.HyperVException, self._download, server,
+                          checksum='fake_checksum')
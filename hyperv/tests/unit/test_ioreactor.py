@@ -0,0 +1,275 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import ctypes
+import errno
+import os
+import socket
+import threading
+
+import mock
+
+from hyperv.nova import ioreactor
+from hyperv.nova import ioutils
+from hyperv.tests.unit import test_base
+
+_WAIT_TIMEOUT = 5
+
+
+class IOReactorTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the platform agnostic reactor.
+
+    Named pipes are emulated using anonymous pipes.
+    """
+
+    def setUp(self):
+        super(IOReactorTestCase, self).setUp()
+
+        self._reactor = ioreactor.IOReactor(workers=2)
+        self._reactor.start()
+        self.addCleanup(self._reactor.stop)
+
+        self._called = threading.Event()
+        self._callback_args = []
+
+    def _callback(self, *args):
+        self._callback_args.append(args)
+        self._called.set()
+
+    def _wait_callback(self):
+        self._called.wait(_WAIT_TIMEOUT)
+        self.assertTrue(self._called.isSet())
+        self._called.clear()
+        return self._callback_args.pop(0)
+
+    def _get_pipe(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, write_fd)
+        self.addCleanup(os.close, read_fd)
+        return read_fd, write_fd
+
+    def test_call_soon(self):
+        self._reactor.call_soon(self._callback, mock.sentinel.arg)
+
+        self.assertEqual((mock.sentinel.arg, ), self._wait_callback())
+
+    def test_call_later(self):
+        self._reactor.call_later(0.01, self._callback, mock.sentinel.arg)
+
+        self.assertEqual((mock.sentinel.arg, ), self._wait_callback())
+
+    def test_cancel_timer(self):
+        timer = self._reactor.call_later(0.01, self._callback)
+        timer.cancel()
+        self._reactor.call_later(0.02, self._callback, mock.sentinel.arg)
+
+        self.assertEqual((mock.sentinel.arg, ), self._wait_callback())
+
+    def test_wait_readable(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+
+        self._reactor.wait_readable(server, self._callback,
+                                    mock.sentinel.arg)
+        client.send(b'fake_data')
+
+        self.assertEqual((mock.sentinel.arg, ), self._wait_callback())
+        # Interests are one-shot.
+        self.assertEqual({}, self._reactor._readers)
+
+    def test_cancel(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+
+        self._reactor.wait_readable(server, self._callback)
+        self._reactor.wait_writable(server, self._callback)
+        self._reactor.cancel(server)
+
+        self.assertEqual({}, self._reactor._readers)
+        self.assertEqual({}, self._reactor._writers)
+
+    @mock.patch.object(ioreactor, '_FD_SETSIZE', 0)
+    def test_wait_readable_too_many_fds(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+
+        self.assertRaises(socket.error, self._reactor.wait_readable,
+                          server, self._callback)
+        self.assertEqual({}, self._reactor._readers)
+
+    @mock.patch.object(ioreactor.IOReactor, '_dispatch_bad_fds')
+    @mock.patch.object(ioreactor.select, 'select')
+    def test_poll_error_backoff(self, mock_select, mock_dispatch_bad_fds):
+        reactor = ioreactor.IOReactor(workers=1)
+        reactor._waker = mock.Mock()
+        reactor._stopped = mock.Mock()
+        reactor._stopped.isSet.side_effect = [False, True]
+        mock_select.side_effect = ValueError
+        mock_dispatch_bad_fds.return_value = 0
+
+        reactor._poll()
+
+        reactor._stopped.wait.assert_called_once_with(
+            ioreactor._POLL_ERROR_RETRY_INTERVAL)
+
+    @mock.patch.object(ioreactor, '_FD_SETSIZE', 0)
+    def test_read_pipe_too_many_fds(self):
+        read_fd, write_fd = self._get_pipe()
+        buff = (ctypes.c_ubyte * 16)()
+
+        self._reactor.read_pipe(read_fd, buff, self._callback)
+
+        self.assertEqual((0, errno.EMFILE), self._wait_callback())
+
+    def test_read_pipe(self):
+        read_fd, write_fd = self._get_pipe()
+        buff = (ctypes.c_ubyte * 16)()
+
+        self._reactor.read_pipe(read_fd, buff, self._callback)
+        os.write(write_fd, b'fake_data')
+
+        self.assertEqual((len(b'fake_data'), None), self._wait_callback())
+        self.assertEqual(b'fake_data', bytes(bytearray(buff[:9])))
+
+    def test_read_pipe_closed(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        os.close(write_fd)
+        buff = (ctypes.c_ubyte * 16)()
+
+        self._reactor.read_pipe(read_fd, buff, self._callback)
+
+        self.assertEqual((0, errno.EPIPE), self._wait_callback())
+
+    def test_write_pipe(self):
+        read_fd, write_fd = self._get_pipe()
+        buff = (ctypes.c_ubyte * 16)()
+        ctypes.memmove(buff, b'fake_data', 9)
+
+        self._reactor.write_pipe(write_fd, buff, 9, self._callback)
+
+        self.assertEqual((9, None), self._wait_callback())
+        self.assertEqual(b'fake_data', os.read(read_fd, 16))
+
+
+class IOCPReactorTestCase(test_base.HyperVBaseTestCase):
+    def setUp(self):
+        super(IOCPReactorTestCase, self).setUp()
+
+        self._reactor = ioreactor.IOCPReactor(workers=1)
+        self._reactor._ioutils = mock.Mock()
+        self._reactor._completion_port = mock.sentinel.completion_port
+        self._reactor.call_soon = mock.Mock()
+
+        overlapped_patcher = mock.patch.object(ioutils, 'OVERLAPPED',
+                                               create=True)
+        self._mock_overlapped_cls = overlapped_patcher.start()
+        self.addCleanup(overlapped_patcher.stop)
+
+    def test_open_pipe(self):
+        mock_ioutils = self._reactor._ioutils
+
+        pipe_handle = self._reactor.open_pipe(mock.sentinel.pipe_name)
+
+        self.assertEqual(mock_ioutils.open.return_value, pipe_handle)
+        mock_ioutils.wait_named_pipe.assert_called_once_with(
+            mock.sentinel.pipe_name)
+        mock_ioutils.open.assert_called_once_with(
+            mock.sentinel.pipe_name,
+            desired_access=(ioutils.GENERIC_READ | ioutils.GENERIC_WRITE),
+            share_mode=(ioutils.FILE_SHARE_READ | ioutils.FILE_SHARE_WRITE),
+            creation_disposition=ioutils.OPEN_EXISTING,
+            flags_and_attributes=ioutils.FILE_FLAG_OVERLAPPED)
+        mock_ioutils.create_io_completion_port.assert_called_once_with(
+            pipe_handle, mock.sentinel.completion_port)
+
+    @mock.patch.object(ioreactor, '_WIN32_FD_SETSIZE', 3)
+    def test_can_poll(self):
+        self.assertTrue(self._reactor._can_poll({1: None}, 2))
+        self.assertFalse(self._reactor._can_poll({1: None, 2: None}, 3))
+
+    def test_close_pipe(self):
+        self._reactor.close_pipe(mock.sentinel.pipe_handle)
+
+        self._reactor._ioutils.cancel_io.assert_called_once_with(
+            mock.sentinel.pipe_handle)
+        self._reactor._ioutils.close_handle.assert_called_once_with(
+            mock.sentinel.pipe_handle)
+
+    def test_read_pipe(self):
+        mock_ioutils = self._reactor._ioutils
+        mock_ioutils.get_address.return_value = mock.sentinel.address
+        fake_buffer = bytearray(16)
+
+        self._reactor.read_pipe(mock.sentinel.pipe_handle, fake_buffer,
+                                mock.sentinel.callback)
+
+        mock_overlapped = self._mock_overlapped_cls.return_value
+        mock_ioutils.read_file.assert_called_once_with(
+            mock.sentinel.pipe_handle, fake_buffer, len(fake_buffer),
+            mock_overlapped)
+        pending_io = self._reactor._pending_io[mock.sentinel.address]
+        self.assertEqual(mock_overlapped, pending_io.overlapped_structure)
+        self.assertEqual(mock.sentinel.callback, pending_io.callback)
+
+    def test_write_pipe_exception(self):
+        mock_ioutils = self._reactor._ioutils
+        mock_ioutils.write_file.side_effect = ioutils.HyperVIOError(
+            error_code=mock.sentinel.error_code)
+
+        self._reactor.write_pipe(mock.sentinel.pipe_handle,
+                                 mock.sentinel.buffer, mock.sentinel.size,
+                                 mock.sentinel.callback)
+
+        self.assertEqual({}, self._reactor._pending_io)
+        self._reactor.call_soon.assert_called_once_with(
+            mock.sentinel.callback, 0, mock.sentinel.error_code)
+
+    def test_process_completions(self):
+        mock_callback = mock.Mock()
+        self._reactor._pending_io[mock.sentinel.address] = (
+            ioreactor._PendingIO(mock.sentinel.overlapped,
+                                 mock.sentinel.buffer, mock_callback))
+        get_status = self._reactor._ioutils.get_queued_completion_status
+        get_status.side_effect = [
+            (mock.sentinel.num_bytes, 0, mock.sentinel.address,
+             mock.sentinel.error_code),
+            (0, 0, mock.sentinel.unknown_address, None),
+            (0, self._reactor._STOP_KEY, None, None)]
+
+        self._reactor._process_completions()
+
+        get_status.assert_called_with(mock.sentinel.completion_port)
+        self._reactor.call_soon.assert_called_once_with(
+            mock_callback, mock.sentinel.num_bytes, mock.sentinel.error_code)
+        self.assertEqual({}, self._reactor._pending_io)
+
+
+class GetReactorTestCase(test_base.HyperVBaseTestCase):
+    @mock.patch.object(ioreactor, '_reactor', None)
+    @mock.patch.object(ioreactor, 'IOCPReactor')
+    def test_get_reactor(self, mock_reactor_cls):
+        self.flags(serial_console_io_workers=mock.sentinel.workers,
+                   group='hyperv')
+
+        reactor = ioreactor.get_reactor()
+        # The reactor is shared.
+        self.assertEqual(reactor, ioreactor.get_reactor())
+
+        mock_reactor_cls.assert_called_once_with(mock.sentinel.workers)
+        reactor.start.assert_called_once_with()
@@ -16,7 +16,6 @@
 import ctypes
 import mock
 
-from hyperv.nova import constants
 from hyperv.nova import ioutils
 from hyperv.tests.unit import test_base
 
@@ -66,6 +65,32 @@ class IOUtilsTestCase(test_base.HyperVBaseTestCase):
             expected_flags, None, last_error_code, 0,
             mock_ctypes.byref(fake_message_buffer), 0, None)
 
+    @mock.patch.object(ioutils.IOUtils, '_run_and_check_output')
+    def test_create_io_completion_port(self, mock_run_and_check_output):
+        ret_val = self._ioutils.create_io_completion_port(
+            mock.sentinel.handle, mock.sentinel.port)
+
+        mock_run_and_check_output.assert_called_once_with(
+            self._fake_kernel32.CreateIoCompletionPort,
+            mock.sentinel.handle, mock.sentinel.port, 0, 0,
+            error_codes=[None])
+        self.assertEqual(mock_run_and_check_output.return_value, ret_val)
+
+    @mock.patch.object(ioutils, 'ctypes')
+    @mock.patch.object(ioutils.IOUtils, '_run_and_check_output')
+    def test_read_file(self, mock_run_and_check_output, mock_ctypes):
+        self._ioutils.read_file(mock.sentinel.handle, mock.sentinel.buff,
+                                mock.sentinel.num_bytes,
+                                mock.sentinel.overlapped_structure)
+
+        mock_ctypes.byref.assert_called_once_with(
+            mock.sentinel.overlapped_structure)
+        mock_run_and_check_output.assert_called_once_with(
+            self._fake_kernel32.ReadFile, mock.sentinel.handle,
+            mock.sentinel.buff, mock.sentinel.num_bytes, None,
+            mock_ctypes.byref.return_value,
+            ignored_error_codes=[ioutils.ERROR_IO_PENDING])
+
     def test_get_write_buffer_data(self):
         fake_data = 'fake data'
         fake_buffer = (ctypes.c_ubyte * len(fake_data))()
@@ -75,93 +100,172 @@ class IOUtilsTestCase(test_base.HyperVBaseTestCase):
 
         self.assertEqual(fake_data, buff_data)
 
+    def test_write_buffer_views(self):
+        fake_data = bytearray(b'fake data')
+        fake_buffer = (ctypes.c_ubyte * len(fake_data))()
+        fake_views = [memoryview(fake_data)[:5], memoryview(fake_data)[5:]]
+
+        num_bytes = self._ioutils.write_buffer_views(fake_buffer, fake_views)
+        buff_data = self._ioutils.get_buffer_data(fake_buffer, num_bytes)
+
+        self.assertEqual(len(fake_data), num_bytes)
+        self.assertEqual(b'fake data', buff_data)
+
+
+class RingBufferTestCase(test_base.HyperVBaseTestCase):
+    _FAKE_BUFFER_SIZE = 8
 
-class IOQueueTestCase(test_base.HyperVBaseTestCase):
     def setUp(self):
-        super(IOQueueTestCase, self).setUp()
+        super(RingBufferTestCase, self).setUp()
+
+        self._ring_buffer = ioutils.RingBuffer(size=self._FAKE_BUFFER_SIZE)
+        self._reader = self._ring_buffer.get_reader()
+
+    def test_write_read(self):
+        other_reader = self._ring_buffer.get_reader()
+
+        self._ring_buffer.write(b'fake')
+
+        self.assertEqual(b'fake', self._reader.read())
+        self.assertEqual(b'fake', other_reader.read())
+        self.assertEqual(4, self._ring_buffer.write_pos)
+
+    def test_read_wraps_around(self):
+        self._ring_buffer.write(b'fake_d')
+        self._reader.read()
+
+        self._ring_buffer.write(b'fake_d')
+
+        self.assertEqual(b'fa', self._reader.read(size=2))
+        self.assertEqual(b'ke_d', self._reader.read())
 
-        self._mock_queue = mock.Mock()
-        queue_patcher = mock.patch.object(ioutils.Queue, 'Queue',
-                                          new=self._mock_queue)
-        queue_patcher.start()
-        self.addCleanup(queue_patcher.stop)
+    def test_get_views(self):
+        other_reader = self._ring_buffer.get_reader()
+        self._ring_buffer.write(b'fake')
 
-        self._mock_client_connected = mock.Mock()
-        self._ioqueue = ioutils.IOQueue(self._mock_client_connected)
+        views = self._reader.get_views()
+        other_views = other_reader.get_views(size=2)
 
-    def test_get(self):
-        self._mock_client_connected.isSet.return_value = True
-        self._mock_queue.get.return_value = mock.sentinel.item
+        self.assertEqual([b'fake'], [view.tobytes() for view in views])
+        self.assertEqual([b'fa'], [view.tobytes() for view in other_views])
+        # The readers get views of the same buffer region, the data not
+        # being copied.
+        self._ring_buffer._buffer[0:1] = b'F'
+        self.assertEqual(b'Fake', views[0].tobytes())
+        self.assertEqual(b'Fa', other_views[0].tobytes())
+        # The reader position is advanced only when consuming the data.
+        self.assertEqual(4, self._reader.available)
 
-        queue_item = self._ioqueue.get(timeout=mock.sentinel.timeout)
+        self._reader.consume(3)
 
-        self._mock_queue.get.assert_called_once_with(
-            self._ioqueue, timeout=mock.sentinel.timeout)
-        self.assertEqual(mock.sentinel.item, queue_item)
+        self.assertEqual(b'e', self._reader.read())
+
+    def test_get_views_wraps_around(self):
+        self._ring_buffer.write(b'fake_d')
+        self._reader.read()
+        self._ring_buffer.write(b'fake_d')
+
+        views = self._reader.get_views()
+
+        self.assertEqual([b'fa', b'ke_d'], [view.tobytes() for view in views])
+
+    def test_get_views_timeout(self):
+        self.assertEqual([], self._reader.get_views(timeout=0))
+
+    def test_consume_skipped_reader(self):
+        self._ring_buffer.write(b'fake')
+        self._reader.get_views()
+
+        self._ring_buffer.write(b'_dat')
+        self._reader.consume(4)
+
+        self.assertEqual(b'_dat', self._reader.read())
+        self.assertEqual(0, self._reader.skipped_bytes)
+
+        self._ring_buffer.write(b'fake_')
+        self._reader.get_views()
+        # The reader falls behind while using the views.
+        self._ring_buffer.write(b'data_123')
+        self._reader.consume(5)
+
+        # The reader position is not moved back.
+        self.assertEqual(5, self._reader.skipped_bytes)
+        self.assertEqual(b'data_123', self._reader.read())
+
+    def test_consume_wakes_up_writers(self):
+        self._ring_buffer = ioutils.RingBuffer(size=self._FAKE_BUFFER_SIZE,
+                                               overwrite=False)
+        self._reader = self._ring_buffer.get_reader()
+        self._ring_buffer.write(b'fake_dat')
+
+        views = self._reader.get_views(size=4)
+        # The region is kept until the data is consumed.
+        self.assertEqual(0, self._ring_buffer.write(b'a', timeout=0))
+
+        self._reader.consume(sum(len(view) for view in views))
+
+        self.assertEqual(1, self._ring_buffer.write(b'a', timeout=0))
+
+    def test_write_buffer_view(self):
+        fake_data = b'fake data'
+        fake_buffer = (ctypes.c_ubyte * len(fake_data))()
+        io_utils = ioutils.IOUtils()
+        io_utils.write_buffer_data(fake_buffer, fake_data)
 
-    def _test_get_timeout(self, continue_on_timeout=True):
-        self._mock_client_connected.isSet.side_effect = [True, True, False]
-        self._mock_queue.get.side_effect = ioutils.Queue.Empty
+        self._ring_buffer.write(io_utils.get_buffer_view(fake_buffer, 4))
 
-        queue_item = self._ioqueue.get(timeout=mock.sentinel.timeout,
-                                       continue_on_timeout=continue_on_timeout)
+        self.assertEqual(b'fake', self._reader.read())
 
-        expected_calls_number = 2 if continue_on_timeout else 1
-        self._mock_queue.get.assert_has_calls(
-            [mock.call(self._ioqueue, timeout=mock.sentinel.timeout)] *
-            expected_calls_number)
-        self.assertIsNone(queue_item)
+    def test_reader_skips_ahead(self):
+        self._ring_buffer.write(b'fake_')
+        written = self._ring_buffer.write(b'data_123')
 
-    def test_get_continue_on_timeout(self):
-        # Test that the queue blocks as long
-        # as the client connected event is set.
-        self._test_get_timeout()
+        self.assertEqual(8, written)
+        self.assertEqual(b'data_123', self._reader.read())
+        self.assertEqual(5, self._reader.skipped_bytes)
 
-    def test_get_break_on_timeout(self):
-        self._test_get_timeout(continue_on_timeout=False)
+    def test_high_water_mark(self):
+        other_reader = self._ring_buffer.get_reader()
+        self._ring_buffer.write(b'fake')
+        other_reader.read()
 
-    def test_put(self):
-        self._mock_client_connected.isSet.side_effect = [True, True, False]
-        self._mock_queue.put.side_effect = ioutils.Queue.Full
+        self._ring_buffer.write(b'_d')
+        self._reader.read()
+        self._ring_buffer.write(b'a')
 
-        self._ioqueue.put(mock.sentinel.item,
-                          timeout=mock.sentinel.timeout)
+        # The slowest reader was 6 bytes behind.
+        self.assertEqual(6, self._ring_buffer.high_water_mark)
 
-        self._mock_queue.put.assert_has_calls(
-            [mock.call(self._ioqueue, mock.sentinel.item,
-                       timeout=mock.sentinel.timeout)] * 2)
+    def test_write_waits_for_readers(self):
+        self._ring_buffer = ioutils.RingBuffer(size=self._FAKE_BUFFER_SIZE,
+                                               overwrite=False)
+        self._reader = self._ring_buffer.get_reader()
 
-    @mock.patch.object(ioutils.IOQueue, 'get')
-    def _test_get_burst(self, mock_get,
-                        exceeded_max_size=False):
-        fake_data = 'fake_data'
+        written = self._ring_buffer.write(b'fake_data', timeout=0)
 
-        mock_get.side_effect = [fake_data, fake_data, None]
+        self.assertEqual(self._FAKE_BUFFER_SIZE, written)
+        self.assertEqual(b'fake_dat', self._reader.read())
+        self.assertEqual(0, self._reader.skipped_bytes)
 
-        if exceeded_max_size:
-            max_size = 0
-        else:
-            max_size = constants.SERIAL_CONSOLE_BUFFER_SIZE
+    def test_write_no_readers(self):
+        self._ring_buffer = ioutils.RingBuffer(size=self._FAKE_BUFFER_SIZE,
+                                               overwrite=False)
 
-        ret_val = self._ioqueue.get_burst(
-            timeout=mock.sentinel.timeout,
-            burst_timeout=mock.sentinel.burst_timeout,
-            max_size=max_size)
+        written = self._ring_buffer.write(b'fake_data')
 
-        expected_calls = [mock.call(timeout=mock.sentinel.timeout)]
-        expected_ret_val = fake_data
+        self.assertEqual(len(b'fake_data'), written)
 
-        if not exceeded_max_size:
-            expected_calls.append(
-                mock.call(timeout=mock.sentinel.burst_timeout,
-                          continue_on_timeout=False))
-            expected_ret_val += fake_data
+    def test_read_timeout(self):
+        self.assertEqual(b'', self._reader.read(timeout=0))
 
-        mock_get.assert_has_calls(expected_calls)
-        self.assertEqual(expected_ret_val, ret_val)
+    def test_closed_buffer(self):
+        self._ring_buffer.write(b'fake')
+        self._ring_buffer.close()
 
-    def test_get_burst(self):
-        self._test_get_burst()
+        self.assertEqual(0, self._ring_buffer.write(b'data'))
+        self.assertEqual(b'fake', self._reader.read())
+        self.assertEqual(b'', self._reader.read())
 
-    def test_get_burst_exceeded_size(self):
-        self._test_get_burst(exceeded_max_size=True)
+    def test_close_reader(self):
+        self._reader.close()
+        self.assertNotIn(self._reader, self._ring_buffer._readers)
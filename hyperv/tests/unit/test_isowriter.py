@@ -0,0 +1,150 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import struct
+import tempfile
+
+from hyperv.nova import isowriter
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+_SECTOR_SIZE = isowriter.SECTOR_SIZE
+
+
+class ISOWriterTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the Hyper-V ISOWriter class."""
+
+    _FAKE_FILES = {
+        'openstack/latest/meta_data.json': b'{"uuid": "fake_uuid"}',
+        'openstack/latest/user_data': b'#!/bin/sh\n' * 500,
+        'openstack/2013-10-17/meta_data.json': b'{}',
+        'openstack/content/0000': b'',
+        'ec2/latest/meta-data.json': b'{"fake": 1}',
+    }
+
+    def setUp(self):
+        super(ISOWriterTestCase, self).setUp()
+
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir)
+        self._iso_path = os.path.join(self._tmp_dir, 'configdrive.iso')
+
+        # Enough files for the directory records to span multiple sectors.
+        self._files = dict(self._FAKE_FILES)
+        for idx in range(100):
+            self._files['openstack/many/fake_file_%03d.txt' % idx] = (
+                str(idx).encode('ascii'))
+
+    def _write_iso(self):
+        iso_writer = isowriter.ISOWriter(volume_id='config-2',
+                                         publisher='fake_publisher')
+        for path, data in self._files.items():
+            iso_writer.add_file(path, data)
+        iso_writer.write(self._iso_path)
+
+        with open(self._iso_path, 'rb') as f:
+            return f.read()
+
+    def _read_dir(self, iso_data, extent, size):
+        entries = {}
+        offset = extent * _SECTOR_SIZE
+        end = offset + size
+        while offset < end:
+            record_length = ord(iso_data[offset:offset + 1])
+            if not record_length:
+                # Skip to the next sector.
+                offset = (offset // _SECTOR_SIZE + 1) * _SECTOR_SIZE
+                continue
+
+            (child_extent, child_size, flags,
+             name_length) = struct.unpack_from('<2xI4xI4x7xB6xB', iso_data,
+                                               offset)
+            name = iso_data[offset + 33:offset + 33 + name_length]
+            entries[name] = (child_extent, child_size, bool(flags & 2))
+            offset += record_length
+        return entries
+
+    def _read_files(self, iso_data, extent, size, decode_name, path=''):
+        files = {}
+        for name, (child_extent, child_size,
+                   is_dir) in self._read_dir(iso_data, extent, size).items():
+            if name in (b'\x00', b'\x01'):
+                continue
+            child_path = path + decode_name(name)
+            if is_dir:
+                files.update(self._read_files(
+                    iso_data, child_extent, child_size, decode_name,
+                    child_path + '/'))
+            else:
+                start = child_extent * _SECTOR_SIZE
+                files[child_path] = iso_data[start:start + child_size]
+        return files
+
+    def _get_volume_descriptor(self, iso_data, idx):
+        offset = (16 + idx) * _SECTOR_SIZE
+        return iso_data[offset:offset + _SECTOR_SIZE]
+
+    def _read_tree(self, iso_data, descriptor, decode_name):
+        root_extent, root_size = struct.unpack_from('<I4xI', descriptor, 158)
+        return self._read_files(iso_data, root_extent, root_size,
+                                decode_name)
+
+    def test_write_joliet_tree(self):
+        iso_data = self._write_iso()
+        descriptor = self._get_volume_descriptor(iso_data, 1)
+
+        self.assertEqual(b'\x02CD001\x01', descriptor[:7])
+        self.assertEqual(b'%/E', descriptor[88:91])
+        self.assertEqual('config-2',
+                         descriptor[40:72].decode('utf-16-be').strip())
+        files = self._read_tree(iso_data, descriptor,
+                                lambda name: name.decode('utf-16-be'))
+        self.assertEqual(self._files, files)
+
+    def test_write_iso_tree(self):
+        iso_data = self._write_iso()
+        descriptor = self._get_volume_descriptor(iso_data, 0)
+
+        self.assertEqual(b'\x01CD001\x01', descriptor[:7])
+        self.assertEqual(b'config-2', descriptor[40:72].strip())
+        self.assertEqual(len(iso_data) // _SECTOR_SIZE,
+                         struct.unpack_from('<I', descriptor, 80)[0])
+        files = self._read_tree(iso_data, descriptor,
+                                lambda name: name.decode('ascii'))
+        self.assertEqual(self._files['openstack/latest/user_data'],
+                         files['OPENSTACK/LATEST/USER_DATA.;1'])
+        self.assertEqual(self._files['ec2/latest/meta-data.json'],
+                         files['EC2/LATEST/META_DATA.JSON;1'])
+        self.assertIn('OPENSTACK/2013_10_17/META_DATA.JSON;1', files)
+        self.assertEqual(len(self._files), len(files))
+
+    def test_write_iso_tree_unique_names(self):
+        self._files = {'meta-data.json': b'1', 'meta_data.json': b'2'}
+        iso_data = self._write_iso()
+
+        files = self._read_tree(iso_data,
+                                self._get_volume_descriptor(iso_data, 0),
+                                lambda name: name.decode('ascii'))
+        self.assertEqual(
+            {'META_DATA.JSON;1': b'1', 'META_DAT1.JSON;1': b'2'}, files)
+
+    def test_add_file_to_file_path(self):
+        iso_writer = isowriter.ISOWriter(volume_id='config-2')
+        iso_writer.add_file('openstack/latest', b'fake_data')
+
+        self.assertRaises(vmutils.HyperVException, iso_writer.add_file,
+                          'openstack/latest/meta_data.json', b'fake_data')
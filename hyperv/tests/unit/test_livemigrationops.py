@@ -33,6 +33,7 @@ class LiveMigrationOpsTestCase(test_base.HyperVBaseTestCase):
         self._livemigrops = livemigrationops.LiveMigrationOps()
         self._livemigrops._livemigrutils = mock.MagicMock()
         self._livemigrops._pathutils = mock.MagicMock()
+        self._livemigrops._vmutils = mock.MagicMock()
 
     @mock.patch('hyperv.nova.serialconsoleops.SerialConsoleOps.'
                 'stop_console_handler')
@@ -52,6 +53,8 @@ class LiveMigrationOpsTestCase(test_base.HyperVBaseTestCase):
                               mock_post, mock_recover, False, None)
             mock_recover.assert_called_once_with(self.context, mock_instance,
                                                  fake_dest, False)
+            self.assertFalse(
+                self._livemigrops._vmutils.forget_controller_slots.called)
         else:
             self._livemigrops.live_migration(context=self.context,
                                              instance_ref=mock_instance,
@@ -67,6 +70,9 @@ class LiveMigrationOpsTestCase(test_base.HyperVBaseTestCase):
             mock_live_migr = self._livemigrops._livemigrutils.live_migrate_vm
             mock_live_migr.assert_called_once_with(mock_instance.name,
                                                    fake_dest)
+            mock_vmutils = self._livemigrops._vmutils
+            mock_vmutils.forget_controller_slots.assert_called_once_with(
+                mock_instance.name)
             mock_post.assert_called_once_with(self.context, mock_instance,
                                               fake_dest, False)
 
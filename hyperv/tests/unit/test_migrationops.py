@@ -19,6 +19,7 @@ from nova import exception
 from oslo_utils import units
 
 from hyperv.nova import migrationops
+from hyperv.nova import vhdreader
 from hyperv.nova import vmutils
 from hyperv.tests import fake_instance
 from hyperv.tests.unit import test_base
@@ -269,34 +270,38 @@ class MigrationOpsTestCase(test_base.HyperVBaseTestCase):
     def test_finish_revert_migration_not_in_block_device(self):
         self._check_finish_revert_migration()
 
-    def test_merge_base_vhd(self):
+    @mock.patch.object(vhdreader, 'VHDChainReader')
+    def test_merge_base_vhd(self, mock_chain_reader):
         fake_diff_vhd_path = 'fake/diff/path'
         fake_base_vhd_path = 'fake/base/path'
-        base_vhd_copy_path = os.path.join(
+        merged_vhd_path = os.path.join(
             os.path.dirname(fake_diff_vhd_path),
             os.path.basename(fake_base_vhd_path))
 
         self._migrationops._merge_base_vhd(diff_vhd_path=fake_diff_vhd_path,
                                            base_vhd_path=fake_base_vhd_path)
 
-        self._migrationops._pathutils.copyfile.assert_called_once_with(
-            fake_base_vhd_path, base_vhd_copy_path)
-        recon_parent_vhd = self._migrationops._vhdutils.reconnect_parent_vhd
-        recon_parent_vhd.assert_called_once_with(fake_diff_vhd_path,
-                                                 base_vhd_copy_path)
-        self._migrationops._vhdutils.merge_vhd.assert_called_once_with(
-            fake_diff_vhd_path, base_vhd_copy_path)
+        mock_chain_reader.assert_called_once_with(
+            fake_diff_vhd_path, parent_path=fake_base_vhd_path)
+        mock_vhd_chain = mock_chain_reader.return_value.__enter__.return_value
+        mock_vhd_chain.export_dynamic_vhd.assert_called_once_with(
+            merged_vhd_path)
+        self._migrationops._pathutils.remove.assert_called_once_with(
+            fake_diff_vhd_path)
         self._migrationops._pathutils.rename.assert_called_once_with(
-            base_vhd_copy_path, fake_diff_vhd_path)
+            merged_vhd_path, fake_diff_vhd_path)
+        self.assertFalse(self._migrationops._vhdutils.merge_vhd.called)
 
-    def test_merge_base_vhd_exception(self):
+    @mock.patch.object(vhdreader, 'VHDChainReader')
+    def test_merge_base_vhd_exception(self, mock_chain_reader):
         fake_diff_vhd_path = 'fake/diff/path'
         fake_base_vhd_path = 'fake/base/path'
-        base_vhd_copy_path = os.path.join(
+        merged_vhd_path = os.path.join(
             os.path.dirname(fake_diff_vhd_path),
             os.path.basename(fake_base_vhd_path))
 
-        self._migrationops._vhdutils.reconnect_parent_vhd.side_effect = (
+        mock_vhd_chain = mock_chain_reader.return_value.__enter__.return_value
+        mock_vhd_chain.export_dynamic_vhd.side_effect = (
             vmutils.HyperVException)
         self._migrationops._pathutils.exists.return_value = True
 
@@ -304,9 +309,9 @@ class MigrationOpsTestCase(test_base.HyperVBaseTestCase):
                           self._migrationops._merge_base_vhd,
                           fake_diff_vhd_path, fake_base_vhd_path)
         self._migrationops._pathutils.exists.assert_called_once_with(
-            base_vhd_copy_path)
+            merged_vhd_path)
         self._migrationops._pathutils.remove.assert_called_once_with(
-            base_vhd_copy_path)
+            merged_vhd_path)
 
     @mock.patch.object(migrationops.MigrationOps, '_resize_vhd')
     def test_check_resize_vhd(self, mock_resize_vhd):
@@ -13,7 +13,6 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import errno
 import mock
 
 from hyperv.nova import constants
@@ -23,15 +22,15 @@ from hyperv.tests.unit import test_base
 
 
 class NamedPipeTestCase(test_base.HyperVBaseTestCase):
-    _FAKE_LOG_PATH = 'fake_log_path'
-
+    @mock.patch.object(namedpipe.ioreactor, 'get_reactor')
     @mock.patch.object(namedpipe.NamedPipeHandler, '_setup_io_structures')
-    def setUp(self, mock_setup_structures):
+    def setUp(self, mock_setup_structures, mock_get_reactor):
         super(NamedPipeTestCase, self).setUp()
 
-        self._mock_input_queue = mock.Mock()
-        self._mock_output_queue = mock.Mock()
-        self._mock_client_connected = mock.Mock()
+        self._mock_input_buffer = mock.Mock()
+        self._mock_output_buffer = mock.Mock()
+        self._mock_log_writer = mock.Mock()
+        self._mock_reactor = mock_get_reactor.return_value
 
         threading_patcher = mock.patch.object(namedpipe, 'threading')
         threading_patcher.start()
@@ -39,41 +38,32 @@ class NamedPipeTestCase(test_base.HyperVBaseTestCase):
 
         self._handler = namedpipe.NamedPipeHandler(
             mock.sentinel.pipe_name,
-            self._mock_input_queue,
-            self._mock_output_queue,
-            self._mock_client_connected,
-            self._FAKE_LOG_PATH)
+            self._mock_input_buffer,
+            self._mock_output_buffer,
+            self._mock_log_writer)
         self._handler._ioutils = mock.Mock()
+        self._handler._stopped.isSet.return_value = False
 
     def _mock_setup_pipe_handler(self):
-        self._handler._log_file_handle = mock.Mock()
         self._handler._pipe_handle = mock.sentinel.pipe_handle
-        self._handler._workers = [mock.Mock(), mock.Mock()]
+        self._handler._input_reader = mock.Mock()
         self._handler._r_buffer = mock.Mock()
         self._handler._w_buffer = mock.Mock()
-        self._handler._r_overlapped = mock.Mock()
-        self._handler._w_overlapped = mock.Mock()
-        self._handler._r_completion_routine = mock.Mock()
-        self._handler._w_completion_routine = mock.Mock()
 
-    @mock.patch('__builtin__.open')
-    @mock.patch.object(namedpipe.NamedPipeHandler, '_open_pipe')
-    def test_start_pipe_handler(self, mock_open_pipe, mock_open):
+    @mock.patch.object(namedpipe.NamedPipeHandler, '_read_from_pipe')
+    def test_start_pipe_handler(self, mock_read_from_pipe):
         self._handler.start()
 
-        mock_open_pipe.assert_called_once_with()
-        mock_open.assert_called_once_with(self._FAKE_LOG_PATH, 'ab', 1)
-        self.assertEqual(mock_open.return_value,
-                         self._handler._log_file_handle)
+        self._mock_reactor.open_pipe.assert_called_once_with(
+            mock.sentinel.pipe_name)
+        self.assertEqual(self._mock_reactor.open_pipe.return_value,
+                         self._handler._pipe_handle)
+        mock_read_from_pipe.assert_called_once_with()
 
-        thread = namedpipe.threading.Thread
-        thread.assert_has_calls(
-            [mock.call(target=self._handler._read_from_pipe),
-             mock.call().setDaemon(True),
-             mock.call().start(),
-             mock.call(target=self._handler._write_to_pipe),
-             mock.call().setDaemon(True),
-             mock.call().start()])
+        self._mock_input_buffer.get_reader.assert_called_once_with(
+            callback=self._handler._write_to_pipe)
+        self.assertEqual(self._mock_input_buffer.get_reader.return_value,
+                         self._handler._input_reader)
 
     @mock.patch.object(namedpipe.NamedPipeHandler, 'stop')
     @mock.patch.object(namedpipe.NamedPipeHandler, '_open_pipe')
@@ -86,149 +76,137 @@ class NamedPipeTestCase(test_base.HyperVBaseTestCase):
 
         mock_stop_handler.assert_called_once_with()
 
-    @mock.patch.object(namedpipe.NamedPipeHandler, '_close_pipe')
-    def test_stop_pipe_handler(self, mock_close_pipe):
+    def test_stop_pipe_handler(self):
         self._mock_setup_pipe_handler()
 
         self._handler.stop()
 
         self._handler._stopped.set.assert_called_once_with()
-        mock_close_pipe.assert_called_once_with()
-        self._handler._log_file_handle.close.assert_called_once_with()
-
-        self._handler._ioutils.set_event.assert_has_calls(
-            [mock.call(self._handler._r_overlapped.hEvent),
-             mock.call(self._handler._w_overlapped.hEvent)])
-        self._handler._ioutils.cancel_io.assert_called_once_with(
+        self._handler._input_reader.close.assert_called_once_with()
+        self._mock_reactor.close_pipe.assert_called_once_with(
             mock.sentinel.pipe_handle)
+        self.assertIsNone(self._handler._pipe_handle)
 
-        for worker in self._handler._workers:
-            worker.join.assert_called_once_with()
+    def test_attach_buffers(self):
+        self._mock_setup_pipe_handler()
+        mock_input_buffer = mock.Mock()
 
-    def _test_start_io_worker(self, buff_update_func=None, exception=None):
-        self._handler._stopped.isSet.side_effect = [False, True]
-        self._handler._pipe_handle = mock.sentinel.pipe_handle
-        self._handler.stop = mock.Mock()
+        self._handler.attach_buffers(mock_input_buffer,
+                                     mock.sentinel.output_buffer)
 
-        io_func = mock.Mock(side_effect=exception)
-        fake_buffer = 'fake_buffer'
+        self.assertEqual(mock.sentinel.output_buffer,
+                         self._handler._output_buffer)
+        mock_input_buffer.get_reader.assert_called_once_with(
+            callback=self._handler._write_to_pipe)
+        self.assertEqual(mock_input_buffer.get_reader.return_value,
+                         self._handler._input_reader)
 
-        self._handler._start_io_worker(io_func, fake_buffer,
-                                       mock.sentinel.overlapped_structure,
-                                       mock.sentinel.completion_routine,
-                                       buff_update_func)
+    def test_detach_buffers(self):
+        self._mock_setup_pipe_handler()
+        mock_input_reader = self._handler._input_reader
 
-        if buff_update_func:
-            num_bytes = buff_update_func()
-        else:
-            num_bytes = len(fake_buffer)
+        self._handler.detach_buffers()
 
-        io_func.assert_called_once_with(mock.sentinel.pipe_handle,
-                                        fake_buffer, num_bytes,
-                                        mock.sentinel.overlapped_structure,
-                                        mock.sentinel.completion_routine)
-        if exception:
-            self._handler._stopped.set.assert_called_once_with()
+        mock_input_reader.close.assert_called_once_with()
+        self.assertIsNone(self._handler._input_reader)
+        self.assertIsNone(self._handler._input_buffer)
+        self.assertIsNone(self._handler._output_buffer)
 
-    def test_start_io_worker(self):
-        self._test_start_io_worker()
+    def test_read_from_pipe(self):
+        self._mock_setup_pipe_handler()
 
-    def test_start_io_worker_with_buffer_update_method(self):
-        self._test_start_io_worker(buff_update_func=mock.Mock())
+        self._handler._read_from_pipe()
 
-    def test_start_io_worker_exception(self):
-        self._test_start_io_worker(exception=IOError)
+        self._mock_reactor.read_pipe.assert_called_once_with(
+            mock.sentinel.pipe_handle, self._handler._r_buffer,
+            self._handler._read_callback)
 
-    @mock.patch.object(namedpipe.NamedPipeHandler, '_write_to_log')
-    def test_read_callback(self, mock_write_to_log):
+    @mock.patch.object(namedpipe.NamedPipeHandler, '_read_from_pipe')
+    def test_read_callback(self, mock_read_from_pipe):
         self._mock_setup_pipe_handler()
-        fake_data = self._handler._ioutils.get_buffer_data.return_value
+        fake_data = self._handler._ioutils.get_buffer_view.return_value
+
+        fake_num_bytes = 4
 
-        self._handler._read_callback(mock.sentinel.num_bytes)
+        self._handler._read_callback(fake_num_bytes)
 
-        self._handler._ioutils.get_buffer_data.assert_called_once_with(
-            self._handler._r_buffer, mock.sentinel.num_bytes)
-        self._mock_output_queue.put.assert_called_once_with(fake_data)
-        mock_write_to_log.assert_called_once_with(fake_data)
+        self._handler._ioutils.get_buffer_view.assert_called_once_with(
+            self._handler._r_buffer, fake_num_bytes)
+        self._mock_output_buffer.write.assert_called_once_with(fake_data)
+        self._mock_log_writer.write.assert_called_once_with(fake_data)
+        mock_read_from_pipe.assert_called_once_with()
+        self.assertEqual(fake_num_bytes, self._handler._stats['bytes_read'])
 
-    @mock.patch.object(namedpipe, 'time')
-    def test_get_data_to_write(self, mock_time):
+    @mock.patch.object(namedpipe.NamedPipeHandler, '_read_from_pipe')
+    def test_read_callback_error(self, mock_read_from_pipe):
         self._mock_setup_pipe_handler()
-        self._handler._stopped.isSet.side_effect = [False, False]
-        self._mock_client_connected.isSet.side_effect = [False, True]
-        fake_data = 'fake input data'
-        self._mock_input_queue.get.return_value = fake_data
 
-        num_bytes = self._handler._get_data_to_write()
+        self._handler._read_callback(0, mock.sentinel.error_code)
 
-        mock_time.sleep.assert_called_once_with(1)
-        self._handler._ioutils.write_buffer_data.assert_called_once_with(
-            self._handler._w_buffer, fake_data)
-        self.assertEqual(len(fake_data), num_bytes)
+        self._handler._stopped.set.assert_called_once_with()
+        self.assertFalse(self._mock_output_buffer.write.called)
+        self.assertFalse(mock_read_from_pipe.called)
+        self.assertEqual(1, self._handler._stats['io_errors'])
 
-    @mock.patch.object(namedpipe.NamedPipeHandler, '_rotate_logs')
-    def _test_write_to_log(self, mock_rotate_logs, size_exceeded=False):
+    def test_write_to_pipe(self):
         self._mock_setup_pipe_handler()
-        self._handler._stopped.isSet.return_value = False
-        fake_handle = self._handler._log_file_handle
-        fake_handle.tell.return_value = (constants.MAX_CONSOLE_LOG_FILE_SIZE
-                                         if size_exceeded else 0)
-        fake_data = 'fake_data'
-
-        self._handler._write_to_log(fake_data)
+        mock_input_reader = self._handler._input_reader
+        mock_input_reader.get_views.return_value = [mock.sentinel.view]
+        mock_write_views = self._handler._ioutils.write_buffer_views
+
+        self._handler._write_to_pipe()
+
+        mock_input_reader.get_views.assert_called_once_with(
+            size=constants.SERIAL_CONSOLE_BUFFER_SIZE, timeout=0)
+        mock_write_views.assert_called_once_with(
+            self._handler._w_buffer, [mock.sentinel.view])
+        mock_input_reader.consume.assert_called_once_with(
+            mock_write_views.return_value)
+        self._mock_reactor.write_pipe.assert_called_once_with(
+            mock.sentinel.pipe_handle, self._handler._w_buffer,
+            mock_write_views.return_value, self._handler._write_callback)
+        self.assertTrue(self._handler._write_pending)
+
+    def test_write_to_pipe_no_data(self):
+        self._mock_setup_pipe_handler()
+        self._handler._input_reader.get_views.return_value = []
 
-        if size_exceeded:
-            mock_rotate_logs.assert_called_once_with()
+        self._handler._write_to_pipe()
 
-        self._handler._log_file_handle.write.assert_called_once_with(
-            fake_data)
+        self.assertFalse(self._mock_reactor.write_pipe.called)
+        self.assertFalse(self._handler._write_pending)
 
-    def test_write_to_log(self):
-        self._test_write_to_log()
+    def test_write_to_pipe_pending_write(self):
+        self._mock_setup_pipe_handler()
+        self._handler._write_pending = True
 
-    def test_write_to_log_size_exceeded(self):
-        self._test_write_to_log(size_exceeded=True)
+        self._handler._write_to_pipe()
 
-    @mock.patch.object(namedpipe.NamedPipeHandler, '_retry_if_file_in_use')
-    @mock.patch('__builtin__.open')
-    @mock.patch.object(namedpipe, 'os')
-    def test_rotate_logs(self, mock_os, mock_open, mock_exec_retry):
-        fake_archived_log_path = self._FAKE_LOG_PATH + '.1'
-        mock_os.path.exists.return_value = True
+        self.assertFalse(self._handler._input_reader.get_views.called)
+        self.assertFalse(self._mock_reactor.write_pipe.called)
 
+    def test_write_to_pipe_detached_buffers(self):
         self._mock_setup_pipe_handler()
-        fake_handle = self._handler._log_file_handle
-
-        self._handler._rotate_logs()
-
-        fake_handle.flush.assert_called_once_with()
-        fake_handle.close.assert_called_once_with()
-        mock_os.path.exists.assert_called_once_with(
-            fake_archived_log_path)
-
-        mock_exec_retry.assert_has_calls([mock.call(mock_os.remove,
-                                                    fake_archived_log_path),
-                                          mock.call(mock_os.rename,
-                                                    self._FAKE_LOG_PATH,
-                                                    fake_archived_log_path)])
-
-        mock_open.assert_called_once_with(self._FAKE_LOG_PATH, 'ab', 1)
-        self.assertEqual(mock_open.return_value,
-                         self._handler._log_file_handle)
-
-    @mock.patch.object(namedpipe, 'time')
-    def test_retry_if_file_in_use_exceeded_retries(self, mock_time):
-        class FakeWindowsException(Exception):
-            errno = errno.EACCES
-
-        raise_count = self._handler._MAX_LOG_ROTATE_RETRIES + 1
-        mock_func_side_eff = [FakeWindowsException] * raise_count
-        mock_func = mock.Mock(side_effect=mock_func_side_eff)
-
-        with mock.patch.object(namedpipe, 'WindowsError',
-                               FakeWindowsException, create=True):
-            self.assertRaises(FakeWindowsException,
-                              self._handler._retry_if_file_in_use,
-                              mock_func, mock.sentinel.arg)
-            mock_time.sleep.assert_has_calls(
-                [mock.call(1)] * self._handler._MAX_LOG_ROTATE_RETRIES)
+        self._handler._input_reader = None
+
+        self._handler._write_to_pipe()
+
+        self.assertFalse(self._mock_reactor.write_pipe.called)
+
+    @mock.patch.object(namedpipe.NamedPipeHandler, '_write_to_pipe')
+    def test_write_callback(self, mock_write_to_pipe):
+        self._handler._write_pending = True
+
+        self._handler._write_callback(4)
+
+        self.assertFalse(self._handler._write_pending)
+        mock_write_to_pipe.assert_called_once_with()
+        self.assertEqual(4, self._handler._stats['bytes_written'])
+
+    def test_get_stats(self):
+        self._handler._stats['bytes_read'] = mock.sentinel.bytes_read
+
+        stats = self._handler.get_stats()
+
+        self.assertEqual(mock.sentinel.bytes_read, stats['bytes_read'])
+        self.assertIsNot(self._handler._stats, stats)
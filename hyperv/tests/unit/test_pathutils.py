@@ -200,6 +200,43 @@ class PathUtilsTestCase(test_base.HyperVBaseTestCase):
                               self._pathutils._get_instances_sub_dir,
                               fake_dir_name)
 
+    @mock.patch.object(pathutils.PathUtils, '_get_instances_sub_dir')
+    def test_get_remote_base_vhd_dir(self, mock_get_instances_sub_dir):
+        base_dir = self._pathutils.get_base_vhd_dir(
+            remote_server=mock.sentinel.remote_server)
+
+        self.assertEqual(mock_get_instances_sub_dir.return_value, base_dir)
+        mock_get_instances_sub_dir.assert_called_once_with(
+            '_base', mock.sentinel.remote_server, create_dir=False)
+
+    @mock.patch.object(pathutils.PathUtils, 'get_instance_dir')
+    def test_get_vm_console_log_paths(self, mock_get_instance_dir):
+        self.flags(console_log_archive_count=2, group='hyperv')
+        mock_get_instance_dir.return_value = 'fake_instance_dir'
+        fake_log_path = os.path.join('fake_instance_dir', 'console.log')
+
+        log_paths = self._pathutils.get_vm_console_log_paths(
+            mock.sentinel.instance_name,
+            remote_server=mock.sentinel.remote_server)
+
+        mock_get_instance_dir.assert_called_once_with(
+            mock.sentinel.instance_name, mock.sentinel.remote_server)
+        self.assertEqual([fake_log_path, fake_log_path + '.1',
+                          fake_log_path + '.1.gz', fake_log_path + '.2.gz'],
+                         log_paths)
+
+    @mock.patch.object(pathutils.PathUtils, 'get_instance_dir')
+    def test_get_vm_console_log_paths_no_archives(self,
+                                                  mock_get_instance_dir):
+        self.flags(console_log_archive_count=0, group='hyperv')
+        mock_get_instance_dir.return_value = 'fake_instance_dir'
+
+        log_paths = self._pathutils.get_vm_console_log_paths(
+            mock.sentinel.instance_name)
+
+        self.assertEqual([os.path.join('fake_instance_dir', 'console.log')],
+                         log_paths)
+
     def test_copy_vm_console_logs(self):
         fake_local_logs = [mock.sentinel.log_path,
                            mock.sentinel.archived_log_path]
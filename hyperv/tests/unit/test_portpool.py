@@ -0,0 +1,201 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import socket
+
+import mock
+from nova import exception
+
+from hyperv.nova import portpool
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class PortPoolTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the serial proxy port pool."""
+
+    def setUp(self):
+        super(PortPoolTestCase, self).setUp()
+
+        self._pool = portpool.PortPool(mock.sentinel.addr, '10000:10002', 2,
+                                       quarantine_time=10)
+
+        socket_patcher = mock.patch.object(portpool.socket, 'socket')
+        self._mock_socket_cls = socket_patcher.start()
+        self.addCleanup(socket_patcher.stop)
+
+    def _mock_socks(self, *bind_errors):
+        mock_socks = []
+        for bind_error in bind_errors:
+            mock_sock = mock.Mock()
+            if bind_error:
+                mock_sock.bind.side_effect = socket.error(bind_error, '')
+            mock_socks.append(mock_sock)
+        self._mock_socket_cls.side_effect = mock_socks
+        return mock_socks
+
+    def test_invalid_port_range(self):
+        for port_range in ('10000', '10001:10000', '0:10', '1:70000', None,
+                           'fake:range'):
+            self.assertRaises(vmutils.HyperVException,
+                              portpool.PortPool,
+                              mock.sentinel.addr, port_range, 2)
+
+    def test_fill(self):
+        mock_socks = self._mock_socks(None, errno.EADDRINUSE, None)
+
+        self._pool.fill()
+
+        self.assertEqual([mock_socks[0], mock_socks[2]],
+                         list(self._pool._free_socks))
+        self.assertEqual(set([10000, 10002]), self._pool._bound_ports)
+        mock_socks[1].close.assert_called_once_with()
+        mock_socks[2].bind.assert_called_once_with((mock.sentinel.addr,
+                                                    10002))
+        mock_socks[2].listen.assert_called_once_with(1)
+        mock_socks[2].setblocking.assert_called_once_with(False)
+
+    def test_fill_range_exhausted(self):
+        self._mock_socks(errno.EADDRINUSE, None, errno.EADDRINUSE,
+                         errno.EADDRINUSE)
+
+        self._pool.fill()
+
+        self.assertEqual(1, len(self._pool._free_socks))
+        self.assertEqual(set([10001]), self._pool._bound_ports)
+
+    def test_acquire_pooled_socket(self):
+        mock_sock = mock.Mock()
+        mock_conn = mock.Mock()
+        mock_sock.accept.side_effect = [(mock_conn, mock.sentinel.addr),
+                                        socket.error]
+        self._pool._free_socks.append(mock_sock)
+
+        sock = self._pool.acquire_socket()
+
+        self.assertEqual(mock_sock, sock)
+        # Stale connections are dropped.
+        mock_conn.close.assert_called_once_with()
+        self.assertFalse(self._mock_socket_cls.called)
+
+    def test_acquire_new_socket(self):
+        mock_sock = self._mock_socks(None)[0]
+        self._pool._bound_ports.add(10000)
+
+        sock = self._pool.acquire_socket()
+
+        self.assertEqual(mock_sock, sock)
+        mock_sock.bind.assert_called_once_with((mock.sentinel.addr, 10001))
+
+    def test_acquire_socket_range_exhausted(self):
+        self._pool._bound_ports.update([10000, 10001, 10002])
+
+        self.assertRaises(exception.SocketPortRangeExhaustedException,
+                          self._pool.acquire_socket)
+
+    def test_acquire_socket_bind_failure(self):
+        self._mock_socks(errno.EINVAL)
+
+        self.assertRaises(vmutils.HyperVException,
+                          self._pool.acquire_socket)
+        self.assertEqual(set(), self._pool._bound_ports)
+
+    @mock.patch.object(portpool, 'socket')
+    def test_create_socket_reuse_addr(self, mock_socket):
+        del mock_socket.SO_EXCLUSIVEADDRUSE
+        mock_sock = mock_socket.socket.return_value
+
+        self._pool._create_socket(mock.sentinel.port)
+
+        mock_sock.setsockopt.assert_called_once_with(
+            mock_socket.SOL_SOCKET, mock_socket.SO_REUSEADDR, 1)
+
+    @mock.patch.object(portpool.socket, 'SO_EXCLUSIVEADDRUSE', create=True)
+    def test_create_socket_exclusive_addr(self, mock_exclusive_addr_use):
+        mock_sock = self._mock_socks(None)[0]
+
+        self._pool._create_socket(mock.sentinel.port)
+
+        mock_sock.setsockopt.assert_called_once_with(
+            socket.SOL_SOCKET, mock_exclusive_addr_use, 1)
+
+    @mock.patch.object(portpool.time, 'time')
+    def _test_release_socket(self, mock_time, pool_full=False):
+        mock_time.return_value = 100
+        mock_sock = mock.Mock()
+        mock_sock.getsockname.return_value = (mock.sentinel.addr, 10000)
+        self._pool._bound_ports.add(10000)
+        if pool_full:
+            self._pool._free_socks.extend([mock.sentinel.sock] * 2)
+
+        self._pool.release_socket(mock_sock)
+
+        if pool_full:
+            mock_sock.close.assert_called_once_with()
+            self.assertEqual([], list(self._pool._quarantined_socks))
+            self.assertEqual(set(), self._pool._bound_ports)
+            self.assertEqual({10000: 110}, self._pool._quarantined_ports)
+        else:
+            self.assertFalse(mock_sock.close.called)
+            self.assertEqual([(110, mock_sock)],
+                             list(self._pool._quarantined_socks))
+            self.assertEqual(set([10000]), self._pool._bound_ports)
+        self.assertNotIn(mock_sock, self._pool._free_socks)
+
+    def test_release_socket(self):
+        self._test_release_socket()
+
+    def test_release_socket_pool_full(self):
+        self._test_release_socket(pool_full=True)
+
+    @mock.patch.object(portpool.time, 'time')
+    def test_acquire_quarantined_socket(self, mock_time):
+        mock_time.return_value = 100
+        mock_sock = mock.Mock()
+        mock_sock.accept.side_effect = socket.error
+        self._pool._quarantined_socks.append((100, mock_sock))
+
+        sock = self._pool.acquire_socket()
+
+        self.assertEqual(mock_sock, sock)
+        self.assertEqual([], list(self._pool._quarantined_socks))
+
+    @mock.patch.object(portpool.time, 'time')
+    def test_acquire_socket_skips_quarantined(self, mock_time):
+        mock_time.return_value = 100
+        self._pool._quarantined_socks.append((101, mock.sentinel.sock))
+        self._pool._bound_ports.add(10000)
+        self._pool._quarantined_ports.update({10001: 101, 10002: 100})
+        mock_sock = self._mock_socks(None)[0]
+
+        sock = self._pool.acquire_socket()
+
+        self.assertEqual(mock_sock, sock)
+        # The quarantine of port 10002 has ended.
+        mock_sock.bind.assert_called_once_with((mock.sentinel.addr, 10002))
+        self.assertEqual({10001: 101}, self._pool._quarantined_ports)
+        self.assertEqual([(101, mock.sentinel.sock)],
+                         list(self._pool._quarantined_socks))
+
+    @mock.patch.object(portpool.time, 'time')
+    def test_fill_counts_quarantined_socks(self, mock_time):
+        mock_time.return_value = 100
+        self._pool._quarantined_socks.append((101, mock.sentinel.sock))
+        mock_socks = self._mock_socks(None)
+
+        self._pool.fill()
+
+        self.assertEqual(mock_socks, list(self._pool._free_socks))
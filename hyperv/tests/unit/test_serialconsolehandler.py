@@ -17,9 +17,11 @@ import mock
 
 from nova import exception
 
+from hyperv.nova import consolelog
 from hyperv.nova import constants
 from hyperv.nova import ioutils
 from hyperv.nova import namedpipe
+from hyperv.nova import portpool
 from hyperv.nova import serialconsolehandler
 from hyperv.nova import serialproxy
 from hyperv.nova import utilsfactory
@@ -28,139 +30,292 @@ from hyperv.tests.unit import test_base
 
 
 class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
+    @mock.patch.object(serialconsolehandler.ioreactor, 'get_reactor')
+    @mock.patch.object(consolelog, 'ConsoleLogWriter')
     @mock.patch.object(utilsfactory, 'get_pathutils')
-    def setUp(self, mock_get_pathutils):
+    def setUp(self, mock_get_pathutils, mock_log_writer_cls,
+              mock_get_reactor):
         super(SerialConsoleHandlerTestCase, self).setUp()
+        self.flags(serial_console_proxy_idle_timeout=10, group='hyperv')
+        self.flags(console_token_ttl=5)
         self._consolehandler = serialconsolehandler.SerialConsoleHandler(
             mock.sentinel.instance_name)
 
-        self._consolehandler._log_path = mock.sentinel.log_path
+        mock_get_log_paths = (
+            mock_get_pathutils.return_value.get_vm_console_log_paths)
+        mock_get_log_paths.assert_called_once_with(
+            mock.sentinel.instance_name)
+        mock_log_writer_cls.assert_called_once_with(
+            mock_get_log_paths.return_value)
+        self._mock_log_writer = mock_log_writer_cls.return_value
+        self._mock_reactor = mock_get_reactor.return_value
         self._consolehandler._pathutils = mock.Mock()
         self._consolehandler._vmutils = mock.Mock()
 
-    @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
-                       '_setup_handlers')
-    def test_start_handler(self, mock_setup_handlers):
-        mock_workers = [mock.Mock(), mock.Mock()]
-        self._consolehandler._workers = mock_workers
-
-        self._consolehandler.start()
-
-        mock_setup_handlers.assert_called_once_with()
-        for worker in mock_workers:
-            worker.start.assert_called_once_with()
-
-    @mock.patch('nova.console.serial.release_port')
-    def test_stop_handler(self, mock_release_port):
+    def _mock_serial_proxy(self, log_pipe_type=constants.SERIAL_PORT_TYPE_RO):
         mock_serial_proxy = mock.Mock()
-        mock_workers = [mock_serial_proxy, mock.Mock()]
+        mock_buffers = [mock.Mock(), mock.Mock()]
+        mock_pipe_handlers = {log_pipe_type: mock.Mock()}
+        if log_pipe_type == constants.SERIAL_PORT_TYPE_RO:
+            mock_pipe_handlers[constants.SERIAL_PORT_TYPE_RW] = mock.Mock()
 
         self._consolehandler._serial_proxy = mock_serial_proxy
+        (self._consolehandler._input_buffer,
+         self._consolehandler._output_buffer) = mock_buffers
         self._consolehandler._listen_host = mock.sentinel.host
         self._consolehandler._listen_port = mock.sentinel.port
-        self._consolehandler._workers = mock_workers
-
-        self._consolehandler.stop()
-
-        mock_release_port.assert_called_once_with(mock.sentinel.host,
-                                                  mock.sentinel.port)
-        for worker in mock_workers:
-            worker.stop.assert_called_once_with()
+        self._consolehandler._listen_sock = mock.sentinel.listen_sock
+        self._consolehandler._pipe_handlers = dict(mock_pipe_handlers)
+        self._consolehandler._log_pipe_type = log_pipe_type
+        return mock_serial_proxy, mock_buffers, mock_pipe_handlers
 
     @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
-                       '_setup_named_pipe_handlers')
+                       '_start_serial_proxy')
     @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
-                       '_setup_serial_proxy_handler')
-    def _test_setup_handlers(self, mock_setup_proxy, mock_setup_pipe_handlers,
-                             serial_console_enabled=True):
-        self.flags(enabled=serial_console_enabled, group='serial_console')
+                       '_setup_named_pipe_handlers')
+    def _test_start_handler(self, mock_setup_pipe_handlers,
+                            mock_start_serial_proxy, lazy_proxy=True):
+        self.flags(enabled=True, group='serial_console')
+        self._consolehandler._lazy_proxy = lazy_proxy
+        mock_handlers = [mock.Mock(), mock.Mock()]
+        self._consolehandler._pipe_handlers = dict(enumerate(mock_handlers))
 
-        self._consolehandler._setup_handlers()
+        self._consolehandler.start()
 
-        self.assertEqual(serial_console_enabled, mock_setup_proxy.called)
         mock_setup_pipe_handlers.assert_called_once_with()
+        self._mock_log_writer.start.assert_called_once_with()
+        for handler in mock_handlers:
+            handler.start.assert_called_once_with()
+        self.assertEqual(not lazy_proxy, mock_start_serial_proxy.called)
+
+    def test_start_handler(self):
+        self._test_start_handler()
 
-    def test_setup_handlers(self):
-        self._test_setup_handlers()
+    def test_start_handler_eager_proxy(self):
+        self._test_start_handler(lazy_proxy=False)
+
+    @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
+                       '_stop_serial_proxy')
+    def test_stop_handler(self, mock_stop_serial_proxy):
+        mock_handlers = [mock.Mock(), mock.Mock()]
+        self._consolehandler._pipe_handlers = dict(enumerate(mock_handlers))
+
+        self._consolehandler.stop()
 
-    def test_setup_handlers_console_disabled(self):
-        self._test_setup_handlers(serial_console_enabled=False)
+        mock_stop_serial_proxy.assert_called_once_with()
+        for handler in mock_handlers:
+            handler.stop.assert_called_once_with()
+        self._mock_log_writer.stop.assert_called_once_with()
 
+    @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
+                       '_attach_rw_pipe_handler')
     @mock.patch.object(serialproxy, 'SerialProxy')
-    @mock.patch('nova.console.serial.acquire_port')
-    @mock.patch.object(serialconsolehandler.threading, 'Event')
-    @mock.patch.object(ioutils, 'IOQueue')
-    def test_setup_serial_proxy_handler(self, mock_io_queue, mock_event,
-                                        mock_acquire_port,
-                                        mock_serial_proxy_class):
-        mock_input_queue = mock.sentinel.input_queue
-        mock_output_queue = mock.sentinel.output_queue
-        mock_client_connected = mock_event.return_value
-        mock_io_queue.side_effect = [mock_input_queue, mock_output_queue]
+    @mock.patch.object(portpool, 'get_port_pool')
+    @mock.patch.object(ioutils, 'RingBuffer')
+    def test_start_serial_proxy(self, mock_ring_buffer, mock_get_port_pool,
+                                mock_serial_proxy_class,
+                                mock_attach_rw_pipe_handler):
+        mock_input_buffer = mock.sentinel.input_buffer
+        mock_output_buffer = mock.sentinel.output_buffer
+        mock_ring_buffer.side_effect = [mock_input_buffer, mock_output_buffer]
         mock_serial_proxy = mock_serial_proxy_class.return_value
+        self._consolehandler._rw_pipe_path = mock.sentinel.rw_pipe_path
 
-        mock_acquire_port.return_value = mock.sentinel.port
+        mock_sock = mock_get_port_pool.return_value.acquire_socket.return_value
+        mock_sock.getsockname.return_value = (mock.sentinel.host,
+                                              mock.sentinel.port)
         self.flags(proxyclient_address=mock.sentinel.host,
                    group='serial_console')
 
-        self._consolehandler._setup_serial_proxy_handler()
+        self._consolehandler._start_serial_proxy()
 
         mock_serial_proxy_class.assert_called_once_with(
             mock.sentinel.instance_name,
             mock.sentinel.host, mock.sentinel.port,
-            mock_input_queue,
-            mock_output_queue,
-            mock_client_connected)
+            mock_input_buffer,
+            mock_output_buffer,
+            sock=mock_sock)
+        mock_ring_buffer.assert_has_calls([mock.call(overwrite=False),
+                                           mock.call()])
+        mock_serial_proxy.start.assert_called_once_with()
+        mock_attach_rw_pipe_handler.assert_called_once_with()
+        self.assertEqual(mock_serial_proxy,
+                         self._consolehandler._serial_proxy)
+        self._mock_reactor.call_later.assert_called_once_with(
+            10, self._consolehandler._check_proxy_idle)
+
+    @mock.patch.object(serialproxy, 'SerialProxy')
+    def test_start_serial_proxy_running(self, mock_serial_proxy_class):
+        mock_serial_proxy = mock.Mock()
+        self._consolehandler._serial_proxy = mock_serial_proxy
+
+        self._consolehandler._start_serial_proxy()
+
+        # The proxy is reused, restarting its idle period.
+        mock_serial_proxy.reset_idle_time.assert_called_once_with()
+        self.assertFalse(mock_serial_proxy_class.called)
+        self.assertFalse(self._mock_reactor.call_later.called)
+
+    @mock.patch.object(serialconsolehandler.ioreactor, 'get_reactor')
+    @mock.patch.object(consolelog, 'ConsoleLogWriter')
+    @mock.patch.object(utilsfactory, 'get_pathutils')
+    def test_proxy_idle_timeout_below_token_ttl(self, mock_get_pathutils,
+                                                mock_log_writer_cls,
+                                                mock_get_reactor):
+        self.flags(console_token_ttl=60)
+
+        consolehandler = serialconsolehandler.SerialConsoleHandler(
+            mock.sentinel.instance_name)
+
+        self.assertEqual(60, consolehandler._proxy_idle_timeout)
+
+    def test_start_serial_proxy_missing_rw_pipe(self):
+        self.assertRaises(exception.ConsoleTypeUnavailable,
+                          self._consolehandler._start_serial_proxy)
+
+    @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
+                       '_stop_serial_proxy')
+    @mock.patch.object(serialproxy, 'SerialProxy')
+    @mock.patch.object(portpool, 'get_port_pool')
+    @mock.patch.object(ioutils, 'RingBuffer')
+    def test_start_serial_proxy_exception(self, mock_ring_buffer,
+                                          mock_get_port_pool,
+                                          mock_serial_proxy_class,
+                                          mock_stop_serial_proxy):
+        mock_serial_proxy_class.return_value.start.side_effect = (
+            vmutils.HyperVException)
+        self._consolehandler._rw_pipe_path = mock.sentinel.rw_pipe_path
+
+        self.assertRaises(vmutils.HyperVException,
+                          self._consolehandler._start_serial_proxy)
+
+        mock_stop_serial_proxy.assert_called_once_with()
+        self.assertFalse(self._mock_reactor.call_later.called)
+
+    @mock.patch.object(portpool, 'get_port_pool')
+    def _test_stop_serial_proxy(self, mock_get_port_pool, log_pipe_type):
+        mock_serial_proxy, mock_buffers, mock_pipe_handlers = (
+            self._mock_serial_proxy(log_pipe_type))
+        mock_rw_handler = mock_pipe_handlers[constants.SERIAL_PORT_TYPE_RW]
+        mock_timer = mock.Mock()
+        self._consolehandler._idle_timer = mock_timer
+
+        self._consolehandler._stop_serial_proxy()
+
+        mock_timer.cancel.assert_called_once_with()
+        mock_serial_proxy.stop.assert_called_once_with()
+        for buff in mock_buffers:
+            buff.close.assert_called_once_with()
+        mock_release_socket = mock_get_port_pool.return_value.release_socket
+        mock_release_socket.assert_called_once_with(
+            mock.sentinel.listen_sock)
+        self.assertIsNone(self._consolehandler._serial_proxy)
+        self.assertIsNone(self._consolehandler._listen_sock)
+
+        if log_pipe_type == constants.SERIAL_PORT_TYPE_RW:
+            mock_rw_handler.detach_buffers.assert_called_once_with()
+            self.assertFalse(mock_rw_handler.stop.called)
+        else:
+            mock_rw_handler.stop.assert_called_once_with()
+            self.assertNotIn(constants.SERIAL_PORT_TYPE_RW,
+                             self._consolehandler._pipe_handlers)
+
+    def test_stop_serial_proxy(self):
+        self._test_stop_serial_proxy(
+            log_pipe_type=constants.SERIAL_PORT_TYPE_RO)
+
+    def test_stop_serial_proxy_logging_rw_pipe(self):
+        self._test_stop_serial_proxy(
+            log_pipe_type=constants.SERIAL_PORT_TYPE_RW)
+
+    def test_attach_rw_pipe_handler_logging(self):
+        mock_rw_handler = mock.Mock()
+        self._consolehandler._pipe_handlers = {
+            constants.SERIAL_PORT_TYPE_RW: mock_rw_handler}
+        self._consolehandler._input_buffer = mock.sentinel.input_buffer
+        self._consolehandler._output_buffer = mock.sentinel.output_buffer
 
-        self.assertIn(mock_serial_proxy, self._consolehandler._workers)
+        self._consolehandler._attach_rw_pipe_handler()
+
+        mock_rw_handler.attach_buffers.assert_called_once_with(
+            mock.sentinel.input_buffer, mock.sentinel.output_buffer)
 
     @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
                        '_get_named_pipe_handler')
+    def test_attach_rw_pipe_handler(self, mock_get_pipe_handler):
+        self._consolehandler._rw_pipe_path = mock.sentinel.rw_pipe_path
+        mock_rw_handler = mock_get_pipe_handler.return_value
+
+        self._consolehandler._attach_rw_pipe_handler()
+
+        mock_get_pipe_handler.assert_called_once_with(
+            mock.sentinel.rw_pipe_path,
+            pipe_type=constants.SERIAL_PORT_TYPE_RW,
+            enable_logging=False)
+        mock_rw_handler.start.assert_called_once_with()
+        self.assertEqual(
+            mock_rw_handler,
+            self._consolehandler._pipe_handlers[
+                constants.SERIAL_PORT_TYPE_RW])
+
     @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
-                       '_get_vm_serial_port_mapping')
-    def _mock_setup_named_pipe_handlers(self, mock_get_port_mapping,
-                                        mock_get_pipe_handler,
-                                        serial_port_mapping=None):
-        mock_get_port_mapping.return_value = serial_port_mapping
+                       '_stop_serial_proxy')
+    def _test_check_proxy_idle(self, mock_stop_serial_proxy, idle_time):
+        mock_serial_proxy = self._mock_serial_proxy()[0]
+        mock_serial_proxy.get_idle_time.return_value = idle_time
 
-        self._consolehandler._setup_named_pipe_handlers()
+        self._consolehandler._check_proxy_idle()
 
-        expected_workers = [mock_get_pipe_handler.return_value
-                            for port in serial_port_mapping]
+        if idle_time >= 10:
+            mock_stop_serial_proxy.assert_called_once_with()
+            self.assertFalse(self._mock_reactor.call_later.called)
+        else:
+            self.assertFalse(mock_stop_serial_proxy.called)
+            self._mock_reactor.call_later.assert_called_once_with(
+                10 - idle_time, self._consolehandler._check_proxy_idle)
 
-        self.assertEqual(expected_workers, self._consolehandler._workers)
+    def test_check_proxy_idle(self):
+        self._test_check_proxy_idle(idle_time=10)
 
-        return mock_get_pipe_handler
+    def test_check_proxy_idle_in_use(self):
+        self._test_check_proxy_idle(idle_time=4)
 
-    def test_setup_ro_pipe_handler(self):
-        serial_port_mapping = {
-            constants.SERIAL_PORT_TYPE_RW: mock.sentinel.pipe_path
-        }
+    @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
+                       '_get_named_pipe_handler')
+    @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
+                       '_get_vm_serial_port_mapping')
+    def _test_setup_named_pipe_handlers(self, mock_get_port_mapping,
+                                        mock_get_pipe_handler,
+                                        serial_port_mapping):
+        mock_get_port_mapping.return_value = serial_port_mapping
 
-        mock_get_handler = self._mock_setup_named_pipe_handlers(
-            serial_port_mapping=serial_port_mapping)
+        self._consolehandler._setup_named_pipe_handlers()
 
-        mock_get_handler.assert_called_once_with(
-            mock.sentinel.pipe_path,
-            pipe_type=constants.SERIAL_PORT_TYPE_RW,
+        log_pipe_type = (constants.SERIAL_PORT_TYPE_RO
+                         if constants.SERIAL_PORT_TYPE_RO in
+                         serial_port_mapping
+                         else constants.SERIAL_PORT_TYPE_RW)
+        mock_get_pipe_handler.assert_called_once_with(
+            serial_port_mapping[log_pipe_type],
+            pipe_type=log_pipe_type,
             enable_logging=True)
+        self.assertEqual({log_pipe_type: mock_get_pipe_handler.return_value},
+                         self._consolehandler._pipe_handlers)
+        self.assertEqual(log_pipe_type, self._consolehandler._log_pipe_type)
+        self.assertEqual(
+            serial_port_mapping.get(constants.SERIAL_PORT_TYPE_RW),
+            self._consolehandler._rw_pipe_path)
+
+    def test_setup_rw_pipe_handler(self):
+        self._test_setup_named_pipe_handlers(
+            serial_port_mapping={
+                constants.SERIAL_PORT_TYPE_RW: mock.sentinel.rw_pipe_path})
 
     def test_setup_pipe_handlers(self):
-        serial_port_mapping = {
-            constants.SERIAL_PORT_TYPE_RO: mock.sentinel.ro_pipe_path,
-            constants.SERIAL_PORT_TYPE_RW: mock.sentinel.rw_pipe_path
-        }
-
-        mock_get_handler = self._mock_setup_named_pipe_handlers(
-            serial_port_mapping=serial_port_mapping)
-
-        expected_calls = [mock.call(mock.sentinel.ro_pipe_path,
-                                    pipe_type=constants.SERIAL_PORT_TYPE_RO,
-                                    enable_logging=True),
-                          mock.call(mock.sentinel.rw_pipe_path,
-                                    pipe_type=constants.SERIAL_PORT_TYPE_RW,
-                                    enable_logging=False)]
-        mock_get_handler.assert_has_calls(expected_calls)
+        self._test_setup_named_pipe_handlers(
+            serial_port_mapping={
+                constants.SERIAL_PORT_TYPE_RO: mock.sentinel.ro_pipe_path,
+                constants.SERIAL_PORT_TYPE_RW: mock.sentinel.rw_pipe_path})
 
     @mock.patch.object(namedpipe, 'NamedPipeHandler')
     def _test_get_named_pipe_handler(self, mock_pipe_handler_class,
@@ -168,17 +323,14 @@ class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
         expected_args = {}
 
         if pipe_type == constants.SERIAL_PORT_TYPE_RW:
-            self._consolehandler._input_queue = mock.sentinel.input_queue
-            self._consolehandler._output_queue = mock.sentinel.output_queue
-            self._consolehandler._client_connected = (
-                mock.sentinel.connect_event)
+            self._consolehandler._input_buffer = mock.sentinel.input_buffer
+            self._consolehandler._output_buffer = mock.sentinel.output_buffer
             expected_args.update({
-                'input_queue': mock.sentinel.input_queue,
-                'output_queue': mock.sentinel.output_queue,
-                'connect_event': mock.sentinel.connect_event})
+                'input_buffer': mock.sentinel.input_buffer,
+                'output_buffer': mock.sentinel.output_buffer})
 
         if enable_logging:
-            expected_args['log_file'] = mock.sentinel.log_path
+            expected_args['log_writer'] = self._mock_log_writer
 
         ret_val = self._consolehandler._get_named_pipe_handler(
             mock.sentinel.pipe_path, pipe_type, enable_logging)
@@ -231,8 +383,44 @@ class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
         self.assertRaises(vmutils.HyperVException,
                           self._consolehandler._get_vm_serial_port_mapping)
 
+    def _test_get_stats(self, proxy_running=True):
+        if proxy_running:
+            mock_serial_proxy, mock_buffers = self._mock_serial_proxy()[:2]
+            mock_serial_proxy.get_stats.return_value = {}
+        mock_pipe_handler = mock.Mock()
+        self._consolehandler._pipe_handlers = {
+            constants.SERIAL_PORT_TYPE_RO: mock_pipe_handler}
+
+        stats = self._consolehandler.get_stats()
+
+        self.assertEqual(self._mock_log_writer.get_stats.return_value,
+                         stats['log'])
+        self.assertEqual(
+            {constants.SERIAL_PORT_TYPE_RO:
+                mock_pipe_handler.get_stats.return_value},
+            stats['pipes'])
+        if proxy_running:
+            expected_proxy_stats = {
+                'clients': mock_serial_proxy.get_conn_stats.return_value,
+                'input_buffer_high_water_mark': (
+                    mock_buffers[0].high_water_mark),
+                'output_buffer_high_water_mark': (
+                    mock_buffers[1].high_water_mark)}
+            self.assertEqual(expected_proxy_stats, stats['proxy'])
+        else:
+            self.assertIsNone(stats['proxy'])
+
+    def test_get_stats(self):
+        self._test_get_stats()
+
+    def test_get_stats_proxy_stopped(self):
+        self._test_get_stats(proxy_running=False)
+
     @mock.patch('nova.console.type.ConsoleSerial')
-    def _test_get_serial_console(self, mock_serial_console,
+    @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
+                       '_start_serial_proxy')
+    def _test_get_serial_console(self, mock_start_serial_proxy,
+                                 mock_serial_console,
                                  console_enabled=True):
         self.flags(enabled=console_enabled, group='serial_console')
 
@@ -242,12 +430,14 @@ class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
 
             ret_val = self._consolehandler.get_serial_console()
             self.assertEqual(mock_serial_console.return_value, ret_val)
+            mock_start_serial_proxy.assert_called_once_with()
             mock_serial_console.assert_called_once_with(
                 host=mock.sentinel.host,
                 port=mock.sentinel.port)
         else:
             self.assertRaises(exception.ConsoleTypeUnavailable,
                               self._consolehandler.get_serial_console)
+            self.assertFalse(mock_start_serial_proxy.called)
 
     def test_get_serial_console(self):
         self._test_get_serial_console()
@@ -17,6 +17,7 @@ import mock
 
 from nova import exception
 
+from hyperv.nova import consolelog
 from hyperv.nova import pathutils
 from hyperv.nova import serialconsolehandler
 from hyperv.nova import serialconsoleops
@@ -28,6 +29,7 @@ class SerialConsoleOpsTestCase(test_base.HyperVBaseTestCase):
     def setUp(self):
         super(SerialConsoleOpsTestCase, self).setUp()
         serialconsoleops._console_handlers = {}
+        serialconsoleops._serial_proxy_disabled = False
         self._serialops = serialconsoleops.SerialConsoleOps()
 
     def _setup_console_handler_mock(self):
@@ -90,34 +92,147 @@ class SerialConsoleOpsTestCase(test_base.HyperVBaseTestCase):
                           self._serialops.get_serial_console,
                           mock.sentinel.instance_name)
 
-    @mock.patch("__builtin__.open")
-    @mock.patch("os.path.exists")
+    def test_get_serial_console_proxy_disabled(self):
+        self._setup_console_handler_mock()
+        serialconsoleops._serial_proxy_disabled = True
+
+        self.assertRaises(exception.ConsoleTypeUnavailable,
+                          self._serialops.get_serial_console,
+                          mock.sentinel.instance_name)
+
+    @mock.patch.object(consolelog, 'read_log_tail')
+    @mock.patch.object(pathutils.PathUtils, 'get_vm_console_log_paths')
+    def test_get_console_output(self, mock_get_log_paths,
+                                mock_read_log_tail):
+        output = self._serialops.get_console_output(
+            mock.sentinel.instance_name,
+            max_bytes=mock.sentinel.max_bytes,
+            max_lines=mock.sentinel.max_lines)
+
+        self.assertEqual(mock_read_log_tail.return_value, output)
+        mock_get_log_paths.assert_called_once_with(
+            mock.sentinel.instance_name)
+        mock_read_log_tail.assert_called_once_with(
+            mock_get_log_paths.return_value,
+            max_bytes=mock.sentinel.max_bytes,
+            max_lines=mock.sentinel.max_lines)
+
+    @mock.patch.object(consolelog, 'read_log_tail')
     @mock.patch.object(pathutils.PathUtils, 'get_vm_console_log_paths')
     def test_get_console_output_exception(self, mock_get_log_paths,
-                                          fake_path_exists, fake_open):
-        mock_get_log_paths.return_value = [mock.sentinel.log_path]
-        fake_open.side_effect = IOError
-        fake_path_exists.return_value = True
+                                          mock_read_log_tail):
+        mock_read_log_tail.side_effect = IOError
 
         self.assertRaises(vmutils.HyperVException,
                           self._serialops.get_console_output,
                           mock.sentinel.instance_name)
-        fake_open.assert_called_once_with(mock.sentinel.log_path, 'rb')
 
+    @mock.patch.object(serialconsoleops.SerialConsoleOps,
+                       '_schedule_console_stats_log')
+    @mock.patch.object(serialconsoleops.portpool, 'get_port_pool')
+    @mock.patch.object(serialconsoleops.eventlet, 'spawn_n')
+    def _test_start_console_handlers(self, mock_spawn_n, mock_get_port_pool,
+                                     mock_schedule_stats_log,
+                                     console_enabled=True,
+                                     stats_log_interval=0,
+                                     fill_failed=False):
+        self.flags(enabled=console_enabled, group='serial_console')
+        self.flags(serial_console_stats_log_interval=stats_log_interval,
+                   group='hyperv')
+        mock_fill = mock_get_port_pool.return_value.fill
+        if fill_failed:
+            mock_fill.side_effect = vmutils.HyperVException
+
+        self._serialops.start_console_handlers()
+
+        mock_spawn_n.assert_called_once_with(
+            self._serialops._start_console_handlers)
+        self.assertEqual(console_enabled, mock_fill.called)
+        self.assertEqual(fill_failed,
+                         serialconsoleops._serial_proxy_disabled)
+        self.assertEqual(bool(stats_log_interval),
+                         mock_schedule_stats_log.called)
+
+    def test_start_console_handlers(self):
+        self._test_start_console_handlers()
+
+    def test_start_console_handlers_console_disabled(self):
+        self._test_start_console_handlers(console_enabled=False)
+
+    def test_start_console_handlers_logging_stats(self):
+        self._test_start_console_handlers(stats_log_interval=60)
+
+    def test_start_console_handlers_port_pool_failure(self):
+        self._test_start_console_handlers(fill_failed=True)
+
+    def test_get_console_stats(self):
+        mock_handler = self._setup_console_handler_mock()
+
+        console_stats = self._serialops.get_console_stats()
+
+        self.assertEqual(
+            {mock.sentinel.instance_name: mock_handler.get_stats.return_value},
+            console_stats)
+
+    def test_get_console_stats_by_instance(self):
+        mock_handler = self._setup_console_handler_mock()
+
+        console_stats = self._serialops.get_console_stats(
+            mock.sentinel.instance_name)
+        missing_instance_stats = self._serialops.get_console_stats(
+            mock.sentinel.other_instance_name)
+
+        self.assertEqual(
+            {mock.sentinel.instance_name: mock_handler.get_stats.return_value},
+            console_stats)
+        self.assertEqual({}, missing_instance_stats)
+
+    @mock.patch.object(serialconsoleops.ioreactor, 'get_reactor')
+    def test_schedule_console_stats_log(self, mock_get_reactor):
+        self.flags(serial_console_stats_log_interval=mock.sentinel.interval,
+                   group='hyperv')
+
+        self._serialops._schedule_console_stats_log()
+
+        mock_get_reactor.return_value.call_later.assert_called_once_with(
+            mock.sentinel.interval, self._serialops._log_console_stats)
+
+    @mock.patch.object(serialconsoleops.SerialConsoleOps,
+                       '_schedule_console_stats_log')
+    @mock.patch.object(serialconsoleops.SerialConsoleOps,
+                       'get_console_stats')
+    @mock.patch.object(serialconsoleops, 'LOG')
+    def test_log_console_stats(self, mock_log, mock_get_console_stats,
+                               mock_schedule_stats_log):
+        mock_get_console_stats.return_value = {
+            mock.sentinel.instance_name: mock.sentinel.stats}
+
+        self._serialops._log_console_stats()
+
+        mock_log.info.assert_called_once_with(
+            mock.ANY, {'instance_name': mock.sentinel.instance_name,
+                       'stats': mock.sentinel.stats})
+        mock_schedule_stats_log.assert_called_once_with()
+
+    @mock.patch.object(serialconsoleops.eventlet, 'GreenPool')
     @mock.patch('os.path.exists')
     @mock.patch('hyperv.nova.pathutils.PathUtils.get_instance_dir')
     @mock.patch('hyperv.nova.vmutils.VMUtils.get_active_instances')
-    @mock.patch.object(serialconsoleops.SerialConsoleOps,
-                       'start_console_handler')
-    def test_start_console_handlers(self, mock_start_console_handler,
-                                    mock_get_active_instances,
-                                    mock_get_instance_dir, mock_exists):
+    def test_start_console_handlers_workers(
+            self, mock_get_active_instances, mock_get_instance_dir,
+            mock_exists, mock_green_pool):
+        self.flags(serial_console_handler_start_workers=mock.sentinel.workers,
+                   group='hyperv')
+        mock_pool = mock_green_pool.return_value
         mock_get_active_instances.return_value = [
             mock.sentinel.nova_instance_name,
             mock.sentinel.other_instance_name]
         mock_exists.side_effect = [True, False]
 
-        self._serialops.start_console_handlers()
+        self._serialops._start_console_handlers()
 
-        mock_start_console_handler.assert_called_once_with(
+        mock_green_pool.assert_called_once_with(mock.sentinel.workers)
+        mock_pool.spawn_n.assert_called_once_with(
+            self._serialops.start_console_handler,
             mock.sentinel.nova_instance_name)
+        mock_pool.waitall.assert_called_once_with()
@@ -16,32 +16,40 @@
 import mock
 import socket
 
+from hyperv.nova import ioutils
 from hyperv.nova import serialproxy
 from hyperv.nova import vmutils
 from hyperv.tests.unit import test_base
 
 
 class SerialProxyTestCase(test_base.HyperVBaseTestCase):
-    @mock.patch.object(socket, 'socket')
-    def setUp(self, mock_socket):
+    @mock.patch.object(serialproxy.ioreactor, 'get_reactor')
+    def setUp(self, mock_get_reactor):
         super(SerialProxyTestCase, self).setUp()
 
-        self._mock_socket = mock_socket
-        self._mock_input_queue = mock.Mock()
-        self._mock_output_queue = mock.Mock()
-        self._mock_client_connected = mock.Mock()
-
-        threading_patcher = mock.patch.object(serialproxy, 'threading')
-        threading_patcher.start()
-        self.addCleanup(threading_patcher.stop)
+        self._mock_input_buffer = mock.Mock()
+        self._mock_output_buffer = mock.Mock()
+        self._mock_reactor = mock_get_reactor.return_value
+        self.flags(serial_console_send_coalesce_size=10,
+                   serial_console_send_coalesce_delay=1,
+                   serial_console_socket_send_buffer_size=(
+                       mock.sentinel.send_buffer_size),
+                   serial_console_max_clients=2,
+                   group='hyperv')
 
         self._proxy = serialproxy.SerialProxy(
             mock.sentinel.instance_nane,
             mock.sentinel.host,
             mock.sentinel.port,
-            self._mock_input_queue,
-            self._mock_output_queue,
-            self._mock_client_connected)
+            self._mock_input_buffer,
+            self._mock_output_buffer)
+        self._proxy._sock = mock.Mock()
+
+    def _mock_connection(self, writer=True):
+        conn = serialproxy._ClientConnection(mock.Mock(), writer=writer)
+        conn.output_reader = mock.Mock(available=1, skipped_bytes=0)
+        self._proxy._conns.append(conn)
+        return conn
 
     @mock.patch.object(socket, 'socket')
     def test_setup_socket_exception(self, mock_socket):
@@ -57,62 +65,427 @@ class SerialProxyTestCase(test_base.HyperVBaseTestCase):
                                                        1)
         fake_socket.bind.assert_called_once_with((mock.sentinel.host,
                                                   mock.sentinel.port))
+        fake_socket.listen.assert_called_once_with(2)
+        fake_socket.close.assert_called_once_with()
+
+    @mock.patch.object(socket, 'socket')
+    def test_setup_socket_pre_bound(self, mock_socket):
+        mock_sock = mock.Mock()
+        self._proxy._sock = mock_sock
+        self._proxy._owns_sock = False
+
+        self._proxy._setup_socket()
+
+        self.assertFalse(mock_socket.called)
+        self.assertFalse(mock_sock.bind.called)
+        mock_sock.listen.assert_called_once_with(2)
+        mock_sock.setblocking.assert_called_once_with(False)
+
+    @mock.patch.object(serialproxy, 'time')
+    @mock.patch.object(serialproxy.SerialProxy, '_setup_socket')
+    def test_start(self, mock_setup_socket, mock_time):
+        self._proxy._sock = mock.sentinel.sock
+
+        self._proxy.start()
+
+        mock_setup_socket.assert_called_once_with()
+        self.assertEqual(mock_time.time.return_value,
+                         self._proxy._idle_since)
+        self._mock_reactor.wait_readable.assert_called_once_with(
+            mock.sentinel.sock, self._proxy._accept_conn)
 
     def test_stop_serial_proxy(self):
-        self._proxy._conn = mock.Mock()
-        self._proxy._sock = mock.Mock()
+        conns = [self._mock_connection(), self._mock_connection(False)]
 
         self._proxy.stop()
 
-        self._proxy._stopped.set.assert_called_once_with()
-        self._proxy._client_connected.clear.assert_called_once_with()
-        self._proxy._conn.shutdown.assert_called_once_with(socket.SHUT_RDWR)
-        self._proxy._conn.close.assert_called_once_with()
+        self.assertTrue(self._proxy._stopped.isSet())
+        for conn in conns:
+            conn.sock.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+            conn.sock.close.assert_called_once_with()
+            conn.output_reader.close.assert_called_once_with()
+        self._mock_reactor.cancel.assert_has_calls(
+            [mock.call(conns[0].sock), mock.call(conns[1].sock),
+             mock.call(self._proxy._sock)])
         self._proxy._sock.close.assert_called_once_with()
+        self.assertEqual([], self._proxy._conns)
+        # No other connections are accepted.
+        self.assertFalse(self._mock_reactor.wait_readable.called)
+
+    def test_stop_serial_proxy_pre_bound_socket(self):
+        self._proxy._owns_sock = False
+
+        self._proxy.stop()
+
+        self._mock_reactor.cancel.assert_called_once_with(self._proxy._sock)
+        self.assertFalse(self._proxy._sock.close.called)
+
+    def _accept_conn(self):
+        mock_sock = mock.Mock()
+        self._proxy._sock.accept.return_value = [
+            mock_sock, (mock.sentinel.client_addr, mock.sentinel.client_port)]
+
+        self._proxy._accept_conn()
+        return mock_sock
 
     def test_accept_connection(self):
-        mock_conn = mock.Mock()
-        self._proxy._sock = mock.Mock()
+        mock_sock = self._accept_conn()
+
+        mock_sock.setblocking.assert_called_once_with(False)
+        mock_sock.setsockopt.assert_has_calls([
+            mock.call(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            mock.call(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                      mock.sentinel.send_buffer_size)])
+
+        conn = self._proxy._conns[0]
+        self.assertEqual(mock_sock, conn.sock)
+        self.assertTrue(conn.writer)
+        self.assertEqual(1, self._proxy._stats['connections'])
+        self.assertEqual(self._mock_output_buffer.get_reader.return_value,
+                         conn.output_reader)
+        reader_callback = self._mock_output_buffer.get_reader.call_args[1][
+            'callback']
+        self.assertEqual(self._proxy._schedule_send, reader_callback.func)
+        self.assertEqual((conn, ), reader_callback.args)
+
+        self._mock_reactor.wait_readable.assert_has_calls([
+            mock.call(mock_sock, self._proxy._get_data, conn),
+            mock.call(self._proxy._sock, self._proxy._accept_conn)])
+
+    def test_accept_connection_max_clients(self):
+        self._mock_connection()
+
+        self._accept_conn()
+
+        conn = self._proxy._conns[1]
+        self.assertFalse(conn.writer)
+        self.assertFalse(self._proxy._accepting)
+        self._mock_reactor.wait_readable.assert_called_once_with(
+            conn.sock, self._proxy._get_data, conn)
+
+    def test_accept_connection_setup_failed(self):
+        mock_sock = mock.Mock()
+        mock_sock.setsockopt.side_effect = socket.error
         self._proxy._sock.accept.return_value = [
-            mock_conn, (mock.sentinel.client_addr, mock.sentinel.client_port)]
+            mock_sock, (mock.sentinel.client_addr, mock.sentinel.client_port)]
 
         self._proxy._accept_conn()
 
-        self._proxy._client_connected.set.assert_called_once_with()
-        mock_conn.close.assert_called_once_with()
-        self.assertIsNone(self._proxy._conn)
+        mock_sock.close.assert_called_once_with()
+        self.assertEqual([], self._proxy._conns)
+        self._mock_reactor.wait_readable.assert_called_once_with(
+            self._proxy._sock, self._proxy._accept_conn)
+
+    def test_accept_connection_too_many_sockets(self):
+        self._mock_reactor.wait_readable.side_effect = [socket.error, None]
+
+        mock_sock = self._accept_conn()
+
+        mock_sock.close.assert_called_once_with()
+        self.assertEqual([], self._proxy._conns)
+        self._mock_reactor.wait_readable.assert_called_with(
+            self._proxy._sock, self._proxy._accept_conn)
+
+    def test_wait_for_conns_too_many_sockets(self):
+        self._mock_reactor.wait_readable.side_effect = socket.error
+
+        self._proxy._wait_for_conns()
+
+        self._mock_reactor.call_later.assert_called_once_with(
+            serialproxy.ACCEPT_RETRY_INTERVAL, self._proxy._wait_for_conns)
+
+    def test_wait_for_conns_stopped(self):
+        self._proxy._stopped.set()
+
+        self._proxy._wait_for_conns()
+
+        self.assertFalse(self._mock_reactor.wait_readable.called)
+
+    def test_close_connection(self):
+        conn = self._mock_connection()
+        mock_timer = mock.Mock()
+        conn.flush_timer = mock_timer
+        other_conn = self._mock_connection(writer=False)
+
+        self.assertTrue(self._proxy._close_conn(conn))
+        self.assertFalse(self._proxy._close_conn(conn))
+
+        conn.sock.close.assert_called_once_with()
+        mock_timer.cancel.assert_called_once_with()
+        self.assertTrue(conn.closed)
+        self.assertEqual([other_conn], self._proxy._conns)
+        # The remaining client gets write access.
+        self.assertTrue(other_conn.writer)
+        self._mock_reactor.wait_readable.assert_called_once_with(
+            self._proxy._sock, self._proxy._accept_conn)
+
+    @mock.patch.object(serialproxy, 'time')
+    def test_close_connection_while_accepting(self, mock_time):
+        conn = self._mock_connection()
+        self._proxy._accepting = True
+
+        self._proxy._close_conn(conn)
+
+        self.assertFalse(self._mock_reactor.wait_readable.called)
+        self.assertEqual(mock_time.time.return_value,
+                         self._proxy._idle_since)
+
+    @mock.patch.object(serialproxy, 'time')
+    def test_get_idle_time(self, mock_time):
+        mock_time.time.return_value = 10
+        self._proxy._idle_since = 4
+
+        self.assertEqual(6, self._proxy.get_idle_time())
+        self._mock_connection()
+        self.assertEqual(0, self._proxy.get_idle_time())
+
+    @mock.patch.object(serialproxy, 'time')
+    def test_reset_idle_time(self, mock_time):
+        mock_time.time.return_value = 10
+        self._proxy._idle_since = 4
+
+        self._proxy.reset_idle_time()
+
+        self.assertEqual(0, self._proxy.get_idle_time())
 
-        thread = serialproxy.threading.Thread
-        for job in [self._proxy._get_data,
-                    self._proxy._send_data]:
-            thread.assert_any_call(target=job)
+    def test_get_stats(self):
+        self._proxy._stats['bytes_sent'] = mock.sentinel.bytes_sent
+
+        stats = self._proxy.get_stats()
+
+        self.assertEqual(mock.sentinel.bytes_sent, stats['bytes_sent'])
+        self.assertIsNot(self._proxy._stats, stats)
+
+    def test_get_conn_stats(self):
+        conn = self._mock_connection()
+        conn.stats['bytes_sent'] = mock.sentinel.bytes_sent
+        conn.output_reader.skipped_bytes = mock.sentinel.skipped_bytes
+
+        conns_stats = self._proxy.get_conn_stats()
+
+        expected_stats = dict(bytes_received=0,
+                              bytes_sent=mock.sentinel.bytes_sent,
+                              flushes=0,
+                              skipped_bytes=mock.sentinel.skipped_bytes,
+                              writer=True)
+        self.assertEqual([expected_stats], conns_stats)
 
     def test_get_data(self):
-        self._mock_client_connected.isSet.return_value = True
-        self._proxy._conn = mock.Mock()
-        self._proxy._conn.recv.side_effect = [mock.sentinel.data, None]
+        conn = self._mock_connection()
+        conn.sock.recv.return_value = b'fake_data'
+        self._mock_input_buffer.write.return_value = len(b'fake_data')
+
+        self._proxy._get_data(conn)
+
+        self._mock_input_buffer.write.assert_called_once_with(
+            b'fake_data', timeout=0)
+        self._mock_reactor.wait_readable.assert_called_once_with(
+            conn.sock, self._proxy._get_data, conn)
+        self.assertEqual(len(b'fake_data'), conn.stats['bytes_received'])
+        self.assertEqual(len(b'fake_data'),
+                         self._proxy._stats['bytes_received'])
+
+    def test_get_data_read_only_client(self):
+        conn = self._mock_connection(writer=False)
+        conn.sock.recv.return_value = b'fake_data'
+
+        self._proxy._get_data(conn)
+
+        self.assertFalse(self._mock_input_buffer.write.called)
+        self._mock_reactor.wait_readable.assert_called_once_with(
+            conn.sock, self._proxy._get_data, conn)
+
+    def test_get_data_guest_busy(self):
+        conn = self._mock_connection()
+        conn.sock.recv.return_value = b'fake_data'
+        self._mock_input_buffer.write.return_value = 4
+
+        self._proxy._get_data(conn)
+
+        self._mock_reactor.call_later.assert_called_once_with(
+            serialproxy.IO_RETRY_INTERVAL, self._proxy._write_input,
+            conn, b'_data')
+        self.assertFalse(self._mock_reactor.wait_readable.called)
+
+    @mock.patch.object(serialproxy.SerialProxy, '_close_conn')
+    def test_get_data_disconnected(self, mock_close_conn):
+        conn = self._mock_connection()
+        conn.sock.recv.return_value = b''
+
+        self._proxy._get_data(conn)
+
+        mock_close_conn.assert_called_once_with(conn)
+
+    def test_schedule_send(self):
+        conn = self._mock_connection()
+
+        self._proxy._schedule_send(conn)
+        self._proxy._schedule_send(conn)
+
+        self.assertTrue(conn.send_pending)
+        self._mock_reactor.wait_writable.assert_called_once_with(
+            conn.sock, self._proxy._send_data, conn)
+
+    def test_schedule_send_no_data(self):
+        conn = self._mock_connection()
+        conn.output_reader.available = 0
+
+        self._proxy._schedule_send(conn)
+
+        self.assertFalse(conn.send_pending)
+        self.assertFalse(self._mock_reactor.wait_writable.called)
+
+    @mock.patch.object(serialproxy.SerialProxy, '_close_conn')
+    def test_schedule_send_slow_client(self, mock_close_conn):
+        self._proxy._drop_slow_clients = True
+        conn = self._mock_connection()
+        conn.output_reader.skipped_bytes = 1
+        mock_close_conn.side_effect = [True, False]
+
+        self._proxy._schedule_send(conn)
+        self._proxy._schedule_send(conn)
 
-        self._proxy._get_data()
+        mock_close_conn.assert_has_calls([mock.call(conn)] * 2)
+        self.assertFalse(self._mock_reactor.wait_writable.called)
+        # Clients are accounted for once.
+        self.assertEqual(1, self._proxy._stats['dropped_clients'])
 
-        self._mock_client_connected.clear.assert_called_once_with()
-        self._mock_input_queue.put.assert_called_once_with(mock.sentinel.data)
+    @mock.patch.object(serialproxy, 'time')
+    def test_schedule_send_coalesced(self, mock_time):
+        conn = self._mock_connection()
+        mock_time.time.return_value = 10.75
+        conn.last_flush = 10.5
 
-    def _test_send_data(self, exception=None):
-        self._mock_client_connected.isSet.side_effect = [True, False]
-        self._mock_output_queue.get_burst.return_value = mock.sentinel.data
-        self._proxy._conn = mock.Mock()
-        self._proxy._conn.sendall.side_effect = exception
+        self._proxy._schedule_send(conn)
+        self._proxy._schedule_send(conn)
 
-        self._proxy._send_data()
+        self.assertFalse(conn.send_pending)
+        self.assertFalse(self._mock_reactor.wait_writable.called)
+        self._mock_reactor.call_later.assert_called_once_with(
+            0.75, self._proxy._flush_output, conn)
 
-        self._proxy._conn.sendall.assert_called_once_with(
-            mock.sentinel.data)
+    @mock.patch.object(serialproxy, 'time')
+    def test_schedule_send_coalesce_size_reached(self, mock_time):
+        conn = self._mock_connection()
+        mock_time.time.return_value = 10.75
+        conn.last_flush = 10.5
+        mock_timer = mock.Mock()
+        conn.flush_timer = mock_timer
+        conn.output_reader.available = 10
+
+        self._proxy._schedule_send(conn)
+
+        mock_timer.cancel.assert_called_once_with()
+        self.assertIsNone(conn.flush_timer)
+        self._mock_reactor.wait_writable.assert_called_once_with(
+            conn.sock, self._proxy._send_data, conn)
+
+    def test_flush_output(self):
+        conn = self._mock_connection()
+        conn.flush_timer = mock.sentinel.timer
+
+        self._proxy._flush_output(conn)
+
+        self.assertIsNone(conn.flush_timer)
+        self.assertTrue(conn.send_pending)
+        self._mock_reactor.wait_writable.assert_called_once_with(
+            conn.sock, self._proxy._send_data, conn)
+
+    def test_flush_output_closed_conn(self):
+        conn = self._mock_connection()
+        conn.closed = True
+
+        self._proxy._flush_output(conn)
+
+        self.assertFalse(self._mock_reactor.wait_writable.called)
+
+    @mock.patch.object(serialproxy.SerialProxy, '_close_conn')
+    def test_flush_output_too_many_sockets(self, mock_close_conn):
+        conn = self._mock_connection()
+        conn.output_reader.available = 1
+        self._mock_reactor.wait_writable.side_effect = socket.error
+
+        self._proxy._flush_output(conn)
+
+        mock_close_conn.assert_called_once_with(conn)
+
+    @mock.patch.object(serialproxy, 'time')
+    def _test_send_data(self, mock_time, sent_bytes, exception=None,
+                        views=(b'fake_data', )):
+        conn = self._mock_connection()
+        mock_reader = conn.output_reader
+        mock_reader.get_views.return_value = list(views)
+        mock_reader.available = 0
+        conn.send_pending = True
+        conn.sock.send.side_effect = exception
+        conn.sock.send.return_value = sent_bytes
+
+        self._proxy._send_data(conn)
+
+        mock_reader.get_views.assert_called_once_with(timeout=0)
+        conn.sock.send.assert_called_once_with(views[0])
 
         if exception:
-            self._proxy._client_connected.clear.assert_called_once_with()
+            self.assertTrue(conn.closed)
+            self.assertFalse(mock_reader.consume.called)
+            return
+
+        mock_reader.consume.assert_called_once_with(sent_bytes)
+        self.assertEqual(sent_bytes, conn.stats['bytes_sent'])
+        self.assertEqual(sent_bytes, self._proxy._stats['bytes_sent'])
+        if sent_bytes < len(b''.join(views)):
+            self._mock_reactor.wait_writable.assert_called_once_with(
+                conn.sock, self._proxy._send_data, conn)
+            self.assertEqual(0, conn.stats['flushes'])
+        else:
+            self.assertFalse(conn.send_pending)
+            self.assertFalse(self._mock_reactor.wait_writable.called)
+            self.assertEqual(1, conn.stats['flushes'])
+            self.assertEqual(mock_time.time.return_value, conn.last_flush)
 
     def test_send_data(self):
-        self._test_send_data()
+        self._test_send_data(sent_bytes=len(b'fake_data'))
+
+    def test_send_data_partially_sent(self):
+        self._test_send_data(sent_bytes=4)
+
+    def test_send_data_wrapped_around(self):
+        self._test_send_data(sent_bytes=4, views=(b'fake', b'_data'))
 
     def test_send_data_exception(self):
-        self._test_send_data(exception=socket.error)
+        self._test_send_data(sent_bytes=0, exception=socket.error)
+
+    @mock.patch.object(serialproxy.SerialProxy, '_schedule_send')
+    def test_send_data_shared_output_buffer(self, mock_schedule_send):
+        output_buffer = ioutils.RingBuffer(size=16)
+        conns = [self._mock_connection() for i in range(2)]
+        sent_data = []
+        for conn in conns:
+            conn.output_reader = output_buffer.get_reader()
+            conn.sock.send.side_effect = (
+                lambda data: sent_data.append(data) or len(data))
+        output_buffer.write(b'fake_data')
+
+        for conn in conns:
+            self._proxy._send_data(conn)
+
+        self.assertEqual([b'fake_data'] * 2,
+                         [data.tobytes() for data in sent_data])
+        # The clients are sent views of the same buffer region instead
+        # of copies of the data.
+        output_buffer._buffer[0:4] = b'FAKE'
+        self.assertEqual([b'FAKE_data'] * 2,
+                         [data.tobytes() for data in sent_data])
+        for conn in conns:
+            self.assertEqual(0, conn.output_reader.available)
+            self.assertEqual(1, conn.stats['flushes'])
+
+    @mock.patch.object(serialproxy.SerialProxy, '_schedule_send')
+    def test_send_data_schedules_pending_output(self, mock_schedule_send):
+        conn = self._mock_connection()
+        conn.output_reader.get_views.return_value = [b'fake_data']
+        conn.sock.send.return_value = len(b'fake_data')
+
+        self._proxy._send_data(conn)
+
+        mock_schedule_send.assert_called_once_with(conn)
@@ -55,8 +55,43 @@ class SnapshotOpsTestCase(test_base.HyperVBaseTestCase):
             self.context, mock.sentinel.IMAGE_ID, image_metadata,
             self._snapshotops._pathutils.open().__enter__())
 
-    @mock.patch('hyperv.nova.snapshotops.SnapshotOps._save_glance_image')
-    def _test_snapshot(self, mock_save_glance_image, base_disk_path):
+    @mock.patch.object(snapshotops.compressionutils, 'CompressedReader')
+    @mock.patch('nova.image.glance.get_remote_image_service')
+    def test_upload_glance_image_compressed(self,
+                                            mock_get_remote_image_service,
+                                            mock_compressed_reader):
+        self.flags(snapshot_image_compression='gzip',
+                   snapshot_compression_workers=2, group='hyperv')
+        image_metadata = {"is_public": False,
+                          "disk_format": "vhd",
+                          "container_format": "bare",
+                          "properties": {"hyperv_image_compression": "gzip"}}
+        glance_image_service = mock.MagicMock()
+        mock_get_remote_image_service.return_value = (glance_image_service,
+                                                      mock.sentinel.IMAGE_ID)
+        mock_reader = mock_compressed_reader.return_value
+        mock_reader.get_stats.return_value = {
+            'codec': 'gzip', 'raw_size': 2, 'compressed_size': 1,
+            'ratio': 2.0, 'throughput': 1.0}
+
+        self._snapshotops._upload_glance_image(
+            self.context, mock.sentinel.IMAGE_ID, mock.sentinel.image_data)
+
+        mock_compressed_reader.assert_called_once_with(
+            mock.sentinel.image_data, 'gzip', workers=2)
+        glance_image_service.update.assert_called_once_with(
+            self.context, mock.sentinel.IMAGE_ID, image_metadata,
+            mock_reader)
+        mock_reader.get_stats.assert_called_once_with()
+
+    @mock.patch.object(snapshotops.SnapshotOps, '_upload_flattened_vhd')
+    @mock.patch.object(snapshotops.SnapshotOps, '_export_merged_vhd')
+    @mock.patch.object(snapshotops.SnapshotOps, '_save_glance_image')
+    def _test_snapshot(self, mock_save_glance_image, mock_export_merged_vhd,
+                       mock_upload_flattened_vhd, base_disk_path,
+                       chain_flattened=True, compact_images=False):
+        self.flags(compact_snapshot_images=compact_images, group='hyperv')
+        mock_upload_flattened_vhd.return_value = chain_flattened
         mock_instance = fake_instance.fake_instance_obj(self.context)
         mock_update = mock.MagicMock()
         fake_src_path = os.path.join('fake', 'path')
@@ -80,42 +115,125 @@ class SnapshotOpsTestCase(test_base.HyperVBaseTestCase):
         mock_lookup_path.assert_called_once_with(mock_instance.name)
         mock_get_vhd_path = self._snapshotops._vhdutils.get_vhd_parent_path
         mock_get_vhd_path.assert_called_once_with(fake_src_path)
-        self._snapshotops._pathutils.get_export_dir.assert_called_once_with(
-            mock_instance.name)
 
-        expected = [mock.call(fake_src_path,
-                              os.path.join(fake_exp_dir,
-                                           os.path.basename(fake_src_path)))]
-        dest_vhd_path = os.path.join(fake_exp_dir,
-                                     os.path.basename(fake_src_path))
-        if base_disk_path:
-            basename = os.path.basename(base_disk_path)
-            base_dest_disk_path = os.path.join(fake_exp_dir, basename)
-            expected.append(mock.call(base_disk_path, base_dest_disk_path))
-            mock_reconnect = self._snapshotops._vhdutils.reconnect_parent_vhd
-            mock_reconnect.assert_called_once_with(dest_vhd_path,
-                                                   base_dest_disk_path)
-            self._snapshotops._vhdutils.merge_vhd.assert_called_once_with(
-                dest_vhd_path, base_dest_disk_path)
+        mock_get_export_dir = self._snapshotops._pathutils.get_export_dir
+        flatten_image = base_disk_path or compact_images
+        if flatten_image:
+            mock_upload_flattened_vhd.assert_called_once_with(
+                self.context, mock.sentinel.IMAGE_ID, fake_src_path,
+                base_disk_path)
+
+        if flatten_image and chain_flattened:
+            self.assertFalse(mock_get_export_dir.called)
+            self.assertFalse(mock_save_glance_image.called)
+        elif base_disk_path:
+            mock_get_export_dir.assert_called_once_with(mock_instance.name)
+            mock_export_merged_vhd.assert_called_once_with(
+                fake_src_path, base_disk_path, fake_exp_dir)
             mock_save_glance_image.assert_called_once_with(
-                self.context, mock.sentinel.IMAGE_ID, base_dest_disk_path)
+                self.context, mock.sentinel.IMAGE_ID,
+                mock_export_merged_vhd.return_value)
+            self._snapshotops._pathutils.rmtree.assert_called_once_with(
+                fake_exp_dir)
         else:
+            self.assertFalse(mock_get_export_dir.called)
+            self.assertEqual(compact_images,
+                             mock_upload_flattened_vhd.called)
+            self.assertFalse(mock_export_merged_vhd.called)
             mock_save_glance_image.assert_called_once_with(
-                self.context, mock.sentinel.IMAGE_ID, dest_vhd_path)
-        self._snapshotops._pathutils.copyfile.has_calls(expected)
+                self.context, mock.sentinel.IMAGE_ID, fake_src_path)
+            self.assertFalse(self._snapshotops._pathutils.rmtree.called)
         expected_update = [
             mock.call(task_state=task_states.IMAGE_PENDING_UPLOAD),
             mock.call(task_state=task_states.IMAGE_UPLOADING,
                       expected_state=task_states.IMAGE_PENDING_UPLOAD)]
-        mock_update.has_calls(expected_update)
+        mock_update.assert_has_calls(expected_update)
         self._snapshotops._vmutils.remove_vm_snapshot.assert_called_once_with(
             fake_snapshot_path)
-        self._snapshotops._pathutils.rmtree.assert_called_once_with(
-            fake_exp_dir)
 
     def test_snapshot(self):
         base_disk_path = os.path.join('fake', 'disk')
         self._test_snapshot(base_disk_path=base_disk_path)
 
+    def test_snapshot_merged_base_disk(self):
+        base_disk_path = os.path.join('fake', 'disk')
+        self._test_snapshot(base_disk_path=base_disk_path,
+                            chain_flattened=False)
+
     def test_snapshot_no_base_disk(self):
         self._test_snapshot(base_disk_path=None)
+
+    def test_snapshot_no_base_disk_compacted(self):
+        self._test_snapshot(base_disk_path=None, compact_images=True)
+
+    def test_snapshot_no_base_disk_compaction_unavailable(self):
+        self._test_snapshot(base_disk_path=None, compact_images=True,
+                            chain_flattened=False)
+
+    @mock.patch.object(snapshotops.SnapshotOps, '_upload_glance_image')
+    @mock.patch.object(snapshotops.vhdreader, 'VHDChainReader')
+    def _test_upload_flattened_vhd(self, mock_chain_reader,
+                                   mock_upload_glance_image,
+                                   virtual_size=1):
+        self.flags(compact_snapshot_images=True, group='hyperv')
+        mock_vhd_chain = mock_chain_reader.return_value.__enter__.return_value
+        mock_vhd_chain.virtual_size = virtual_size
+
+        uploaded = self._snapshotops._upload_flattened_vhd(
+            self.context, mock.sentinel.IMAGE_ID, mock.sentinel.src_path,
+            mock.sentinel.base_path)
+
+        mock_chain_reader.assert_called_once_with(
+            mock.sentinel.src_path, parent_path=mock.sentinel.base_path)
+        if virtual_size > snapshotops.vhdreader.VHD_MAX_VIRTUAL_SIZE:
+            self.assertFalse(uploaded)
+            self.assertFalse(mock_upload_glance_image.called)
+        else:
+            self.assertTrue(uploaded)
+            mock_upload_glance_image.assert_called_once_with(
+                self.context, mock.sentinel.IMAGE_ID,
+                mock_vhd_chain.get_dynamic_vhd_stream.return_value)
+            mock_vhd_chain.get_dynamic_vhd_stream.assert_called_once_with(
+                skip_zero_blocks=True)
+
+    def test_upload_flattened_vhd(self):
+        self._test_upload_flattened_vhd()
+
+    def test_upload_flattened_vhd_exceeding_max_size(self):
+        self._test_upload_flattened_vhd(
+            virtual_size=snapshotops.vhdreader.VHD_MAX_VIRTUAL_SIZE + 1)
+
+    def test_export_merged_vhd(self):
+        fake_src_path = os.path.join('fake', 'path')
+        fake_base_disk_path = os.path.join('fake', 'disk')
+        fake_exp_dir = os.path.join('fake', 'exp', 'dir')
+        dest_vhd_path = os.path.join(fake_exp_dir,
+                                     os.path.basename(fake_src_path))
+        dest_base_disk_path = os.path.join(
+            fake_exp_dir, os.path.basename(fake_base_disk_path))
+
+        merged_vhd_path = self._snapshotops._export_merged_vhd(
+            fake_src_path, fake_base_disk_path, fake_exp_dir)
+
+        self.assertEqual(dest_base_disk_path, merged_vhd_path)
+        self._snapshotops._pathutils.copyfile.assert_has_calls(
+            [mock.call(fake_src_path, dest_vhd_path),
+             mock.call(fake_base_disk_path, dest_base_disk_path)],
+            any_order=True)
+        mock_reconnect = self._snapshotops._vhdutils.reconnect_parent_vhd
+        mock_reconnect.assert_called_once_with(dest_vhd_path,
+                                               dest_base_disk_path)
+        self._snapshotops._vhdutils.merge_vhd.assert_called_once_with(
+            dest_vhd_path, dest_base_disk_path)
+
+    def test_export_merged_vhd_copy_failure(self):
+        self._snapshotops._pathutils.copyfile.side_effect = [
+            IOError, None]
+
+        self.assertRaises(IOError, self._snapshotops._export_merged_vhd,
+                          os.path.join('fake', 'path'),
+                          os.path.join('fake', 'disk'),
+                          os.path.join('fake', 'exp', 'dir'))
+
+        self.assertEqual(2, self._snapshotops._pathutils.copyfile.call_count)
+        self.assertFalse(self._snapshotops._vhdutils.merge_vhd.called)
@@ -0,0 +1,366 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import struct
+import tempfile
+import uuid
+
+import mock
+from oslo_utils import units
+
+from hyperv.nova import constants
+from hyperv.nova import vhdreader
+from hyperv.nova import vhdutils
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+_SECTOR_SIZE = 512
+_BLOCK_SIZE = 4 * units.Ki
+_SECTORS_PER_BLOCK = _BLOCK_SIZE // _SECTOR_SIZE
+
+
+def _get_sector_data(marker, sector_count=1):
+    return (marker * _SECTOR_SIZE)[:_SECTOR_SIZE] * sector_count
+
+
+def _write_vhd(path, virtual_size, blocks, parent_path=None):
+    """Writes a dynamic or differencing VHD.
+
+    The blocks are passed as a dict mapping block indexes to lists of
+    sector data, None marking sectors that are not present.
+    """
+    block_count = virtual_size // _BLOCK_SIZE
+    bat_offset = vhdreader.VHD_FOOTER_SIZE + vhdreader.VHD_DYNAMIC_HEADER_SIZE
+    bat_size = block_count * 4
+    bat_size += -bat_size % _SECTOR_SIZE
+    data_offset = bat_offset + bat_size
+
+    footer = bytearray(vhdreader._get_vhd_footer(virtual_size))
+    header = bytearray(vhdreader._get_vhd_dynamic_header(
+        bat_offset, block_count, _BLOCK_SIZE))
+    if parent_path:
+        struct.pack_into('>I', footer, 60, 4)
+        parent_locator = parent_path.encode('utf-16-le')
+        struct.pack_into('>4sIIIQ', header, 576, b'W2ru', _SECTOR_SIZE,
+                         len(parent_locator), 0, data_offset)
+        data_offset += _SECTOR_SIZE
+
+    bat = [vhdreader.VHD_UNALLOCATED_BLOCK] * block_count
+    with open(path, 'wb') as f:
+        if parent_path:
+            f.seek(data_offset - _SECTOR_SIZE)
+            f.write(parent_locator)
+
+        for block_index, sectors in sorted(blocks.items()):
+            bat[block_index] = data_offset // _SECTOR_SIZE
+            bitmap = 0
+            for idx, sector in enumerate(sectors):
+                if sector is not None:
+                    bitmap |= 1 << (7 - idx)
+            f.seek(data_offset)
+            f.write(struct.pack('B', bitmap).ljust(_SECTOR_SIZE, b'\x00'))
+            f.write(b''.join(sector or _get_sector_data(b'\x00')
+                             for sector in sectors))
+            data_offset = f.tell()
+
+        f.seek(0)
+        f.write(bytes(footer))
+        f.write(bytes(header))
+        f.write(struct.pack('>%dI' % block_count, *bat))
+        f.seek(data_offset)
+        f.write(bytes(footer))
+
+
+def _write_vhdx(path, virtual_size, blocks, parent_path=None):
+    """Writes a dynamic or differencing VHDX.
+
+    The blocks are passed as a dict mapping block indexes to either a
+    payload block state or a list of sector data, as for VHD files.
+    """
+    chunk_ratio = (vhdreader.VHDX_CHUNK_SECTOR_COUNT * _SECTOR_SIZE //
+                   _BLOCK_SIZE)
+    block_count = virtual_size // _BLOCK_SIZE
+    bat = [0] * ((block_count // chunk_ratio + 1) * (chunk_ratio + 1))
+    metadata_offset = units.Mi
+    bat_offset = 2 * units.Mi
+    data_offset = 3 * units.Mi
+    sector_bitmaps = {}
+
+    metadata_items = [
+        (vhdreader.VHDX_FILE_PARAMETERS_GUID,
+         struct.pack('<II', _BLOCK_SIZE,
+                     vhdreader.VHDX_HAS_PARENT_FLAG if parent_path else 0)),
+        (vhdreader.VHDX_VIRTUAL_DISK_SIZE_GUID,
+         struct.pack('<Q', virtual_size)),
+        (vhdreader.VHDX_LOGICAL_SECTOR_SIZE_GUID,
+         struct.pack('<I', _SECTOR_SIZE))]
+    if parent_path:
+        key = u'relative_path'.encode('utf-16-le')
+        value = parent_path.encode('utf-16-le')
+        metadata_items.append(
+            (vhdreader.VHDX_PARENT_LOCATOR_GUID,
+             uuid.uuid4().bytes_le + struct.pack(
+                 '<HHIIHH', 0, 1, 32, 32 + len(key), len(key),
+                 len(value)) + key + value))
+
+    with open(path, 'wb') as f:
+        f.write(vhdutils.VHDX_SIGNATURE)
+        f.seek(vhdreader.VHDX_HEADER_OFFSETS[0])
+        f.write(struct.pack('<4sIQ', b'head', 0, 1).ljust(80, b'\x00'))
+
+        f.seek(vhdreader.VHDX_REGION_TABLE_OFFSET)
+        f.write(struct.pack('<4sIII', b'regi', 0, 2, 0))
+        f.write(vhdreader.VHDX_BAT_REGION_GUID.bytes_le +
+                struct.pack('<QII', bat_offset, units.Mi, 1))
+        f.write(vhdreader.VHDX_METADATA_REGION_GUID.bytes_le +
+                struct.pack('<QII', metadata_offset, units.Mi, 1))
+
+        f.seek(metadata_offset)
+        f.write(struct.pack('<8sHH', b'metadata', 0, len(metadata_items)))
+        item_offset = 64 * units.Ki
+        for idx, (item_id, item) in enumerate(metadata_items):
+            f.seek(metadata_offset + 32 + idx * 32)
+            f.write(item_id.bytes_le +
+                    struct.pack('<IIII', item_offset, len(item), 0, 0))
+            f.seek(metadata_offset + item_offset)
+            f.write(item)
+            item_offset += units.Ki
+
+        for block_index, sectors in sorted(blocks.items()):
+            chunk_index = block_index // chunk_ratio
+            entry_index = block_index + chunk_index
+            if not isinstance(sectors, list):
+                bat[entry_index] = sectors
+                continue
+
+            if None not in sectors:
+                state = vhdreader.VHDX_PAYLOAD_BLOCK_FULLY_PRESENT
+            else:
+                state = vhdreader.VHDX_PAYLOAD_BLOCK_PARTIALLY_PRESENT
+            bat[entry_index] = state | (data_offset // units.Mi) << 20
+            f.seek(data_offset)
+            f.write(b''.join(sector or _get_sector_data(b'\x00')
+                             for sector in sectors))
+            data_offset += units.Mi
+
+            if state == vhdreader.VHDX_PAYLOAD_BLOCK_PARTIALLY_PRESENT:
+                sb_entry_index = (chunk_index + 1) * (chunk_ratio + 1) - 1
+                if not bat[sb_entry_index]:
+                    bat[sb_entry_index] = (
+                        vhdreader.VHDX_SB_BLOCK_PRESENT |
+                        (data_offset // units.Mi) << 20)
+                    data_offset += units.Mi
+                bitmap = sector_bitmaps.setdefault(
+                    bat[sb_entry_index] >> 20,
+                    bytearray(chunk_ratio * _SECTORS_PER_BLOCK // 8))
+                chunk_sector = (block_index % chunk_ratio *
+                                _SECTORS_PER_BLOCK)
+                for idx, sector in enumerate(sectors):
+                    if sector is not None:
+                        bit = chunk_sector + idx
+                        bitmap[bit // 8] |= 1 << bit % 8
+
+        for sb_offset_mb, bitmap in sector_bitmaps.items():
+            f.seek(sb_offset_mb * units.Mi)
+            f.write(bytes(bitmap))
+        f.seek(bat_offset)
+        f.write(struct.pack('<%dQ' % len(bat), *bat))
+        f.seek(data_offset)
+        f.write(b'\x00')
+
+
+class VHDReaderTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the VHD chain reader, using synthetic disk chains."""
+
+    _VIRTUAL_SIZE = 4 * _BLOCK_SIZE
+
+    def setUp(self):
+        super(VHDReaderTestCase, self).setUp()
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir)
+
+        # Chunks of 2 blocks keep the synthetic VHDX block tables small.
+        patcher = mock.patch.object(vhdreader, 'VHDX_CHUNK_SECTOR_COUNT',
+                                    2 * _SECTORS_PER_BLOCK)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_path(self, name):
+        return os.path.join(self._tmp_dir, name)
+
+    def _get_block_data(self, marker):
+        return [_get_sector_data(marker)] * _SECTORS_PER_BLOCK
+
+    def _get_chain_blocks(self):
+        base_blocks = {0: self._get_block_data(b'a'),
+                       1: self._get_block_data(b'b'),
+                       2: self._get_block_data(b'c')}
+        child_blocks = {
+            1: [_get_sector_data(b'x'), None] * (_SECTORS_PER_BLOCK // 2),
+            3: self._get_block_data(b'y')}
+
+        expected_data = (
+            _get_sector_data(b'a', _SECTORS_PER_BLOCK) +
+            (_get_sector_data(b'x') + _get_sector_data(b'b')) *
+            (_SECTORS_PER_BLOCK // 2) +
+            _get_sector_data(b'c', _SECTORS_PER_BLOCK) +
+            _get_sector_data(b'y', _SECTORS_PER_BLOCK))
+        return base_blocks, child_blocks, expected_data
+
+    def _create_chain(self, write_disk, ext):
+        base_blocks, child_blocks, expected_data = self._get_chain_blocks()
+        base_path = self._get_path('base.' + ext)
+        child_path = self._get_path('child.' + ext)
+        write_disk(base_path, self._VIRTUAL_SIZE, base_blocks)
+        write_disk(child_path, self._VIRTUAL_SIZE, child_blocks,
+                   parent_path='.\\base.' + ext)
+        return child_path, expected_data
+
+    def test_get_bitmap_runs(self):
+        bitmap = bytearray([0xFF, 0x0F, 0x00, 0x80])
+
+        runs = vhdreader._get_bitmap_runs(bitmap, 4, 28)
+        msb_runs = vhdreader._get_bitmap_runs(bitmap, 4, 28, msb_first=True)
+
+        self.assertEqual([(4, 8), (31, 1)], runs)
+        self.assertEqual([(4, 4), (12, 4), (24, 1)], msb_runs)
+
+    def _test_read_chain(self, write_disk, ext):
+        child_path, expected_data = self._create_chain(write_disk, ext)
+
+        with vhdreader.VHDChainReader(child_path) as chain:
+            self.assertEqual(self._VIRTUAL_SIZE, chain.virtual_size)
+            self.assertEqual(expected_data,
+                             chain.read(0, self._VIRTUAL_SIZE))
+            self.assertEqual(expected_data[1000:9000],
+                             chain.read(1000, 8000))
+
+    def test_read_vhd_chain(self):
+        self._test_read_chain(_write_vhd, 'vhd')
+
+    def test_read_vhdx_chain(self):
+        self._test_read_chain(_write_vhdx, 'vhdx')
+
+    def test_read_vhdx_zero_block(self):
+        base_path = self._get_path('base.vhdx')
+        child_path = self._get_path('child.vhdx')
+        _write_vhdx(base_path, self._VIRTUAL_SIZE,
+                    {0: self._get_block_data(b'a'),
+                     1: self._get_block_data(b'b')})
+        _write_vhdx(child_path, self._VIRTUAL_SIZE,
+                    {0: vhdreader.VHDX_PAYLOAD_BLOCK_ZERO},
+                    parent_path=base_path)
+
+        with vhdreader.VHDChainReader(child_path) as chain:
+            self.assertEqual(b'\x00' * _BLOCK_SIZE,
+                             chain.read(0, _BLOCK_SIZE))
+            self.assertEqual(_get_sector_data(b'b', _SECTORS_PER_BLOCK),
+                             chain.read(_BLOCK_SIZE, _BLOCK_SIZE))
+            self.assertFalse(chain.is_allocated(0, _BLOCK_SIZE))
+
+    def test_read_chain_parent_path(self):
+        child_path, expected_data = self._create_chain(_write_vhd, 'vhd')
+        moved_base_path = self._get_path('moved_base.vhd')
+        os.rename(self._get_path('base.vhd'), moved_base_path)
+
+        self.assertRaises(vmutils.HyperVException,
+                          vhdreader.VHDChainReader, child_path)
+        with vhdreader.VHDChainReader(
+                child_path, parent_path=moved_base_path) as chain:
+            self.assertEqual(expected_data,
+                             chain.read(0, self._VIRTUAL_SIZE))
+
+    def test_invalid_virtual_disk(self):
+        path = self._get_path('invalid.vhd')
+        with open(path, 'wb') as f:
+            f.write(b'\x00' * vhdreader.VHD_FOOTER_SIZE)
+
+        self.assertRaises(vmutils.HyperVException,
+                          vhdreader.open_virtual_disk, path)
+
+    def _test_export_dynamic_vhd(self, write_disk, ext):
+        child_path, expected_data = self._create_chain(write_disk, ext)
+        dest_path = self._get_path('flat.vhd')
+
+        with vhdreader.VHDChainReader(child_path) as chain:
+            chain.export_dynamic_vhd(dest_path)
+
+        # The virtual size fits a single VHD block, which is allocated.
+        expected_size = (3 * vhdreader.VHD_FOOTER_SIZE +
+                         vhdreader.VHD_DYNAMIC_HEADER_SIZE + _SECTOR_SIZE +
+                         vhdreader.VHD_DEFAULT_BLOCK_SIZE)
+        self.assertEqual(expected_size, os.path.getsize(dest_path))
+        with vhdreader.VHDChainReader(dest_path) as flat_disk:
+            self.assertEqual(self._VIRTUAL_SIZE, flat_disk.virtual_size)
+            self.assertEqual(expected_data,
+                             flat_disk.read(0, self._VIRTUAL_SIZE))
+
+    def test_export_dynamic_vhd(self):
+        self._test_export_dynamic_vhd(_write_vhd, 'vhd')
+
+    def test_export_dynamic_vhd_from_vhdx(self):
+        self._test_export_dynamic_vhd(_write_vhdx, 'vhdx')
+
+    def test_iter_dynamic_vhd_unallocated_blocks(self):
+        path = self._get_path('base.vhd')
+        _write_vhd(path, self._VIRTUAL_SIZE, {3: self._get_block_data(b'a')})
+
+        with vhdreader.VHDChainReader(path) as chain:
+            chunks = list(chain.iter_dynamic_vhd(block_size=_BLOCK_SIZE))
+
+        # Footer, header, BAT, the allocated block bitmap and data, footer.
+        self.assertEqual(6, len(chunks))
+        bat = struct.unpack('>4I', chunks[2][:16])
+        self.assertEqual([vhdreader.VHD_UNALLOCATED_BLOCK] * 3, list(bat[:3]))
+        footer = chunks[0]
+        self.assertEqual(constants.VHD_TYPE_DYNAMIC,
+                         struct.unpack_from('>I', footer, 60)[0])
+        self.assertEqual(footer, chunks[-1])
+
+    def test_iter_dynamic_vhd_skip_zero_blocks(self):
+        path = self._get_path('base.vhd')
+        _write_vhd(path, self._VIRTUAL_SIZE,
+                   {0: self._get_block_data(b'\x00'),
+                    1: [None] * (_SECTORS_PER_BLOCK - 1) + [
+                        _get_sector_data(b'a')]})
+
+        with vhdreader.VHDChainReader(path) as chain:
+            chunks = list(chain.iter_dynamic_vhd(block_size=_BLOCK_SIZE,
+                                                 skip_zero_blocks=True))
+            data = chain.read(0, self._VIRTUAL_SIZE)
+
+        bat = struct.unpack('>4I', chunks[2][:16])
+        self.assertEqual(vhdreader.VHD_UNALLOCATED_BLOCK, bat[0])
+        self.assertNotEqual(vhdreader.VHD_UNALLOCATED_BLOCK, bat[1])
+        self.assertEqual(6, len(chunks))
+        self.assertEqual(data[_BLOCK_SIZE:2 * _BLOCK_SIZE], chunks[4])
+
+    def test_get_dynamic_vhd_stream(self):
+        path = self._get_path('base.vhd')
+        _write_vhd(path, self._VIRTUAL_SIZE, {0: self._get_block_data(b'a')})
+
+        # The footers include a timestamp and a random unique id.
+        fake_footer = b'f' * vhdreader.VHD_FOOTER_SIZE
+        with mock.patch.object(vhdreader, '_get_vhd_footer',
+                               return_value=fake_footer), \
+                vhdreader.VHDChainReader(path) as chain:
+            expected_data = b''.join(chain.iter_dynamic_vhd())
+            stream = chain.get_dynamic_vhd_stream()
+            data = stream.read(1000) + stream.read(units.Mi) + stream.read()
+
+        self.assertEqual(expected_data, data)
+        self.assertEqual(b'', stream.read(1))
@@ -12,6 +12,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import shutil
+import struct
+import tempfile
+
 import mock
 from oslo_utils import units
 
@@ -286,3 +291,59 @@ class VHDUtilsTestCase(VHDUtilsBaseTestCase):
     def test_get_supported_vhd_format(self):
         fmt = self._vhdutils.get_best_supported_vhd_format()
         self.assertEqual(constants.DISK_FORMAT_VHD, fmt)
+
+    def _get_tmp_file(self, data):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'fake_disk')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_convert_raw_to_fixed_vhd(self):
+        raw_data = b'fake_data' * 100
+        path = self._get_tmp_file(raw_data)
+
+        self._vhdutils.convert_raw_to_fixed_vhd(path)
+
+        with open(path, 'rb') as f:
+            vhd_data = f.read()
+        virtual_size = len(vhd_data) - vhdutils.VHD_HEADER_SIZE_FIX
+        self.assertEqual(0, virtual_size % vhdutils.VHD_SECTOR_SIZE)
+        self.assertEqual(raw_data.ljust(virtual_size, b'\x00'),
+                         vhd_data[:virtual_size])
+
+        footer = bytearray(vhd_data[virtual_size:])
+        (signature, data_offset, current_size, vhd_type,
+         checksum) = struct.unpack_from('>8s8xQ24xQ4xII', bytes(footer))
+        self.assertEqual(vhdutils.VHD_SIGNATURE, signature)
+        self.assertEqual(vhdutils.VHD_NO_DATA_OFFSET, data_offset)
+        self.assertEqual(virtual_size, current_size)
+        self.assertEqual(constants.VHD_TYPE_FIXED, vhd_type)
+        footer[64:68] = b'\x00' * 4
+        self.assertEqual(vhdutils.get_vhd_checksum(footer), checksum)
+        self.assertEqual(constants.DISK_FORMAT_VHD,
+                         self._vhdutils.get_vhd_format(path))
+
+    def test_convert_fixed_vhd_to_raw(self):
+        raw_data = b'fake_data' * 512
+        path = self._get_tmp_file(raw_data)
+        self._vhdutils.convert_raw_to_fixed_vhd(path)
+
+        self._vhdutils.convert_fixed_vhd_to_raw(path)
+
+        with open(path, 'rb') as f:
+            self.assertEqual(raw_data, f.read())
+
+    def test_convert_dynamic_vhd_to_raw(self):
+        path = self._get_tmp_file(vhdutils.get_vhd_footer(
+            units.Mi, constants.VHD_TYPE_DYNAMIC))
+
+        self.assertRaises(vmutils.HyperVException,
+                          self._vhdutils.convert_fixed_vhd_to_raw, path)
+
+    def test_convert_invalid_vhd_to_raw(self):
+        path = self._get_tmp_file(b'fake_data')
+
+        self.assertRaises(vmutils.HyperVException,
+                          self._vhdutils.convert_fixed_vhd_to_raw, path)
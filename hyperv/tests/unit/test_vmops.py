@@ -595,17 +595,21 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
             constants.DISK_FORMAT_VHD)
         self._check_get_image_vm_gen_except(constants.IMAGE_PROP_VM_GEN_2)
 
+    @mock.patch.object(vmops.VMOps, '_write_config_drive_iso')
     @mock.patch('nova.api.metadata.base.InstanceMetadata')
     @mock.patch('nova.virt.configdrive.ConfigDriveBuilder')
-    @mock.patch('nova.utils.execute')
-    def _test_create_config_drive(self, mock_execute, mock_ConfigDriveBuilder,
-                                  mock_InstanceMetadata, config_drive_format,
+    def _test_create_config_drive(self, mock_ConfigDriveBuilder,
+                                  mock_InstanceMetadata,
+                                  mock_write_config_drive_iso,
+                                  config_drive_format,
                                   config_drive_cdrom, side_effect,
-                                  rescue=False):
+                                  rescue=False, use_iso_writer=False):
         mock_instance = fake_instance.fake_instance_obj(self.context)
         self.flags(config_drive_format=config_drive_format)
         self.flags(config_drive_cdrom=config_drive_cdrom, group='hyperv')
         self.flags(config_drive_inject_password=True, group='hyperv')
+        self.flags(config_drive_use_iso_writer=use_iso_writer,
+                   group='hyperv')
         mock_ConfigDriveBuilder().__enter__().make_drive.side_effect = [
             side_effect]
 
@@ -654,18 +658,22 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
                 network_info=mock.sentinel.NET_INFO)
             mock_get_configdrive_path.assert_has_calls(
                 expected_get_configdrive_path_calls)
-            mock_ConfigDriveBuilder.assert_called_with(
-                instance_md=mock_InstanceMetadata())
-            mock_make_drive = mock_ConfigDriveBuilder().__enter__().make_drive
-            mock_make_drive.assert_called_once_with(path_iso)
+            if use_iso_writer:
+                mock_write_config_drive_iso.assert_called_once_with(
+                    mock_InstanceMetadata(), path_iso)
+            else:
+                mock_ConfigDriveBuilder.assert_called_with(
+                    instance_md=mock_InstanceMetadata())
+                mock_make_drive = (
+                    mock_ConfigDriveBuilder().__enter__().make_drive)
+                mock_make_drive.assert_called_once_with(path_iso)
+                self.assertFalse(mock_write_config_drive_iso.called)
             if not CONF.hyperv.config_drive_cdrom:
                 expected = path_vhd
-                mock_execute.assert_called_once_with(
-                    CONF.hyperv.qemu_img_cmd,
-                    'convert', '-f', 'raw', '-O', 'vpc',
-                    path_iso, path_vhd, attempts=1)
-                self._vmops._pathutils.remove.assert_called_once_with(
-                    os.path.join(self.FAKE_DIR, self.FAKE_CONFIG_DRIVE_ISO))
+                mock_convert = self._vmops._vhdutils.convert_raw_to_fixed_vhd
+                mock_convert.assert_called_once_with(path_iso)
+                self._vmops._pathutils.rename.assert_called_once_with(
+                    path_iso, path_vhd)
             else:
                 expected = path_iso
 
@@ -687,6 +695,28 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
                                        side_effect=None,
                                        rescue=True)
 
+    def test_create_config_drive_iso_writer(self):
+        self._test_create_config_drive(config_drive_format=self.ISO9660,
+                                       config_drive_cdrom=True,
+                                       side_effect=None,
+                                       use_iso_writer=True)
+
+    @mock.patch.object(vmops.isowriter, 'ISOWriter')
+    def test_write_config_drive_iso(self, mock_iso_writer):
+        mock_inst_md = mock.Mock()
+        mock_inst_md.metadata_for_config_drive.return_value = [
+            (mock.sentinel.path, mock.sentinel.data)]
+
+        self._vmops._write_config_drive_iso(mock_inst_md,
+                                            mock.sentinel.iso_path)
+
+        mock_iso_writer.assert_called_once_with(
+            volume_id=vmops.CONFIG_DRIVE_LABEL, publisher=mock.ANY)
+        mock_writer = mock_iso_writer.return_value
+        mock_writer.add_file.assert_called_once_with(mock.sentinel.path,
+                                                     mock.sentinel.data)
+        mock_writer.write.assert_called_once_with(mock.sentinel.iso_path)
+
     def test_create_config_drive_other_drive_format(self):
         self._test_create_config_drive(config_drive_format=mock.sentinel.OTHER,
                                        config_drive_cdrom=False,
@@ -777,6 +807,8 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
 
         self._vmops.destroy(instance=mock_instance)
         self.assertFalse(self._vmops._vmutils.destroy_vm.called)
+        self._vmops._vmutils.forget_controller_slots.assert_called_once_with(
+            mock_instance.name)
 
     @mock.patch('hyperv.nova.vmops.VMOps.power_off')
     def test_destroy_exception(self, mock_power_off):
@@ -13,6 +13,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import time
+
 import mock
 from nova import exception
 
@@ -268,6 +270,99 @@ class VMUtilsTestCase(test.NoDBTestCase):
 
             self.assertEqual(response, 0)
 
+    @mock.patch.dict(vmutils._slot_allocators, clear=True)
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_reserve_controller_slots(self, mock_get_attached_disks):
+        with mock.patch.object(self._vmutils,
+                               '_get_disk_resource_address') as mock_get_addr:
+            mock_get_addr.side_effect = ['0', '2']
+            mock_get_attached_disks.return_value = [mock.sentinel.disk_0,
+                                                    mock.sentinel.disk_2]
+
+            first_slots = self._vmutils.reserve_controller_slots(
+                self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, 2)
+            second_slots = self._vmutils.reserve_controller_slots(
+                self._FAKE_VM_NAME, self._FAKE_CTRL_PATH)
+
+            mock_get_attached_disks.assert_called_once_with(
+                self._FAKE_CTRL_PATH)
+            self.assertEqual([1, 3], first_slots)
+            self.assertEqual([4], second_slots)
+
+    @mock.patch.dict(vmutils._slot_allocators, clear=True)
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_release_controller_slots(self, mock_get_attached_disks):
+        mock_get_attached_disks.return_value = []
+
+        slots = self._vmutils.reserve_controller_slots(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, 2)
+        self._vmutils.release_controller_slots(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, slots[:1])
+        slots = self._vmutils.reserve_controller_slots(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, 2)
+
+        self.assertEqual([0, 2], slots)
+
+    @mock.patch.dict(vmutils._slot_allocators, clear=True)
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_reserve_controller_slots_reseed_when_full(
+            self, mock_get_attached_disks):
+        mock_get_attached_disks.return_value = []
+        self._vmutils.reserve_controller_slots(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH,
+            constants.SCSI_CONTROLLER_SLOTS_NUMBER)
+
+        # All the slots are reserved, yet the disks are not attached
+        # anymore, having been detached without the allocator knowing it.
+        expired_time = (time.time() +
+                        vmutils.ControllerSlotAllocator._PENDING_SLOT_TIMEOUT)
+        with mock.patch.object(vmutils.time, 'time',
+                               return_value=expired_time):
+            slots = self._vmutils.reserve_controller_slots(
+                self._FAKE_VM_NAME, self._FAKE_CTRL_PATH)
+
+        self.assertEqual([0], slots)
+        self.assertEqual(2, mock_get_attached_disks.call_count)
+
+    @mock.patch.dict(vmutils._slot_allocators, clear=True)
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_reserve_controller_slots_keeps_pending_slots(
+            self, mock_get_attached_disks):
+        mock_get_attached_disks.return_value = []
+        self._vmutils.reserve_controller_slots(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH,
+            constants.SCSI_CONTROLLER_SLOTS_NUMBER)
+
+        # Recently reserved slots may still be in use.
+        self.assertRaises(vmutils.HyperVException,
+                          self._vmutils.reserve_controller_slots,
+                          self._FAKE_VM_NAME, self._FAKE_CTRL_PATH)
+
+    @mock.patch.dict(vmutils._slot_allocators, clear=True)
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_release_controller_slots_reseed(self, mock_get_attached_disks):
+        mock_get_attached_disks.return_value = []
+        slots = self._vmutils.reserve_controller_slots(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, 2)
+
+        # The first disk got attached before the failure.
+        mock_get_attached_disks.return_value = [mock.sentinel.disk]
+        self._vmutils.release_controller_slots(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH.upper(), slots)
+        with mock.patch.object(self._vmutils, '_get_disk_resource_address',
+                               return_value=str(slots[0])):
+            new_slots = self._vmutils.reserve_controller_slots(
+                self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, 2)
+
+        self.assertEqual([1, 2], new_slots)
+        self.assertEqual(2, mock_get_attached_disks.call_count)
+
+    @mock.patch.dict(vmutils._slot_allocators, clear=True)
+    def test_release_untracked_controller_slots(self):
+        self._vmutils.release_controller_slots(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, [0])
+        self.assertEqual({}, vmutils._slot_allocators)
+
     def test_get_free_controller_slot_exception(self):
         mock_get_address = mock.Mock()
         mock_get_address.side_effect = range(
@@ -312,26 +407,44 @@ class VMUtilsTestCase(test.NoDBTestCase):
         mock_rasds.ResourceSubType = mock_subtype
         return mock_rasds
 
-    @mock.patch("hyperv.nova.vmutils.VMUtils.get_free_controller_slot")
+    @mock.patch("hyperv.nova.vmutils.VMUtils.release_controller_slots")
+    @mock.patch("hyperv.nova.vmutils.VMUtils.reserve_controller_slots")
     @mock.patch("hyperv.nova.vmutils.VMUtils._get_vm_scsi_controller")
-    def test_attach_scsi_drive(self, mock_get_vm_scsi_controller,
-                               mock_get_free_controller_slot):
+    def _test_attach_scsi_drive(self, mock_get_vm_scsi_controller,
+                                mock_reserve_controller_slots,
+                                mock_release_controller_slots,
+                                attach_failure=False):
         mock_vm = self._lookup_vm()
         mock_get_vm_scsi_controller.return_value = self._FAKE_CTRL_PATH
-        mock_get_free_controller_slot.return_value = self._FAKE_DRIVE_ADDR
+        mock_reserve_controller_slots.return_value = [self._FAKE_DRIVE_ADDR]
 
         with mock.patch.object(self._vmutils,
                                'attach_drive') as mock_attach_drive:
-            self._vmutils.attach_scsi_drive(mock_vm, self._FAKE_PATH,
-                                            constants.DISK)
+            if attach_failure:
+                mock_attach_drive.side_effect = vmutils.HyperVException
+                self.assertRaises(vmutils.HyperVException,
+                                  self._vmutils.attach_scsi_drive,
+                                  mock_vm, self._FAKE_PATH, constants.DISK)
+                mock_release_controller_slots.assert_called_once_with(
+                    mock_vm, self._FAKE_CTRL_PATH, [self._FAKE_DRIVE_ADDR])
+            else:
+                self._vmutils.attach_scsi_drive(mock_vm, self._FAKE_PATH,
+                                                constants.DISK)
+                self.assertFalse(mock_release_controller_slots.called)
 
             mock_get_vm_scsi_controller.assert_called_once_with(mock_vm)
-            mock_get_free_controller_slot.assert_called_once_with(
-                self._FAKE_CTRL_PATH)
+            mock_reserve_controller_slots.assert_called_once_with(
+                mock_vm, self._FAKE_CTRL_PATH)
             mock_attach_drive.assert_called_once_with(
                 mock_vm, self._FAKE_PATH, self._FAKE_CTRL_PATH,
                 self._FAKE_DRIVE_ADDR, constants.DISK)
 
+    def test_attach_scsi_drive(self):
+        self._test_attach_scsi_drive()
+
+    def test_attach_scsi_drive_failure(self):
+        self._test_attach_scsi_drive(attach_failure=True)
+
     @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
     @mock.patch.object(vmutils.VMUtils, '_get_vm_ide_controller')
     def test_attach_ide_drive(self, mock_get_ide_ctrl, mock_get_new_rsd):
@@ -373,6 +486,28 @@ class VMUtilsTestCase(test.NoDBTestCase):
             mock_add_virt_res.assert_called_with(mock_get_new_rsd.return_value,
                                                  mock_vm.path_.return_value)
 
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    def test_attach_volumes_to_controller(self, mock_get_new_rsd):
+        mock_vm = self._lookup_vm()
+        mock_diskdrives = [mock.Mock(), mock.Mock()]
+        mock_get_new_rsd.side_effect = mock_diskdrives
+        volumes = [(1, mock.sentinel.disk_path_1),
+                   (2, mock.sentinel.disk_path_2)]
+
+        with mock.patch.object(self._vmutils,
+                               '_add_virt_resources') as mock_add_res:
+            self._vmutils.attach_volumes_to_controller(
+                self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, volumes)
+
+        for diskdrive, (address, disk_path) in zip(mock_diskdrives, volumes):
+            self.assertEqual(address,
+                             self._vmutils._get_disk_resource_address(
+                                 diskdrive))
+            self.assertEqual(self._FAKE_CTRL_PATH, diskdrive.Parent)
+            self.assertEqual([disk_path], diskdrive.HostResource)
+        mock_add_res.assert_called_once_with(
+            mock_diskdrives, mock_vm.path_.return_value)
+
     @mock.patch.object(vmutils.VMUtils, '_modify_virt_resource')
     @mock.patch.object(vmutils.VMUtils, '_get_nic_data_by_name')
     def test_set_nic_connection(self, mock_get_nic_conn, mock_modify_virt_res):
@@ -416,6 +551,7 @@ class VMUtilsTestCase(test.NoDBTestCase):
         mock_vm.RequestStateChange.assert_called_with(
             constants.HYPERV_VM_STATE_ENABLED)
 
+    @mock.patch.dict(vmutils._slot_allocators, clear=True)
     def test_destroy_vm(self):
         self._lookup_vm()
 
@@ -423,10 +559,13 @@ class VMUtilsTestCase(test.NoDBTestCase):
         getattr(mock_svc, self._DESTROY_SYSTEM).return_value = (
             self._FAKE_JOB_PATH, self._FAKE_RET_VAL)
 
+        vmutils._slot_allocators[self._FAKE_VM_NAME] = {}
+
         self._vmutils.destroy_vm(self._FAKE_VM_NAME)
 
         getattr(mock_svc, self._DESTROY_SYSTEM).assert_called_with(
             self._FAKE_VM_PATH)
+        self.assertNotIn(self._FAKE_VM_NAME, vmutils._slot_allocators)
 
     @mock.patch.object(vmutils.VMUtils, '_wait_for_job')
     def test_check_ret_val_ok(self, mock_wait_for_job):
@@ -486,6 +625,17 @@ class VMUtilsTestCase(test.NoDBTestCase):
                                          self._FAKE_VM_PATH)
         self._assert_add_resources(mock_svc)
 
+    def test_add_virt_resources(self):
+        mock_svc = self._vmutils._conn.Msvm_VirtualSystemManagementService()[0]
+        getattr(mock_svc, self._ADD_RESOURCE).return_value = (
+            self._FAKE_JOB_PATH, mock.MagicMock(), self._FAKE_RET_VAL)
+        mock_res_setting_data = mock.MagicMock()
+        mock_res_setting_data.GetText_.return_value = self._FAKE_RES_DATA
+
+        self._vmutils._add_virt_resources([mock_res_setting_data] * 2,
+                                          self._FAKE_VM_PATH)
+        self._assert_add_resources(mock_svc, [self._FAKE_RES_DATA] * 2)
+
     def test_modify_virt_resource(self):
         mock_svc = self._vmutils._conn.Msvm_VirtualSystemManagementService()[0]
         mock_svc.ModifyVirtualSystemResources.return_value = (
@@ -571,6 +721,44 @@ class VMUtilsTestCase(test.NoDBTestCase):
 
             mock_rm_virt_res.assert_called_with(mock_disk, self._FAKE_VM_PATH)
 
+    @mock.patch.dict(vmutils._slot_allocators, clear=True)
+    @mock.patch.object(vmutils.VMUtils, '_get_mounted_disk_resource_from_path')
+    def test_detach_vm_disk_releases_slot(self, mock_get_disk_resource):
+        self._lookup_vm()
+        mock_disk = mock_get_disk_resource.return_value
+        # The controller path may differ in case from the one used when
+        # reserving the slot.
+        mock_disk.Parent = self._FAKE_CTRL_PATH.upper()
+        mock_allocator = mock.Mock(needs_reseed=False)
+        vmutils._slot_allocators[self._FAKE_VM_NAME] = {
+            self._vmutils._get_slot_allocator_key(
+                self._FAKE_CTRL_PATH): mock_allocator}
+
+        with mock.patch.multiple(
+                self._vmutils, _remove_virt_resource=mock.DEFAULT,
+                _get_disk_resource_address=mock.DEFAULT) as mocks:
+            mock_get_addr = mocks['_get_disk_resource_address']
+            mock_get_addr.return_value = str(self._FAKE_DRIVE_ADDR)
+
+            self._vmutils.detach_vm_disk(self._FAKE_VM_NAME,
+                                         self._FAKE_HOST_RESOURCE)
+
+        mock_get_addr.assert_called_once_with(mock_disk)
+        mock_allocator.release.assert_called_once_with(
+            [self._FAKE_DRIVE_ADDR])
+        # Detached disks do not require re-seeding the allocator.
+        self.assertFalse(mock_allocator.needs_reseed)
+
+    def test_get_slot_allocator_key(self):
+        ctrl_path = (r'\\HOST\root\virtualization:Msvm_ResourceAllocation'
+                     r'SettingData.InstanceID="Microsoft:GUID\0"')
+        other_ctrl_path = (r'ROOT\virtualization:msvm_resourceallocation'
+                           r'settingdata.InstanceID="Microsoft:guid\0"')
+
+        self.assertEqual(self._vmutils._get_slot_allocator_key(ctrl_path),
+                         self._vmutils._get_slot_allocator_key(
+                             other_ctrl_path))
+
     def _test_get_mounted_disk_resource_from_path(self, is_physical):
         mock_disk_1 = mock.MagicMock()
         mock_disk_2 = mock.MagicMock()
@@ -590,6 +778,23 @@ class VMUtilsTestCase(test.NoDBTestCase):
     def test_get_virtual_mounted_disk_resource_from_path(self):
         self._test_get_mounted_disk_resource_from_path(is_physical=False)
 
+    def test_get_attached_virtual_disk_paths(self):
+        mock_disk = mock.MagicMock()
+        setattr(mock_disk, self._vmutils._VIRT_DISK_CONNECTION_ATTR,
+                [self._FAKE_VHD_PATH])
+        mock_empty_drive = mock.MagicMock()
+        setattr(mock_empty_drive, self._vmutils._VIRT_DISK_CONNECTION_ATTR,
+                None)
+        self._vmutils._conn.query.return_value = [mock_disk,
+                                                  mock_empty_drive]
+
+        disk_paths = self._vmutils.get_attached_virtual_disk_paths()
+
+        self.assertEqual([self._FAKE_VHD_PATH], disk_paths)
+        query = self._vmutils._conn.query.call_args[0][0]
+        self.assertIn(self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS, query)
+        self.assertIn(self._vmutils._HARD_DISK_RES_SUB_TYPE, query)
+
     def test_get_controller_volume_paths(self):
         self._prepare_mock_disk()
         mock_disks = {self._FAKE_RES_PATH: self._FAKE_HOST_RESOURCE}
@@ -608,28 +813,24 @@ class VMUtilsTestCase(test.NoDBTestCase):
     def _get_snapshot_service(self):
         return self._vmutils._conn.Msvm_VirtualSystemManagementService()[0]
 
-    def _assert_add_resources(self, mock_svc):
+    def _assert_add_resources(self, mock_svc, res_data=None):
         getattr(mock_svc, self._ADD_RESOURCE).assert_called_with(
-            [self._FAKE_RES_DATA], self._FAKE_VM_PATH)
+            res_data or [self._FAKE_RES_DATA], self._FAKE_VM_PATH)
 
     def _assert_remove_resources(self, mock_svc):
         getattr(mock_svc, self._REMOVE_RESOURCE).assert_called_with(
             [self._FAKE_RES_PATH], self._FAKE_VM_PATH)
 
     def test_get_active_instances(self):
-        fake_vm = mock.MagicMock()
-
-        type(fake_vm).ElementName = mock.PropertyMock(
-            side_effect=['active_vm', 'inactive_vm'])
-        type(fake_vm).EnabledState = mock.PropertyMock(
-            side_effect=[constants.HYPERV_VM_STATE_ENABLED,
-                         constants.HYPERV_VM_STATE_DISABLED])
-        self._vmutils.list_instances = mock.MagicMock(
-            return_value=[mock.sentinel.fake_vm_name] * 2)
-        self._vmutils._lookup_vm = mock.MagicMock(side_effect=[fake_vm] * 2)
+        fake_vm = mock.Mock(ElementName=mock.sentinel.vm_name)
+        self._vmutils._conn.Msvm_ComputerSystem.return_value = [fake_vm]
+
         active_instances = self._vmutils.get_active_instances()
 
-        self.assertEqual(['active_vm'], active_instances)
+        self.assertEqual([mock.sentinel.vm_name], active_instances)
+        self._vmutils._conn.Msvm_ComputerSystem.assert_called_once_with(
+            ['ElementName'], Caption=self._vmutils._VM_CAPTION,
+            EnabledState=constants.HYPERV_VM_STATE_ENABLED)
 
     def test_get_vm_serial_ports(self):
         mock_vm = self._lookup_vm()
@@ -891,3 +1092,52 @@ class VMUtilsTestCase(test.NoDBTestCase):
                 fields=[self._vmutils._VM_ENABLED_STATE_PROP])
 
             self.assertEqual(watcher.return_value, listener)
+
+    def test_get_creation_event_wql_query(self):
+        expected_query = ("SELECT * FROM __InstanceCreationEvent "
+                          "WITHIN 10 "
+                          "WHERE TargetInstance ISA 'Msvm_DiskDrive'")
+
+        query = self._vmutils._get_creation_event_wql_query(
+            cls='Msvm_DiskDrive', timeframe=10)
+
+        self.assertEqual(expected_query, query)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_creation_event_wql_query')
+    def test_get_disk_drive_arrival_listener(self, mock_get_query):
+        listener = self._vmutils.get_disk_drive_arrival_listener(
+            mock.sentinel.timeframe)
+
+        mock_get_query.assert_called_once_with(
+            cls=self._vmutils._DISK_DRIVE_CLASS,
+            timeframe=mock.sentinel.timeframe)
+        watcher = self._vmutils._conn.Msvm_DiskDrive.watch_for
+        watcher.assert_called_once_with(
+            raw_wql=mock_get_query.return_value)
+        self.assertEqual(watcher.return_value, listener)
+
+
+class ControllerSlotAllocatorTestCase(test.NoDBTestCase):
+    """Unit tests for the Hyper-V ControllerSlotAllocator class."""
+
+    def setUp(self):
+        super(ControllerSlotAllocatorTestCase, self).setUp()
+        self._allocator = vmutils.ControllerSlotAllocator(
+            slot_count=4, used_slots=[0, 2])
+
+    def test_reserve(self):
+        self.assertEqual([1], self._allocator.reserve())
+        self.assertEqual([3], self._allocator.reserve())
+
+    def test_reserve_multiple(self):
+        self.assertEqual([1, 3], self._allocator.reserve(2))
+
+    def test_reserve_exceeded(self):
+        self.assertRaises(vmutils.HyperVException,
+                          self._allocator.reserve, 3)
+        # Failed reservations must not hold any slot.
+        self.assertEqual([1, 3], self._allocator.reserve(2))
+
+    def test_release(self):
+        self._allocator.release([0, 2])
+        self.assertEqual([0, 1, 2], self._allocator.reserve(3))
@@ -129,9 +129,9 @@ class VMUtilsV2TestCase(test_vmutils.VMUtilsTestCase):
     def _get_snapshot_service(self):
         return self._vmutils._conn.Msvm_VirtualSystemSnapshotService()[0]
 
-    def _assert_add_resources(self, mock_svc):
+    def _assert_add_resources(self, mock_svc, res_data=None):
         getattr(mock_svc, self._ADD_RESOURCE).assert_called_with(
-            self._FAKE_VM_PATH, [self._FAKE_RES_DATA])
+            self._FAKE_VM_PATH, res_data or [self._FAKE_RES_DATA])
 
     def _assert_remove_resources(self, mock_svc):
         getattr(mock_svc, self._REMOVE_RESOURCE).assert_called_with(
@@ -14,7 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import contextlib
+import itertools
 import mock
 import os
 
@@ -97,6 +99,68 @@ class VolumeOpsTestCase(test_base.HyperVBaseTestCase):
             fake_conn_info, mock.sentinel.instance_name,
             mock.sentinel.min_iops, mock.sentinel.max_iops)
 
+    @mock.patch.object(volumeops.VolumeOps, '_attach_volumes_batch')
+    @mock.patch.object(volumeops.VolumeOps, 'attach_volume')
+    def _test_attach_volumes(self, mock_attach_volume, mock_attach_batch,
+                             batch_attach=False, driver_types=('iscsi',)):
+        self.flags(volume_batch_attach=batch_attach, group='hyperv')
+        connection_infos = [{'driver_volume_type': driver_type}
+                            for driver_type in driver_types] * 2
+        block_device_info = {
+            'block_device_mapping': [{'connection_info': connection_info}
+                                     for connection_info in connection_infos]}
+
+        self._volumeops.attach_volumes(block_device_info,
+                                       mock.sentinel.instance_name,
+                                       ebs_root=True)
+
+        if batch_attach and len(driver_types) == 1:
+            mock_attach_batch.assert_called_once_with(
+                connection_infos, mock.sentinel.instance_name, True)
+            self.assertFalse(mock_attach_volume.called)
+        else:
+            self.assertFalse(mock_attach_batch.called)
+            expected_calls = [
+                mock.call(connection_infos[0], mock.sentinel.instance_name,
+                          True)]
+            expected_calls += [
+                mock.call(connection_info, mock.sentinel.instance_name)
+                for connection_info in connection_infos[1:]]
+            self.assertEqual(expected_calls,
+                             mock_attach_volume.call_args_list)
+
+    def test_attach_volumes(self):
+        self._test_attach_volumes()
+
+    def test_attach_volumes_batch(self):
+        self._test_attach_volumes(batch_attach=True)
+
+    def test_attach_volumes_batch_mixed_drivers(self):
+        self._test_attach_volumes(batch_attach=True,
+                                  driver_types=('iscsi', 'smbfs'))
+
+    @mock.patch.object(volumeops.VolumeOps, '_get_volume_driver')
+    @mock.patch.object(volumeops.VolumeOps, '_set_volume_qos_specs')
+    def test_attach_volumes_batch_driver(self, mock_set_qos_specs,
+                                         mock_get_volume_driver):
+        connection_infos = [mock.sentinel.conn_info_0,
+                            mock.sentinel.conn_info_1]
+        mock_volume_driver = mock_get_volume_driver.return_value
+
+        self._volumeops._attach_volumes_batch(connection_infos,
+                                              mock.sentinel.instance_name,
+                                              mock.sentinel.ebs_root)
+
+        mock_get_volume_driver.assert_called_once_with(
+            connection_info=mock.sentinel.conn_info_0)
+        mock_volume_driver.attach_volumes.assert_called_once_with(
+            connection_infos, mock.sentinel.instance_name,
+            mock.sentinel.ebs_root)
+        mock_set_qos_specs.assert_has_calls(
+            [mock.call(mock_volume_driver, connection_info,
+                       mock.sentinel.instance_name)
+             for connection_info in connection_infos])
+
     @mock.patch.object(volumeops.VolumeOps, '_get_volume_driver')
     def test_disconnect_volumes(self, mock_get_volume_driver):
         block_device_info = db_fakes.get_fake_block_device_info(
@@ -151,6 +215,17 @@ class ISCSIVolumeDriverTestCase(test_base.HyperVBaseTestCase):
         super(ISCSIVolumeDriverTestCase, self).setUp()
         self._volume_driver = volumeops.ISCSIVolumeDriver()
 
+        patcher = mock.patch.object(volumeops, '_target_users',
+                                    collections.Counter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(volumeops._idle_target_logouts, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(volumeops, '_session_stats_log_loop', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_get_mounted_disk_from_lun(self):
         with contextlib.nested(
             mock.patch.object(self._volume_driver._volutils,
@@ -206,8 +281,13 @@ class ISCSIVolumeDriverTestCase(test_base.HyperVBaseTestCase):
                 mock.sentinel.disk_address, mock.sentinel.mounted_path)
 
     @mock.patch('time.sleep')
-    def test_get_mounted_disk_from_lun_failure(self, fake_sleep):
+    @mock.patch('time.time')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_get_event_listener')
+    def test_get_mounted_disk_from_lun_failure(self, mock_get_listener,
+                                               mock_time, fake_sleep):
         self.flags(mounted_disk_query_retry_count=1, group='hyperv')
+        mock_time.side_effect = itertools.count()
+        mock_get_listener.return_value = None
 
         with mock.patch.object(self._volume_driver._volutils,
                                'get_device_number_for_target') as m_device_num:
@@ -218,6 +298,306 @@ class ISCSIVolumeDriverTestCase(test_base.HyperVBaseTestCase):
                               mock.sentinel.target_iqn,
                               mock.sentinel.target_lun)
 
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_wait_for_device')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_get_event_listener')
+    def test_get_mounted_disk_from_lun_wait_for_device(self, mock_get_listener,
+                                                       mock_wait):
+        self.flags(volume_attach_retry_count=3, group='hyperv')
+        self.flags(volume_attach_retry_interval=2, group='hyperv')
+        mock_wait.side_effect = [mock.sentinel.device_number,
+                                 mock.sentinel.disk_path]
+
+        disk_path = self._volume_driver._get_mounted_disk_from_lun(
+            mock.sentinel.target_iqn, mock.sentinel.target_lun,
+            wait_for_device=True)
+
+        self.assertEqual(mock.sentinel.disk_path, disk_path)
+        mock_wait.assert_called_with(mock.ANY, mock.ANY,
+                                     timeout=6, max_interval=2)
+
+        get_listener = mock_wait.call_args[0][1]
+        self.assertEqual(mock_get_listener.return_value, get_listener())
+        mock_get_listener.assert_called_once_with(
+            'Msvm_DiskDrive',
+            self._volume_driver._vmutils.get_disk_drive_arrival_listener)
+
+    def test_get_event_listener(self):
+        mock_get_listener = mock.Mock()
+
+        for i in range(2):
+            listener = self._volume_driver._get_event_listener(
+                mock.sentinel.event_type, mock_get_listener)
+
+        self.assertEqual(mock_get_listener.return_value, listener)
+        mock_get_listener.assert_called_once_with(
+            self._volume_driver._DISK_EVENT_TIMEFRAME)
+
+    @mock.patch.object(volumeops, 'wmi', create=True)
+    def test_get_event_listener_unavailable(self, mock_wmi):
+        mock_wmi.x_wmi = Exception
+        mock_get_listener = mock.Mock(side_effect=mock_wmi.x_wmi)
+
+        listener = self._volume_driver._get_event_listener(
+            mock.sentinel.event_type, mock_get_listener)
+
+        self.assertIsNone(listener)
+
+    @mock.patch.object(volumeops, 'wmi', create=True)
+    def test_check_disk_arrival(self, mock_wmi):
+        mock_wmi.x_wmi_timed_out = Exception
+        mock_listener = mock.Mock(
+            side_effect=[mock.sentinel.event, mock.sentinel.event,
+                         mock_wmi.x_wmi_timed_out])
+
+        disk_arrived = self._volume_driver._check_disk_arrival(mock_listener)
+
+        self.assertTrue(disk_arrived)
+        self.assertEqual(3, mock_listener.call_count)
+
+    def test_check_disk_arrival_no_listener(self):
+        self.assertFalse(self._volume_driver._check_disk_arrival(None))
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_check_disk_arrival')
+    def test_wait_for_device_on_event(self, mock_check_arrival, mock_time,
+                                      mock_sleep):
+        mock_time.return_value = 0
+        mock_check_arrival.side_effect = [False, True]
+        mock_get_device = mock.Mock(
+            side_effect=[None, mock.sentinel.device])
+        mock_get_listener = mock.Mock(return_value=mock.sentinel.listener)
+
+        device = self._volume_driver._wait_for_device(
+            mock_get_device, mock_get_listener,
+            timeout=10, max_interval=5)
+
+        self.assertEqual(mock.sentinel.device, device)
+        self.assertEqual(2, mock_get_device.call_count)
+        mock_get_listener.assert_called_once_with()
+        mock_check_arrival.assert_called_with(mock.sentinel.listener)
+        mock_sleep.assert_called_with(
+            self._volume_driver._DISK_EVENT_CHECK_INTERVAL)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_wait_for_device_polling_timeout(self, mock_time, mock_sleep):
+        now = [0]
+
+        def fake_sleep(interval):
+            now[0] += interval
+
+        mock_time.side_effect = lambda: now[0]
+        mock_sleep.side_effect = fake_sleep
+        mock_get_device = mock.Mock(return_value=None)
+
+        device = self._volume_driver._wait_for_device(
+            mock_get_device, None, timeout=4, max_interval=2)
+
+        self.assertIsNone(device)
+        sleep_intervals = [call[0][0] for call in mock_sleep.call_args_list]
+        self.assertEqual([0.5, 1, 2, 0.5], sleep_intervals)
+        self.assertEqual(5, mock_get_device.call_count)
+
+    def _get_fake_iscsi_connection_info(self, target_iqn, target_lun):
+        return {'data': {'target_iqn': target_iqn,
+                         'target_lun': target_lun}}
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, 'disconnect_volumes')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_login_storage_targets')
+    def _test_attach_volumes(self, mock_login_targets,
+                             mock_disconnect_volumes,
+                             ebs_root=False, attach_failure=False):
+        connection_infos = [mock.sentinel.conn_info_0,
+                            mock.sentinel.conn_info_1,
+                            mock.sentinel.conn_info_2]
+
+        def fake_login_targets(connection_infos, connected_infos):
+            connected_infos.extend(connection_infos)
+            return [mock.sentinel.disk_path_0,
+                    mock.sentinel.disk_path_1,
+                    mock.sentinel.disk_path_2]
+
+        mock_login_targets.side_effect = fake_login_targets
+        mock_vmutils = mock.Mock()
+        self._volume_driver._vmutils = mock_vmutils
+        mock_vmutils.reserve_controller_slots.return_value = [1, 2, 3]
+        if attach_failure:
+            mock_vmutils.attach_volumes_to_controller.side_effect = (
+                vmutils.HyperVException)
+
+        if attach_failure:
+            self.assertRaises(vmutils.HyperVException,
+                              self._volume_driver.attach_volumes,
+                              connection_infos,
+                              mock.sentinel.instance_name, ebs_root)
+        else:
+            self._volume_driver.attach_volumes(connection_infos,
+                                               mock.sentinel.instance_name,
+                                               ebs_root)
+
+        mock_login_targets.assert_called_once_with(connection_infos,
+                                                   mock.ANY)
+        mock_get_ctrller = mock_vmutils.get_vm_scsi_controller
+        mock_get_ctrller.assert_called_once_with(mock.sentinel.instance_name)
+        if ebs_root:
+            mock_vmutils.attach_volume_to_controller.assert_called_once_with(
+                mock.sentinel.instance_name,
+                mock_vmutils.get_vm_ide_controller.return_value, 0,
+                mock.sentinel.disk_path_0)
+            expected_volumes = [(1, mock.sentinel.disk_path_1),
+                                (2, mock.sentinel.disk_path_2)]
+        else:
+            self.assertFalse(mock_vmutils.attach_volume_to_controller.called)
+            expected_volumes = [(1, mock.sentinel.disk_path_0),
+                                (2, mock.sentinel.disk_path_1),
+                                (3, mock.sentinel.disk_path_2)]
+        mock_vmutils.reserve_controller_slots.assert_called_once_with(
+            mock.sentinel.instance_name, mock_get_ctrller.return_value,
+            len(connection_infos) - ebs_root)
+        mock_vmutils.attach_volumes_to_controller.assert_called_once_with(
+            mock.sentinel.instance_name, mock_get_ctrller.return_value,
+            mock.ANY)
+        attached_volumes = (
+            mock_vmutils.attach_volumes_to_controller.call_args[0][2])
+        self.assertEqual(expected_volumes, list(attached_volumes))
+
+        if attach_failure:
+            mock_vmutils.release_controller_slots.assert_called_once_with(
+                mock.sentinel.instance_name, mock_get_ctrller.return_value,
+                [1, 2, 3])
+            mock_disconnect_volumes.assert_called_once_with(
+                [{'connection_info': connection_info}
+                 for connection_info in connection_infos])
+            if ebs_root:
+                mock_vmutils.detach_vm_disk.assert_called_once_with(
+                    mock.sentinel.instance_name, mock.sentinel.disk_path_0)
+            else:
+                self.assertFalse(mock_vmutils.detach_vm_disk.called)
+        else:
+            self.assertFalse(mock_vmutils.release_controller_slots.called)
+            self.assertFalse(mock_disconnect_volumes.called)
+
+    def test_attach_volumes(self):
+        self._test_attach_volumes()
+
+    def test_attach_volumes_ebs_root(self):
+        self._test_attach_volumes(ebs_root=True)
+
+    def test_attach_volumes_rollback(self):
+        self._test_attach_volumes(attach_failure=True)
+
+    def test_attach_volumes_ebs_root_rollback(self):
+        self._test_attach_volumes(ebs_root=True, attach_failure=True)
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, 'disconnect_volumes')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, 'login_storage_target')
+    def test_attach_volumes_login_failure(self, mock_login_storage_target,
+                                          mock_disconnect_volumes):
+        connection_infos = [
+            self._get_fake_iscsi_connection_info(mock.sentinel.iqn_0, 1),
+            self._get_fake_iscsi_connection_info(mock.sentinel.iqn_1, 1)]
+        mock_login_storage_target.side_effect = [
+            None, vmutils.HyperVException]
+        self._volume_driver._vmutils = mock.Mock()
+
+        self.assertRaises(vmutils.HyperVException,
+                          self._volume_driver.attach_volumes,
+                          connection_infos, mock.sentinel.instance_name)
+
+        # Only the targets which were logged in are released.
+        mock_disconnect_volumes.assert_called_once_with(
+            [{'connection_info': connection_infos[0]}])
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver,
+                       '_wait_for_mounted_disks')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, 'login_storage_target')
+    def test_login_storage_targets(self, mock_login_storage_target,
+                                   mock_wait_for_disks):
+        connection_infos = [
+            self._get_fake_iscsi_connection_info(mock.sentinel.iqn_0, 1),
+            self._get_fake_iscsi_connection_info(mock.sentinel.iqn_1, 1),
+            self._get_fake_iscsi_connection_info(mock.sentinel.iqn_0, 2)]
+        target_luns = [(mock.sentinel.iqn_0, 1), (mock.sentinel.iqn_1, 1),
+                       (mock.sentinel.iqn_0, 2)]
+        mock_wait_for_disks.return_value = dict(
+            (target_lun, mock.Mock(target_lun=target_lun))
+            for target_lun in target_luns)
+        connected_infos = []
+
+        mounted_disk_paths = self._volume_driver._login_storage_targets(
+            connection_infos, connected_infos)
+
+        self.assertEqual(target_luns,
+                         [disk_path.target_lun
+                          for disk_path in mounted_disk_paths])
+        # The volumes exported by the same target are handled together,
+        # all the disks being awaited once all the targets are logged in.
+        mock_login_storage_target.assert_has_calls(
+            [mock.call(connection_infos[0], wait_for_device=False),
+             mock.call(connection_infos[2], wait_for_device=False),
+             mock.call(connection_infos[1], wait_for_device=False)])
+        mock_wait_for_disks.assert_called_once_with(target_luns)
+        self.assertEqual(3, len(connected_infos))
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver,
+                       '_wait_for_mounted_disks')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, 'login_storage_target')
+    def test_login_storage_targets_failure(self, mock_login_storage_target,
+                                           mock_wait_for_disks):
+        connection_infos = [
+            self._get_fake_iscsi_connection_info(mock.sentinel.iqn_0, 1),
+            self._get_fake_iscsi_connection_info(mock.sentinel.iqn_1, 1)]
+        mock_login_storage_target.side_effect = [
+            None, vmutils.HyperVException]
+        connected_infos = []
+
+        self.assertRaises(vmutils.HyperVException,
+                          self._volume_driver._login_storage_targets,
+                          connection_infos, connected_infos)
+        self.assertEqual([connection_infos[0]], connected_infos)
+        self.assertFalse(mock_wait_for_disks.called)
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_wait_for_device')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_get_device_number')
+    def test_wait_for_mounted_disks(self, mock_get_device_number,
+                                    mock_wait_for_device):
+        mock_vmutils = mock.Mock()
+        self._volume_driver._vmutils = mock_vmutils
+        mock_wait_for_device.side_effect = (
+            lambda get_device, get_listener, timeout, max_interval: (
+                get_device() or get_device()))
+        lookups = []
+
+        def fake_get_device_number(target_iqn, target_lun):
+            lookups.append(target_lun)
+            # The second disk shows up on the second lookup.
+            if target_lun == 2 and lookups.count(2) == 1:
+                return None
+            return target_lun
+
+        mock_get_device_number.side_effect = fake_get_device_number
+        mock_vmutils.get_mounted_disk_by_drive_number.side_effect = (
+            lambda device_number: 'disk_%s' % device_number)
+
+        mounted_disks = self._volume_driver._wait_for_mounted_disks(
+            [(mock.sentinel.iqn_0, 1), (mock.sentinel.iqn_0, 2)])
+
+        self.assertEqual({(mock.sentinel.iqn_0, 1): 'disk_1',
+                          (mock.sentinel.iqn_0, 2): 'disk_2'},
+                         mounted_disks)
+        # The disks already found are not looked up again.
+        self.assertEqual([1, 2, 2], sorted(lookups))
+        self.assertEqual(1, mock_wait_for_device.call_count)
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_wait_for_device')
+    def test_wait_for_mounted_disks_timeout(self, mock_wait_for_device):
+        mock_wait_for_device.return_value = None
+
+        self.assertRaises(exception.NotFound,
+                          self._volume_driver._wait_for_mounted_disks,
+                          [(mock.sentinel.iqn_0, 1)])
+
     @mock.patch.object(volumeops.ISCSIVolumeDriver, 'logout_storage_target')
     def test_disconnect_volumes(self, mock_logout_storage_target):
         block_device_info = db_fakes.get_fake_block_device_info(
@@ -229,6 +609,151 @@ class ISCSIVolumeDriverTestCase(test_base.HyperVBaseTestCase):
 
         mock_logout_storage_target.assert_called_once_with(fake_target_iqn, 1)
 
+    @mock.patch.object(volumeops.ISCSIVolumeDriver,
+                       '_start_session_stats_log')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver,
+                       '_get_mounted_disk_from_lun')
+    def _test_acquire_target_session(self, mock_get_mounted_disk,
+                                     mock_start_stats_log, logged_in=False):
+        mock_volutils = mock.Mock()
+        self._volume_driver._volutils = mock_volutils
+        mock_volutils.get_device_number_for_target.return_value = (
+            1 if logged_in else None)
+        mock_idle_logout = mock.Mock()
+        volumeops._idle_target_logouts[mock.sentinel.target_iqn] = (
+            mock_idle_logout)
+
+        self._volume_driver._acquire_target_session(
+            mock.sentinel.target_iqn, mock.sentinel.target_lun,
+            mock.sentinel.target_portal)
+
+        mock_idle_logout.cancel.assert_called_once_with()
+        self.assertNotIn(mock.sentinel.target_iqn,
+                         volumeops._idle_target_logouts)
+        if logged_in:
+            self.assertFalse(mock_volutils.login_storage_target.called)
+        else:
+            mock_volutils.login_storage_target.assert_called_once_with(
+                mock.sentinel.target_lun, mock.sentinel.target_iqn,
+                mock.sentinel.target_portal, None, None)
+            mock_get_mounted_disk.assert_called_once_with(
+                mock.sentinel.target_iqn, mock.sentinel.target_lun, True)
+        self.assertEqual(1, volumeops._target_users[mock.sentinel.target_iqn])
+        mock_start_stats_log.assert_called_once_with()
+
+    def test_acquire_target_session(self):
+        self._test_acquire_target_session()
+
+    def test_acquire_target_session_reused(self):
+        self._test_acquire_target_session(logged_in=True)
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_logout_target')
+    def test_logout_storage_target_in_use(self, mock_logout_target):
+        volumeops._target_users[mock.sentinel.target_iqn] = 3
+
+        self._volume_driver.logout_storage_target(mock.sentinel.target_iqn, 2)
+
+        self.assertEqual(1, volumeops._target_users[mock.sentinel.target_iqn])
+        self.assertFalse(mock_logout_target.called)
+
+    @mock.patch('eventlet.spawn_after')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_logout_target')
+    def _test_logout_storage_target(self, mock_logout_target,
+                                    mock_spawn_after, linger_time=0,
+                                    other_luns_available=False):
+        self.flags(iscsi_session_linger_time=linger_time, group='hyperv')
+        volumeops._target_users[mock.sentinel.target_iqn] = 1
+        mock_volutils = mock.Mock()
+        self._volume_driver._volutils = mock_volutils
+        mock_volutils.get_target_lun_count.return_value = (
+            1 + int(other_luns_available))
+
+        self._volume_driver.logout_storage_target(mock.sentinel.target_iqn)
+
+        self.assertNotIn(mock.sentinel.target_iqn, volumeops._target_users)
+        if other_luns_available:
+            self.assertFalse(mock_logout_target.called)
+            self.assertFalse(mock_spawn_after.called)
+        elif linger_time:
+            mock_spawn_after.assert_called_once_with(
+                linger_time, self._volume_driver._logout_idle_target,
+                mock.sentinel.target_iqn)
+            self.assertEqual(
+                mock_spawn_after.return_value,
+                volumeops._idle_target_logouts[mock.sentinel.target_iqn])
+            self.assertFalse(mock_logout_target.called)
+        else:
+            mock_logout_target.assert_called_once_with(
+                mock.sentinel.target_iqn)
+
+    def test_logout_storage_target(self):
+        self._test_logout_storage_target()
+
+    def test_logout_storage_target_lingering(self):
+        self._test_logout_storage_target(linger_time=10)
+
+    def test_logout_storage_target_other_luns(self):
+        self._test_logout_storage_target(other_luns_available=True)
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_logout_target')
+    def test_logout_idle_target(self, mock_logout_target):
+        volumeops._idle_target_logouts[mock.sentinel.target_iqn] = (
+            mock.sentinel.idle_logout)
+
+        self._volume_driver._logout_idle_target(mock.sentinel.target_iqn)
+
+        mock_logout_target.assert_called_once_with(mock.sentinel.target_iqn)
+        self.assertEqual({}, volumeops._idle_target_logouts)
+
+    @mock.patch.object(volumeops.ISCSIVolumeDriver, '_logout_target')
+    def test_logout_idle_target_cancelled(self, mock_logout_target):
+        self._volume_driver._logout_idle_target(mock.sentinel.target_iqn)
+
+        self.assertFalse(mock_logout_target.called)
+
+    @mock.patch.object(volumeops, '_target_session_stats',
+                       collections.Counter(logins=2))
+    def test_get_target_session_stats(self):
+        volumeops._target_users.update({mock.sentinel.iqn_0: 2,
+                                        mock.sentinel.iqn_1: 1})
+        volumeops._idle_target_logouts[mock.sentinel.iqn_2] = (
+            mock.sentinel.idle_logout)
+
+        stats = self._volume_driver.get_target_session_stats()
+
+        expected_stats = dict(logins=2, active_targets=2,
+                              volume_users=3, idle_targets=1)
+        self.assertEqual(expected_stats, stats)
+
+    @mock.patch.object(volumeops.loopingcall, 'FixedIntervalLoopingCall')
+    def test_start_session_stats_log(self, mock_looping_call):
+        self.flags(iscsi_session_stats_log_interval=10, group='hyperv')
+
+        self._volume_driver._start_session_stats_log()
+        self._volume_driver._start_session_stats_log()
+
+        mock_looping_call.assert_called_once_with(
+            self._volume_driver._log_target_session_stats)
+        mock_looping_call.return_value.start.assert_called_once_with(
+            interval=10, initial_delay=10)
+
+    @mock.patch.object(volumeops.loopingcall, 'FixedIntervalLoopingCall')
+    def test_start_session_stats_log_disabled(self, mock_looping_call):
+        self.flags(iscsi_session_stats_log_interval=0, group='hyperv')
+
+        self._volume_driver._start_session_stats_log()
+
+        self.assertFalse(mock_looping_call.called)
+
+    @mock.patch.object(volumeops, 'LOG')
+    @mock.patch.object(volumeops.ISCSIVolumeDriver,
+                       'get_target_session_stats')
+    def test_log_target_session_stats(self, mock_get_stats, mock_log):
+        self._volume_driver._log_target_session_stats()
+
+        mock_log.info.assert_called_once_with(
+            mock.ANY, mock_get_stats.return_value)
+
 
 class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
     """Unit tests for the Hyper-V SMBFSVolumeDriver class."""
@@ -248,25 +773,40 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
         super(SMBFSVolumeDriverTestCase, self).setUp()
         self._volume_driver = volumeops.SMBFSVolumeDriver()
 
+        for patcher in (
+                mock.patch.object(volumeops, '_mounted_shares', set()),
+                mock.patch.object(volumeops, '_share_users',
+                                  collections.defaultdict(set)),
+                mock.patch.dict(volumeops._idle_share_unmounts, clear=True),
+                mock.patch.object(volumeops, '_share_check_loop', []),
+                mock.patch.object(volumeops.loopingcall,
+                                  'FixedIntervalLoopingCall')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     @mock.patch.object(volumeops.SMBFSVolumeDriver, '_parse_credentials')
-    @mock.patch.object(volumeops.SMBFSVolumeDriver, 'ensure_share_mounted')
+    @mock.patch.object(volumeops.SMBFSVolumeDriver, '_release_share')
+    @mock.patch.object(volumeops.SMBFSVolumeDriver, '_acquire_share')
     @mock.patch.object(volumeops.SMBFSVolumeDriver, '_get_disk_path')
     @mock.patch.object(vmutils.VMUtils, 'get_vm_scsi_controller')
-    @mock.patch.object(vmutils.VMUtils, 'get_free_controller_slot')
+    @mock.patch.object(vmutils.VMUtils, 'reserve_controller_slots')
+    @mock.patch.object(vmutils.VMUtils, 'release_controller_slots')
     @mock.patch.object(vmutils.VMUtils, 'attach_drive')
     def _test_attach_volume(self, mock_attach_drive,
-                            mock_get_free_controller_slot,
+                            mock_release_controller_slots,
+                            mock_reserve_controller_slots,
                             mock_get_vm_scsi_controller,
                             mock_get_disk_path,
-                            mock_ensure_share_mounted,
+                            mock_acquire_share,
+                            mock_release_share,
                             mock_parse_credentials,
                             image_exists=True):
         mock_parse_credentials.return_value = (
             mock.sentinel.username, self._FAKE_PASSWORD)
         mock_get_vm_scsi_controller.return_value = (
             mock.sentinel.controller_path)
-        mock_get_free_controller_slot.return_value = (
-            mock.sentinel.controller_slot)
+        mock_reserve_controller_slots.return_value = [
+            mock.sentinel.controller_slot]
         mock_get_disk_path.return_value = (
             mock.sentinel.disk_path)
 
@@ -275,18 +815,21 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
                 self._FAKE_CONNECTION_INFO,
                 mock.sentinel.instance_name)
 
-            mock_ensure_share_mounted.assert_called_with(
-                self._FAKE_CONNECTION_INFO)
+            mock_acquire_share.assert_called_once_with(
+                self._FAKE_SHARE_NORMALIZED, self._FAKE_SMB_OPTIONS,
+                [mock.sentinel.disk_path])
             mock_get_disk_path.assert_called_with(
                 self._FAKE_CONNECTION_INFO)
             mock_get_vm_scsi_controller.assert_called_with(
                 mock.sentinel.instance_name)
-            mock_get_free_controller_slot.assert_called_with(
-                mock.sentinel.controller_path)
+            mock_reserve_controller_slots.assert_called_with(
+                mock.sentinel.instance_name, mock.sentinel.controller_path)
             mock_attach_drive.assert_called_with(
                 mock.sentinel.instance_name, mock.sentinel.disk_path,
                 mock.sentinel.controller_path,
                 mock.sentinel.controller_slot)
+            self.assertFalse(mock_release_controller_slots.called)
+            self.assertFalse(mock_release_share.called)
         else:
             mock_attach_drive.side_effect = (
                 vmutils.HyperVException())
@@ -294,6 +837,11 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
                               self._volume_driver.attach_volume,
                               self._FAKE_CONNECTION_INFO,
                               mock.sentinel.instance_name)
+            mock_release_controller_slots.assert_called_once_with(
+                mock.sentinel.instance_name, mock.sentinel.controller_path,
+                [mock.sentinel.controller_slot])
+            mock_release_share.assert_called_once_with(
+                self._FAKE_SHARE_NORMALIZED, [mock.sentinel.disk_path])
 
     def test_attach_volume(self):
         self._test_attach_volume()
@@ -301,11 +849,69 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
     def test_attach_non_existing_image(self):
         self._test_attach_volume(image_exists=False)
 
+    @mock.patch.object(volumeops.SMBFSVolumeDriver, '_release_share')
+    @mock.patch.object(volumeops.SMBFSVolumeDriver, '_acquire_share')
+    def _test_attach_volumes(self, mock_acquire_share, mock_release_share,
+                             attach_failure=False):
+        connection_infos = [self._FAKE_CONNECTION_INFO] * 3
+        mock_vmutils = mock.Mock()
+        self._volume_driver._vmutils = mock_vmutils
+        mock_vmutils.reserve_controller_slots.return_value = [1, 2]
+        disk_path = self._volume_driver._get_disk_path(
+            self._FAKE_CONNECTION_INFO)
+        if attach_failure:
+            mock_vmutils.attach_drive.side_effect = [
+                None, None, vmutils.HyperVException]
+
+            self.assertRaises(vmutils.HyperVException,
+                              self._volume_driver.attach_volumes,
+                              connection_infos,
+                              mock.sentinel.instance_name,
+                              ebs_root=True)
+        else:
+            self._volume_driver.attach_volumes(connection_infos,
+                                               mock.sentinel.instance_name,
+                                               ebs_root=True)
+
+        mock_acquire_share.assert_called_once_with(
+            self._FAKE_SHARE_NORMALIZED, self._FAKE_SMB_OPTIONS,
+            [disk_path] * 3)
+        mock_get_ctrller = mock_vmutils.get_vm_scsi_controller
+        mock_vmutils.reserve_controller_slots.assert_called_once_with(
+            mock.sentinel.instance_name, mock_get_ctrller.return_value, 2)
+        mock_vmutils.attach_drive.assert_has_calls(
+            [mock.call(mock.sentinel.instance_name, disk_path,
+                       mock_vmutils.get_vm_ide_controller.return_value, 0),
+             mock.call(mock.sentinel.instance_name, disk_path,
+                       mock_get_ctrller.return_value, 1),
+             mock.call(mock.sentinel.instance_name, disk_path,
+                       mock_get_ctrller.return_value, 2)])
+
+        if attach_failure:
+            self.assertEqual(2, mock_vmutils.detach_vm_disk.call_count)
+            mock_vmutils.detach_vm_disk.assert_called_with(
+                mock.sentinel.instance_name, disk_path, is_physical=False)
+            mock_vmutils.release_controller_slots.assert_called_once_with(
+                mock.sentinel.instance_name, mock_get_ctrller.return_value,
+                [2])
+            mock_release_share.assert_called_once_with(
+                self._FAKE_SHARE_NORMALIZED, [disk_path] * 3)
+        else:
+            self.assertFalse(mock_vmutils.detach_vm_disk.called)
+            self.assertFalse(mock_vmutils.release_controller_slots.called)
+            self.assertFalse(mock_release_share.called)
+
+    def test_attach_volumes(self):
+        self._test_attach_volumes()
+
+    def test_attach_volumes_rollback(self):
+        self._test_attach_volumes(attach_failure=True)
+
+    @mock.patch.object(volumeops.SMBFSVolumeDriver, '_release_share')
     @mock.patch.object(volumeops.SMBFSVolumeDriver, '_get_disk_path')
     @mock.patch.object(vmutils.VMUtils, 'detach_vm_disk')
-    @mock.patch.object(pathutils.PathUtils, 'unmount_smb_share')
-    def test_detach_volume(self, mock_unmount_smb_share, mock_detach_vm_disk,
-                           mock_get_disk_path):
+    def test_detach_volume(self, mock_detach_vm_disk, mock_get_disk_path,
+                           mock_release_share):
         mock_get_disk_path.return_value = (
             mock.sentinel.disk_path)
 
@@ -315,6 +921,56 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
         mock_detach_vm_disk.assert_called_once_with(
             mock.sentinel.instance_name, mock.sentinel.disk_path,
             is_physical=False)
+        mock_release_share.assert_called_once_with(
+            self._FAKE_SHARE_NORMALIZED, [mock.sentinel.disk_path])
+
+    @mock.patch.object(pathutils.PathUtils, 'check_smb_mapping')
+    @mock.patch.object(pathutils.PathUtils, 'unmount_smb_share')
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_virtual_disk_paths')
+    @mock.patch.object(vmutils.VMUtils, 'detach_vm_disk')
+    def _test_detach_volume_untracked_share(self, mock_detach_vm_disk,
+                                            mock_get_attached_disks,
+                                            mock_unmount_smb_share,
+                                            mock_check_smb_mapping,
+                                            fix_disk_path=False):
+        # The share is already mounted, having been used by instances
+        # started before the service was restarted.
+        mock_check_smb_mapping.return_value = True
+        other_conn_info = {'data': dict(self._FAKE_CONNECTION_INFO['data'],
+                                        name='other_volume.vhdx')}
+        disk_path = self._volume_driver._get_disk_path(
+            self._FAKE_CONNECTION_INFO)
+        other_disk_path = self._FAKE_SHARE_NORMALIZED + '\\other_volume.vhdx'
+
+        # Only one of the volumes stored on the share is reconnected, the
+        # other one remaining attached to an untracked instance.
+        if fix_disk_path:
+            for i in range(2):
+                self._volume_driver.fix_instance_volume_disk_path(
+                    mock.sentinel.instance_name,
+                    self._FAKE_CONNECTION_INFO, 0)
+        else:
+            self._volume_driver.initialize_volume_connection(
+                self._FAKE_CONNECTION_INFO)
+        self.assertEqual(set([disk_path]),
+                         volumeops._share_users[self._FAKE_SHARE_NORMALIZED])
+
+        mock_get_attached_disks.return_value = [other_disk_path.upper()]
+        self._volume_driver.detach_volume(self._FAKE_CONNECTION_INFO,
+                                          mock.sentinel.instance_name)
+        self.assertFalse(mock_unmount_smb_share.called)
+
+        mock_get_attached_disks.return_value = []
+        self._volume_driver.detach_volume(other_conn_info,
+                                          mock.sentinel.instance_name)
+        mock_unmount_smb_share.assert_called_once_with(
+            self._FAKE_SHARE_NORMALIZED)
+
+    def test_detach_volume_initialized_share(self):
+        self._test_detach_volume_untracked_share()
+
+    def test_detach_volume_fixed_disk_path_share(self):
+        self._test_detach_volume_untracked_share(fix_disk_path=True)
 
     def test_parse_credentials(self):
         username, password = self._volume_driver._parse_credentials(
@@ -322,6 +978,12 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
         self.assertEqual(self._FAKE_USERNAME, username)
         self.assertEqual(self._FAKE_PASSWORD, password)
 
+    def test_parse_guest_credentials(self):
+        username, password = self._volume_driver._parse_credentials(
+            '-o user=guest,pass=%s' % self._FAKE_PASSWORD)
+        self.assertIsNone(username)
+        self.assertEqual(self._FAKE_PASSWORD, password)
+
     def test_get_disk_path(self):
         expected = os.path.join(self._FAKE_SHARE_NORMALIZED,
                                 self._FAKE_DISK_NAME)
@@ -336,7 +998,9 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
     @mock.patch.object(pathutils.PathUtils, 'mount_smb_share')
     def _test_ensure_mounted(self, mock_mount_smb_share,
                              mock_check_smb_mapping, mock_parse_credentials,
-                             is_mounted=False):
+                             is_mounted=False, is_cached=False):
+        if is_cached:
+            volumeops._mounted_shares.add(self._FAKE_SHARE_NORMALIZED)
         mock_check_smb_mapping.return_value = is_mounted
         mock_parse_credentials.return_value = (
             self._FAKE_USERNAME, self._FAKE_PASSWORD)
@@ -344,7 +1008,11 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
         self._volume_driver.ensure_share_mounted(
             self._FAKE_CONNECTION_INFO)
 
-        if is_mounted:
+        self.assertIn(self._FAKE_SHARE_NORMALIZED, volumeops._mounted_shares)
+        if is_cached:
+            self.assertFalse(mock_check_smb_mapping.called)
+            self.assertFalse(mock_mount_smb_share.called)
+        elif is_mounted:
             self.assertFalse(
                 mock_mount_smb_share.called)
         else:
@@ -359,8 +1027,134 @@ class SMBFSVolumeDriverTestCase(test_base.HyperVBaseTestCase):
     def test_ensure_already_mounted(self):
         self._test_ensure_mounted(is_mounted=True)
 
+    def test_ensure_mounted_cached(self):
+        self._test_ensure_mounted(is_cached=True)
+
+    @mock.patch.object(volumeops.SMBFSVolumeDriver, '_mount_share')
+    def test_acquire_share(self, mock_mount_share):
+        mock_idle_unmount = mock.Mock()
+        volumeops._idle_share_unmounts[mock.sentinel.export_path] = (
+            mock_idle_unmount)
+
+        self._volume_driver._acquire_share(mock.sentinel.export_path,
+                                           mock.sentinel.opts_str,
+                                           [mock.sentinel.disk_path_0,
+                                            mock.sentinel.disk_path_1])
+
+        mock_idle_unmount.cancel.assert_called_once_with()
+        self.assertEqual({}, volumeops._idle_share_unmounts)
+        mock_mount_share.assert_called_once_with(mock.sentinel.export_path,
+                                                 mock.sentinel.opts_str)
+        self.assertEqual(set([mock.sentinel.disk_path_0,
+                              mock.sentinel.disk_path_1]),
+                         volumeops._share_users[mock.sentinel.export_path])
+
+    @mock.patch('eventlet.spawn_after')
+    @mock.patch.object(volumeops.SMBFSVolumeDriver, '_unmount_share')
+    @mock.patch.object(volumeops.SMBFSVolumeDriver,
+                       '_share_has_attached_disks')
+    def _test_release_share(self, mock_has_attached_disks,
+                            mock_unmount_share, mock_spawn_after,
+                            in_use=False, has_attached_disks=False,
+                            linger_time=0):
+        self.flags(smbfs_share_linger_time=linger_time, group='hyperv')
+        mock_has_attached_disks.return_value = has_attached_disks
+        volumeops._share_users[mock.sentinel.export_path].add(
+            mock.sentinel.disk_path)
+        if in_use:
+            volumeops._share_users[mock.sentinel.export_path].add(
+                mock.sentinel.other_disk_path)
+
+        self._volume_driver._release_share(mock.sentinel.export_path,
+                                           [mock.sentinel.disk_path])
+
+        if in_use:
+            self.assertEqual(
+                set([mock.sentinel.other_disk_path]),
+                volumeops._share_users[mock.sentinel.export_path])
+            self.assertFalse(mock_has_attached_disks.called)
+            self.assertFalse(mock_unmount_share.called)
+            return
+
+        self.assertNotIn(mock.sentinel.export_path, volumeops._share_users)
+        mock_has_attached_disks.assert_called_once_with(
+            mock.sentinel.export_path)
+        if has_attached_disks:
+            self.assertFalse(mock_spawn_after.called)
+            self.assertFalse(mock_unmount_share.called)
+        elif linger_time:
+            mock_spawn_after.assert_called_once_with(
+                linger_time, self._volume_driver._unmount_idle_share,
+                mock.sentinel.export_path)
+            self.assertFalse(mock_unmount_share.called)
+        else:
+            mock_unmount_share.assert_called_once_with(
+                mock.sentinel.export_path)
+
+    def test_release_share(self):
+        self._test_release_share()
+
+    def test_release_share_in_use(self):
+        self._test_release_share(in_use=True)
+
+    def test_release_share_attached_disks(self):
+        self._test_release_share(has_attached_disks=True)
+
+    def test_release_share_lingering(self):
+        self._test_release_share(linger_time=10)
+
+    @mock.patch.object(pathutils.PathUtils, 'unmount_smb_share')
+    def test_unmount_idle_share(self, mock_unmount_smb_share):
+        volumeops._mounted_shares.add(mock.sentinel.export_path)
+        volumeops._idle_share_unmounts[mock.sentinel.export_path] = (
+            mock.sentinel.idle_unmount)
+
+        self._volume_driver._unmount_idle_share(mock.sentinel.export_path)
+
+        mock_unmount_smb_share.assert_called_once_with(
+            mock.sentinel.export_path)
+        self.assertEqual(set(), volumeops._mounted_shares)
+
+    def test_start_share_checks(self):
+        self.flags(smbfs_share_check_interval=10, group='hyperv')
+        mock_looping_call = volumeops.loopingcall.FixedIntervalLoopingCall
+
+        self._volume_driver._start_share_checks()
+        self._volume_driver._start_share_checks()
+
+        mock_looping_call.assert_called_once_with(
+            self._volume_driver._check_mounted_shares)
+        mock_looping_call.return_value.start.assert_called_once_with(
+            interval=10, initial_delay=10)
+
+    @mock.patch.object(pathutils.PathUtils, 'check_smb_mapping')
+    def test_check_mounted_shares(self, mock_check_smb_mapping):
+        volumeops._mounted_shares.update([mock.sentinel.share_0,
+                                          mock.sentinel.share_1])
+        mock_check_smb_mapping.side_effect = (
+            lambda export_path: export_path == mock.sentinel.share_0)
+
+        self._volume_driver._check_mounted_shares()
+
+        self.assertEqual(set([mock.sentinel.share_0]),
+                         volumeops._mounted_shares)
+
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_virtual_disk_paths')
+    def test_share_has_attached_disks(self, mock_get_attached_disks):
+        mock_get_attached_disks.return_value = [
+            '\\\\1.2.3.4\\fake_share_2\\fake_volume_name.vhdx',
+            '\\\\1.2.3.4\\FAKE_SHARE\\fake_volume_name.vhdx']
+
+        self.assertTrue(self._volume_driver._share_has_attached_disks(
+            self._FAKE_SHARE_NORMALIZED))
+        self.assertFalse(self._volume_driver._share_has_attached_disks(
+            '\\\\1.2.3.4\\fake'))
+
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_virtual_disk_paths')
     @mock.patch.object(pathutils.PathUtils, 'unmount_smb_share')
-    def test_disconnect_volumes(self, mock_unmount_smb_share):
+    def test_disconnect_volumes(self, mock_unmount_smb_share,
+                                mock_get_attached_disks):
+        mock_get_attached_disks.return_value = []
         block_device_mapping = [
             {'connection_info': self._FAKE_CONNECTION_INFO}]
         self._volume_driver.disconnect_volumes(block_device_mapping)
@@ -15,6 +15,7 @@
 import mock
 from oslo_config import cfg
 
+from hyperv.nova import basevolumeutils
 from hyperv.nova import vmutils
 from hyperv.nova import volumeutilsv2
 from hyperv.tests import test
@@ -37,9 +38,19 @@ class VolumeUtilsV2TestCase(test.NoDBTestCase):
         self._volutilsv2 = volumeutilsv2.VolumeUtilsV2()
         self._volutilsv2._conn_storage = mock.MagicMock()
         self._volutilsv2._conn_wmi = mock.MagicMock()
+
+        session_table_patcher = mock.patch.object(
+            basevolumeutils, '_session_table', None)
+        session_table_patcher.start()
+        self.addCleanup(session_table_patcher.stop)
         self.flags(volume_attach_retry_count=4, group='hyperv')
         self.flags(volume_attach_retry_interval=0, group='hyperv')
 
+        patcher = mock.patch.dict(basevolumeutils._portal_refresh_times,
+                                  clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def _test_login_target_portal(self, portal_connected):
         fake_portal = '%s:%s' % (self._FAKE_PORTAL_ADDR,
                                  self._FAKE_PORTAL_PORT)
@@ -162,3 +173,36 @@ class VolumeUtilsV2TestCase(test.NoDBTestCase):
         sess_class.assert_called_once_with(
             SessionId=mock.sentinel.FAKE_SESSION_ID)
         mock_logout_target.assert_called_once_with(mock_session.TargetName)
+
+    def test_get_disk_arrival_listener(self):
+        expected_query = ("SELECT * FROM __InstanceCreationEvent "
+                          "WITHIN 1 "
+                          "WHERE TargetInstance ISA 'MSFT_Disk'")
+
+        listener = self._volutilsv2.get_disk_arrival_listener(1)
+
+        watcher = self._volutilsv2._conn_storage.MSFT_Disk.watch_for
+        watcher.assert_called_once_with(raw_wql=expected_query)
+        self.assertEqual(watcher.return_value, listener)
+
+    @mock.patch.object(volumeutilsv2.VolumeUtilsV2, '_login_storage_target')
+    @mock.patch.object(basevolumeutils, '_session_table',
+                       mock.sentinel.session_table)
+    def test_login_storage_target_invalidates_sessions(self, mock_login):
+        self._volutilsv2.login_storage_target(
+            mock.sentinel.lun, mock.sentinel.target_iqn,
+            mock.sentinel.target_portal)
+
+        mock_login.assert_called_once_with(
+            mock.sentinel.lun, mock.sentinel.target_iqn,
+            mock.sentinel.target_portal, None, None)
+        self.assertIsNone(basevolumeutils._session_table)
+
+    @mock.patch.object(volumeutilsv2.VolumeUtilsV2, '_logout_storage_target')
+    @mock.patch.object(basevolumeutils, '_session_table',
+                       mock.sentinel.session_table)
+    def test_logout_storage_target_invalidates_sessions(self, mock_logout):
+        self._volutilsv2.logout_storage_target(mock.sentinel.target_iqn)
+
+        mock_logout.assert_called_once_with(mock.sentinel.target_iqn)
+        self.assertIsNone(basevolumeutils._session_table)
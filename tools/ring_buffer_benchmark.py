@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compares the serial console ring buffer with the former IOQueue.
+
+The guest output is written in bursts of a fixed size, modeling a chatty
+guest, the console clients consuming it after every few bursts. IOQueue,
+which used to hold the guest output, needs a queue per client, the bursts
+being concatenated when read. The ring buffer is written once for all the
+clients, which either read copies of the data or use views of the buffer.
+
+Only the cost of passing the data through the buffers is measured: the
+clients do not send the data, and the timeout IOQueue used to wait for
+more data when reading a burst is not included.
+
+Usage: python tools/ring_buffer_benchmark.py [--clients N] [--repeat N]
+"""
+
+import argparse
+import sys
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from hyperv.nova import constants
+from hyperv.nova import ioutils
+
+# Burst sizes: keystroke echoes, short and full lines, and bursts filling
+# the serial console buffer.
+_BURST_SIZES = (1, 16, 80, 512, constants.SERIAL_CONSOLE_BUFFER_SIZE)
+_TOTAL_SIZE = 16 * 1024 * 1024
+
+
+class IOQueue(queue.Queue):
+    """The former serial console queue, without the read timeouts."""
+
+    def get_burst(self, max_size=constants.SERIAL_CONSOLE_BUFFER_SIZE):
+        # Gets as much data as possible from the queue, avoiding sending
+        # small chunks.
+        data = self.get_nowait()
+        while len(data) <= max_size:
+            try:
+                data += self.get_nowait()
+            except queue.Empty:
+                break
+        return data
+
+
+def _run_ioqueue(burst, num_bursts, num_clients, drain_interval):
+    queues = [IOQueue() for i in range(num_clients)]
+    consumed = 0
+    for i in range(num_bursts):
+        for client_queue in queues:
+            client_queue.put(burst)
+        if (i + 1) % drain_interval:
+            continue
+        for client_queue in queues:
+            while not client_queue.empty():
+                consumed += len(client_queue.get_burst())
+    return consumed
+
+
+def _run_ring_buffer(burst, num_bursts, num_clients, drain_interval,
+                     use_views=False):
+    ring_buffer = ioutils.RingBuffer()
+    readers = [ring_buffer.get_reader() for i in range(num_clients)]
+    consumed = 0
+    for i in range(num_bursts):
+        ring_buffer.write(burst)
+        if (i + 1) % drain_interval:
+            continue
+        for reader in readers:
+            while reader.available:
+                if use_views:
+                    num_bytes = sum(
+                        len(view) for view in reader.get_views(
+                            size=constants.SERIAL_CONSOLE_BUFFER_SIZE,
+                            timeout=0))
+                    reader.consume(num_bytes)
+                else:
+                    num_bytes = len(reader.read(
+                        size=constants.SERIAL_CONSOLE_BUFFER_SIZE,
+                        timeout=0))
+                consumed += num_bytes
+    return consumed
+
+
+def _time(func, repeat, *args, **kwargs):
+    # The best run is kept, as done by timeit.
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=1,
+                        help='The number of console clients.')
+    parser.add_argument('--drain-interval', type=int, default=8,
+                        help='The number of bursts written between reads.')
+    parser.add_argument('--total-size', type=int, default=_TOTAL_SIZE,
+                        help='The amount of guest output, in bytes.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='The number of runs per measurement.')
+    args = parser.parse_args()
+
+    print('Python %s, %d client(s), %d bytes of output, reading every %d '
+          'bursts' % (sys.version.split()[0], args.clients, args.total_size,
+                      args.drain_interval))
+    print('%-8s %14s %14s %14s' % ('burst', 'IOQueue MB/s',
+                                   'ring copy MB/s', 'ring view MB/s'))
+
+    for burst_size in _BURST_SIZES:
+        burst = b'x' * burst_size
+        num_bursts = args.total_size // burst_size
+        total_mb = float(num_bursts * burst_size) / (1024 * 1024)
+        timings = [
+            _time(_run_ioqueue, args.repeat, burst, num_bursts,
+                  args.clients, args.drain_interval),
+            _time(_run_ring_buffer, args.repeat, burst, num_bursts,
+                  args.clients, args.drain_interval),
+            _time(_run_ring_buffer, args.repeat, burst, num_bursts,
+                  args.clients, args.drain_interval, use_views=True)]
+        print('%-8d %14.1f %14.1f %14.1f' % (
+            (burst_size, ) + tuple(total_mb / timing for timing in timings)))
+
+
+if __name__ == '__main__':
+    main()